@@ -0,0 +1,98 @@
+"""
+Measures how long it takes to upload execution artifacts with different numbers of artifact workers
+
+Each execution writes --artifacts files of --artifact-kb KiB to its own directory and returns them with
+artifacts_from_directory(delete=True). MockCloudShell adds --latency seconds to every request, which stands in for
+the round trip and server-side processing time that parallel uploads overlap. Reports the time from the first
+command until every artifact of every execution has arrived.
+
+Usage:
+    python benchmarks/bench_artifacts.py [--executions 20] [--artifacts 10] [--artifact-kb 256] [--latency 0.05] [--workers 1,4,8]
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+
+from cloudshell.custom_execution_server.custom_execution_server import CustomExecutionServer, CustomExecutionServerCommandHandler, PassedCommandResult
+from cloudshell.custom_execution_server.report_data import artifacts_from_directory
+
+from mock_cloudshell import MockCloudShell
+
+
+class ArtifactCommandHandler(CustomExecutionServerCommandHandler):
+    def __init__(self, root, artifacts, size):
+        CustomExecutionServerCommandHandler.__init__(self)
+        self._root = root
+        self._artifacts = artifacts
+        self._size = size
+
+    def execute_command(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger):
+        directory = os.path.join(self._root, execution_id)
+        os.makedirs(directory)
+        for i in range(self._artifacts):
+            with open(os.path.join(directory, 'screenshot%d.png' % i), 'wb') as f:
+                f.write(os.urandom(self._size))
+        result = PassedCommandResult('output.log', 'ok', 'text/plain')
+        result.artifacts = artifacts_from_directory(directory, delete=True)
+        return result
+
+    def stop_command(self, execution_id, logger):
+        pass
+
+
+def run(workers, args):
+    logger = logging.getLogger('bench-artifacts')
+    root = tempfile.mkdtemp(prefix='bench-artifacts-')
+    mock = MockCloudShell(poll_timeout=0.5, latency=args.latency)
+    mock.start()
+    server = CustomExecutionServer(server_name='bench',
+                                   server_description='benchmark',
+                                   server_type='Python',
+                                   server_capacity=args.capacity,
+                                   command_handler=ArtifactCommandHandler(root, args.artifacts, args.artifact_kb * 1024),
+                                   logger=logger,
+                                   cloudshell_host='127.0.0.1',
+                                   cloudshell_port=mock.port,
+                                   cloudshell_username='admin',
+                                   cloudshell_password='admin',
+                                   cloudshell_domain='Global',
+                                   auto_register=True,
+                                   auto_start=True,
+                                   artifact_workers=workers)
+    expected = args.executions * (args.artifacts + 1)
+    t0 = time.time()
+    mock.add_commands([{'Type': 'startExecution', 'ExecutionId': 'e%d' % i} for i in range(args.executions)])
+    deadline = t0 + 600
+    while len(mock.reports) < expected and time.time() < deadline:
+        time.sleep(0.01)
+    elapsed = time.time() - t0
+    server.stop()
+    mock.stop()
+    shutil.rmtree(root, ignore_errors=True)
+    print('artifact_workers %2d  %s %4d reports  %7.1f MB in %6.2fs  %6.1f MB/s' % (
+        workers, 'ok' if len(mock.reports) >= expected else 'TIMEOUT', len(mock.reports), mock.report_bytes / 1e6, elapsed, mock.report_bytes / 1e6 / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default='1,4,8', help='artifact_workers values to compare')
+    parser.add_argument('--executions', type=int, default=20)
+    parser.add_argument('--capacity', type=int, default=4)
+    parser.add_argument('--artifacts', type=int, default=10, help='Artifacts per execution')
+    parser.add_argument('--artifact-kb', type=int, default=256)
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds MockCloudShell adds to every request')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    for workers in args.workers.split(','):
+        run(int(workers), args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Compares CustomExecutionServer (threads) with AsyncCustomExecutionServer (asyncio) against a local MockCloudShell
+
+Each execution sleeps for --duration seconds, so the measurement is dominated by dispatch and reporting overhead.
+
+Usage:
+    python benchmarks/bench_async_server.py [--executions 500] [--capacity 200] [--duration 0.2] [--pollers 4]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+
+from cloudshell.custom_execution_server.custom_execution_server import CustomExecutionServer, CustomExecutionServerCommandHandler, PassedCommandResult
+from cloudshell.custom_execution_server.async_execution_server import AsyncCustomExecutionServer, AsyncCustomExecutionServerCommandHandler
+
+from mock_cloudshell import MockCloudShell
+
+
+class SleepCommandHandler(CustomExecutionServerCommandHandler):
+    def __init__(self, duration):
+        CustomExecutionServerCommandHandler.__init__(self)
+        self._duration = duration
+
+    def execute_command(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger):
+        time.sleep(self._duration)
+        return PassedCommandResult('result.log', 'benchmark output', 'text/plain')
+
+    def stop_command(self, execution_id, logger):
+        pass
+
+
+class AsyncSleepCommandHandler(AsyncCustomExecutionServerCommandHandler):
+    def __init__(self, duration):
+        AsyncCustomExecutionServerCommandHandler.__init__(self)
+        self._duration = duration
+
+    async def execute_command(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger):
+        await asyncio.sleep(self._duration)
+        return PassedCommandResult('result.log', 'benchmark output', 'text/plain')
+
+    async def stop_command(self, execution_id, logger):
+        pass
+
+
+class ThreadSampler:
+    """
+    Records the peak number of live threads, not counting the mock's, while a benchmark runs
+    """
+    def __init__(self):
+        self.peak = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            self.peak = max(self.peak, len([t for t in threading.enumerate() if t.name != 'mock-cloudshell']))
+            time.sleep(0.01)
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+
+
+def make_commands(prefix, count):
+    return [{'Type': 'startExecution', 'ExecutionId': '%s%d' % (prefix, i), 'TestPath': 'bench'} for i in range(count)]
+
+
+def report(name, mock, count, elapsed, peak_threads):
+    print('%-28s %6d executions in %7.2fs  %8.1f executions/s  peak threads %4d  requests %d' % (
+        name, count, elapsed, count / elapsed, peak_threads, sum(mock.request_counts.values())))
+
+
+def bench_threaded(args, logger):
+    mock = MockCloudShell(poll_timeout=0.5)
+    mock.start()
+    server = CustomExecutionServer('BenchThreaded', 'benchmark', 'Python', args.capacity, SleepCommandHandler(args.duration), logger,
+                                   '127.0.0.1', mock.port, 'admin', 'admin', 'Global',
+                                   auto_register=True, auto_start=False, poller_count=args.pollers)
+    sampler = ThreadSampler()
+    t0 = time.time()
+    server.start()
+    mock.add_commands(make_commands('t', args.executions))
+    ok = mock.wait_finished(args.executions, 600)
+    elapsed = time.time() - t0
+    sampler.stop()
+    server.stop()
+    mock.stop()
+    if not ok:
+        print('threaded: timed out')
+    report('threaded', mock, args.executions, elapsed, sampler.peak)
+
+
+def bench_async(args, logger, sync_handler):
+    mock = MockCloudShell(poll_timeout=0.5)
+    mock.start()
+    handler = SleepCommandHandler(args.duration) if sync_handler else AsyncSleepCommandHandler(args.duration)
+
+    async def run():
+        server = AsyncCustomExecutionServer('BenchAsync', 'benchmark', 'Python', args.capacity, handler, logger,
+                                            '127.0.0.1', mock.port, 'admin', 'admin', 'Global',
+                                            poller_count=args.pollers)
+        sampler = ThreadSampler()
+        t0 = time.time()
+        await server.start()
+        mock.add_commands(make_commands('a', args.executions))
+        loop = asyncio.get_event_loop()
+        ok = await loop.run_in_executor(None, mock.wait_finished, args.executions, 600)
+        elapsed = time.time() - t0
+        sampler.stop()
+        await server.stop()
+        return ok, elapsed, sampler.peak
+
+    ok, elapsed, peak = asyncio.get_event_loop().run_until_complete(run())
+    mock.stop()
+    if not ok:
+        print('async: timed out')
+    report('async (thread pool adapter)' if sync_handler else 'async', mock, args.executions, elapsed, peak)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--executions', type=int, default=500)
+    parser.add_argument('--capacity', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=0.2)
+    parser.add_argument('--pollers', type=int, default=4)
+    args = parser.parse_args()
+
+    logger = logging.getLogger('bench')
+    logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.WARNING)
+
+    bench_threaded(args, logger)
+    bench_async(args, logger, sync_handler=False)
+    bench_async(args, logger, sync_handler=True)
+
+
+if __name__ == '__main__':
+    main()
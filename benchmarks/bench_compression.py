@@ -0,0 +1,103 @@
+"""
+Trades the CPU time of compressing execution reports against the upload time it saves
+
+Compresses a generated test log (timestamps, repeated log lines with varying ids, tracebacks and some hex dumps), or
+the files given with --file, with ReportCompression at several levels, streaming it in 64 KiB chunks as a report
+upload does. For each level it reports the ratio, CPU time and throughput, and the upload time at --bandwidth Mbit/s:
+compression runs while the body is being sent, so a compressed upload takes the longer of the CPU time and the time
+to send the compressed bytes.
+
+Usage:
+    python benchmarks/bench_compression.py [--size-mb 50] [--bandwidth 100] [--file output.log ...]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from cloudshell.custom_execution_server.report_data import ReportCompression, zstandard
+
+LEVELS = {
+    'gzip': [1, 6, 9],
+    'zstd': [1, 3, 10, 19],
+}
+
+
+def generate_log(size, seed=1):
+    rnd = random.Random(seed)
+    messages = [
+        b'INFO  Connecting to device %s port %d',
+        b'DEBUG Sent command "show interfaces %s" (%d bytes)',
+        b'INFO  Step %s passed in %d ms',
+        b'WARN  Retrying request to %s, attempt %d',
+        b'DEBUG Received response from %s: status %d',
+    ]
+    lines = []
+    n = 0
+    t = 1700000000.0
+    while n < size:
+        t += rnd.random()
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t)).encode('ascii')
+        r = rnd.random()
+        if r < 0.01:
+            line = b'%s ERROR Test step failed\nTraceback (most recent call last):\n  File "/opt/tests/test_%d.py", line %d, in run\n    assert response.status == 200\nAssertionError: status %d' % (
+                stamp, rnd.randint(1, 500), rnd.randint(10, 900), rnd.choice([404, 500, 503]))
+        elif r < 0.03:
+            line = b'%s DEBUG payload %s' % (stamp, os.urandom(32).hex().encode('ascii') if sys.version_info.major == 3 else os.urandom(32).encode('hex'))
+        else:
+            line = b'%s %s' % (stamp, rnd.choice(messages) % (b'10.%d.%d.%d' % (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254)), rnd.randint(1, 65535)))
+        lines.append(line)
+        n += len(line) + 1
+    return b'\n'.join(lines) + b'\n'
+
+
+def chunks_of(data, size=65536):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def measure(data, method, level):
+    compression = ReportCompression(method, level=level, threshold=0)
+    t0 = time.process_time()
+    _, _, body, _, _ = compression.compress_body('output.log', 'text/plain', chunks_of(data), None)
+    out = [chunk for chunk in body]
+    cpu = time.process_time() - t0
+    compressed = b''.join(out)
+    if method == 'gzip':
+        assert zlib.decompress(compressed, 16 + zlib.MAX_WBITS) == data
+    else:
+        assert zstandard.ZstdDecompressor().decompressobj().decompress(compressed) == data
+    return len(compressed), cpu
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=float, default=50, help='Size of the generated log')
+    parser.add_argument('--file', action='append', help='Log file to compress instead of the generated one, may be repeated')
+    parser.add_argument('--bandwidth', type=float, default=100, help='Upload bandwidth to CloudShell in Mbit/s')
+    args = parser.parse_args()
+    if args.file:
+        inputs = [(os.path.basename(path), open(path, 'rb').read()) for path in args.file]
+    else:
+        inputs = [('generated', generate_log(int(args.size_mb * 1e6)))]
+    methods = ['gzip'] + (['zstd'] if zstandard is not None else [])
+    if zstandard is None:
+        print('zstandard is not installed, only measuring gzip')
+    bytes_per_second = args.bandwidth * 1e6 / 8
+    for name, data in inputs:
+        plain = len(data) / bytes_per_second
+        print('%s: %.1f MB, uncompressed upload %.2fs at %g Mbit/s' % (name, len(data) / 1e6, plain, args.bandwidth))
+        for method in methods:
+            for level in LEVELS[method]:
+                size, cpu = measure(data, method, level)
+                upload = max(cpu, size / bytes_per_second)
+                print('  %-4s level %2d  ratio %5.1fx  %8.2f MB  cpu %6.2fs  %7.1f MB/s  upload %6.2fs  saves %6.2fs' % (
+                    method, level, len(data) / float(size), size / 1e6, cpu, len(data) / 1e6 / cpu if cpu else 0, upload, plain - upload))
+
+
+if __name__ == '__main__':
+    main()
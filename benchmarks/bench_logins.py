@@ -0,0 +1,113 @@
+"""
+Counts the logins of execution server processes restarting together, with and without a shared token file
+
+Starts --processes processes at once, each hosting one CustomExecutionServer logging in as the same user, then
+expires the token on MockCloudShell so every process gets 401s at the same time. Reports the logins CloudShell saw
+for the start and for the expiry, and the time until every process was polling again with a valid token. Without a
+token file each process logs in on its own; with one, one process logs in and the others take its token.
+
+Usage:
+    python benchmarks/bench_logins.py [--processes 20] [--pollers 2] [--latency 0.05]
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+
+from cloudshell.custom_execution_server.custom_execution_server import CustomExecutionServer, CustomExecutionServerCommandHandler, PassedCommandResult
+from cloudshell.custom_execution_server.session import CloudShellSession
+
+from mock_cloudshell import MockCloudShell
+
+
+class NullCommandHandler(CustomExecutionServerCommandHandler):
+    def execute_command(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger):
+        return PassedCommandResult('result.log', 'ok', 'text/plain')
+
+    def stop_command(self, execution_id, logger):
+        pass
+
+
+def serve(i, port, token_file, pollers, go, stop):
+    logging.basicConfig(level=logging.ERROR)
+    go.wait()
+    server = CustomExecutionServer(server_name='bench%d' % i,
+                                   server_description='benchmark',
+                                   server_type='Python',
+                                   server_capacity=1,
+                                   command_handler=NullCommandHandler(),
+                                   logger=logging.getLogger('bench-logins'),
+                                   cloudshell_host='127.0.0.1',
+                                   cloudshell_port=port,
+                                   cloudshell_username='admin',
+                                   cloudshell_password='admin',
+                                   cloudshell_domain='Global',
+                                   auto_register=True,
+                                   auto_start=True,
+                                   poller_count=pollers,
+                                   session=CloudShellSession(token_file=token_file))
+    stop.wait()
+    server.stop()
+
+
+def wait_for(condition, timeout=60):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def run(shared, args):
+    directory = tempfile.mkdtemp(prefix='bench-logins-')
+    token_file = os.path.join(directory, 'admin.token') if shared else None
+    mock = MockCloudShell(poll_timeout=0.5, latency=args.latency)
+    mock.start()
+    go = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    processes = [multiprocessing.Process(target=serve, args=(i, mock.port, token_file, args.pollers, go, stop))
+                 for i in range(args.processes)]
+    for p in processes:
+        p.start()
+    t0 = time.time()
+    go.set()
+    wait_for(lambda: len(mock.servers) == args.processes)
+    start_seconds = time.time() - t0
+    start_logins = mock.logins
+
+    # Every process polls with the old token until it is rejected
+    mock.expire_token()
+    t0 = time.time()
+    polls = mock.request_counts.get('PendingCommand', 0)
+    unauthorized = mock.unauthorized
+    wait_for(lambda: mock.request_counts.get('PendingCommand', 0) - polls - (mock.unauthorized - unauthorized) >= args.processes * args.pollers)
+    expiry_seconds = time.time() - t0
+    expiry_logins = mock.logins - start_logins
+
+    stop.set()
+    for p in processes:
+        p.join()
+    mock.stop()
+    shutil.rmtree(directory, ignore_errors=True)
+    print('%-17s start: %3d logins in %5.2fs  token expiry: %3d logins, %3d requests rejected, polling again in %5.2fs' % (
+        'shared token file' if shared else 'separate logins', start_logins, start_seconds, expiry_logins,
+        mock.unauthorized - unauthorized, expiry_seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=20)
+    parser.add_argument('--pollers', type=int, default=2, help='poller_count of each server')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds MockCloudShell adds to every request')
+    args = parser.parse_args()
+    for shared in (False, True):
+        run(shared, args)
+
+
+if __name__ == '__main__':
+    main()
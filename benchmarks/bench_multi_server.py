@@ -0,0 +1,128 @@
+"""
+Compares hosting many execution servers in one process with ServerSupervisor against independent servers
+
+One server is flooded with executions while the others get a trickle. Reports logins, threads, and the latency from
+a command being queued in CloudShell until its execution starts, separately for the flooded and the quiet servers.
+Independent servers each have server_capacity workers; the supervisor shares --workers workers between all of
+them, so the quiet servers' latency shows whether the flooded one can starve them.
+
+Usage:
+    python benchmarks/bench_multi_server.py [--servers 10] [--capacity 8] [--workers 16] [--flood 400] [--trickle 20] [--duration 0.05]
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+
+from cloudshell.custom_execution_server.custom_execution_server import CustomExecutionServer, CustomExecutionServerCommandHandler, PassedCommandResult
+from cloudshell.custom_execution_server.supervisor import ServerSupervisor
+
+from mock_cloudshell import MockCloudShell
+
+
+class SleepCommandHandler(CustomExecutionServerCommandHandler):
+    def __init__(self, duration, start_times, lock):
+        CustomExecutionServerCommandHandler.__init__(self)
+        self._duration = duration
+        self._start_times = start_times
+        self._lock = lock
+
+    def execute_command(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger):
+        with self._lock:
+            self._start_times[execution_id] = time.time()
+        time.sleep(self._duration)
+        return PassedCommandResult('result.log', 'ok', 'text/plain')
+
+    def stop_command(self, execution_id, logger):
+        pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def run(mode, args):
+    logger = logging.getLogger('bench-multi-server')
+    mock = MockCloudShell(poll_timeout=0.5)
+    mock.start()
+    start_times = {}
+    lock = threading.Lock()
+    names = ['server%d' % i for i in range(args.servers)]
+    threads_before = threading.active_count()
+
+    if mode == 'supervisor':
+        supervisor = ServerSupervisor(logger, '127.0.0.1', mock.port, args.workers)
+        for name in names:
+            supervisor.add_server(name, 'benchmark', 'Python', args.capacity, SleepCommandHandler(args.duration, start_times, lock),
+                                  'admin', 'admin', 'Global')
+        supervisor.start()
+        stop = supervisor.close
+    else:
+        servers = [CustomExecutionServer(server_name=name,
+                                         server_description='benchmark',
+                                         server_type='Python',
+                                         server_capacity=args.capacity,
+                                         command_handler=SleepCommandHandler(args.duration, start_times, lock),
+                                         logger=logger,
+                                         cloudshell_host='127.0.0.1',
+                                         cloudshell_port=mock.port,
+                                         cloudshell_username='admin',
+                                         cloudshell_password='admin',
+                                         cloudshell_domain='Global',
+                                         auto_register=True,
+                                         auto_start=True) for name in names]
+
+        def stop():
+            for server in servers:
+                server.stop()
+
+    commands = [{'Type': 'startExecution', 'ExecutionId': 'flood-%d' % i, 'ServerName': names[0]} for i in range(args.flood)]
+    for name in names[1:]:
+        commands += [{'Type': 'startExecution', 'ExecutionId': '%s-%d' % (name, i), 'ServerName': name} for i in range(args.trickle)]
+    total = len(commands)
+    t0 = time.time()
+    mock.add_commands(commands[:args.flood])
+    # The quiet servers' executions arrive while the flood is queued
+    mock.feed_commands(commands[args.flood:], rate=len(commands[args.flood:]) / 2.0, poisson=False)
+    finished = mock.wait_finished(total, 600)
+    elapsed = time.time() - t0
+    threads = threading.active_count() - threads_before
+    stop()
+    mock.stop()
+
+    def latencies(prefix, negate=False):
+        return [start_times[k] - mock.command_arrival_times[k] for k in start_times
+                if k.startswith(prefix) != negate and k in mock.command_arrival_times]
+
+    flood = latencies('flood-')
+    quiet = latencies('flood-', negate=True)
+    print('%-11s %s %5d executions in %6.2fs  logins %3d  threads %4d  flooded p50 %7.1f ms  quiet p50 %7.1f p99 %7.1f ms' % (
+        mode, 'ok' if finished else 'TIMEOUT', total, elapsed, mock.logins, threads,
+        percentile(flood, 50) * 1000, percentile(quiet, 50) * 1000, percentile(quiet, 99) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', default='separate,supervisor')
+    parser.add_argument('--servers', type=int, default=10)
+    parser.add_argument('--capacity', type=int, default=8, help='Capacity of every server')
+    parser.add_argument('--workers', type=int, default=16, help='Workers shared by all servers under the supervisor')
+    parser.add_argument('--flood', type=int, default=400, help='Executions queued at once for the first server')
+    parser.add_argument('--trickle', type=int, default=20, help='Executions for each other server, spread over 2 seconds')
+    parser.add_argument('--duration', type=float, default=0.05, help='Seconds each execution takes')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    for mode in args.modes.split(','):
+        run(mode, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Measures the throughput and peak memory of the streaming output parsers on generated TAP, JUnit and Robot output
+
+Each output mixes result lines with --noise lines of log output per test. The streaming parser is fed --block-size
+blocks, as ProcessRunner.execute_spooled does; the naive baseline reads the whole output and parses it in one go
+(a Python loop over splitlines() for TAP and Robot, ElementTree for JUnit). Peak memory is measured with tracemalloc.
+
+Usage:
+    python benchmarks/bench_parsers.py [--tests 200000] [--noise 5] [--block-size 65536] [--formats tap,junit,robot]
+"""
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ElementTree
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from cloudshell.custom_execution_server.output_parsers import make_parser
+
+
+def generate(fmt, path, tests, noise):
+    with open(path, 'wb') as f:
+        if fmt == 'tap':
+            f.write(b'TAP version 13\n1..%d\n' % tests)
+        elif fmt == 'junit':
+            f.write(b'<?xml version="1.0"?>\n<testsuite name="bench" tests="%d">\n' % tests)
+        else:
+            f.write(b'=' * 78 + b'\nBench\n' + b'=' * 78 + b'\n')
+        for i in range(tests):
+            # TAP diagnostics start with '#'
+            prefix = b'# ' if fmt == 'tap' else b''
+            log = b''.join(b'%s2024-01-01 12:00:00,000 INFO step %d of test %d: connecting to 10.0.0.%d\n' % (prefix, j, i, j) for j in range(noise))
+            failed = i % 50 == 0
+            if fmt == 'tap':
+                f.write(log)
+                f.write(b'%s %d - test_%d\n' % (b'not ok' if failed else b'ok', i + 1, i))
+            elif fmt == 'junit':
+                f.write(b'<testcase classname="bench" name="test_%d" time="0.1">' % i)
+                if failed:
+                    f.write(b'<failure message="assertion failed">Traceback</failure>')
+                f.write(b'<system-out>%s</system-out></testcase>\n' % log)
+            else:
+                f.write(log)
+                f.write(b'%-70s| %s |\n' % (b'Test %d' % i, b'FAIL' if failed else b'PASS'))
+                if failed:
+                    f.write(b'Expected 1 but got 2\n')
+                f.write(b'-' * 78 + b'\n')
+        if fmt == 'junit':
+            f.write(b'</testsuite>\n')
+        elif fmt == 'robot':
+            f.write(b'%-70s| FAIL |\n%d tests, %d passed, %d failed\n' % (b'Bench', tests, tests - (tests + 49) // 50, (tests + 49) // 50))
+
+
+def streaming(fmt, path, block_size):
+    parser = make_parser(fmt)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            parser.feed(data)
+    parser.close()
+    return parser.passed, parser.failed
+
+
+def naive(fmt, path, block_size):
+    with open(path, 'rb') as f:
+        data = f.read()
+    passed = failed = 0
+    if fmt == 'junit':
+        for case in ElementTree.fromstring(data).iter('testcase'):
+            if case.find('failure') is not None or case.find('error') is not None:
+                failed += 1
+            else:
+                passed += 1
+    elif fmt == 'tap':
+        for line in data.splitlines():
+            if line.startswith(b'ok'):
+                passed += 1
+            elif line.startswith(b'not ok'):
+                failed += 1
+    else:
+        lines = data.splitlines()
+        status = re.compile(br'.* \| (PASS|FAIL) \|$')
+        for i, line in enumerate(lines):
+            m = status.match(line)
+            if m and not (i + 1 < len(lines) and b' tests, ' in lines[i + 1]):
+                if m.group(1) == b'PASS':
+                    passed += 1
+                else:
+                    failed += 1
+    return passed, failed
+
+
+def measure(fn, fmt, path, block_size):
+    tracemalloc.start()
+    t0 = time.time()
+    counts = fn(fmt, path, block_size)
+    elapsed = time.time() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return counts, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--formats', default='tap,junit,robot')
+    parser.add_argument('--tests', type=int, default=200000)
+    parser.add_argument('--noise', type=int, default=5, help='Log lines per test')
+    parser.add_argument('--block-size', type=int, default=65536)
+    args = parser.parse_args()
+    for fmt in args.formats.split(','):
+        fd, path = tempfile.mkstemp(suffix='.' + fmt)
+        os.close(fd)
+        try:
+            generate(fmt, path, args.tests, args.noise)
+            size = os.path.getsize(path)
+            for name, fn in (('naive', naive), ('streaming', streaming)):
+                (passed, failed), elapsed, peak = measure(fn, fmt, path, args.block_size)
+                print('%-6s %-9s %7.1f MB  passed %7d failed %6d  %7.2fs  %7.1f MB/s  peak memory %8.1f MB' % (
+                    fmt, name, size / 1e6, passed, failed, elapsed, size / 1e6 / elapsed, peak / 1e6))
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Compares ProcessRunner backends launching many short commands from a multi-threaded process
+
+--ballast-mb grows the parent's memory, which slows down fork() based spawning but not posix_spawn or the
+launcher, whose helper process stays small.
+
+Usage:
+    python benchmarks/bench_spawn.py [--backends popen,posix_spawn,launcher] [--count 500] [--threads 8] [--ballast-mb 1024]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from cloudshell.custom_execution_server.process_manager import ProcessRunner
+from cloudshell.custom_execution_server.process_backends import make_backend
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def bench(name, args):
+    runner = ProcessRunner(None, backend=make_backend(name))
+    # Start a launcher before timing
+    runner.execute(['true'], 'warmup')
+    latencies = []
+    lock = threading.Lock()
+    per_thread = args.count // args.threads
+
+    def worker(n):
+        for i in range(per_thread):
+            t0 = time.time()
+            runner.execute(['true'], '%d-%d' % (n, i))
+            with lock:
+                latencies.append(time.time() - t0)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.threads)]
+    t0 = time.time()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    elapsed = time.time() - t0
+    runner.close()
+    print('%-12s %6d spawns in %6.2fs %8.1f spawns/s  latency p50 %6.1f p99 %6.1f ms' % (
+        name, len(latencies), elapsed, len(latencies) / elapsed, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backends', default='popen,posix_spawn,launcher')
+    parser.add_argument('--count', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--ballast-mb', type=int, default=1024, help='Memory to allocate and touch in the parent before spawning')
+    args = parser.parse_args()
+
+    ballast = bytearray(args.ballast_mb * 1024 * 1024)
+    for i in range(0, len(ballast), 4096):
+        ballast[i] = 1
+    print('Parent RSS ballast %d MB, %d threads' % (args.ballast_mb, args.threads))
+    for name in args.backends.split(','):
+        bench(name, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+End-to-end throughput benchmark of CustomExecutionServer against a local MockCloudShell
+
+Runs every handler in a fresh interpreter so peak RSS is measured per run, and reports dispatch latency
+percentiles (command queued in CloudShell until execute_command() starts), executions/s, report upload MB/s
+and peak RSS. The mock runs in the same process, so RSS includes it. Handlers:
+
+    minimal   returns a report of --report-size bytes from memory
+    process   runs a child Python process printing --report-size bytes through ProcessRunner.execute_spooled()
+
+Usage:
+    python benchmarks/bench_throughput.py [--handlers minimal,process] [--executions 500] [--capacity 50]
+        [--rate 0] [--latency 0] [--error-rate 0]
+        [--error-endpoints FinishedExecution,ExecutionReport,Status] [--report-size 65536] [--json]
+
+Use --json to save the results and compare them between versions.
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+
+from cloudshell.custom_execution_server.custom_execution_server import CustomExecutionServer, CustomExecutionServerCommandHandler, PassedCommandResult, FailedCommandResult
+from cloudshell.custom_execution_server.process_manager import ProcessRunner
+
+from mock_cloudshell import MockCloudShell
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+class _TimingCommandHandler(CustomExecutionServerCommandHandler):
+    def __init__(self, report_size):
+        CustomExecutionServerCommandHandler.__init__(self)
+        self._report_size = report_size
+        self._lock = threading.Lock()
+        self.start_times = {}
+
+    def execute_command(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger):
+        with self._lock:
+            self.start_times[execution_id] = time.time()
+        return self._execute(execution_id, logger)
+
+    def _execute(self, execution_id, logger):
+        raise NotImplementedError()
+
+
+class MinimalCommandHandler(_TimingCommandHandler):
+    def _execute(self, execution_id, logger):
+        return PassedCommandResult('result.log', 'x' * self._report_size, 'text/plain')
+
+    def stop_command(self, execution_id, logger):
+        pass
+
+
+class ProcessCommandHandler(_TimingCommandHandler):
+    def __init__(self, report_size):
+        _TimingCommandHandler.__init__(self, report_size)
+        self.process_runner = ProcessRunner(None)
+
+    def _execute(self, execution_id, logger):
+        capture, code = self.process_runner.execute_spooled(
+            [sys.executable, '-c', 'import sys; sys.stdout.write("x" * %d)' % self._report_size], execution_id)
+        if capture is None:
+            return FailedCommandResult('result.log', 'Stopped', 'text/plain', error_name='Stopped')
+        return PassedCommandResult('result.log', capture.report_data(), 'text/plain')
+
+    def stop_command(self, execution_id, logger):
+        self.process_runner.stop(execution_id)
+
+
+HANDLERS = {
+    'minimal': MinimalCommandHandler,
+    'process': ProcessCommandHandler,
+}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def peak_rss_mb():
+    """
+    :return: float : Peak RSS of this process and, separately, of its largest child, or None if unknown
+    """
+    if resource is None:
+        return None, None
+    # Kilobytes on Linux, bytes on macOS
+    scale = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+
+def run_one(args):
+    """
+    Runs a single benchmark in this process
+
+    :return: dict : Results
+    """
+    logger = logging.getLogger('bench')
+    logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.WARNING)
+
+    mock = MockCloudShell(poll_timeout=0.5, latency=args.latency, error_rate=args.error_rate,
+                          error_endpoints=args.error_endpoints.split(','),
+                          error_code=503, seed=1)
+    mock.start()
+    handler = HANDLERS[args.run](args.report_size)
+    server = CustomExecutionServer('Bench-%s' % args.run, 'benchmark', 'Python', args.capacity, handler, logger,
+                                   '127.0.0.1', mock.port, 'admin', 'admin', 'Global',
+                                   auto_register=True, auto_start=False, poller_count=args.pollers)
+    commands = [{'Type': 'startExecution', 'ExecutionId': 'e%d' % i, 'TestPath': 'bench'} for i in range(args.executions)]
+    server.start()
+    t0 = time.time()
+    if args.rate:
+        mock.feed_commands(commands, args.rate)
+    else:
+        mock.add_commands(commands)
+    ok = mock.wait_finished(args.executions, args.timeout)
+    elapsed = time.time() - t0
+    server.stop()
+    mock.stop()
+
+    latencies = [handler.start_times[k] - mock.command_arrival_times[k] for k in handler.start_times if k in mock.command_arrival_times]
+    rss, child_rss = peak_rss_mb()
+    return {
+        'handler': args.run,
+        'completed': ok,
+        'executions': len(mock.finished),
+        'elapsed': elapsed,
+        'executions_per_second': len(mock.finished) / elapsed,
+        'report_mb_per_second': mock.report_bytes / elapsed / 1e6,
+        'dispatch_latency_p50_ms': percentile(latencies, 50) * 1000,
+        'dispatch_latency_p90_ms': percentile(latencies, 90) * 1000,
+        'dispatch_latency_p99_ms': percentile(latencies, 99) * 1000,
+        'dispatch_latency_max_ms': max(latencies) * 1000 if latencies else 0.0,
+        'peak_rss_mb': rss,
+        'peak_child_rss_mb': child_rss,
+        'requests': sum(mock.request_counts.values()),
+        'injected_errors': mock.injected_errors,
+    }
+
+
+def run_subprocess(args, handler_name):
+    command = [sys.executable, os.path.realpath(__file__), '--run', handler_name,
+               '--executions', str(args.executions), '--capacity', str(args.capacity), '--pollers', str(args.pollers),
+               '--rate', str(args.rate), '--latency', str(args.latency), '--error-rate', str(args.error_rate),
+               '--error-endpoints', args.error_endpoints,
+               '--report-size', str(args.report_size), '--timeout', str(args.timeout)]
+    output = subprocess.check_output(command)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def print_result(r):
+    rss = '%7.1f MB' % r['peak_rss_mb'] if r['peak_rss_mb'] is not None else '    n/a'
+    print('%-8s %5d executions in %6.2fs %8.1f exec/s %8.2f MB/s  dispatch p50 %7.1f p90 %7.1f p99 %7.1f max %7.1f ms  peak RSS %s%s' % (
+        r['handler'], r['executions'], r['elapsed'], r['executions_per_second'], r['report_mb_per_second'],
+        r['dispatch_latency_p50_ms'], r['dispatch_latency_p90_ms'], r['dispatch_latency_p99_ms'], r['dispatch_latency_max_ms'],
+        rss, '' if r['completed'] else '  TIMED OUT'))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--handlers', default='minimal,process', help='Comma separated: %s' % ', '.join(sorted(HANDLERS)))
+    parser.add_argument('--executions', type=int, default=500)
+    parser.add_argument('--capacity', type=int, default=50)
+    parser.add_argument('--pollers', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=0, help='Commands per second arriving in CloudShell, 0 to queue them all at once')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added to every CloudShell response')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of CloudShell requests failing with 503')
+    parser.add_argument('--error-endpoints', default='FinishedExecution,ExecutionReport,Status',
+                        help='Comma separated CloudShell endpoints that --error-rate applies to. A failed PendingCommand pauses polling, '
+                             'so include it only to measure that.')
+    parser.add_argument('--report-size', type=int, default=65536, help='Report bytes per execution')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_one(args)))
+        return
+
+    results = []
+    for handler_name in args.handlers.split(','):
+        if handler_name not in HANDLERS:
+            parser.error('Unknown handler %s' % handler_name)
+        results.append(run_subprocess(args, handler_name))
+        if not args.json:
+            print_result(results[-1])
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Compares running short Python tests cold and in the warm backend's pre-started interpreters
+
+Each test imports a module standing in for a test framework, which takes --import-seconds to import, and does
+--test-seconds of work. Cold, every execution pays for the interpreter startup and the import; warm, the workers
+imported it before the first test. Tests are run by --threads threads, as by that many CloudShell executions at once.
+
+Usage:
+    python benchmarks/bench_warm_pool.py [--count 40] [--threads 4] [--import-seconds 1.0] [--test-seconds 0.1]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from cloudshell.custom_execution_server.process_manager import ProcessRunner
+from cloudshell.custom_execution_server.process_backends import make_backend
+
+FRAMEWORK = '''import time
+time.sleep(%f)
+'''
+
+TEST = '''import os
+import time
+import bench_framework
+time.sleep(%f)
+print('reservation %%s passed' %% os.environ['CLOUDSHELL_RESERVATION_ID'])
+'''
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def bench(name, directory, args):
+    os.environ['PYTHONPATH'] = directory
+    backend = make_backend(name, warm_runtimes={'python': {'preload': ['bench_framework'], 'scripts': True}},
+                           warm_pool_size=args.threads, warm_max_runs=args.max_runs)
+    runner = ProcessRunner(None, backend=backend)
+    test = os.path.join(directory, 'test_bench.py')
+    env = {'PYTHONPATH': directory}
+    if name == 'warm':
+        # Let the pool fill before timing
+        deadline = time.time() + 60
+        while backend.stats()['runtimes']['python']['idle'] < args.threads and time.time() < deadline:
+            time.sleep(0.05)
+    latencies = []
+    lock = threading.Lock()
+    per_thread = args.count // args.threads
+
+    def worker(n):
+        for i in range(per_thread):
+            t0 = time.time()
+            output, code = runner.execute([sys.executable, test], '%d-%d' % (n, i), env=dict(env, CLOUDSHELL_RESERVATION_ID='%d-%d' % (n, i)))
+            if code != 0:
+                raise Exception('Test failed with %d: %s' % (code, output))
+            with lock:
+                latencies.append(time.time() - t0)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.threads)]
+    t0 = time.time()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    elapsed = time.time() - t0
+    stats = backend.stats() if name == 'warm' else None
+    runner.close()
+    print('%-6s %4d tests in %6.2fs  per test p50 %6.3fs p99 %6.3fs%s' % (
+        name, len(latencies), elapsed, percentile(latencies, 50), percentile(latencies, 99),
+        '  (%d warm, %d cold, %d workers started)' % (stats['warm_runs'], stats['cold_runs'], stats['started']) if stats else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=40)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--import-seconds', type=float, default=1.0, help='Import time of the framework module')
+    parser.add_argument('--test-seconds', type=float, default=0.1, help='Run time of each test')
+    parser.add_argument('--max-runs', type=int, default=50, help='Tests per warm worker before it is replaced')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench-warm-')
+    try:
+        with open(os.path.join(directory, 'bench_framework.py'), 'w') as f:
+            f.write(FRAMEWORK % args.import_seconds)
+        with open(os.path.join(directory, 'test_bench.py'), 'w') as f:
+            f.write(TEST % args.test_seconds)
+        for name in ('popen', 'warm'):
+            bench(name, directory, args)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
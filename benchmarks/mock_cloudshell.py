@@ -0,0 +1,295 @@
+"""
+Local stand-in for the CloudShell execution server API, for benchmarks and manual testing
+
+    mock = MockCloudShell()
+    mock.start()
+    mock.add_commands([{'Type': 'startExecution', 'ExecutionId': '1', 'TestPath': 'x'}])
+    ... point a CustomExecutionServer at 127.0.0.1:mock.port ...
+    mock.wait_finished(1, timeout=10)
+    mock.stop()
+
+Latency, randomly injected errors and a steady command arrival rate (feed_commands) can be configured
+to see how the server behaves under load and when CloudShell misbehaves.
+"""
+import json
+import random
+import sys
+import threading
+import time
+
+if sys.version_info.major == 2:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class MockCloudShell:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, poll_timeout=1.0, token='mocktoken',
+                 latency_jitter=0.0, error_rate=0.0, error_endpoints=None, error_code=500, seed=None):
+        """
+        :param host: str
+        :param port: int : 0 to pick a free port, see .port after start()
+        :param latency: float : Seconds added to every response
+        :param poll_timeout: float : Seconds a PendingCommand long-poll waits for a command before returning 204
+        :param token: str : Token returned by /API/Auth/login
+        :param latency_jitter: float : Up to this many extra seconds, chosen at random, added to every response
+        :param error_rate: float : Fraction of requests, 0 to 1, answered with error_code instead of being handled
+        :param error_endpoints: list : Endpoint names such as 'FinishedExecution' that error_rate applies to, None for all but login
+        :param error_code: int : HTTP status for injected errors
+        :param seed: int : Random seed for reproducible jitter and errors
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.poll_timeout = poll_timeout
+        self.token = token
+        self.error_rate = error_rate
+        self.error_endpoints = error_endpoints
+        self.error_code = error_code
+        # Set to an HTTP status such as 503 to fail every request, simulating an outage
+        self.error_status = None
+        # Set by expire_token(): requests without the current token are answered with 401
+        self.check_auth = False
+        self._random = random.Random(seed)
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._pending = []
+        self._httpd = None
+        self._thread = None
+        self._feeders = []
+        self._stopping = threading.Event()
+
+        self.servers = {}
+        self.finished = []
+        self.reports = []
+        self.status_updates = []
+        self.update_files_ended = 0
+        self.reservation_requests = 0
+        self.command_arrival_times = {}
+        self.command_dispatch_times = {}
+        self.finish_times = {}
+        self.report_bytes = 0
+        self.logins = 0
+        self.request_counts = {}
+        self.injected_errors = 0
+        self.unauthorized = 0
+        self.expired_tokens = 0
+
+    def start(self):
+        mock = self
+        self._stopping.clear()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                threading.current_thread().name = 'mock-cloudshell'
+                BaseHTTPRequestHandler.setup(self)
+
+            def _handle(self):
+                mock._dispatch(self)
+
+            do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = _ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        with self._lock:
+            self._changed.notify_all()
+        for th in self._feeders:
+            th.join()
+        self._feeders = []
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def expire_token(self):
+        """
+        Rejects the current token from now on, as CloudShell does once a token expires, and hands out a new one on login
+        """
+        with self._lock:
+            self.expired_tokens += 1
+            self.token = '%s.%d' % (self.token.split('.')[0], self.expired_tokens)
+            self.check_auth = True
+
+    def add_commands(self, commands):
+        """
+        :param commands: list : dicts as returned by PendingCommand, e.g. {'Type': 'startExecution', 'ExecutionId': '1', 'TestPath': 'x', 'ReservationId': 'r1'}. A command with a 'ServerName' key only goes to that execution server.
+        """
+        now = time.time()
+        with self._lock:
+            for command in commands:
+                self.command_arrival_times[command.get('ExecutionId')] = now
+            self._pending.extend(commands)
+            self._changed.notify_all()
+
+    def feed_commands(self, commands, rate, poisson=True):
+        """
+        Adds commands in the background at an average rate, as if users were starting executions
+
+        :param commands: list : As for add_commands()
+        :param rate: float : Commands per second
+        :param poisson: bool : Exponentially distributed gaps between commands, False for evenly spaced ones
+        :return: threading.Thread : Finishes once every command has been added or the mock is stopped
+        """
+        def feed():
+            next_time = time.time()
+            for command in commands:
+                delay = next_time - time.time()
+                if delay > 0 and self._stopping.wait(delay):
+                    return
+                self.add_commands([command])
+                next_time += self._random.expovariate(rate) if poisson else 1.0 / rate
+
+        th = threading.Thread(target=feed, name='mock-cloudshell-feeder')
+        th.daemon = True
+        th.start()
+        self._feeders.append(th)
+        return th
+
+    def wait_finished(self, count, timeout):
+        """
+        :return: bool : True if at least count FinishedExecution calls arrived within timeout seconds
+        """
+        deadline = time.time() + timeout
+        with self._lock:
+            while len(self.finished) < count:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+            return True
+
+    def _dispatch(self, handler):
+        path = handler.path.split('?')[0]
+        method = handler.command
+        data = self._read_body(handler)
+        endpoint = path.split('/')[3] if path.startswith('/API/') and len(path.split('/')) > 3 else path
+        with self._lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+            delay = self.latency + (self._random.uniform(0, self.latency_jitter) if self.latency_jitter else 0)
+            inject = self.error_rate and self._random.random() < self.error_rate and \
+                (endpoint in self.error_endpoints if self.error_endpoints is not None else endpoint != 'login')
+            if inject:
+                self.injected_errors += 1
+        if delay:
+            time.sleep(delay)
+        if self.check_auth and endpoint != 'login' and handler.headers.get('Authorization') != 'Basic ' + self.token:
+            with self._lock:
+                self.unauthorized += 1
+            code, body = 401, json.dumps({'Message': 'Unauthorized'})
+        elif self.error_status:
+            code, body = self.error_status, json.dumps({'Message': 'Simulated outage'})
+        elif inject:
+            code, body = self.error_code, json.dumps({'Message': 'Injected error'})
+        else:
+            code, body = self._route(method, path, data)
+        self._reply(handler, code, body)
+
+    def _next_command_locked(self, server_name):
+        for i, command in enumerate(self._pending):
+            if command.get('ServerName', server_name) == server_name:
+                return i
+        return None
+
+    def _route(self, method, path, data):
+        now = time.time()
+        if path == '/API/Auth/login':
+            with self._lock:
+                self.logins += 1
+            return 200, json.dumps(self.token)
+        if path == '/API/Execution/ExecutionServers':
+            o = json.loads(data.decode('utf-8'))
+            with self._lock:
+                if method == 'PUT' and o['Name'] in self.servers:
+                    return 400, json.dumps({'Message': 'Execution server %s already exists' % o['Name']})
+                self.servers.setdefault(o['Name'], {}).update(o)
+            return 200, ''
+        if path == '/API/Execution/PendingCommand':
+            deadline = now + self.poll_timeout
+            name = json.loads(data.decode('utf-8')).get('Name')
+            with self._lock:
+                while True:
+                    index = self._next_command_locked(name)
+                    if index is not None:
+                        break
+                    remaining = deadline - time.time()
+                    if remaining <= 0 or self._stopping.is_set():
+                        return 204, ''
+                    self._changed.wait(remaining)
+                command = self._pending.pop(index)
+                self.command_dispatch_times[command.get('ExecutionId')] = time.time()
+            return 200, json.dumps(command)
+        if path == '/API/Execution/Status':
+            with self._lock:
+                self.status_updates.append((now, json.loads(data.decode('utf-8'))))
+            return 200, ''
+        if path.startswith('/API/Execution/Reservations/'):
+            resid = path.split('/')[-1]
+            with self._lock:
+                self.reservation_requests += 1
+            return 200, json.dumps({'ReservationId': resid, 'Resources': [], 'Services': []})
+        if path == '/API/Execution/FinishedExecution':
+            o = json.loads(data.decode('utf-8'))
+            with self._lock:
+                self.finished.append(o)
+                self.finish_times[o.get('ExecutionId')] = now
+                self._changed.notify_all()
+            return 200, ''
+        if path.startswith('/API/Execution/ExecutionReport/'):
+            with self._lock:
+                self.reports.append((path, len(data)))
+                self.report_bytes += len(data)
+            return 200, ''
+        if path == '/API/Execution/UpdateFilesEnded':
+            with self._lock:
+                self.update_files_ended += 1
+            return 200, ''
+        return 404, json.dumps({'Message': 'Unknown path %s' % path})
+
+    @staticmethod
+    def _read_body(handler):
+        if handler.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(handler.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    while handler.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(handler.rfile.read(size))
+                handler.rfile.readline()
+            return b''.join(chunks)
+        length = int(handler.headers.get('Content-Length') or 0)
+        return handler.rfile.read(length) if length else b''
+
+    @staticmethod
+    def _reply(handler, code, body):
+        body = body.encode('utf-8') if not isinstance(body, bytes) else body
+        handler.send_response(code)
+        if code != 204:
+            handler.send_header('Content-Type', 'application/json')
+            handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        if code != 204:
+            handler.wfile.write(body)
@@ -0,0 +1,96 @@
+"""
+Replays a recorded host load trace through a capacity policy offline
+
+Record a trace by running the server with capacity_trace_path set, or generate a synthetic one with --generate.
+Prints the capacity after every change and a summary of how often the capacity changed and how far the executions
+in the trace were from it.
+
+Usage:
+    python benchmarks/simulate_capacity.py trace.jsonl [--capacity 4] [--min 1] [--max 16] [--hysteresis 1] [--stable-samples 3] [--min-update-interval 300]
+    python benchmarks/simulate_capacity.py --generate trace.jsonl [--cpus 8] [--hours 24]
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from cloudshell.custom_execution_server.capacity_tuner import CapacityPolicy, read_trace, simulate
+
+
+def generate(path, cpus, hours, interval, seed):
+    """
+    Writes a day-shaped trace: load follows a sine wave with noise and occasional spikes from other work on the host
+    """
+    rng = random.Random(seed)
+    memory = 32 * 1024 ** 3
+    with open(path, 'w') as f:
+        for i in range(int(hours * 3600 / interval)):
+            t = i * interval
+            day = 0.5 - 0.5 * math.cos(2 * math.pi * t / 86400.0)
+            executions = int(round(day * cpus * 0.8 + rng.uniform(-1, 1)))
+            executions = max(0, executions)
+            load = executions * 0.9 + rng.uniform(0, 0.5) + (cpus * 0.7 if rng.random() < 0.02 else 0)
+            f.write(json.dumps({
+                'time': t,
+                'load': round(load, 2),
+                'cpus': cpus,
+                'available_memory_bytes': memory - executions * 1024 ** 3 - int(rng.uniform(0, 2) * 1024 ** 3),
+                'executions': executions,
+            }) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('trace', help='JSON lines trace, as recorded with capacity_trace_path')
+    parser.add_argument('--generate', action='store_true', help='Write a synthetic trace to the trace path instead of simulating')
+    parser.add_argument('--cpus', type=int, default=8)
+    parser.add_argument('--hours', type=float, default=24)
+    parser.add_argument('--interval', type=float, default=30, help='Seconds between generated samples')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--capacity', type=int, default=4, help='Capacity at the start of the trace')
+    parser.add_argument('--min', type=int, default=1)
+    parser.add_argument('--max', type=int, default=16)
+    parser.add_argument('--max-load-per-cpu', type=float, default=1.0)
+    parser.add_argument('--load-per-execution', type=float, default=1.0)
+    parser.add_argument('--memory-per-execution-bytes', type=int, default=None)
+    parser.add_argument('--hysteresis', type=int, default=1)
+    parser.add_argument('--stable-samples', type=int, default=3)
+    parser.add_argument('--min-update-interval', type=float, default=300)
+    parser.add_argument('--json', action='store_true', help='Print the whole timeline as JSON')
+    args = parser.parse_args()
+
+    if args.generate:
+        generate(args.trace, args.cpus, args.hours, args.interval, args.seed)
+        return
+
+    policy = CapacityPolicy(args.min, args.max,
+                            max_load_per_cpu=args.max_load_per_cpu,
+                            load_per_execution=args.load_per_execution,
+                            memory_per_execution_bytes=args.memory_per_execution_bytes,
+                            hysteresis=args.hysteresis,
+                            stable_samples=args.stable_samples,
+                            min_update_interval=args.min_update_interval)
+    samples = read_trace(args.trace)
+    timeline = simulate(policy, samples, args.capacity)
+    if args.json:
+        print(json.dumps(timeline, indent=2))
+        return
+
+    start = timeline[0]['time'] if timeline else 0
+    for point in timeline:
+        if point['changed']:
+            print('%8.0fs  load %6.2f  executions %3d  target %3d  -> capacity %3d' % (
+                point['time'] - start, point['load'] or 0, point['executions'] or 0, point['target'], point['capacity']))
+    changes = sum(1 for point in timeline if point['changed'])
+    over = sum(1 for point in timeline if (point['executions'] or 0) > point['capacity'])
+    headroom = [point['capacity'] - (point['executions'] or 0) for point in timeline]
+    print('%d samples, %d capacity changes, %d samples with more executions than capacity, mean headroom %.2f' % (
+        len(timeline), changes, over, sum(headroom) / float(len(headroom)) if headroom else 0.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,634 @@
+"""
+asyncio implementation of the execution server, for hosting many lightweight concurrent executions in one thread
+
+Requires Python 3.5+. Handlers implement AsyncCustomExecutionServerCommandHandler with async methods; existing
+CustomExecutionServerCommandHandler subclasses are run on a thread pool through ThreadedCommandHandlerAdapter.
+"""
+import asyncio
+import functools
+import itertools
+import json
+import time
+import traceback
+from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from cloudshell.custom_execution_server.compat import bytes23, string23, string23ppbinary
+from cloudshell.custom_execution_server.connection_pool import IDEMPOTENT_METHODS, CloudShellApiError, iter_body_chunks
+from cloudshell.custom_execution_server.custom_execution_server import ErrorCommandResult, _ExecutionIdSet
+from cloudshell.custom_execution_server.poll_controller import PollController
+from cloudshell.custom_execution_server.report_data import is_streamed_report_data, open_report_body
+from cloudshell.custom_execution_server.request_log import RequestLogger
+from cloudshell.custom_execution_server.result_reporter import summary_filename
+
+
+class AsyncCustomExecutionServerCommandHandler:
+
+    def __init__(self):
+        pass
+
+    @abstractmethod
+    async def execute_command(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger):
+        """
+        Executes the requested command as a coroutine on the server's event loop. Must not block the loop.
+
+        Same arguments and return value as CustomExecutionServerCommandHandler.execute_command().
+
+        :return: CommandResult
+        """
+        raise Exception('AsyncCustomExecutionServerCommandHandler.execute_command() was not implemented')
+
+    @abstractmethod
+    async def stop_command(self, execution_id, logger):
+        """
+        Signals the running execute_command() coroutine for execution_id to exit
+
+        :return: None
+        """
+        pass
+
+
+class ThreadedCommandHandlerAdapter(AsyncCustomExecutionServerCommandHandler):
+    """
+    Runs a synchronous CustomExecutionServerCommandHandler on a thread pool, and its stop_command() on a pool of its
+    own so stops don't wait behind the executions they are meant to stop
+    """
+    def __init__(self, command_handler, max_workers, max_stop_workers=2):
+        """
+        :param command_handler: CustomExecutionServerCommandHandler
+        :param max_workers: int : Size of the thread pool, normally the server capacity
+        :param max_stop_workers: int : Size of the thread pool for stop_command()
+        """
+        AsyncCustomExecutionServerCommandHandler.__init__(self)
+        self._command_handler = command_handler
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._stop_executor = ThreadPoolExecutor(max_workers=max_stop_workers)
+
+    async def execute_command(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger):
+        return await asyncio.get_event_loop().run_in_executor(
+            self._executor, self._command_handler.execute_command,
+            test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger)
+
+    async def stop_command(self, execution_id, logger):
+        return await asyncio.get_event_loop().run_in_executor(
+            self._stop_executor, self._command_handler.stop_command, execution_id, logger)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+        self._stop_executor.shutdown(wait=False)
+
+
+class AsyncHttpConnectionPool:
+    """
+    Keep-alive HTTP/1.1 client connections on asyncio streams, one idle list per (host, port)
+    """
+    def __init__(self, max_size=16, idle_timeout=30):
+        """
+        :param max_size: int : Maximum number of idle connections kept per (host, port)
+        :param idle_timeout: float : Seconds after which an unused connection is closed instead of reused
+        """
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._idle = {}
+
+        self.opened = 0
+        self.reused = 0
+        self.stale_reconnects = 0
+
+    def stats(self):
+        return {
+            'opened': self.opened,
+            'reused': self.reused,
+            'stale_reconnects': self.stale_reconnects,
+            'idle': sum(len(v) for v in self._idle.values()),
+        }
+
+    async def request(self, host, port, method, path, body=None, headers=None, timeout=None, content_length=None):
+        """
+        A request on a reused connection that the server closed without answering is retried once on a new connection
+        if its method is idempotent
+
+        :param body: bytes, file-like object or iterable of chunks : Anything other than bytes is streamed, with chunked transfer encoding if content_length is None
+        :return: (int, bytes) : HTTP status code and response body
+        """
+        key = (host, port)
+        streamed = body is not None and not isinstance(body, bytes)
+        for attempt in range(2):
+            conn, reused = await self._checkout(key)
+            progress = {'response': False}
+            try:
+                send = self._send(conn, host, port, method, path, body, headers or {}, content_length, progress)
+                if timeout:
+                    code, data, keep = await asyncio.wait_for(send, timeout)
+                else:
+                    code, data, keep = await send
+            except (ConnectionError, EOFError):
+                conn[1].close()
+                # As HttpConnectionPool: only when the server closed the connection without answering, and only for
+                # methods that may be sent twice. Timeouts are never retried.
+                if reused and attempt == 0 and not streamed and not progress['response'] and method.upper() in IDEMPOTENT_METHODS:
+                    self.stale_reconnects += 1
+                    continue
+                raise
+            except BaseException:
+                conn[1].close()
+                raise
+            self._checkin(key, conn, keep)
+            return code, data
+
+    def close(self):
+        for idle in self._idle.values():
+            for reader, writer, _ in idle:
+                writer.close()
+        self._idle = {}
+
+    async def _checkout(self, key):
+        idle = self._idle.get(key, [])
+        now = time.time()
+        while idle:
+            reader, writer, last_used = idle.pop()
+            if now - last_used > self._idle_timeout or reader.at_eof():
+                writer.close()
+                continue
+            self.reused += 1
+            return (reader, writer), True
+        reader, writer = await asyncio.open_connection(key[0], key[1])
+        self.opened += 1
+        return (reader, writer), False
+
+    def _checkin(self, key, conn, keep):
+        idle = self._idle.setdefault(key, [])
+        if keep and len(idle) < self._max_size:
+            idle.append((conn[0], conn[1], time.time()))
+        else:
+            conn[1].close()
+
+    @staticmethod
+    async def _send(conn, host, port, method, path, body, headers, content_length, progress):
+        reader, writer = conn
+        streamed = body is not None and not isinstance(body, bytes)
+        lines = ['%s %s HTTP/1.1' % (method.upper(), path), 'Host: %s:%d' % (host, port)]
+        for k, v in headers.items():
+            lines.append('%s: %s' % (k, v))
+        if not streamed:
+            lines.append('Content-Length: %d' % len(body or b''))
+        elif content_length is not None:
+            lines.append('Content-Length: %d' % content_length)
+        else:
+            lines.append('Transfer-Encoding: chunked')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if not streamed:
+            if body:
+                writer.write(body)
+        else:
+            for chunk in iter_body_chunks(body):
+                if content_length is None:
+                    writer.write(('%x\r\n' % len(chunk)).encode('ascii'))
+                    writer.write(chunk)
+                    writer.write(b'\r\n')
+                else:
+                    writer.write(chunk)
+                await writer.drain()
+            if content_length is None:
+                writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise EOFError('Connection closed by server')
+        progress['response'] = True
+        version, code = status_line.decode('latin-1').split(None, 2)[:2]
+        code = int(code)
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            k, _, v = line.decode('latin-1').partition(':')
+            response_headers[k.strip().lower()] = v.strip()
+
+        keep = version == 'HTTP/1.1' and response_headers.get('connection', '').lower() != 'close'
+        if code in (204, 304) or method.upper() == 'HEAD' or 100 <= code < 200:
+            data = b''
+        elif response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            data = b''.join(chunks)
+        elif 'content-length' in response_headers:
+            data = await reader.readexactly(int(response_headers['content-length']))
+        else:
+            data = await reader.read()
+            keep = False
+        return code, data, keep
+
+
+class AsyncCustomExecutionServer:
+    def __init__(self,
+                 server_name,
+                 server_description,
+                 server_type,
+                 server_capacity,
+                 command_handler,
+                 logger,
+                 cloudshell_host,
+                 cloudshell_port,
+                 cloudshell_username,
+                 cloudshell_password,
+                 cloudshell_domain,
+                 poller_count=1,
+                 connection_pool=None,
+                 log_payload_preview=4096,
+                 report_compression=None,
+                 poll_controller=None,
+                 status_interval=60,
+                 status_idle_interval=None,
+                 status_debounce=0.5):
+        """
+        Same arguments as CustomExecutionServer. Call and await start() from a running event loop to log in, register and begin polling.
+
+        :param command_handler: AsyncCustomExecutionServerCommandHandler or CustomExecutionServerCommandHandler : A synchronous handler is wrapped in ThreadedCommandHandlerAdapter
+        :param poller_count: int : Number of concurrent PendingCommand long-polls
+        :param connection_pool: AsyncHttpConnectionPool
+        :param log_payload_preview: int : Characters of each request and response body to include in DEBUG logging
+        :param report_compression: ReportCompression : Compresses execution reports as they are uploaded. It runs on the event loop, so prefer a low level.
+        :param poll_controller: PollController : Backoff, circuit breaker and request timeout of the PendingCommand long-poll
+        :param status_interval: float : Seconds between status heartbeats while executions are running. A heartbeat is also sent whenever the set of running executions changes.
+        :param status_idle_interval: float : Longest interval the heartbeat backs off to while no executions are running, by default status_interval
+        :param status_debounce: float : Seconds to collect execution changes before sending a heartbeat for them
+        """
+        self._cloudshell_host = cloudshell_host
+        self._cloudshell_port = cloudshell_port
+        self._cloudshell_username = cloudshell_username
+        self._cloudshell_password = cloudshell_password
+        self._cloudshell_domain = cloudshell_domain
+
+        self._server_name = server_name
+        self._server_description = server_description
+        self._server_type = server_type
+        self._server_capacity = server_capacity
+        self._logger = logger
+        self._request_log = RequestLogger(logger, log_payload_preview)
+        self._report_compression = report_compression
+
+        if asyncio.iscoroutinefunction(command_handler.execute_command):
+            self._command_handler = command_handler
+        else:
+            self._command_handler = ThreadedCommandHandlerAdapter(command_handler, server_capacity)
+
+        self._poller_count = max(1, int(poller_count))
+        self._connection_pool = connection_pool or AsyncHttpConnectionPool()
+        self._poll_controller = poll_controller or PollController()
+
+        self._status_interval = status_interval
+        self._status_idle_interval = max(status_interval, status_idle_interval or status_interval)
+        self._status_debounce = status_debounce
+        self._status_triggered_at = None
+        self._status_wake = None
+
+        self._execution_ids = _ExecutionIdSet(self._trigger_status)
+        self._stopped_ids = set()
+        self._execution_tasks = set()
+        # Stops and UpdateFilesEnded replies, which stop() waits for
+        self._background_tasks = set()
+        self._tasks = []
+        self._running = False
+        self._capacity = None
+        self._counter = itertools.count()
+        self._token = None
+        self._login_lock = None
+
+    async def login(self):
+        _, body = await self._request('put', '/API/Auth/login',
+                                      data=json.dumps({
+                                          'Username': self._cloudshell_username,
+                                          'Password': self._cloudshell_password,
+                                          'Domain': self._cloudshell_domain,
+                                      }),
+                                      hide_result=True,
+                                      retry_auth=False)
+        self._token = body.replace('"', '')
+
+    async def register(self):
+        await self._request('put', '/API/Execution/ExecutionServers',
+                            data=json.dumps({
+                                'Name': self._server_name,
+                                'Description': self._server_description,
+                                'Type': self._server_type,
+                                'Capacity': self._server_capacity,
+                            }))
+        self._logger.info('Successfully registered execution server %s (type %s) on CloudShell server %s' % (self._server_name, self._server_type, self._cloudshell_host))
+
+    async def update(self):
+        self._logger.info('Updating execution server %s on CloudShell server %s: Description: %s, Capacity: %d' % (self._server_name, self._cloudshell_host, self._server_description, self._server_capacity))
+        await self._request('post', '/API/Execution/ExecutionServers',
+                            data=json.dumps({
+                                'Name': self._server_name,
+                                'Description': self._server_description,
+                                'Capacity': self._server_capacity,
+                            }))
+
+    async def start(self, auto_register=True):
+        """
+        Logs in, optionally registers, and starts the heartbeat and poll tasks
+
+        :param auto_register: bool : Register the server, falling back to update() if it already exists
+        """
+        self._login_lock = asyncio.Lock()
+        self._status_wake = asyncio.Event()
+        if self._token is None:
+            await self.login()
+        if auto_register:
+            try:
+                await self.register()
+            except Exception as e:
+                if 'already' in str(e):
+                    self._logger.info('Execution server %s already exists on CloudShell server %s' % (self._server_name, self._cloudshell_host))
+                    await self.update()
+                else:
+                    raise
+        self._running = True
+        self._capacity = asyncio.Semaphore(self._server_capacity)
+        self._tasks = [asyncio.ensure_future(self._status_update_task())]
+        for _ in range(self._poller_count):
+            self._tasks.append(asyncio.ensure_future(self._command_poll_task()))
+
+    async def stop(self, wait_for_executions=True):
+        """
+        Cancels polling immediately, then optionally waits for running executions to report their results
+
+        :param wait_for_executions: bool
+        """
+        self._running = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._background_tasks:
+            await asyncio.gather(*list(self._background_tasks), return_exceptions=True)
+        if wait_for_executions and self._execution_tasks:
+            await asyncio.gather(*list(self._execution_tasks), return_exceptions=True)
+            if isinstance(self._command_handler, ThreadedCommandHandlerAdapter):
+                self._command_handler.shutdown()
+        self._connection_pool.close()
+
+    def poll_stats(self):
+        """
+        :return: dict : Circuit breaker state, backoff and why polling is paused, as PollController.stats()
+        """
+        return self._poll_controller.stats()
+
+    def _trigger_status(self):
+        if self._status_triggered_at is None:
+            self._status_triggered_at = time.time()
+        if self._status_wake is not None:
+            self._status_wake.set()
+
+    async def _status_update_task(self):
+        # The schedule of the threaded server's PeriodicTask: status_interval apart, backing off to
+        # status_idle_interval while idle, and status_debounce after the running executions change
+        interval = self._status_interval
+        next_run = time.time()
+        while self._running:
+            while True:
+                if self._status_triggered_at is not None:
+                    due = min(next_run, self._status_triggered_at + self._status_debounce)
+                else:
+                    due = next_run
+                now = time.time()
+                if now >= due:
+                    break
+                self._status_wake.clear()
+                try:
+                    await asyncio.wait_for(self._status_wake.wait(), due - now)
+                except asyncio.TimeoutError:
+                    pass
+            triggered = self._status_triggered_at is not None
+            self._status_triggered_at = None
+            execution_ids = list(self._execution_ids)
+            try:
+                await self._request('post', '/API/Execution/Status',
+                                    data=json.dumps({
+                                        'Name': self._server_name,
+                                        'ExecutionIds': execution_ids,
+                                    }))
+            except Exception as e:
+                self._logger.warning(str(e))
+            if not execution_ids and not triggered:
+                interval = min(self._status_idle_interval, interval * 2)
+            else:
+                interval = self._status_interval
+            next_run = time.time() + interval
+
+    def _start_background_task(self, coro, description):
+        task = asyncio.ensure_future(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(functools.partial(self._background_task_done, description))
+        return task
+
+    def _background_task_done(self, description, task):
+        self._background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            e = task.exception()
+            self._logger.error('%s failed: %s' % (description, str(e) or type(e).__name__))
+
+    async def _command_poll_task(self):
+        # Polls whatever the capacity, so stopExecution arrives while every slot is busy. Executions wait for a slot.
+        while self._running:
+            while True:
+                delay, _ = self._poll_controller.next_delay()
+                if delay <= 0:
+                    break
+                # Checks again within a second, so a probe returning from another poller is noticed
+                await asyncio.sleep(min(delay, 1))
+            t0 = time.time()
+            try:
+                code, body = await self._request('delete', '/API/Execution/PendingCommand',
+                                                 data=json.dumps({
+                                                     'Name': self._server_name,
+                                                 }),
+                                                 timeout=self._poll_controller.request_timeout())
+                o = json.loads(body) if code != 204 and body else None
+            except asyncio.CancelledError:
+                self._poll_controller.poll_cancelled()
+                raise
+            except Exception as e:
+                delay = self._poll_controller.poll_failed(time.time() - t0, e)
+                self._logger.warning('%s: Polling again in %.1f seconds' % (str(e) or type(e).__name__, delay))
+                continue
+
+            self._poll_controller.poll_succeeded(time.time() - t0, bool(o))
+            if not o:
+                continue
+
+            self._logger.debug('command request %s', o)
+            command_type = o['Type']
+            execution_id = o['ExecutionId']
+            if command_type == 'startExecution':
+                self._execution_ids.add(execution_id)
+                task = asyncio.ensure_future(self._execution_task(o.get('TestPath', ''),
+                                                                  o.get('TestArguments', ''),
+                                                                  execution_id,
+                                                                  o.get('UserName', ''),
+                                                                  o.get('ReservationId', '')))
+                self._execution_tasks.add(task)
+                task.add_done_callback(self._execution_tasks.discard)
+            elif command_type == 'stopExecution':
+                if execution_id not in self._execution_ids:
+                    # Its result has been reported already
+                    self._logger.info('Ignoring stop command for execution %s, which is not running' % execution_id)
+                    continue
+                self._stopped_ids.add(execution_id)
+                self._start_background_task(self._stop_execution(execution_id), 'Stopping execution %s' % execution_id)
+            elif command_type == 'updateFiles':
+                self._start_background_task(self._request('post', '/API/Execution/UpdateFilesEnded',
+                                                          data=json.dumps({
+                                                              'Name': self._server_name,
+                                                              'ErrorMessage': ''
+                                                          })),
+                                            'UpdateFilesEnded')
+
+    async def _stop_execution(self, execution_id):
+        try:
+            await self._command_handler.stop_command(execution_id, self._logger)
+            await self._request('put', '/API/Execution/FinishedExecution',
+                                data=json.dumps({
+                                    'Name': self._server_name,
+                                    'ExecutionId': execution_id,
+                                    'Result': 'Stopped',
+                                }))
+        except Exception as e:
+            self._logger.error('Failed to stop execution %s: %s: %s' % (execution_id, str(e), traceback.format_exc()))
+
+    async def _execution_task(self, test_path, test_arguments, execution_id, username, reservation_id):
+        try:
+            async with self._capacity:
+                if execution_id in self._stopped_ids:
+                    # Stopped while waiting for a slot, and reported as such
+                    self._stopped_ids.discard(execution_id)
+                    return
+                await self._run_execution(test_path, test_arguments, execution_id, username, reservation_id)
+        except Exception as e:
+            self._logger.error('Failed to report execution %s: %s: %s' % (execution_id, str(e), traceback.format_exc()))
+        finally:
+            self._execution_ids.discard(execution_id)
+
+    async def _run_execution(self, test_path, test_arguments, execution_id, username, reservation_id):
+        try:
+            if reservation_id:
+                _, reservation_json = await self._request('get', '/API/Execution/Reservations/%s' % reservation_id)
+            else:
+                reservation_json = ''
+        except Exception as er:
+            result = ErrorCommandResult('Reservation lookup failed', '%s: %s' % (str(er), traceback.format_exc()))
+        else:
+            try:
+                self._logger.info(
+                    'Executing test_path=%s test_arguments=%s execution_id=%s username=%s reservation_id=%s' % (
+                        test_path, test_arguments, execution_id, username, reservation_id))
+                result = await self._command_handler.execute_command(test_path, test_arguments, execution_id, username, reservation_id, reservation_json, self._logger)
+            except Exception as ek:
+                result = ErrorCommandResult('Unhandled Python exception', '%s: %s' % (str(ek), traceback.format_exc()))
+
+        if execution_id in self._stopped_ids:
+            # _stop_execution() reports it as stopped
+            self._stopped_ids.discard(execution_id)
+            return
+        # No longer running, so a stop arriving from now on is ignored rather than reported as well
+        self._execution_ids.discard(execution_id)
+        if not result:
+            result = ErrorCommandResult('Internal error', 'AsyncCustomExecutionServerCommandHandler.execute_command() should return a CommandResult object or throw an exception')
+
+        self._logger.info('Result for execution %s: %s' % (execution_id, result))
+        await self._request('put', '/API/Execution/FinishedExecution',
+                            data=json.dumps({
+                                'Name': self._server_name,
+                                'ExecutionId': execution_id,
+                                'Result': result.result,
+                                'ErrorDescription': result.error_description,
+                                'ErrorName': result.error_name,
+                            }))
+        if result.report_filename:
+            body, length, close = open_report_body(result.report_data)
+            report_filename = result.report_filename
+            headers = {
+                'Accept': 'application/json',
+                'Content-Type': result.report_mime_type,
+            }
+            try:
+                if self._report_compression:
+                    report_filename, headers['Content-Type'], body, length, extra_headers = self._report_compression.compress_body(
+                        report_filename, result.report_mime_type, body, length)
+                    headers.update(extra_headers)
+                await self._request('post', '/API/Execution/ExecutionReport/%s/%s/%s' % (quote(self._server_name),
+                                                                                         execution_id,
+                                                                                         quote(report_filename)),
+                                    headers=headers,
+                                    data=body,
+                                    content_length=length)
+            finally:
+                close()
+        if getattr(result, 'summary', None) is not None:
+            await self._request('post', '/API/Execution/ExecutionReport/%s/%s/%s' % (quote(self._server_name),
+                                                                                     execution_id,
+                                                                                     quote(summary_filename(result.report_filename))),
+                                headers={
+                                    'Accept': 'application/json',
+                                    'Content-Type': 'application/json',
+                                },
+                                data=json.dumps(result.summary, separators=(',', ':'), sort_keys=True))
+
+    async def _relogin(self, rejected_token):
+        # Requests rejected with the same token share one login
+        async with self._login_lock:
+            if self._token == rejected_token:
+                await self.login()
+
+    async def _request(self, method, path, data=None, headers=None, hide_result=False, content_length=None, timeout=None,
+                       retry_auth=True):
+        counter = next(self._counter)
+        if not headers:
+            headers = {
+                'Accept': 'application/json',
+                'Content-Type': 'application/json',
+            }
+        token = self._token
+        if token:
+            headers['Authorization'] = 'Basic ' + token
+        if not path.startswith('/'):
+            path = '/' + path
+
+        self._request_log.request(counter, method, path, headers, data, content_length)
+        streamed = is_streamed_report_data(data)
+        if data is not None and not streamed:
+            data = bytes23(data)
+
+        code, body = await self._connection_pool.request(self._cloudshell_host, self._cloudshell_port, method, path,
+                                                         body=data,
+                                                         headers=headers,
+                                                         content_length=content_length,
+                                                         timeout=timeout)
+
+        self._request_log.response(counter, code, body, hide_result)
+
+        if code == 401 and token and retry_auth and self._login_lock is not None:
+            self._logger.info('CloudShell rejected the auth token, logging in again')
+            await self._relogin(token)
+            if not streamed:
+                return await self._request(method, path, data=data, headers=headers, hide_result=hide_result,
+                                           content_length=content_length, timeout=timeout, retry_auth=False)
+
+        if code >= 400:
+            try:
+                message = string23(body)
+            except:
+                message = string23ppbinary(body)
+            raise CloudShellApiError(code, message)
+        return code, string23(body)
@@ -0,0 +1,261 @@
+import json
+import math
+import multiprocessing
+import os
+import threading
+import time
+
+
+class HostSampler:
+    """
+    Samples what the capacity policy decides on: load average, available memory and running executions
+    """
+    def __init__(self, count_executions):
+        """
+        :param count_executions: function : count_executions() -> int
+        """
+        self._count_executions = count_executions
+        try:
+            self._cpus = multiprocessing.cpu_count()
+        except NotImplementedError:
+            self._cpus = 1
+
+    def sample(self):
+        """
+        :return: dict : time, load (1 minute load average, None if unavailable), cpus, available_memory_bytes (None if unavailable) and executions
+        """
+        try:
+            load = os.getloadavg()[0]
+        except (AttributeError, OSError):
+            # Windows
+            load = None
+        return {
+            'time': time.time(),
+            'load': load,
+            'cpus': self._cpus,
+            'available_memory_bytes': self._available_memory(),
+            'executions': self._count_executions(),
+        }
+
+    @staticmethod
+    def _available_memory():
+        # MemAvailable counts reclaimable page cache, unlike MemFree. Linux only.
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        except (IOError, OSError, ValueError):
+            pass
+        return None
+
+
+class CapacityPolicy:
+    """
+    Computes a capacity from a host sample, and how eagerly to apply it
+
+    Every running execution is assumed to add load_per_execution to the load average and use
+    memory_per_execution_bytes, so the target is the running executions plus as many more as fit in the spare load
+    and memory, within min_capacity and max_capacity.
+    """
+    def __init__(self, min_capacity, max_capacity, max_load_per_cpu=1.0, load_per_execution=1.0,
+                 memory_per_execution_bytes=None, reserve_memory_bytes=0,
+                 hysteresis=1, stable_samples=3, min_update_interval=300):
+        """
+        :param min_capacity: int
+        :param max_capacity: int
+        :param max_load_per_cpu: float : Load average per CPU to stay under
+        :param load_per_execution: float : Load average one execution is expected to add
+        :param memory_per_execution_bytes: int : Memory one execution is expected to use, None to ignore memory
+        :param reserve_memory_bytes: int : Available memory to leave alone
+        :param hysteresis: int : Smallest capacity change worth applying
+        :param stable_samples: int : Consecutive samples that must want a change in the same direction before it is applied
+        :param min_update_interval: float : Seconds between capacity updates sent to CloudShell
+        """
+        if min_capacity < 1 or max_capacity < min_capacity:
+            raise Exception('Capacity bounds must satisfy 1 <= min_capacity <= max_capacity, got %s and %s' % (min_capacity, max_capacity))
+        self.min_capacity = int(min_capacity)
+        self.max_capacity = int(max_capacity)
+        self.max_load_per_cpu = max_load_per_cpu
+        self.load_per_execution = load_per_execution
+        self.memory_per_execution_bytes = memory_per_execution_bytes
+        self.reserve_memory_bytes = reserve_memory_bytes
+        self.hysteresis = max(1, int(hysteresis))
+        self.stable_samples = max(1, int(stable_samples))
+        self.min_update_interval = min_update_interval
+
+    def target(self, sample):
+        """
+        :param sample: dict : As returned by HostSampler.sample()
+        :return: int : Capacity the host has room for
+        """
+        executions = sample.get('executions') or 0
+        targets = [self.max_capacity]
+        if sample.get('load') is not None:
+            spare = sample['cpus'] * self.max_load_per_cpu - sample['load']
+            targets.append(executions + int(math.floor(spare / self.load_per_execution)))
+        if sample.get('available_memory_bytes') is not None and self.memory_per_execution_bytes:
+            spare = sample['available_memory_bytes'] - self.reserve_memory_bytes
+            targets.append(executions + int(math.floor(spare / float(self.memory_per_execution_bytes))))
+        return max(self.min_capacity, min(targets))
+
+
+class CapacityTuner:
+    """
+    Adjusts the server capacity to the host load
+
+    A change is applied once stable_samples consecutive samples want to move the capacity by at least hysteresis in
+    the same direction, and no sooner than min_update_interval after the previous change. It moves to the target all
+    of those samples agree on, i.e. the smallest one when growing and the largest one when shrinking.
+    """
+    def __init__(self, policy, capacity, sampler=None, apply=None, logger=None, trace_path=None):
+        """
+        :param policy: CapacityPolicy
+        :param capacity: int : Current capacity
+        :param sampler: HostSampler : None when samples are passed to step() directly, as in simulate()
+        :param apply: function : apply(capacity) : Applies a new capacity, e.g. CustomExecutionServer.set_capacity. If it raises, the change is tried again on the next sample.
+        :param logger: logging.Logger
+        :param trace_path: str : File to append every sample to as a JSON line, for replaying with simulate()
+        """
+        self.policy = policy
+        self.capacity = capacity
+        self._sampler = sampler
+        self._apply = apply
+        self._logger = logger
+        self._trace_path = trace_path
+        self._lock = threading.Lock()
+        self._direction = 0
+        self._pending = []
+        self._last_update = None
+
+        self.last_sample = None
+        self.last_target = None
+        self.updates = 0
+        self.failed_updates = 0
+
+    def run_once(self):
+        """
+        Samples the host and applies a new capacity if the policy calls for one. For PeriodicTask.
+        """
+        sample = self._sampler.sample()
+        if self._trace_path:
+            self._record(sample)
+        with self._lock:
+            capacity = self.step(sample)
+            if capacity is None:
+                return
+            if self._logger:
+                self._logger.info('Changing capacity from %d to %d: load %s on %d CPUs, %s bytes available, %d executions' % (
+                    self.capacity, capacity, sample['load'], sample['cpus'], sample['available_memory_bytes'], sample['executions']))
+            try:
+                self._apply(capacity)
+            except Exception as e:
+                self.failed_updates += 1
+                if self._logger:
+                    self._logger.warning('Failed to change capacity to %d: %s' % (capacity, str(e)))
+                return
+            self.applied(capacity, sample['time'])
+
+    def step(self, sample):
+        """
+        Feeds one sample to the policy
+
+        :param sample: dict : As returned by HostSampler.sample()
+        :return: int : New capacity to apply, then report with applied(), or None to keep the current one
+        """
+        target = self.policy.target(sample)
+        self.last_sample = sample
+        self.last_target = target
+        if abs(target - self.capacity) < self.policy.hysteresis:
+            self._direction = 0
+            self._pending = []
+            return None
+        direction = 1 if target > self.capacity else -1
+        if direction != self._direction:
+            self._direction = direction
+            self._pending = []
+        self._pending = (self._pending + [target])[-self.policy.stable_samples:]
+        if len(self._pending) < self.policy.stable_samples:
+            return None
+        if self._last_update is not None and sample['time'] - self._last_update < self.policy.min_update_interval:
+            return None
+        return min(self._pending) if direction > 0 else max(self._pending)
+
+    def reset(self, capacity):
+        """
+        Takes a capacity set from outside, e.g. by a config reload, as the new starting point
+        """
+        with self._lock:
+            self.capacity = capacity
+            self._direction = 0
+            self._pending = []
+
+    def applied(self, capacity, now):
+        self.capacity = capacity
+        self._last_update = now
+        self._direction = 0
+        self._pending = []
+        self.updates += 1
+
+    def stats(self):
+        """
+        :return: dict : Current capacity, last sample and target, and update counters
+        """
+        with self._lock:
+            return {
+                'capacity': self.capacity,
+                'target': self.last_target,
+                'sample': self.last_sample,
+                'updates': self.updates,
+                'failed_updates': self.failed_updates,
+            }
+
+    def _record(self, sample):
+        try:
+            with open(self._trace_path, 'a') as f:
+                f.write(json.dumps(sample) + '\n')
+        except (IOError, OSError) as e:
+            if self._logger:
+                self._logger.warning('Failed to record capacity sample to %s: %s' % (self._trace_path, str(e)))
+
+
+def read_trace(path):
+    """
+    :param path: str : JSON lines file as written by CapacityTuner(trace_path=...)
+    :return: list of dict : Samples
+    """
+    samples = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                samples.append(json.loads(line))
+    return samples
+
+
+def simulate(policy, samples, capacity):
+    """
+    Replays recorded samples through the policy offline. The executions in the samples are as recorded, they don't
+    react to the simulated capacity.
+
+    :param policy: CapacityPolicy
+    :param samples: list of dict : E.g. from read_trace()
+    :param capacity: int : Capacity at the start of the trace
+    :return: list of dict : One per sample: time, load, available_memory_bytes, executions, target and capacity after the sample
+    """
+    tuner = CapacityTuner(policy, capacity)
+    timeline = []
+    for sample in samples:
+        new_capacity = tuner.step(sample)
+        if new_capacity is not None:
+            tuner.applied(new_capacity, sample['time'])
+        timeline.append({
+            'time': sample['time'],
+            'load': sample.get('load'),
+            'available_memory_bytes': sample.get('available_memory_bytes'),
+            'executions': sample.get('executions'),
+            'target': tuner.last_target,
+            'capacity': tuner.capacity,
+            'changed': new_capacity is not None,
+        })
+    return timeline
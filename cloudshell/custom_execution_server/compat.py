@@ -0,0 +1,35 @@
+import sys
+
+
+def bytes23(s):
+    if sys.version_info.major == 3:
+        if isinstance(s, str):
+            return s.encode('utf-8', 'replace')
+        else:
+            return s or b''
+    else:
+        if isinstance(s, unicode):
+            return s.encode('utf-8', 'replace')
+        else:
+            return s or b''
+
+
+def string23(b, errors='strict'):
+    if sys.version_info.major == 3:
+        if isinstance(b, bytes):
+            return b.decode('utf-8', errors)
+    return b or ''
+
+
+def string23ppbinary(s):
+    if sys.version_info.major == 3:
+        if isinstance(s, bytes):
+            return '(%d bytes binary data)' % len(s)
+        else:
+            return s or ''
+    else:
+        s = s or ''
+        try:
+            return s.decode('utf-8')
+        except:
+            return '(%d bytes binary data)' % len(s)
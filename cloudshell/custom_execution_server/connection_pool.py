@@ -0,0 +1,364 @@
+import select
+import socket
+import sys
+import threading
+import time
+
+if sys.version_info.major == 2:
+    import httplib as http_client
+else:
+    import http.client as http_client
+
+
+# Errors writing to a reused keep-alive socket that the server closed while it was idle
+if sys.version_info.major == 2:
+    STALE_CONNECTION_ERRORS = (socket.error,)
+else:
+    STALE_CONNECTION_ERRORS = (ConnectionError,)
+
+# Errors reading the response that mean the server closed the connection without answering
+if sys.version_info.major == 2:
+    EMPTY_RESPONSE_ERRORS = (http_client.BadStatusLine, socket.error)
+else:
+    EMPTY_RESPONSE_ERRORS = (http_client.BadStatusLine, ConnectionResetError)
+
+# Methods whose requests may be sent twice. CloudShell's PUT and DELETE calls are not idempotent: DELETE PendingCommand
+# hands out a command and PUT FinishedExecution reports a result.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+STREAM_CHUNK_SIZE = 65536
+
+
+class CloudShellApiError(Exception):
+    """
+    Raised for an HTTP error status from the CloudShell API
+    """
+    def __init__(self, code, message):
+        Exception.__init__(self, 'Error: %d: %s' % (code, message))
+        self.code = code
+
+    def is_permanent(self):
+        """
+        :return: bool : True for client errors that will fail the same way if retried
+        """
+        return 400 <= self.code < 500 and self.code not in (401, 408, 429)
+
+
+def iter_body_chunks(body, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yields a streamed request body as bytes chunks
+
+    :param body: file-like object with read(), or an iterable of bytes or str chunks
+    """
+    if hasattr(body, 'read'):
+        while True:
+            chunk = body.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk if isinstance(chunk, bytes) else chunk.encode('utf-8', 'replace')
+    else:
+        for chunk in body:
+            if chunk:
+                yield chunk if isinstance(chunk, bytes) else chunk.encode('utf-8', 'replace')
+
+
+def _rewinder(body):
+    """
+    :return: function : Restores body to its current position so the request can be resent, or None if it can't be resent
+    """
+    if body is None or isinstance(body, bytes):
+        return lambda: None
+    if hasattr(body, 'seek') and hasattr(body, 'tell'):
+        try:
+            pos = body.tell()
+            return lambda: body.seek(pos)
+        except:
+            return None
+    return None
+
+
+class RequestInterrupted(Exception):
+    pass
+
+
+class _CountingHTTPConnection(http_client.HTTPConnection):
+    """
+    HTTPConnection that counts the bytes of the request written to the socket, to tell whether a failed request could
+    have reached the server
+    """
+    bytes_sent = 0
+
+    def send(self, data):
+        http_client.HTTPConnection.send(self, data)
+        self.bytes_sent += len(data) if hasattr(data, '__len__') else 1
+
+
+class _PooledConnection:
+    def __init__(self, connection):
+        self.connection = connection
+        self.last_used = time.time()
+        self.uses = 0
+        self.tag = None
+        self.interrupted = False
+
+
+class HttpConnectionPool:
+    """
+    Thread-safe pool of persistent HTTP/1.1 connections, one idle list per (host, port)
+    """
+    def __init__(self, max_size=4, idle_timeout=30, timeout=None):
+        """
+        :param max_size: int : Maximum number of idle connections kept per (host, port). More connections are opened under concurrent load, but only max_size are kept afterwards.
+        :param idle_timeout: float : Seconds after which an unused connection is closed instead of reused
+        :param timeout: float : Socket timeout for new connections, None to block indefinitely
+        """
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._active = set()
+        self._interrupted_tags = set()
+        self._closed = False
+
+        self.opened = 0
+        self.reused = 0
+        self.evicted = 0
+        self.stale_reconnects = 0
+
+    def stats(self):
+        """
+        :return: dict : Counters of connections opened, reused, evicted and reconnected after finding a stale socket
+        """
+        with self._lock:
+            return {
+                'opened': self.opened,
+                'reused': self.reused,
+                'evicted': self.evicted,
+                'stale_reconnects': self.stale_reconnects,
+                'idle': sum(len(v) for v in self._idle.values()),
+                'active': len(self._active),
+            }
+
+    def request(self, host, port, method, path, body=None, headers=None, timeout=None, content_length=None, tag=None):
+        """
+        Sends one request over a pooled connection and reads the complete response
+
+        A request that fails on a reused connection is retried once on a new connection, unless its streamed body can't
+        be rewound, if the server can't have seen it: writing it failed before any byte was sent, or the server closed
+        the connection without a response and the method is idempotent. Timeouts are never retried, since the server
+        may still be processing the request.
+
+        :param host: str
+        :param port: int
+        :param method: str : GET, PUT, POST, DELETE
+        :param path: str : Path starting with /
+        :param body: bytes, file-like object or iterable of chunks : Anything other than bytes is streamed without being read into memory
+        :param headers: dict
+        :param timeout: float : Socket timeout for this request, overriding the pool default
+        :param content_length: int : Length of a streamed body. If None, a streamed body is sent with chunked transfer encoding.
+        :param tag: object : Identifies the request for interrupt()
+        :return: (int, bytes) : HTTP status code and response body
+        :raises: RequestInterrupted : If interrupt() was called for the tag
+        """
+        headers = headers or {}
+        key = (host, port)
+        rewind = _rewinder(body)
+        pc = self._checkout(key, timeout, tag)
+        try:
+            try:
+                code, data, reusable = self._send(pc, method, path, body, headers, content_length)
+            except Exception as e:
+                if pc.interrupted:
+                    raise RequestInterrupted('Request interrupted')
+                if not pc.uses or rewind is None or not self._retryable(e, method, pc.connection.bytes_sent):
+                    raise
+                pc.connection.close()
+                with self._lock:
+                    self.stale_reconnects += 1
+                    self._active.discard(pc)
+                pc = self._open(key, timeout, tag)
+                rewind()
+                code, data, reusable = self._send(pc, method, path, body, headers, content_length)
+        except:
+            pc.connection.close()
+            with self._lock:
+                self._active.discard(pc)
+            if pc.interrupted:
+                raise RequestInterrupted('Request interrupted')
+            raise
+        self._checkin(key, pc, reusable)
+        return code, data
+
+    def close(self):
+        """
+        Closes all idle connections and interrupts requests in progress, for example a blocking long-poll
+        """
+        with self._lock:
+            self._closed = True
+            conns = [pc for v in self._idle.values() for pc in v] + list(self._active)
+            self._idle = {}
+        for pc in conns:
+            sock = pc.connection.sock
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except:
+                    pass
+            pc.connection.close()
+
+    def interrupt(self, tag):
+        """
+        Aborts requests in progress with the given tag, such as a long-poll blocking shutdown,
+        and makes new requests with the tag fail until clear_interrupt() is called
+
+        :param tag: object
+        """
+        with self._lock:
+            self._interrupted_tags.add(tag)
+            conns = [pc for pc in self._active if pc.tag == tag]
+            for pc in conns:
+                pc.interrupted = True
+        for pc in conns:
+            sock = pc.connection.sock
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except:
+                    pass
+
+    def clear_interrupt(self, tag):
+        with self._lock:
+            self._interrupted_tags.discard(tag)
+
+    def reopen(self):
+        """
+        Allows the pool to be used again after close()
+        """
+        with self._lock:
+            self._closed = False
+
+    @staticmethod
+    def _retryable(e, method, bytes_sent):
+        """
+        :return: bool : Whether a request that failed on a reused connection with e can't have reached the server
+        """
+        if isinstance(e, socket.timeout):
+            return False
+        if bytes_sent == 0:
+            # A partial first write is an incomplete header block the server can't act on
+            return isinstance(e, STALE_CONNECTION_ERRORS)
+        return method.upper() in IDEMPOTENT_METHODS and isinstance(e, EMPTY_RESPONSE_ERRORS)
+
+    def _send(self, pc, method, path, body, headers, content_length):
+        pc.connection.bytes_sent = 0
+        if body is None or isinstance(body, bytes):
+            pc.connection.request(method.upper(), path, body, headers)
+        else:
+            self._send_streaming(pc.connection, method, path, body, headers, content_length)
+        response = pc.connection.getresponse()
+        data = response.read()
+        code = response.status
+        reusable = not response.will_close
+        pc.uses += 1
+        return code, data, reusable
+
+    @staticmethod
+    def _send_streaming(connection, method, path, body, headers, content_length):
+        connection.putrequest(method.upper(), path, skip_accept_encoding=True)
+        for k, v in headers.items():
+            connection.putheader(k, v)
+        if content_length is not None:
+            connection.putheader('Content-Length', str(content_length))
+        else:
+            connection.putheader('Transfer-Encoding', 'chunked')
+        connection.endheaders()
+        for chunk in iter_body_chunks(body):
+            if content_length is not None:
+                connection.send(chunk)
+            else:
+                connection.send(('%x\r\n' % len(chunk)).encode('ascii') + chunk + b'\r\n')
+        if content_length is None:
+            connection.send(b'0\r\n\r\n')
+
+    def _open(self, key, timeout, tag=None):
+        if timeout is None:
+            timeout = self._timeout
+        if timeout is None:
+            connection = _CountingHTTPConnection(key[0], key[1])
+        else:
+            connection = _CountingHTTPConnection(key[0], key[1], timeout=timeout)
+        connection.connect()
+        # Streamed bodies are written in several sends, which Nagle's algorithm would delay
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        pc = _PooledConnection(connection)
+        pc.tag = tag
+        with self._lock:
+            if self._closed:
+                connection.close()
+                raise Exception('Connection pool is closed')
+            if tag is not None and tag in self._interrupted_tags:
+                connection.close()
+                raise RequestInterrupted('Request interrupted')
+            self.opened += 1
+            self._active.add(pc)
+        return pc
+
+    def _checkout(self, key, timeout, tag=None):
+        now = time.time()
+        stale = []
+        pc = None
+        with self._lock:
+            if tag is not None and tag in self._interrupted_tags:
+                raise RequestInterrupted('Request interrupted')
+            idle = self._idle.get(key, [])
+            while idle:
+                candidate = idle.pop()
+                if now - candidate.last_used > self._idle_timeout or self._is_dropped(candidate):
+                    stale.append(candidate)
+                    self.evicted += 1
+                    continue
+                pc = candidate
+                pc.tag = tag
+                pc.interrupted = False
+                self.reused += 1
+                self._active.add(pc)
+                break
+        for s in stale:
+            s.connection.close()
+        if pc is None:
+            return self._open(key, timeout, tag)
+        sock = pc.connection.sock
+        if sock is not None:
+            sock.settimeout(timeout if timeout is not None else self._timeout)
+        return pc
+
+    def _checkin(self, key, pc, reusable):
+        pc.last_used = time.time()
+        with self._lock:
+            self._active.discard(pc)
+            idle = self._idle.setdefault(key, [])
+            if reusable and not self._closed and len(idle) < self._max_size:
+                idle.append(pc)
+                return
+        pc.connection.close()
+
+    @staticmethod
+    def _is_dropped(pc):
+        """
+        An idle keep-alive socket should never be readable; if it is, the server closed it or sent garbage
+        """
+        sock = pc.connection.sock
+        if sock is None:
+            return True
+        try:
+            if hasattr(select, 'poll'):
+                # select.select() can't take descriptors of 1024 and up, which a busy server soon reaches
+                poller = select.poll()
+                poller.register(sock, select.POLLIN | select.POLLPRI)
+                return bool(poller.poll(0))
+            r, _, _ = select.select([sock], [], [], 0)
+            return bool(r)
+        except:
+            return True
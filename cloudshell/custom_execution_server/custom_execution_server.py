@@ -1,7 +1,9 @@
 import json
+import os
+import signal
 import threading
 from abc import abstractmethod
-from time import sleep
+import time
 import sys
 import traceback
 
@@ -10,52 +12,40 @@ import itertools
 import re
 
 if sys.version_info.major == 2:
-    from urllib2 import Request
-    from urllib2 import urlopen
     from urllib import quote
 else:
-    from urllib.request import Request
-    from urllib.request import urlopen
     from urllib.parse import quote
 
-
-def bytes23(s):
-    if sys.version_info.major == 3:
-        if isinstance(s, str):
-            return s.encode('utf-8', 'replace')
-        else:
-            return s or b''
-    else:
-        if isinstance(s, unicode):
-            return s.encode('utf-8', 'replace')
-        else:
-            return s or b''
+from cloudshell.custom_execution_server.compat import bytes23, string23, string23ppbinary
+from cloudshell.custom_execution_server.capacity_tuner import CapacityTuner, HostSampler
+from cloudshell.custom_execution_server.connection_pool import CloudShellApiError, HttpConnectionPool, RequestInterrupted, iter_body_chunks
+from cloudshell.custom_execution_server.report_data import ReportFile, is_streamed_report_data, open_report_body
+from cloudshell.custom_execution_server.journal import ExecutionJournal, ACCEPTED, RUNNING, PROCESS, FINISHED, REPORTED, process_start_time
+from cloudshell.custom_execution_server.metrics import MetricsRegistry, MetricsServer, DURATION_BUCKETS, SIZE_BUCKETS
+from cloudshell.custom_execution_server.poll_controller import PollController, HALF_OPEN, OPEN, STATE_VALUES
+from cloudshell.custom_execution_server.request_log import PayloadPreview, RequestLogger
+from cloudshell.custom_execution_server.reservation_cache import ReservationCache
+from cloudshell.custom_execution_server.result_reporter import ResultReporter, TokenBucket
+from cloudshell.custom_execution_server.scheduler import PeriodicTask
+from cloudshell.custom_execution_server.session import CloudShellSession
+from cloudshell.custom_execution_server.worker_pool import WorkerPool
 
 
-def string23(b):
-    if sys.version_info.major == 3:
-        if isinstance(b, bytes):
-            return b.decode('utf-8')
-    return b or ''
+class CommandResult:
+    """
+    Base class for command results
 
+    report_data may be str or bytes, or to avoid holding a large report in memory, a ReportFile, a binary file-like
+    object or an iterator of chunks. Streamed report data is closed after upload.
 
-def string23ppbinary(s):
-    if sys.version_info.major == 3:
-        if isinstance(s, bytes):
-            return '(%d bytes binary data)' % len(s)
-        else:
-            return s or ''
-    else:
-        s = s or ''
-        try:
-            return s.decode('utf-8')
-        except:
-            return '(%d bytes binary data)' % len(s)
+    resource_usage may be set to the process_manager.ResourceUsage of the execution, e.g. from
+    ProcessRunner.last_usage(), to log it and export it as metrics.
 
+    summary may be set to a dict of test counts parsed from the output, e.g. OutputParser.summary(), to upload it as
+    a small JSON report next to the main one.
 
-class CommandResult:
-    """
-    Base class for command results
+    artifacts may list report_data.Artifacts, such as screenshots and packet captures, to upload as further reports,
+    e.g. artifacts_from_directory('/tmp/1234', delete=True). They are streamed from disk, several at a time.
     """
     def __init__(self):
         self.result = ''
@@ -64,15 +54,22 @@ class CommandResult:
         self.report_filename = ''
         self.report_data = ''
         self.report_mime_type = ''
+        self.resource_usage = None
+        self.summary = None
+        self.artifacts = []
 
     def __repr__(self):
         d = self.report_data
         try:
             if isinstance(self.report_data, bytes):
                 d = '(binary data)'
+            elif is_streamed_report_data(self.report_data) and not isinstance(self.report_data, ReportFile):
+                d = '(streamed data)'
+            elif not isinstance(self.report_data, ReportFile):
+                d = PayloadPreview(self.report_data, 1024)
         except:
             pass
-        return '%s result=%s error_name=%s error_description=%s report_filename=%s report_data=<<<%s>>> report_mime_type=%s' % (
+        s = '%s result=%s error_name=%s error_description=%s report_filename=%s report_data=<<<%s>>> report_mime_type=%s' % (
             self.__class__.__name__,
             self.result,
             self.error_name,
@@ -80,6 +77,14 @@ class CommandResult:
             self.report_filename,
             d,
             self.report_mime_type)
+        if getattr(self, 'resource_usage', None) is not None:
+            s += ' resource_usage=<<<%s>>>' % self.resource_usage
+        summary = getattr(self, 'summary', None)
+        if summary is not None:
+            s += ' summary=<<<%s passed=%s failed=%s skipped=%s>>>' % (summary.get('verdict'), summary.get('passed'), summary.get('failed'), summary.get('skipped'))
+        if getattr(self, 'artifacts', None):
+            s += ' artifacts=<<<%s>>>' % ', '.join(a.name for a in self.artifacts)
+        return s
 
 
 class StoppedCommandResult(CommandResult):
@@ -187,6 +192,29 @@ class CustomExecutionServerCommandHandler:
         pass
 
 
+class _ExecutionIdSet(set):
+    """
+    Set of execution ids that calls on_change when an id is added or removed
+    """
+    def __init__(self, on_change):
+        set.__init__(self)
+        self._on_change = on_change
+
+    def add(self, execution_id):
+        if execution_id not in self:
+            set.add(self, execution_id)
+            self._on_change()
+
+    def discard(self, execution_id):
+        if execution_id in self:
+            set.discard(self, execution_id)
+            self._on_change()
+
+    def remove(self, execution_id):
+        set.remove(self, execution_id)
+        self._on_change()
+
+
 class CustomExecutionServer:
     def __init__(self,
                  server_name,
@@ -201,7 +229,37 @@ class CustomExecutionServer:
                  cloudshell_password,
                  cloudshell_domain,
                  auto_register,
-                 auto_start):
+                 auto_start,
+                 connection_pool=None,
+                 worker_queue_size=None,
+                 queue_full_policy='block',
+                 poller_count=1,
+                 reservation_cache_size=100,
+                 reservation_cache_ttl=30,
+                 result_spool_directory=None,
+                 report_requests_per_second=None,
+                 report_max_retries=None,
+                 journal_path=None,
+                 journal_fsync='interval',
+                 status_interval=60,
+                 status_idle_interval=None,
+                 status_debounce=0.5,
+                 metrics=None,
+                 metrics_port=None,
+                 metrics_host='127.0.0.1',
+                 log_payload_preview=4096,
+                 capacity_policy=None,
+                 capacity_interval=30,
+                 capacity_trace_path=None,
+                 session=None,
+                 worker_pool=None,
+                 worker_weight=1,
+                 report_compression=None,
+                 artifact_workers=4,
+                 artifact_max_bytes=None,
+                 report_bytes_per_second=None,
+                 report_cache=None,
+                 poll_controller=None):
         """
 
         :param server_name: str : Unique name for registering execution server in CloudShell
@@ -221,6 +279,49 @@ class CustomExecutionServer:
 
         :param auto_register: bool : Automatically register this execution server in CloudShell in the constructor, ignoring 'already registered' error
         :param auto_start: bool : Automatically start the server threads in the constructor. Consider setting to False and using the cloudshell.custom_execution_server.daemon module to control starting and stopping.
+
+        :param connection_pool: HttpConnectionPool : Pool of keep-alive connections to CloudShell, possibly shared with other servers. By default a private pool is created.
+
+        :param worker_queue_size: int : Number of accepted commands allowed to wait for one of the server_capacity workers, by default server_capacity
+        :param queue_full_policy: str : What to do when all workers are busy and the queue is full: 'block' stops polling CloudShell until a worker is free, 'reject' keeps polling and reports new executions back to CloudShell as errors
+
+        :param poller_count: int : Number of threads concurrently long-polling CloudShell for pending commands
+
+        :param reservation_cache_size: int : Number of reservations whose details JSON is cached for executions queued against the same reservation
+        :param reservation_cache_ttl: float : Seconds to reuse cached reservation details, 0 to always fetch
+
+        :param result_spool_directory: str : Directory where results are persisted until CloudShell has accepted them, so they survive an outage or restart. None to keep unsent results in memory only.
+        :param report_requests_per_second: float : Limit on FinishedExecution, ExecutionReport and status requests per second, None for no limit
+        :param report_max_retries: int : Retries before giving up on reporting a result, None to retry until it succeeds
+
+        :param journal_path: str : File journaling accepted, running and finished executions. On start() it is replayed to report executions interrupted by a restart and reattach to their surviving process groups. None to disable.
+        :param journal_fsync: str : 'always', 'interval' (at most once a second) or 'never'
+
+        :param status_interval: float : Seconds between status heartbeats while executions are running. A heartbeat is also sent whenever the set of running executions changes.
+        :param status_idle_interval: float : Longest interval the heartbeat backs off to while no executions are running, by default status_interval
+        :param status_debounce: float : Seconds to collect execution changes before sending a heartbeat for them
+
+        :param metrics: MetricsRegistry : Registry to record metrics in, possibly shared with other servers. By default a private one is created, see .metrics.
+        :param metrics_port: int : Serve the metrics in Prometheus text format at http://metrics_host:metrics_port/metrics while the server is started. None to not serve them.
+        :param metrics_host: str : Interface for the metrics endpoint, by default only local scrapers can reach it
+
+        :param log_payload_preview: int : Characters of each CloudShell request and response body to include in DEBUG logging
+
+        :param capacity_policy: CapacityPolicy : Adjusts the capacity to the host's load average and available memory while the server is started, starting from server_capacity. None to keep server_capacity.
+        :param capacity_interval: float : Seconds between host samples for capacity_policy
+        :param capacity_trace_path: str : File to record the host samples in, for replaying with capacity_tuner.simulate()
+
+        :param session: CloudShellSession : Auth token shared with other servers logging in as the same user, so only the first one logs in, and possibly with other processes through its token file. By default a private session is created.
+        :param worker_pool: FairWorkerPool : Worker threads shared with other servers, of which this server uses up to server_capacity. By default the server has its own server_capacity workers.
+        :param worker_weight: float : This server's share of a shared worker_pool relative to the other servers when they compete for workers
+
+        :param report_compression: ReportCompression : Compresses execution reports as they are uploaded, e.g. ReportCompression('gzip', threshold=65536). None to upload them as they are.
+        :param artifact_workers: int : Artifacts of CommandResult.artifacts uploaded at once, across all executions
+        :param artifact_max_bytes: int : Largest artifact uploaded; larger ones are dropped with a warning. None for no limit.
+        :param report_bytes_per_second: float : Limit on the upload bandwidth of all reports and artifacts together, None for no limit
+        :param report_cache: ReportCache : Index of uploaded content, so reports and artifacts identical to earlier ones are replaced by a note naming the earlier upload. None to always upload in full.
+
+        :param poll_controller: PollController : Backoff, circuit breaker and request timeout of the PendingCommand long-poll. By default one with the default settings is created.
         """
         self._cloudshell_host = cloudshell_host
         self._cloudshell_port = cloudshell_port
@@ -233,26 +334,91 @@ class CustomExecutionServer:
         self._server_type = server_type
         self._server_capacity = server_capacity
         self._logger = logger
+        self._request_log = RequestLogger(logger, log_payload_preview)
 
         self._command_handler = command_handler
-
-        self._execution_ids = set()
+        self._handler_lock = threading.Lock()
+        # Execution id -> the command handler running it, which may be an earlier one than _command_handler
+        self._execution_handlers = {}
+        # id(handler) -> (handler, on_drained) for replaced handlers with executions still running
+        self._draining_handlers = {}
+
+        self._stop_event = threading.Event()
+        self._status_task = PeriodicTask(self._send_status, status_interval, self._stop_event, logger,
+                                         debounce=status_debounce,
+                                         idle_interval=status_idle_interval,
+                                         name='%s-status' % server_name)
+        self._execution_ids = _ExecutionIdSet(self._status_task.trigger)
+        # Executions without a result yet, and those of them that a stop command will report as stopped
+        self._running_ids = set()
         self._stopped_ids = set()
+        self._stop_lock = threading.Lock()
 
         self._running = False
         self._threads = []
 
         self._counter = itertools.count()
 
-        self._token = None
-        _, body = self._request('put', '/API/Auth/login',
-                                data=json.dumps({
-                                    'Username': cloudshell_username,
-                                    'Password': cloudshell_password,
-                                    'Domain': cloudshell_domain,
-                                }),
-                                hide_result=True)
-        self._token = body.replace('"', '')
+        self._connection_pool = connection_pool or HttpConnectionPool()
+
+        if queue_full_policy not in ('block', 'reject'):
+            raise Exception('queue_full_policy must be block or reject, not %s' % queue_full_policy)
+        self._queue_full_policy = queue_full_policy
+        if worker_pool is not None:
+            self._worker_pool = worker_pool.tenant(server_name, server_capacity,
+                                                   worker_queue_size if worker_queue_size is not None else server_capacity,
+                                                   weight=worker_weight)
+        else:
+            self._worker_pool = WorkerPool(server_capacity,
+                                           worker_queue_size if worker_queue_size is not None else server_capacity,
+                                           logger,
+                                           name='%s-worker' % server_name)
+        # Replies to stopExecution and updateFiles are sent from here so they don't hold up polling
+        self._reply_pool = WorkerPool(2, 1000, logger, name='%s-reply' % server_name)
+        self._poller_count = max(1, int(poller_count))
+        self._poll_controller = poll_controller or PollController()
+        self._reservation_cache = ReservationCache(self._fetch_reservation, reservation_cache_size, reservation_cache_ttl)
+        self._result_reporter = ResultReporter(self._send_finished, self._send_report, logger,
+                                               spool_directory=result_spool_directory,
+                                               requests_per_second=report_requests_per_second,
+                                               max_retries=report_max_retries,
+                                               on_done=self._on_result_reported,
+                                               name='%s-reporter' % server_name,
+                                               artifact_workers=artifact_workers,
+                                               artifact_max_bytes=artifact_max_bytes,
+                                               on_artifact=self._on_artifact,
+                                               report_cache=report_cache,
+                                               on_dedup=self._on_dedup)
+        self._result_spool_directory = result_spool_directory
+        self._report_compression = report_compression
+        self._report_cache = report_cache
+        # 64 KiB chunks can always be sent, however low the limit
+        self._report_bandwidth = TokenBucket(report_bytes_per_second, burst=max(65536, report_bytes_per_second or 0)) if report_bytes_per_second else None
+        self._journal = ExecutionJournal(journal_path, logger, fsync=journal_fsync) if journal_path else None
+        self._reattached = {}
+
+        self._capacity_tuner = None
+        self._capacity_task = None
+        if capacity_policy:
+            self._capacity_tuner = CapacityTuner(capacity_policy, server_capacity,
+                                                 sampler=HostSampler(lambda: len(self._execution_ids)),
+                                                 apply=self.set_capacity,
+                                                 logger=logger,
+                                                 trace_path=capacity_trace_path)
+            self._capacity_task = PeriodicTask(self._capacity_tuner.run_once, capacity_interval, self._stop_event, logger,
+                                               name='%s-capacity' % server_name)
+
+        self.metrics = metrics or MetricsRegistry()
+        self._init_metrics()
+        self._metrics_server = MetricsServer(self.metrics, metrics_host, metrics_port, logger) if metrics_port is not None else None
+
+        self._stats_lock = threading.Lock()
+        self._start_time = None
+        self._first_execution_latency = None
+        self._dispatched = 0
+
+        self._session = session or CloudShellSession()
+        self._session.ensure_login(self._login)
 
         if auto_register:
             try:
@@ -268,6 +434,17 @@ class CustomExecutionServer:
         if auto_start:
             self.start()
 
+    def _login(self):
+        _, body = self._request('put', '/API/Auth/login',
+                                data=json.dumps({
+                                    'Username': self._cloudshell_username,
+                                    'Password': self._cloudshell_password,
+                                    'Domain': self._cloudshell_domain,
+                                }),
+                                hide_result=True,
+                                authenticate=False)
+        return body.replace('"', '')
+
     def register(self):
         """
         Registers the server
@@ -298,140 +475,594 @@ class CustomExecutionServer:
         """
         self._threads = []
         self._running = True
-        th = threading.Thread(target=self._status_update_thread)
-        # th.daemon = True
-        th.start()
-        self._threads.append(th)
-        th = threading.Thread(target=self._command_poll_thread)
-        # th.daemon = True
-        th.start()
-        self._threads.append(th)
+        self._stop_event.clear()
+        self._connection_pool.clear_interrupt(self)
+        with self._stats_lock:
+            self._start_time = time.time()
+            self._first_execution_latency = None
+            self._dispatched = 0
+        self._worker_pool.start()
+        self._reply_pool.start()
+        if self._report_cache:
+            self._report_cache.open()
+        self._result_reporter.start()
+        if self._journal:
+            self._recover(self._journal.open())
+        self._threads.append(self._status_task.start())
+        if self._capacity_task:
+            self._threads.append(self._capacity_task.start())
+        if self._metrics_server:
+            self._metrics_server.start()
+        for _ in range(self._poller_count):
+            th = threading.Thread(target=self._command_poll_thread)
+            # th.daemon = True
+            th.start()
+            self._threads.append(th)
 
     def stop(self):
         """
-        Stops the server. May take up to 2 minutes to cleanly close. It can be restarted.
+        Stops the server. Polling and the heartbeat stop within about a second; queued results get up to 10 more seconds to be sent. It can be restarted.
         :return: 
         """
         self._running = False
+        self._stop_event.set()
+        self._status_task.wake()
+        if self._capacity_task:
+            self._capacity_task.wake()
+        self._worker_pool.wake()
+        self._poll_controller.wake()
+        self._connection_pool.interrupt(self)
         for th in self._threads:
             th.join()
         self._threads = []
+        self._worker_pool.stop()
+        self._reply_pool.stop()
+        self._result_reporter.stop()
+        if self._report_cache:
+            self._report_cache.close()
+        if self._journal:
+            self._journal.close()
+        if self._metrics_server:
+            self._metrics_server.stop()
+
+    def set_command_handler(self, command_handler, on_drained=None):
+        """
+        Replaces the command handler without interrupting polling. New executions go to the new handler, while
+        running ones finish on the old one, which also gets their stop requests.
 
-    def _status_update_thread(self):
-        while self._running:
-            try:
-                self._request('post', '/API/Execution/Status',
-                              data=json.dumps({
-                                  'Name': self._server_name,
-                                  'ExecutionIds': list(self._execution_ids),
-                              }))
-            except Exception as e:
-                self._logger.warn(str(e))
+        :param command_handler: CustomExecutionServerCommandHandler
+        :param on_drained: function : on_drained() : Called once no execution runs on the old handler any more, e.g. to release its resources
+        """
+        with self._handler_lock:
+            old = self._command_handler
+            self._command_handler = command_handler
+            running = sum(1 for h in self._execution_handlers.values() if h is old)
+            if running and on_drained and old is not command_handler:
+                self._draining_handlers[id(old)] = (old, on_drained)
+        self._logger.info('Replaced command handler, %d executions still running on the previous one' % running)
+        if not running and on_drained and old is not command_handler:
+            self._handler_drained(old, on_drained)
+
+    def reconfigure(self, server_description=None, server_capacity=None):
+        """
+        Applies a new description and capacity with one update() on CloudShell, without interrupting polling or
+        running executions. None leaves a setting as it is.
 
-            for _ in range(60):
-                sleep(1)
-                if not self._running:
-                    break
+        :param server_description: str
+        :param server_capacity: int : Also the starting point of the capacity tuner, if there is one
+        """
+        previous_description = self._server_description
+        if server_description is not None:
+            self._server_description = server_description
+        try:
+            if server_capacity is not None and int(server_capacity) != self._server_capacity:
+                self.set_capacity(server_capacity)
+                if self._capacity_tuner:
+                    self._capacity_tuner.reset(self._server_capacity)
+            elif self._server_description != previous_description:
+                self.update()
+        except Exception:
+            self._server_description = previous_description
+            raise
+
+    def set_capacity(self, capacity):
+        """
+        Changes the number of concurrent executions, on CloudShell and in the worker pool. When shrinking, running
+        executions finish normally.
+
+        :param capacity: int
+        """
+        capacity = max(1, int(capacity))
+        previous = self._server_capacity
+        self._server_capacity = capacity
+        try:
+            self.update()
+        except Exception:
+            self._server_capacity = previous
+            raise
+        self._worker_pool.resize(capacity)
+        self._capacity_updates.inc((self._server_name, 'up' if capacity > previous else 'down'))
+
+    def capacity_stats(self):
+        """
+        :return: dict : Current capacity, last host sample and target capacity, and update counters of the capacity tuner, None without capacity_policy
+        """
+        return self._capacity_tuner.stats() if self._capacity_tuner else None
+
+    def record_process(self, execution_id, pid):
+        """
+        Journals the process group started for an execution, with its start time so that a later process given the same
+        pid is not mistaken for it, so it can be reattached after a restart.
+        Pass as ProcessRunner(logger, on_process_started=server.record_process).
+
+        :param execution_id: str
+        :param pid: int : Process id, which is also the process group id of a process started in its own session
+        """
+        self._journal_record(PROCESS, execution_id, pid=pid, start_time=process_start_time(pid))
+
+    def worker_stats(self):
+        """
+        :return: dict : Queue depth, busy workers, utilization and task counters of the execution worker pool
+        """
+        return self._worker_pool.stats()
+
+    def dispatch_stats(self):
+        """
+        :return: dict : Number of pollers, commands dispatched since start() and per second, seconds from start() to the first execution starting
+        """
+        with self._stats_lock:
+            elapsed = time.time() - self._start_time if self._start_time else 0
+            return {
+                'pollers': self._poller_count,
+                'dispatched': self._dispatched,
+                'dispatched_per_second': self._dispatched / elapsed if elapsed > 0 else 0.0,
+                'first_execution_latency': self._first_execution_latency,
+            }
+
+    def poll_stats(self):
+        """
+        :return: dict : Why polling is paused, if it is: the circuit breaker state, backoff and last error of the poll controller, its observed poll latency and request timeout, and whether all workers are busy with the 'block' queue_full_policy
+        """
+        stats = self._poll_controller.stats()
+        stats['workers_full'] = self._queue_full_policy == 'block' and not self._worker_pool.has_capacity()
+        if stats['workers_full'] and not stats['paused']:
+            stats['paused'] = True
+            stats['reason'] = 'All %d workers busy and queue full' % self._server_capacity
+        return stats
+
+    def reservation_cache_stats(self):
+        """
+        :return: dict : Hit, miss and coalesced lookup counters of the reservation details cache
+        """
+        return self._reservation_cache.stats()
+
+    def report_stats(self):
+        """
+        :return: dict : Queue depth and sent, retried, coalesced and dropped counters of the result reporting queue, and the report cache stats as 'cache' if there is one
+        """
+        stats = self._result_reporter.stats()
+        if self._report_cache:
+            stats['cache'] = self._report_cache.stats()
+        return stats
+
+    def _init_metrics(self):
+        m = self.metrics
+        labels = (self._server_name,)
+        self._labels = labels
+        self._request_seconds = m.histogram('cloudshell_execution_server_request_seconds', 'CloudShell API request latency', ('server', 'endpoint', 'status'))
+        self._poll_seconds = m.histogram('cloudshell_execution_server_poll_seconds', 'PendingCommand long-poll round trip time', ('server', 'result'))
+        self._commands_total = m.counter('cloudshell_execution_server_commands_total', 'Commands received from CloudShell', ('server', 'type'))
+        self._execution_seconds = m.histogram('cloudshell_execution_server_execution_seconds', 'Time spent in execute_command()', ('server', 'result'), buckets=DURATION_BUCKETS)
+        self._report_bytes = m.histogram('cloudshell_execution_server_report_bytes', 'Size of uploaded execution reports', ('server',), buckets=SIZE_BUCKETS)
+        self._report_upload_seconds = m.histogram('cloudshell_execution_server_report_upload_seconds', 'Time to upload an execution report or artifact', ('server',), buckets=DURATION_BUCKETS)
+        self._report_dedup_total = m.counter('cloudshell_execution_server_report_dedup_total', 'Reports looked up in the report cache', ('server', 'result'))
+        self._report_dedup_bytes_saved = m.counter('cloudshell_execution_server_report_dedup_bytes_saved_total', 'Bytes not uploaded because the same content had been uploaded before', ('server',))
+        self._artifacts_total = m.counter('cloudshell_execution_server_artifacts_total', 'Execution artifacts uploaded or dropped', ('server', 'result'))
+        self._report_compression_bytes = m.counter('cloudshell_execution_server_report_compression_bytes_total', 'Bytes of compressed execution reports before and after compression', ('server', 'stage'))
+        self._execution_cpu_seconds = m.histogram('cloudshell_execution_server_execution_cpu_seconds', 'User and system CPU time of execution processes', ('server',), buckets=DURATION_BUCKETS)
+        self._execution_max_rss_bytes = m.histogram('cloudshell_execution_server_execution_max_rss_bytes', 'Peak resident memory of execution processes', ('server',), buckets=SIZE_BUCKETS)
+        self._poll_breaker_transitions = m.counter('cloudshell_execution_server_poll_breaker_transitions_total', 'PendingCommand circuit breaker state changes', ('server', 'state'))
+        self._poll_controller.add_state_listener(self._on_poll_state_change)
+        self._auth_rejected = m.counter('cloudshell_execution_server_auth_rejected_total', 'Requests CloudShell rejected with 401, after which the server logged in again', ('server',))
+        self._capacity_updates = m.counter('cloudshell_execution_server_capacity_updates_total', 'Capacity changes sent to CloudShell', ('server', 'direction'))
+        self._execution_io_blocks = m.counter('cloudshell_execution_server_execution_io_blocks_total', 'Block I/O operations of execution processes', ('server', 'direction'))
+        for name, help, fn in [
+            ('cloudshell_execution_server_capacity', 'Concurrent executions the server accepts', lambda: self._server_capacity),
+            ('cloudshell_execution_server_active_executions', 'Executions running or waiting for their result to be reported', lambda: len(self._execution_ids)),
+            ('cloudshell_execution_server_busy_workers', 'Workers running an execution', lambda: self._worker_pool.stats()['busy']),
+            ('cloudshell_execution_server_worker_queue_depth', 'Accepted executions waiting for a worker', lambda: self._worker_pool.stats()['queue_depth']),
+            ('cloudshell_execution_server_report_queue_depth', 'Results waiting to be reported', lambda: self._result_reporter.stats()['queue_depth']),
+            ('cloudshell_execution_server_poll_breaker_state', 'PendingCommand circuit breaker state: 0 closed, 1 half-open, 2 open', lambda: STATE_VALUES[self._poll_controller.state()]),
+            ('cloudshell_execution_server_poll_timeout_seconds', 'PendingCommand request timeout', self._poll_controller.request_timeout),
+        ]:
+            m.gauge(name, help, ('server',)).set_function(fn, labels)
+
+    def _on_poll_state_change(self, state):
+        self._poll_breaker_transitions.inc((self._server_name, state))
+        if state == OPEN:
+            self._logger.warning('Pausing poll: %s' % self._poll_controller.stats()['reason'])
+        elif state == HALF_OPEN:
+            self._logger.info('Probing CloudShell with one poll')
+        else:
+            self._logger.info('CloudShell answered a poll, resuming poll')
+
+    def _send_status(self):
+        """
+        :return: bool : False when no executions are running, so the heartbeat can back off
+        """
+        execution_ids = list(self._execution_ids)
+        try:
+            self._result_reporter.throttle()
+            self._request('post', '/API/Execution/Status',
+                          data=json.dumps({
+                              'Name': self._server_name,
+                              'ExecutionIds': execution_ids,
+                          }))
+        except Exception as e:
+            self._logger.warning(str(e))
+        return bool(execution_ids)
 
     def _command_poll_thread(self):
         while self._running:
+            if self._queue_full_policy == 'block' and not self._worker_pool.has_capacity():
+                self._logger.info('All %d workers busy and queue full, pausing poll' % self._server_capacity)
+                while self._running and not self._worker_pool.wait_for_capacity(1):
+                    pass
+                continue
+            if not self._poll_controller.wait(self._stop_event):
+                continue
+            t0 = time.time()
             try:
                 self._logger.info('Poll...')
 
                 code, body = self._request('delete', '/API/Execution/PendingCommand',
                                   data=json.dumps({
                                       'Name': self._server_name,
-                                  }))
+                                  }),
+                                  tag=self,
+                                  timeout=self._poll_controller.request_timeout())
                 self._logger.info('Poll returned')
-            except Exception as e:
-                self._logger.warn('%s: Sleeping 30 seconds to wait for CloudShell to recover...' % str(e))
-                sleep(30)
+                o = json.loads(body) if code != 204 and body else None
+            except RequestInterrupted:
+                self._poll_controller.poll_cancelled()
                 continue
-
-            if code == 204:
+            except Exception as e:
+                self._poll_seconds.observe(time.time() - t0, (self._server_name, 'error'))
+                if not self._running:
+                    self._poll_controller.poll_cancelled()
+                    continue
+                delay = self._poll_controller.poll_failed(time.time() - t0, e)
+                self._logger.warning('%s: Polling again in %.1f seconds' % (str(e), delay))
                 continue
 
-            o = json.loads(body)
+            self._poll_seconds.observe(time.time() - t0, (self._server_name, 'command' if o else 'empty'))
+            self._poll_controller.poll_succeeded(time.time() - t0, bool(o))
             if not o:
                 continue
 
-            self._logger.debug('command request %s' % o)
+            self._logger.debug('command request %s', o)
             command_type = o['Type']
             execution_id = o['ExecutionId']
+            self._commands_total.inc((self._server_name, command_type))
+            with self._stats_lock:
+                self._dispatched += 1
             if command_type == 'startExecution':
-                resid = o.get('ReservationId', '')
-                if resid:
-                    _, reservation_json = self._request('get', '/API/Execution/Reservations/%s' % resid)
-                else:
-                    reservation_json = ''
-
-                th = threading.Thread(target=self._command_worker_thread, args=(
-                    o.get('TestPath', ''),
-                    o.get('TestArguments', ''),
-                    execution_id,
-                    o.get('UserName', ''),
-                    resid,
-                    reservation_json
-                ))
-                th.daemon = True
-                th.start()
+                self._execution_ids.add(execution_id)
+                with self._stop_lock:
+                    self._running_ids.add(execution_id)
+                self._journal_record(ACCEPTED, execution_id)
+                if not self._worker_pool.submit(self._command_worker_thread, args=(
+                        o.get('TestPath', ''),
+                        o.get('TestArguments', ''),
+                        execution_id,
+                        o.get('UserName', ''),
+                        o.get('ReservationId', ''),
+                ), block=self._queue_full_policy == 'block', stop_event=self._stop_event):
+                    self._finish_running(execution_id)
+                    if not self._running:
+                        self._logger.warning('Rejecting execution %s: server stopping' % execution_id)
+                        self._submit_result(execution_id, ErrorCommandResult('Server stopping', 'Execution server %s stopped before the execution could start' % self._server_name))
+                    else:
+                        self._logger.warning('Rejecting execution %s: all %d workers busy and queue full' % (execution_id, self._server_capacity))
+                        self._submit_result(execution_id, ErrorCommandResult('Server busy', 'Execution server %s has no free workers' % self._server_name))
             elif command_type == 'stopExecution':
-                self._stopped_ids.add(execution_id)
-                self._command_handler.stop_command(execution_id, self._logger)
-                self._request('put', '/API/Execution/FinishedExecution',
-                              data=json.dumps({
-                                  'Name': self._server_name,
-                                  'ExecutionId': execution_id,
-                                  'Result': 'Stopped',
-                              }))
+                with self._stop_lock:
+                    running = execution_id in self._running_ids
+                    if running:
+                        self._stopped_ids.add(execution_id)
+                if not running:
+                    # Its result has been reported already
+                    self._logger.info('Ignoring stop command for execution %s, which is not running' % execution_id)
+                elif not self._reply_pool.submit(self._stop_execution, args=(execution_id,), block=True, stop_event=self._stop_event):
+                    # Stopping the server: the execution reports its own result
+                    with self._stop_lock:
+                        self._stopped_ids.discard(execution_id)
             elif command_type == 'updateFiles':
-                # Must send this response or the execution server will be disabled
-                self._request('post', '/API/Execution/UpdateFilesEnded',
-                              data=json.dumps({
-                                  'Name': self._server_name,
-                                  'ErrorMessage': ''
-                              }))
-
-    def _command_worker_thread(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json):
-        self._execution_ids.add(execution_id)
-        try:
-            self._logger.info(
-                'Executing test_path=%s test_arguments=%s execution_id=%s username=%s reservation_id=%s reservation_json=%s' % (
-                    test_path, test_arguments, execution_id, username, reservation_id, reservation_json))
-            result = self._command_handler.execute_command(test_path, test_arguments, execution_id, username, reservation_id, reservation_json, self._logger)
-        except Exception as ek:
+                self._reply_pool.submit(self._update_files_ended, block=True, stop_event=self._stop_event)
+
+    def _stop_execution(self, execution_id):
+        reattached = self._reattached.get(execution_id)
+        if reattached is not None:
+            pid, start_time = reattached
+            if self._process_group_alive(pid, start_time):
+                self._logger.info('Stopping reattached execution %s, process group %d' % (execution_id, pid))
+                try:
+                    os.killpg(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        else:
+            with self._handler_lock:
+                command_handler = self._execution_handlers.get(execution_id, self._command_handler)
+            command_handler.stop_command(execution_id, self._logger)
+        self._submit_result(execution_id, StoppedCommandResult())
+
+    def _finish_running(self, execution_id):
+        """
+        Marks an execution as having a result, so a stop command arriving from now on is ignored
+
+        :return: bool : False if a stop command arrived before, and _stop_execution() reports the execution as stopped instead
+        """
+        with self._stop_lock:
+            self._running_ids.discard(execution_id)
             if execution_id in self._stopped_ids:
-                self._stopped_ids.remove(execution_id)
+                self._stopped_ids.discard(execution_id)
+                return False
+            return True
+
+    def _submit_result(self, execution_id, result):
+        self._journal_record(FINISHED, execution_id, result={
+            'Result': result.result,
+            'ErrorName': result.error_name,
+            'ErrorDescription': result.error_description,
+        })
+        self._result_reporter.submit(execution_id, result)
+
+    def _journal_record(self, event, execution_id, **fields):
+        if self._journal:
+            try:
+                self._journal.record(event, execution_id, **fields)
+            except Exception as e:
+                self._logger.error('Failed to journal %s for execution %s: %s' % (event, execution_id, str(e)))
+
+    def _recover(self, live):
+        """
+        Deals with executions that were in flight when the previous run ended: results not yet reported are sent again,
+        executions whose process group is still running are reattached, and the rest are reported as interrupted
+        """
+        if live:
+            self._logger.info('Recovering %d executions from journal' % len(live))
+        for execution_id, state in live.items():
+            if state['state'] == FINISHED:
+                if self._result_spool_directory:
+                    # The result reporter resends its own spooled copy, including the report
+                    continue
+                result = CommandResult()
+                r = state.get('result') or {}
+                result.result = r.get('Result', 'Error')
+                result.error_name = r.get('ErrorName', '')
+                result.error_description = r.get('ErrorDescription', '')
+                self._execution_ids.add(execution_id)
+                self._result_reporter.submit(execution_id, result)
+                continue
+            pid = state.get('pid')
+            start_time = state.get('start_time')
+            if pid and hasattr(os, 'killpg') and self._process_group_alive(pid, start_time):
+                self._logger.info('Reattaching to execution %s, process group %d' % (execution_id, pid))
+                self._execution_ids.add(execution_id)
+                with self._stop_lock:
+                    self._running_ids.add(execution_id)
+                self._reattached[execution_id] = (pid, start_time)
+                th = threading.Thread(target=self._reattached_execution_thread, args=(execution_id, pid, start_time))
+                th.daemon = True
+                th.start()
+            else:
+                self._execution_ids.add(execution_id)
+                self._submit_result(execution_id, ErrorCommandResult('Execution interrupted',
+                                                                     'Execution server %s restarted while the execution was running' % self._server_name))
+        if self._journal:
+            self._journal.compact()
+
+    @staticmethod
+    def _process_group_alive(pgid, start_time=None):
+        """
+        :param pgid: int : Process group id, the pid of its leader
+        :param start_time: int : Journalled process_start_time() of the leader, None to only check that the group exists
+        :return: bool : True if the group exists and is the one journalled, not a new group whose leader reused the pid
+        """
+        try:
+            os.killpg(pgid, 0)
+        except OSError:
+            return False
+        if start_time is None:
+            return True
+        # A pid is not reused while a process group of that id exists, so once the leader is gone the group is still ours
+        leader_start_time = process_start_time(pgid)
+        return leader_start_time is None or leader_start_time == start_time
+
+    def _reattached_execution_thread(self, execution_id, pid, start_time):
+        while self._process_group_alive(pid, start_time):
+            if self._stop_event.wait(1):
+                # Picked up again from the journal when the server restarts
                 return
+        self._reattached.pop(execution_id, None)
+        if not self._finish_running(execution_id):
+            return
+        # The exit code of a process that is not our child can't be collected, and its output pipe went with the old server
+        result = ErrorCommandResult('Reattached, outcome unknown',
+                                    'Execution server %s restarted while the execution was running. It has finished, but its result and output could not be collected.' % self._server_name)
+        self._logger.info('Reattached execution %s finished: %s' % (execution_id, result))
+        self._submit_result(execution_id, result)
+
+    def _update_files_ended(self):
+        # Must send this response or the execution server will be disabled
+        self._request('post', '/API/Execution/UpdateFilesEnded',
+                      data=json.dumps({
+                          'Name': self._server_name,
+                          'ErrorMessage': ''
+                      }))
+
+    def _fetch_reservation(self, reservation_id):
+        _, reservation_json = self._request('get', '/API/Execution/Reservations/%s' % reservation_id)
+        return reservation_json
+
+    def _send_finished(self, execution_id, payload):
+        payload = dict(payload)
+        payload['Name'] = self._server_name
+        self._request('put', '/API/Execution/FinishedExecution', data=json.dumps(payload))
+
+    def _send_report(self, execution_id, report_filename, report_mime_type, report_data):
+        body, length, close = open_report_body(report_data)
+        headers = {
+            'Accept': 'application/json',
+            'Content-Type': report_mime_type,
+        }
+        try:
+            if self._report_compression:
+                report_filename, headers['Content-Type'], body, length, extra_headers = self._report_compression.compress_body(
+                    report_filename, report_mime_type, body, length, on_done=self._observe_compression)
+                headers.update(extra_headers)
+            if length is None:
+                body = self._counted_chunks(body)
+            else:
+                self._report_bytes.observe(length, self._labels)
+            if self._report_bandwidth is not None:
+                body = self._throttled_chunks(body)
+            t0 = time.time()
+            self._request('post', '/API/Execution/ExecutionReport/%s/%s/%s' % (quote(self._server_name),
+                                                                               execution_id,
+                                                                               quote(report_filename)),
+                          headers=headers,
+                          data=body,
+                          content_length=length)
+            self._report_upload_seconds.observe(time.time() - t0, self._labels)
+        finally:
+            close()
+
+    def _throttled_chunks(self, body):
+        if isinstance(body, bytes):
+            chunks = (body[i:i + 65536] for i in range(0, len(body), 65536))
+        else:
+            chunks = iter_body_chunks(body)
+        for chunk in chunks:
+            self._report_bandwidth.acquire(tokens=len(chunk))
+            yield chunk
+
+    def _on_artifact(self, execution_id, name, size, outcome):
+        self._artifacts_total.inc((self._server_name, outcome))
+
+    def _on_dedup(self, execution_id, name, hit, bytes_saved):
+        self._report_dedup_total.inc((self._server_name, 'hit' if hit else 'miss'))
+        if bytes_saved:
+            self._report_dedup_bytes_saved.inc(self._labels, bytes_saved)
+
+    def _observe_compression(self, uncompressed_bytes, compressed_bytes):
+        self._report_compression_bytes.inc((self._server_name, 'uncompressed'), uncompressed_bytes)
+        self._report_compression_bytes.inc((self._server_name, 'compressed'), compressed_bytes)
+
+    def _counted_chunks(self, body):
+        n = 0
+        for chunk in iter_body_chunks(body):
+            n += len(chunk)
+            yield chunk
+        self._report_bytes.observe(n, self._labels)
+
+    def _on_result_reported(self, execution_id, sent):
+        # Executions are listed in the status heartbeat until CloudShell has their result
+        self._execution_ids.discard(execution_id)
+        self._journal_record(REPORTED, execution_id)
+
+    def _command_worker_thread(self, test_path, test_arguments, execution_id, username, reservation_id):
+        reported = False
+        try:
+            reported = self._run_execution(test_path, test_arguments, execution_id, username, reservation_id)
+        finally:
+            if not reported:
+                self._finish_running(execution_id)
+                self._execution_ids.discard(execution_id)
+
+    def _run_execution(self, test_path, test_arguments, execution_id, username, reservation_id):
+        """
+        :return: bool : True if the execution's result has been submitted, by this or by _stop_execution()
+        """
+        with self._stop_lock:
+            stopped = execution_id in self._stopped_ids
+        if stopped:
+            # Stopped while waiting for a worker, and reported as such
+            self._finish_running(execution_id)
+            return True
+        self._journal_record(RUNNING, execution_id)
+        with self._stats_lock:
+            if self._first_execution_latency is None and self._start_time is not None:
+                self._first_execution_latency = time.time() - self._start_time
+        try:
+            if reservation_id:
+                reservation_json = self._reservation_cache.get(reservation_id)
             else:
+                reservation_json = ''
+        except Exception as er:
+            result = ErrorCommandResult('Reservation lookup failed', '%s: %s' % (str(er), traceback.format_exc()))
+        else:
+            t0 = time.time()
+            command_handler = self._acquire_handler(execution_id)
+            try:
+                self._logger.info(
+                    'Executing test_path=%s test_arguments=%s execution_id=%s username=%s reservation_id=%s reservation_json=%s' % (
+                        test_path, test_arguments, execution_id, username, reservation_id, reservation_json))
+                result = command_handler.execute_command(test_path, test_arguments, execution_id, username, reservation_id, reservation_json, self._logger)
+                self._execution_seconds.observe(time.time() - t0, (self._server_name, getattr(result, 'result', 'Error')))
+            except Exception as ek:
+                self._execution_seconds.observe(time.time() - t0, (self._server_name, 'Stopped' if execution_id in self._stopped_ids else 'Error'))
                 result = ErrorCommandResult('Unhandled Python exception', '%s: %s' % (str(ek), traceback.format_exc()))
+            finally:
+                self._release_handler(execution_id)
+
+        if not self._finish_running(execution_id):
+            # _stop_execution() reports it as stopped, whatever execute_command() returned
+            return True
 
         if not result:
             result = ErrorCommandResult('Internal error', 'CustomExecutionServerCommandHandler.execute_command() should return a CommandResult object or throw an exception')
 
-        self._logger.info('Result for execution %s: %s' % (execution_id, result))
-        try:
-            self._request('put', '/API/Execution/FinishedExecution',
-                          data=json.dumps({
-                              'Name': self._server_name,
-                              'ExecutionId': execution_id,
-                              'Result': result.result,
-                              'ErrorDescription': result.error_description,
-                              'ErrorName': result.error_name,
-                          }))
-            if result.report_filename:
-                self._request('post', '/API/Execution/ExecutionReport/%s/%s/%s' % (quote(self._server_name),
-                                                                                   execution_id,
-                                                                                   quote(result.report_filename)),
-                              headers={
-                                  'Accept': 'application/json',
-                                  'Content-Type': result.report_mime_type,
-                              },
-                              data=bytes23(result.report_data))
-        finally:
-            self._execution_ids.remove(execution_id)
+        self._logger.info('Result for execution %s: %s', execution_id, result)
+        self._observe_usage(getattr(result, 'resource_usage', None))
+        self._submit_result(execution_id, result)
+        return True
+
+    def _acquire_handler(self, execution_id):
+        with self._handler_lock:
+            command_handler = self._command_handler
+            self._execution_handlers[execution_id] = command_handler
+            return command_handler
+
+    def _release_handler(self, execution_id):
+        with self._handler_lock:
+            command_handler = self._execution_handlers.pop(execution_id, None)
+            drained = self._draining_handlers.get(id(command_handler))
+            if drained is None or any(h is command_handler for h in self._execution_handlers.values()):
+                return
+            del self._draining_handlers[id(command_handler)]
+        self._handler_drained(*drained)
 
-    def _request(self, method, path, data=None, headers=None, hide_result=False, **kwargs):
+    def _handler_drained(self, command_handler, on_drained):
+        self._logger.info('Previous command handler %s has no more running executions' % command_handler.__class__.__name__)
+        try:
+            on_drained()
+        except Exception as e:
+            self._logger.error('Cleaning up previous command handler failed: %s: %s' % (str(e), traceback.format_exc()))
+
+    def _observe_usage(self, usage):
+        if usage is None:
+            return
+        if usage.user_seconds is not None:
+            self._execution_cpu_seconds.observe(usage.user_seconds + usage.system_seconds, self._labels)
+        if usage.max_rss_bytes is not None:
+            self._execution_max_rss_bytes.observe(usage.max_rss_bytes, self._labels)
+        if usage.in_blocks is not None:
+            self._execution_io_blocks.inc((self._server_name, 'in'), usage.in_blocks)
+            self._execution_io_blocks.inc((self._server_name, 'out'), usage.out_blocks)
+
+    def _request(self, method, path, data=None, headers=None, hide_result=False, content_length=None, tag=None, timeout=None,
+                 authenticate=True, retry_auth=True, **kwargs):
         if sys.version_info.major == 3:
             counter = self._counter.__next__()
         else:
@@ -441,42 +1072,72 @@ class CustomExecutionServer:
                 'Accept': 'application/json',
                 'Content-Type': 'application/json',
             }
-        if self._token:
-            headers['Authorization'] = 'Basic ' + self._token
+        token = self._session.ensure_login(self._login) if authenticate else None
+        if token:
+            headers['Authorization'] = 'Basic ' + token
 
-        if path.startswith('/'):
-            path = path[1:]
+        if not path.startswith('/'):
+            path = '/' + path
 
-        url = 'http://%s:%d/%s' % (self._cloudshell_host, self._cloudshell_port, path)
+        url = 'http://%s:%d%s' % (self._cloudshell_host, self._cloudshell_port, path)
 
         if sys.version_info.major == 2:
-            if isinstance(url, unicode):
-                url = url.encode('ascii')
+            if isinstance(path, unicode):
+                path = path.encode('ascii')
             headers = dict((k.encode('ascii') if isinstance(k, unicode) else k,
                             v.encode('ascii') if isinstance(v, unicode) else v)
                            for k, v in headers.items())
 
-        pdata = string23ppbinary(data)
-        pdata = re.sub(r':[^@]*@', ':(password hidden)@', pdata)
-        pdata = re.sub(r'"Password":\s*"[^"]*"', '"Password": "(password hidden)"', pdata)
-        pheaders = dict(headers)
-        if 'Authorization' in pheaders:
-            pheaders['Authorization'] = '(token hidden)'
-
-        self._logger.debug('Request %d: %s %s headers=%s data=<<<%s>>>' % (counter, method, url, pheaders, pdata))
-
-        request = Request(url, bytes23(data), headers)
-        request.get_method = lambda: method.upper()
-        response = urlopen(request)
-        body = response.read()
-        code = response.getcode()
-        response.close()
+        self._request_log.request(counter, method, url, headers, data, content_length)
+        streamed = is_streamed_report_data(data)
+        if data is not None and not streamed:
+            data = bytes23(data)
 
-        if hide_result:
-            self._logger.debug('Result %d: %d: (hidden)' % (counter, code))
-        else:
-            self._logger.debug('Result %d: %d: %s' % (counter, code, string23ppbinary(body)))
+        parts = path.split('?')[0].split('/')
+        endpoint = parts[3] if len(parts) > 3 else path
+        t0 = time.time()
+        try:
+            code, body = self._connection_pool.request(self._cloudshell_host, self._cloudshell_port, method, path,
+                                                       body=data,
+                                                       headers=headers,
+                                                       content_length=content_length,
+                                                       tag=tag,
+                                                       timeout=timeout)
+        except RequestInterrupted:
+            raise
+        except Exception:
+            self._request_seconds.observe(time.time() - t0, (self._server_name, endpoint, 'error'))
+            raise
+        self._request_seconds.observe(time.time() - t0, (self._server_name, endpoint, str(code)))
+
+        self._request_log.response(counter, code, body, hide_result)
+
+        if code == 401 and token and retry_auth:
+            # The token expired or CloudShell restarted
+            self._auth_rejected.inc(self._labels)
+            self._logger.info('CloudShell rejected the auth token, logging in again')
+            self._session.relogin(self._login, token)
+            if not streamed:
+                return self._request(method, path, data=data, headers=headers, hide_result=hide_result, content_length=content_length,
+                                     tag=tag, timeout=timeout, retry_auth=False)
+            # A streamed body has been consumed, so the caller retries it with the new token
 
         if code >= 400:
-            raise Exception('Error: %d: %s' % (code, string23ppbinary(body)))
+            try:
+                message = string23(body)
+            except:
+                message = string23ppbinary(body)
+            raise CloudShellApiError(code, message)
         return code, string23(body)
+
+    def session_stats(self):
+        """
+        :return: dict : Token age and login counters of the session, which may be shared with other servers
+        """
+        return self._session.stats()
+
+    def connection_stats(self):
+        """
+        :return: dict : Counters of CloudShell API connections opened and reused
+        """
+        return self._connection_pool.stats()
@@ -1,21 +1,33 @@
+import logging
 import os
 import signal
 import time
+import traceback
 
 
-def become_daemon_and_wait(on_start, on_exit, exit_signal=signal.SIGTERM):
+def become_daemon_and_wait(on_start, on_exit, exit_signal=signal.SIGTERM, on_reload=None, reload_signal=getattr(signal, 'SIGHUP', None), logger=None):
     """
     Detaches from the terminal and sleeps in the main thread until the exit signal is received
 
     :param on_start: function with no arguments that starts the service threads
     :param on_exit: function with no arguments that stops the service threads (does not need to exit the process)
     :param exit_signal: signal that will trigger shutdown, by default SIGTERM
+    :param on_reload: function with no arguments that re-reads the configuration while the service keeps running, called from the main thread when the reload signal is received. None to ignore the reload signal.
+    :param reload_signal: signal that will trigger on_reload, by default SIGHUP
+    :param logger: logging.Logger : Logs an exception raised by on_reload, by default the logger of this module
     :return:
     """
+    logger = logger or logging.getLogger(__name__)
+    reload_requested = []
+
     def handler0(signum, frame):
         on_exit()
         os._exit(0)
 
+    def reload_handler(signum, frame):
+        # Only flag it: on_reload takes locks that the interrupted code may hold
+        reload_requested.append(signum)
+
     signal.signal(exit_signal, handler0)
 
     try:
@@ -35,5 +47,34 @@ def become_daemon_and_wait(on_start, on_exit, exit_signal=signal.SIGTERM):
 
     on_start()
 
+    if on_reload is None:
+        while True:
+            time.sleep(60)
+
+    # Installed after detaching, so the hangup of the terminal the server was started from can't trigger a reload
+    signal.signal(reload_signal, reload_handler)
     while True:
-        time.sleep(60)
+        time.sleep(1)
+        if reload_requested:
+            del reload_requested[:]
+            try:
+                on_reload()
+            except Exception as e:
+                logger.error('Reload failed: %s: %s' % (str(e), traceback.format_exc()))
+
+
+def reopen_log_files(logger):
+    """
+    Reopens the files of the logger's file handlers, e.g. after logrotate moved them away or their directory changed
+
+    :param logger: logging.Logger
+    """
+    for handler in logger.handlers:
+        if isinstance(handler, logging.FileHandler):
+            handler.acquire()
+            try:
+                if handler.stream:
+                    handler.stream.close()
+                handler.stream = handler._open()
+            finally:
+                handler.release()
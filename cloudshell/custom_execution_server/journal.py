@@ -0,0 +1,173 @@
+import json
+import os
+import threading
+import time
+
+
+# os.rename() can't replace an existing file on Windows, and Python 2 has no os.replace()
+replace_file = getattr(os, 'replace', os.rename)
+
+
+ACCEPTED = 'accepted'
+RUNNING = 'running'
+PROCESS = 'process'
+FINISHED = 'finished'
+REPORTED = 'reported'
+
+
+def process_start_time(pid):
+    """
+    Start time of a process, to tell it apart from a later process that was given the same pid
+
+    :param pid: int
+    :return: int : Clock ticks after boot the process started at (field 22 of /proc/<pid>/stat), None if there is no such process or no /proc
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            stat = f.read()
+        # The command name in parentheses may contain spaces, so count fields from after it
+        return int(stat[stat.rindex(')') + 2:].split()[19])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class ExecutionJournal:
+    """
+    Append-only file of execution state changes, replayed after a restart to recover executions that were in flight
+
+    Each line is a JSON record {"t": time, "e": event, "id": execution_id, ...}. An execution is live from its
+    'accepted' record until its 'reported' record. Compaction rewrites the file with only the live executions.
+    """
+    def __init__(self, path, logger, fsync='interval', fsync_interval=1.0, compact_every=1000):
+        """
+        :param path: str : Journal file, created if missing
+        :param logger: logging.Logger
+        :param fsync: str : 'always' to fsync every record, 'interval' to fsync at most every fsync_interval seconds, 'never' to leave it to the OS.
+            Records are flushed to the OS immediately in every mode, so only a host crash can lose unsynced records.
+        :param fsync_interval: float : Seconds between fsyncs in 'interval' mode
+        :param compact_every: int : Compact after this many records have been appended
+        """
+        if fsync not in ('always', 'interval', 'never'):
+            raise Exception('fsync must be always, interval or never, not %s' % fsync)
+        self._path = path
+        self._logger = logger
+        self._fsync = fsync
+        self._fsync_interval = fsync_interval
+        self._compact_every = compact_every
+        self._lock = threading.Lock()
+        self._live = {}
+        self._file = None
+        self._appended = 0
+        self._last_fsync = 0
+
+    def open(self):
+        """
+        Loads the existing journal and opens it for appending
+
+        :return: dict : execution_id -> state of every execution that was live when the previous run ended.
+            The state is a dict with 'state' (accepted, running or finished) and, if recorded, 'pid', its 'start_time' from
+            process_start_time() and the finished 'result'.
+        """
+        directory = os.path.dirname(self._path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._lock:
+            self._live = self._load()
+            self._rewrite()
+            return dict((k, dict(v)) for k, v in self._live.items())
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._rewrite()
+                self._file.close()
+                self._file = None
+
+    def record(self, event, execution_id, **fields):
+        """
+        :param event: str : ACCEPTED, RUNNING, PROCESS, FINISHED or REPORTED
+        :param execution_id: str
+        :param fields: Extra JSON-serializable fields, e.g. pid=1234 and start_time=... for PROCESS, result={...} for FINISHED
+        """
+        record = dict(fields)
+        record['t'] = time.time()
+        record['e'] = event
+        record['id'] = execution_id
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            if self._file is None:
+                return
+            self._apply(self._live, record)
+            self._file.write(line)
+            self._file.flush()
+            now = time.time()
+            if self._fsync == 'always' or (self._fsync == 'interval' and now - self._last_fsync >= self._fsync_interval):
+                os.fsync(self._file.fileno())
+                self._last_fsync = now
+            self._appended += 1
+            if self._appended >= self._compact_every:
+                self._rewrite()
+
+    def compact(self):
+        with self._lock:
+            if self._file is not None:
+                self._rewrite()
+
+    def live_count(self):
+        with self._lock:
+            return len(self._live)
+
+    @staticmethod
+    def _apply(live, record):
+        event = record['e']
+        execution_id = record['id']
+        if event == REPORTED:
+            live.pop(execution_id, None)
+            return
+        state = live.setdefault(execution_id, {'state': ACCEPTED})
+        if event == PROCESS:
+            state['pid'] = record.get('pid')
+            state['start_time'] = record.get('start_time')
+        elif event in (RUNNING, FINISHED):
+            state['state'] = event
+            if event == FINISHED:
+                state['result'] = record.get('result')
+                state.pop('pid', None)
+                state.pop('start_time', None)
+
+    def _load(self):
+        live = {}
+        if not os.path.exists(self._path):
+            return live
+        with open(self._path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash mid-write
+                    self._logger.warning('Ignoring corrupt journal line in %s' % self._path)
+                    continue
+                self._apply(live, record)
+        return live
+
+    def _rewrite(self):
+        """
+        Atomically replaces the journal with one record per live execution state
+        """
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w') as f:
+            for execution_id, state in self._live.items():
+                f.write(json.dumps({'t': time.time(), 'e': ACCEPTED, 'id': execution_id}) + '\n')
+                if 'pid' in state:
+                    f.write(json.dumps({'t': time.time(), 'e': PROCESS, 'id': execution_id, 'pid': state['pid'],
+                                        'start_time': state.get('start_time')}) + '\n')
+                if state['state'] != ACCEPTED:
+                    f.write(json.dumps({'t': time.time(), 'e': state['state'], 'id': execution_id, 'result': state.get('result')}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if self._file is not None:
+            self._file.close()
+        replace_file(tmp, self._path)
+        self._file = open(self._path, 'a')
+        self._appended = 0
+        self._last_fsync = time.time()
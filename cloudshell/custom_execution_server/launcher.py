@@ -0,0 +1,197 @@
+"""
+Pre-forked process launcher, started by LauncherBackend as a separate small single-threaded Python process
+
+It forks cheaply because its memory is small and it has no other threads, so it is safe to fork. The protocol
+runs over a Unix socket, one JSON object per line:
+
+    request  {"id": 1, "argv": [...], "env": {...}, "cwd": "/dir" or null, "rlimits": {"RLIMIT_CPU": 60} or null}
+    reply    {"id": 1, "pid": 1234}, with the read end of the child's output pipe attached as SCM_RIGHTS
+             {"id": 1, "error": "...", "errno": 2} if the command could not be started
+    exit     {"exit": 1234, "status": <raw wait status>, "rusage": {...}}, once per child
+
+Each child runs in its own session, so its process group id equals its pid.
+
+Only uses the standard library, so it can run as a script without the package on sys.path:
+
+    python launcher.py <socket fd>
+"""
+import array
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import sys
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _send(sock, message, fds=()):
+    data = (json.dumps(message) + '\n').encode('utf-8')
+    if fds:
+        sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+    else:
+        sock.sendall(data)
+
+
+def rusage_dict(rusage):
+    return {
+        'utime': rusage.ru_utime,
+        'stime': rusage.ru_stime,
+        'maxrss': rusage.ru_maxrss,
+        'inblock': rusage.ru_inblock,
+        'oublock': rusage.ru_oublock,
+    }
+
+
+class _Launcher:
+    def __init__(self, sock):
+        self._sock = sock
+        # Error pipe -> [request id, pid, output pipe, error bytes] of children that haven't exec'd yet
+        self._starting = {}
+        # Exits of children whose spawn hasn't been replied to yet
+        self._held_exits = {}
+
+    def spawn(self, request):
+        if hasattr(os, 'posix_spawn') and not request.get('cwd') and not request.get('rlimits'):
+            self._posix_spawn(request)
+            return
+        r, w = os.pipe()
+        err_r, err_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # Ignored signals would stay ignored after exec
+                for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGCHLD):
+                    signal.signal(signum, signal.SIG_DFL)
+                os.setsid()
+                for name, value in (request.get('rlimits') or {}).items():
+                    resource.setrlimit(getattr(resource, name), (value, value))
+                if request.get('cwd'):
+                    os.chdir(request['cwd'])
+                os.dup2(w, 1)
+                os.dup2(w, 2)
+                os.execvpe(request['argv'][0], request['argv'], request.get('env') or {})
+            except OSError as e:
+                os.write(err_w, ('%d:%s' % (e.errno or 0, e.strerror or str(e))).encode('utf-8'))
+            except BaseException as e:
+                os.write(err_w, ('0:%s' % str(e)).encode('utf-8'))
+            os._exit(127)
+        os.close(w)
+        os.close(err_w)
+        # The error pipe is close-on-exec: EOF without data means the exec succeeded. Other spawns go ahead
+        # while this one is exec'ing.
+        self._starting[err_r] = [request['id'], pid, r, b'']
+
+    def _posix_spawn(self, request):
+        # Much faster than os.fork() followed by Python code in the child, and reports exec errors itself.
+        # posix_spawnp searches the launcher's PATH, so search the command's own PATH like execvpe does.
+        env = request.get('env') or {}
+        argv = request['argv']
+        path = argv[0]
+        if not os.path.dirname(path):
+            for directory in os.get_exec_path(env):
+                candidate = os.path.join(directory, path)
+                if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                    path = candidate
+                    break
+        r, w = os.pipe()
+        try:
+            pid = os.posix_spawn(path, argv, env,
+                                 file_actions=[(os.POSIX_SPAWN_DUP2, w, 1), (os.POSIX_SPAWN_DUP2, w, 2)],
+                                 setsid=True, setsigdef=(signal.SIGINT, signal.SIGTERM, signal.SIGCHLD))
+        except OSError as e:
+            os.close(r)
+            _send(self._sock, {'id': request['id'], 'error': e.strerror or str(e), 'errno': e.errno or 0})
+            return
+        finally:
+            os.close(w)
+        _send(self._sock, {'id': request['id'], 'pid': pid}, [r])
+        os.close(r)
+
+    def error_pipes(self):
+        return list(self._starting)
+
+    def read_error_pipe(self, err_r):
+        entry = self._starting[err_r]
+        chunk = os.read(err_r, 4096)
+        if chunk:
+            entry[3] += chunk
+            return
+        del self._starting[err_r]
+        os.close(err_r)
+        request_id, pid, r, err = entry
+        if err:
+            os.close(r)
+            code, _, message = err.decode('utf-8', 'replace').partition(':')
+            _send(self._sock, {'id': request_id, 'error': message, 'errno': int(code)})
+            self._held_exits.pop(pid, None)
+            return
+        _send(self._sock, {'id': request_id, 'pid': pid}, [r])
+        os.close(r)
+        held = self._held_exits.pop(pid, None)
+        if held is not None:
+            _send(self._sock, held)
+
+    def reap(self):
+        starting_pids = set(entry[1] for entry in self._starting.values())
+        while True:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            message = {'exit': pid, 'status': status, 'rusage': rusage_dict(rusage)}
+            if pid in starting_pids:
+                self._held_exits[pid] = message
+            else:
+                _send(self._sock, message)
+
+
+def main(fd):
+    # Inherited through pass_fds; children must not keep it open, or the server would not notice this process dying
+    os.set_inheritable(fd, False)
+    sock = socket.socket(fileno=fd)
+    launcher = _Launcher(sock)
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    # The server handles SIGINT and SIGTERM; this process ends when the server closes the socket
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    buf = b''
+    while True:
+        try:
+            readable, _, _ = select.select([sock, wake_r] + launcher.error_pipes(), [], [])
+        except (OSError, select.error):
+            # Interrupted by SIGCHLD on Pythons that don't retry
+            readable = [wake_r]
+        for fd in readable:
+            if fd not in (sock, wake_r):
+                launcher.read_error_pipe(fd)
+        if wake_r in readable:
+            try:
+                os.read(wake_r, 4096)
+            except OSError:
+                pass
+        if sock in readable:
+            data = sock.recv(65536)
+            if not data:
+                return
+            buf += data
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                launcher.spawn(json.loads(line.decode('utf-8')))
+        launcher.reap()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]))
@@ -0,0 +1,298 @@
+import bisect
+import sys
+import threading
+
+if sys.version_info.major == 2:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+DURATION_BUCKETS = (0.1, 1, 5, 10, 30, 60, 300, 600, 1800, 3600, 7200, 14400, 43200, 86400)
+SIZE_BUCKETS = (1024, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864, 268435456, 1073741824)
+
+
+def _format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    if v == int(v):
+        return '%d' % v
+    return repr(float(v))
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in pairs)
+
+
+class _Metric:
+    """
+    Base class for metrics updated without locks: each thread writes only to its own cell, and render() adds the
+    cells up. Cells of threads that have exited are folded into one so short-lived threads don't accumulate.
+    """
+    type_name = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._cells_lock = threading.Lock()
+        self._cells = []
+        self._retired = {}
+
+    def _cell(self):
+        cell = getattr(self._local, 'cell', None)
+        if cell is None:
+            cell = {}
+            self._local.cell = cell
+            with self._cells_lock:
+                self._cells.append((threading.current_thread(), cell))
+        return cell
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise Exception('%s takes labels %s, got %s' % (self.name, self.labelnames, labels))
+        return tuple(labels)
+
+    def _merge(self, total, key, value):
+        raise NotImplementedError()
+
+    def _collect(self):
+        """
+        :return: dict : labels tuple -> value summed over all threads
+        """
+        with self._cells_lock:
+            live = []
+            for thread, cell in self._cells:
+                if thread.is_alive():
+                    live.append((thread, cell))
+                else:
+                    for key, value in list(cell.items()):
+                        self._merge(self._retired, key, value)
+            self._cells = live
+            total = {}
+            for key, value in self._retired.items():
+                self._merge(total, key, value)
+            for _, cell in live:
+                while True:
+                    try:
+                        items = list(cell.items())
+                        break
+                    except RuntimeError:
+                        # The owning thread added a label set while we were copying
+                        pass
+                for key, value in items:
+                    self._merge(total, key, value)
+            return total
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type_name)]
+        for key, value in sorted(self._collect().items()):
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, key), _format_value(value))]
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        cell = self._cell()
+        key = self._key(labels)
+        cell[key] = cell.get(key, 0) + amount
+
+    def value(self, labels=()):
+        return self._collect().get(self._key(labels), 0)
+
+    def _merge(self, total, key, value):
+        total[key] = total.get(key, 0) + value
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        _Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        cell = self._cell()
+        key = self._key(labels)
+        counts = cell.get(key)
+        if counts is None:
+            # One count per bucket, +Inf, then sum
+            counts = [0] * (len(self.buckets) + 2)
+            cell[key] = counts
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def count(self, labels=()):
+        counts = self._collect().get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def _merge(self, total, key, value):
+        counts = total.get(key)
+        if counts is None:
+            total[key] = list(value)
+        else:
+            for i, v in enumerate(value):
+                counts[i] += v
+
+    def _render_value(self, key, counts):
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts[:-1]):
+            cumulative += n
+            lines.append('%s_bucket%s %d' % (self.name, _format_labels(self.labelnames, key, ('le', _format_value(bound))), cumulative))
+        labels = _format_labels(self.labelnames, key)
+        lines.append('%s_sum%s %s' % (self.name, labels, _format_value(counts[-1])))
+        lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+        return lines
+
+
+class Gauge(_Metric):
+    """
+    A value that is set, or read from a function at render time, rather than accumulated
+    """
+    type_name = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        _Metric.__init__(self, name, help, labelnames)
+        self._values = {}
+        self._functions = {}
+
+    def set(self, value, labels=()):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, fn, labels=()):
+        """
+        :param fn: function : fn() -> number, called on every render
+        """
+        self._functions[self._key(labels)] = fn
+
+    def remove(self, labels=()):
+        key = self._key(labels)
+        self._values.pop(key, None)
+        self._functions.pop(key, None)
+
+    def _collect(self):
+        total = dict(self._values)
+        for key, fn in list(self._functions.items()):
+            try:
+                total[key] = fn()
+            except Exception:
+                pass
+        return total
+
+
+class MetricsRegistry:
+    """
+    Named metrics rendered together in the Prometheus text exposition format
+
+    Asking for a metric that already exists returns it, so several servers can share a registry and tell their
+    values apart by a label.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._order = []
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+    def _get(self, cls, name, help, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, help, labelnames, **kwargs)
+                self._metrics[name] = metric
+                self._order.append(name)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise Exception('Metric %s already registered as %s with labels %s' % (name, metric.type_name, metric.labelnames))
+            return metric
+
+    def render(self):
+        """
+        :return: str : All metrics in the text exposition format
+        """
+        with self._lock:
+            metrics = [self._metrics[name] for name in self._order]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsServer:
+    """
+    Serves a MetricsRegistry at http://host:port/metrics
+    """
+    def __init__(self, registry, host='127.0.0.1', port=9464, logger=None):
+        """
+        :param registry: MetricsRegistry
+        :param host: str : Interface to listen on. The default only accepts local scrapers.
+        :param port: int : 0 to pick a free port, see .port after start()
+        :param logger: logging.Logger
+        """
+        self._registry = registry
+        self.host = host
+        self.port = port
+        self._logger = logger
+        self._httpd = None
+        self._thread = None
+
+    def start(self):
+        registry = self._registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = _ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='metrics')
+        self._thread.daemon = True
+        self._thread.start()
+        if self._logger:
+            self._logger.info('Serving metrics at http://%s:%d/metrics' % (self.host, self.port))
+
+    def stop(self):
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+            self._thread.join()
+            self._thread = None
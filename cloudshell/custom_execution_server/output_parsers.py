@@ -0,0 +1,334 @@
+"""
+Streaming parsers that count test results in process output as it is captured
+
+Feed them the output in blocks of any size, e.g. ProcessRunner.execute_spooled(..., parser=make_parser('tap')).
+Memory use is bounded whatever the output length: only an incomplete last line (at most max_line_size bytes) and
+the first max_failures failures are kept.
+"""
+import json
+import re
+import xml.parsers.expat
+
+
+class OutputParser:
+    """
+    Base class: counts tests and remembers the first failures
+    """
+    format = None
+
+    def __init__(self, max_failures=100, max_message_size=1024):
+        """
+        :param max_failures: int : Failed tests to list in the summary by name and message; the rest are only counted
+        :param max_message_size: int : Characters kept of each failure message
+        """
+        self._max_failures = max_failures
+        self._max_message_size = max_message_size
+        self.passed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.failures = []
+        self.bytes_parsed = 0
+        self.complete = False
+        self.parse_error = None
+
+    def feed(self, data):
+        """
+        :param data: bytes : Next block of output
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """
+        Parses whatever is left at the end of the output
+        """
+        pass
+
+    def verdict(self):
+        """
+        :return: str : 'Passed' if tests ran and none failed, otherwise 'Failed'
+        """
+        return 'Passed' if self.passed + self.skipped > 0 and not self.failed else 'Failed'
+
+    def summary(self):
+        """
+        :return: dict : Counts, verdict and the first failures
+        """
+        summary = {
+            'format': self.format,
+            'verdict': self.verdict(),
+            'total': self.passed + self.failed + self.skipped,
+            'passed': self.passed,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'failures': self.failures,
+            'failures_omitted': max(0, self.failed - len(self.failures)),
+            'complete': self.complete,
+            'bytes_parsed': self.bytes_parsed,
+        }
+        if self.parse_error:
+            summary['parse_error'] = self.parse_error
+        return summary
+
+    def summary_json(self):
+        """
+        :return: str : summary() as compact JSON, for a report next to the raw log
+        """
+        return json.dumps(self.summary(), separators=(',', ':'), sort_keys=True)
+
+    def _fail(self, name, message):
+        self.failed += 1
+        if len(self.failures) < self._max_failures:
+            self.failures.append({'name': name[:self._max_message_size], 'message': (message or '')[:self._max_message_size]})
+
+
+class _LineParser(OutputParser):
+    """
+    Base class for line oriented formats: finds result lines with one precompiled regex per block. The regexes start
+    with a literal, such as the newline before a line, so the lines in between are skipped in C.
+    """
+    pattern = None
+
+    def __init__(self, max_failures=100, max_message_size=1024, max_line_size=65536):
+        """
+        :param max_line_size: int : Longest incomplete line kept between blocks; longer lines are cut
+        """
+        OutputParser.__init__(self, max_failures, max_message_size)
+        self._max_line_size = max_line_size
+        # Unparsed rest of the output, from the newline before its first line
+        self._carry = b'\n'
+
+    def feed(self, data):
+        if not data:
+            return
+        self.bytes_parsed += len(data)
+        buf = self._carry + data
+        end = buf.rfind(b'\n') + 1
+        if end == 1:
+            self._carry = buf[-self._max_line_size:]
+            return
+        self._carry = self._scan(buf, end, False)[-self._max_line_size:]
+
+    def close(self):
+        if len(self._carry) > 1:
+            buf = self._carry + b'\n'
+            self._carry = b'\n'
+            self._scan(buf, len(buf), True)
+
+    def _scan(self, buf, end, final):
+        """
+        Handles the result lines in buf[:end], which ends with a newline
+
+        :return: bytes : Unparsed rest of buf to prepend to the next block, from the newline before it
+        """
+        for m in self.pattern.finditer(buf, 0, end):
+            self._match(buf, m)
+        return buf[end - 1:]
+
+    def _match(self, buf, m):
+        raise NotImplementedError()
+
+    @staticmethod
+    def _text(b):
+        return b.decode('utf-8', 'replace').strip() if b else ''
+
+
+class TapParser(_LineParser):
+    """
+    Test Anything Protocol: 'ok 1 - name', 'not ok 2 - name # TODO', '1..N' plan, 'Bail out!'. Indented subtests
+    are left to their parent's result line.
+    """
+    format = 'tap'
+    pattern = re.compile(br'\n(?:(not )?ok\b[ \t]*\d*[ \t]*-?[ \t]*([^\n#]*)(?:#[ \t]*((\w+)[^\n]*))?|1\.\.(\d+)|Bail out!([^\n]*))')
+
+    def __init__(self, max_failures=100, max_message_size=1024, max_line_size=65536):
+        _LineParser.__init__(self, max_failures, max_message_size, max_line_size)
+        self.planned = None
+
+    def _match(self, buf, m):
+        not_ok, name, comment, directive, plan, bail_out = m.groups()
+        if plan is not None:
+            self.planned = int(plan)
+            return
+        if bail_out is not None:
+            self._fail('Bail out!', self._text(bail_out))
+            return
+        directive = directive.upper() if directive else b''
+        if directive.startswith(b'SKIP'):
+            self.skipped += 1
+        elif directive.startswith(b'TODO'):
+            # Expected to fail, doesn't count against the run either way
+            self.skipped += 1
+        elif not_ok:
+            self._fail(self._text(name), self._text(comment))
+        else:
+            self.passed += 1
+
+    def close(self):
+        _LineParser.close(self)
+        self.complete = self.planned is not None and self.planned == self.passed + self.failed + self.skipped
+
+    def summary(self):
+        summary = _LineParser.summary(self)
+        summary['planned'] = self.planned
+        return summary
+
+
+class RobotParser(_LineParser):
+    """
+    Robot Framework console output: 'Test name   | PASS |' lines, the line after a FAIL being its message. Suite
+    status lines look the same but are followed by an 'N tests, N passed, N failed' line, so they aren't counted.
+    """
+    format = 'robot'
+    pattern = re.compile(br' \| (PASS|FAIL|SKIP) \|[ \t]*\r?\n(?:(?=([^\n]*)\n))?')
+    _suite_stats = re.compile(br'\d+ tests?, \d+ passed, \d+ failed')
+
+    def _scan(self, buf, end, final):
+        for m in self.pattern.finditer(buf, 0, end):
+            if m.group(2) is None and m.end() == end and not final:
+                # The line after it, which tells a test from a suite, hasn't arrived yet
+                return buf[buf.rfind(b'\n', 0, m.start()):]
+            self._match(buf, m)
+        return buf[end - 1:]
+
+    def _match(self, buf, m):
+        status, following = m.groups()
+        if following is not None and self._suite_stats.match(following):
+            self.complete = True
+            return
+        if status == b'PASS':
+            self.passed += 1
+        elif status == b'SKIP':
+            self.skipped += 1
+        else:
+            name = buf[buf.rfind(b'\n', 0, m.start()) + 1:m.start()]
+            message = following if following is not None and not following.startswith((b'---', b'===')) else b''
+            self._fail(self._text(name), self._text(message))
+
+
+class JUnitParser(OutputParser):
+    """
+    JUnit XML, parsed with expat's push parser as it arrives. Anything before the XML, such as log lines, is skipped,
+    and parsing ends at the end of the root element.
+    """
+    format = 'junit'
+    _start = re.compile(br'<\?xml|<testsuites?[\s>]')
+
+    def __init__(self, max_failures=100, max_message_size=1024):
+        OutputParser.__init__(self, max_failures, max_message_size)
+        self._parser = xml.parsers.expat.ParserCreate()
+        self._parser.StartElementHandler = self._start_element
+        self._parser.EndElementHandler = self._end_element
+        self._parser.CharacterDataHandler = self._characters
+        self._parser.buffer_text = True
+        self._started = False
+        self._done = False
+        self._skip = b''
+        self._depth = 0
+        self._case = None
+        self._message = None
+        self._message_attr = None
+
+    def feed(self, data):
+        if not data:
+            return
+        self.bytes_parsed += len(data)
+        if self._done:
+            return
+        if not self._started:
+            buf = self._skip + data
+            m = self._start.search(buf)
+            if m is None:
+                # Keep enough to match a start tag split between blocks
+                self._skip = buf[-16:]
+                return
+            self._started = True
+            self._skip = b''
+            data = buf[m.start():]
+        self._parse(data, False)
+
+    def close(self):
+        if self._started and not self._done:
+            self._parse(b'', True)
+
+    def _parse(self, data, final):
+        try:
+            self._parser.Parse(data, final)
+        except xml.parsers.expat.ExpatError as e:
+            self._done = True
+            if not self.complete:
+                self.parse_error = str(e)
+
+    def _start_element(self, name, attrs):
+        self._depth += 1
+        if name == 'testcase':
+            self._case = {'name': '%s.%s' % (attrs['classname'], attrs.get('name', '')) if attrs.get('classname') else attrs.get('name', ''),
+                          'status': 'passed'}
+        elif self._case is not None and name in ('failure', 'error'):
+            self._case['status'] = 'failed'
+            self._message_attr = attrs.get('message', '')
+            self._message = []
+        elif self._case is not None and name == 'skipped':
+            if self._case['status'] == 'passed':
+                self._case['status'] = 'skipped'
+
+    def _characters(self, text):
+        # Failure text is only collected up to the message size
+        if self._message is not None and sum(len(t) for t in self._message) < self._max_message_size:
+            self._message.append(text)
+
+    def _end_element(self, name):
+        self._depth -= 1
+        if name in ('failure', 'error') and self._message is not None:
+            if self._case is not None and 'message' not in self._case:
+                # expat may split the text at block boundaries, so the pieces are joined as they are
+                self._case['message'] = '\n'.join(t for t in (self._message_attr, ''.join(self._message).strip()) if t)
+            self._message = None
+        elif name == 'testcase' and self._case is not None:
+            case, self._case = self._case, None
+            if case['status'] == 'failed':
+                self._fail(case['name'], case.get('message'))
+            elif case['status'] == 'skipped':
+                self.skipped += 1
+            else:
+                self.passed += 1
+        if self._depth == 0:
+            self.complete = True
+            self._done = True
+            # Stop expat from complaining about whatever follows the document
+            self._parser.StartElementHandler = None
+            self._parser.EndElementHandler = None
+            self._parser.CharacterDataHandler = None
+
+
+PARSERS = {
+    'tap': TapParser,
+    'junit': JUnitParser,
+    'robot': RobotParser,
+}
+
+
+def make_parser(name, **kwargs):
+    """
+    :param name: str : 'tap', 'junit' or 'robot'
+    :param kwargs: Parser settings such as max_failures
+    :return: OutputParser
+    """
+    if name not in PARSERS:
+        raise Exception('Unknown output format %s, use one of %s' % (name, ', '.join(sorted(PARSERS))))
+    return PARSERS[name](**kwargs)
+
+
+def parse_file(parser, path, block_size=65536):
+    """
+    Feeds a whole file to a parser in blocks, e.g. a JUnit XML file written by the test rather than its output
+
+    :return: OutputParser : parser, closed
+    """
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            parser.feed(data)
+    parser.close()
+    return parser
@@ -0,0 +1,264 @@
+import random
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# For a gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class PollController:
+    """
+    Decides when the PendingCommand long-poll is sent next and how long it may take, shared by all pollers of a server
+
+    After a failed poll, polling backs off exponentially with full jitter: a random delay of up to
+    initial_backoff * 2 ** (failures - 1), at most max_backoff. After failure_threshold consecutive failures the
+    circuit breaker opens and nothing is polled for open_seconds; then it is half-open and a single poll probes
+    CloudShell. If the probe succeeds the breaker closes again, if it fails it opens for twice as long as before, up to
+    max_open_seconds.
+
+    An empty poll that took less than fast_empty_seconds means CloudShell isn't holding the long-poll open, so the next
+    poll waits, starting at min_empty_interval and doubling with each consecutive fast empty poll up to
+    max_empty_interval. Empty polls that were held open tell how long CloudShell holds them: their moving average sets
+    the request timeout, timeout_factor times it plus timeout_margin, within min_timeout and max_timeout.
+    CloudShell may still hand a command to a poll abandoned by the timeout, and that command is lost, so keep the
+    timeout well above the hold time.
+    """
+    def __init__(self, failure_threshold=3, initial_backoff=0.5, max_backoff=30, open_seconds=30, max_open_seconds=300,
+                 min_empty_interval=0.1, max_empty_interval=5, fast_empty_seconds=0.25,
+                 initial_timeout=120, min_timeout=30, max_timeout=300, timeout_factor=2.0, timeout_margin=10,
+                 on_state_change=None):
+        """
+        :param failure_threshold: int : Consecutive failed polls that open the breaker
+        :param initial_backoff: float : Longest delay after the first failed poll, doubled with every further failure
+        :param max_backoff: float : Longest delay after a failed poll while the breaker is closed
+        :param open_seconds: float : Seconds the breaker stays open the first time
+        :param max_open_seconds: float : Longest the breaker stays open after repeated failed probes
+        :param min_empty_interval: float : Seconds between polls after the first fast empty poll
+        :param max_empty_interval: float : Longest interval fast empty polls back off to
+        :param fast_empty_seconds: float : Empty polls returning sooner than this weren't held open by CloudShell
+        :param initial_timeout: float : Request timeout until CloudShell has held an empty poll open
+        :param min_timeout: float : Shortest request timeout
+        :param max_timeout: float : Longest request timeout
+        :param timeout_factor: float : Request timeout as a multiple of the average time CloudShell holds a poll
+        :param timeout_margin: float : Seconds added to the request timeout
+        :param on_state_change: function : on_state_change(state) : Called with 'closed', 'open' or 'half-open' whenever the breaker changes state
+        """
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.min_empty_interval = min_empty_interval
+        self.max_empty_interval = max_empty_interval
+        self.fast_empty_seconds = fast_empty_seconds
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_factor = timeout_factor
+        self.timeout_margin = timeout_margin
+        self._listeners = [on_state_change] if on_state_change else []
+        self._cond = threading.Condition()
+        self._random = random.Random()
+
+        self._state = CLOSED
+        self._failures = 0
+        self._fast_empty = 0
+        self._open_for = None
+        self._resume_at = 0
+        self._reason = None
+        self._probing = False
+        self._last_error = None
+        self._hold_seconds = None
+        self._latency = None
+
+        self.polls = 0
+        self.commands = 0
+        self.empty = 0
+        self.fast_empty = 0
+        self.failed = 0
+        self.opened = 0
+
+    def next_delay(self, now=None):
+        """
+        Asks whether a poll may be sent now. A poll allowed while the breaker is half-open is the probe, so its
+        outcome must be reported.
+
+        :return: (float, str) : Seconds to wait before asking again, 0 to poll now, and why polling is paused
+        """
+        now = now if now is not None else time.time()
+        with self._cond:
+            if self._state == OPEN:
+                if now < self._resume_at:
+                    return self._resume_at - now, self._reason
+                self._set_state(HALF_OPEN)
+            if self._state == HALF_OPEN:
+                if self._probing:
+                    # Until the probe returns; a probe is bounded by the request timeout
+                    return self.request_timeout(), 'Waiting for a probe poll to CloudShell'
+                self._probing = True
+                return 0, None
+            if now < self._resume_at:
+                return self._resume_at - now, self._reason
+            return 0, None
+
+    def wait(self, stop_event):
+        """
+        Blocks a poller until it may poll
+
+        :param stop_event: threading.Event : Returns early once set, see wake()
+        :return: bool : True to poll, False if stop_event was set
+        """
+        while not stop_event.is_set():
+            delay, _ = self.next_delay()
+            if delay <= 0:
+                return True
+            with self._cond:
+                self._cond.wait(delay)
+        return False
+
+    def wake(self):
+        """
+        Wakes pollers blocked in wait(), e.g. to stop them
+        """
+        with self._cond:
+            self._cond.notify_all()
+
+    def request_timeout(self):
+        """
+        :return: float : Seconds a poll may take before it is abandoned as failed
+        """
+        with self._cond:
+            if self._hold_seconds is None:
+                return self.initial_timeout
+            timeout = self._hold_seconds * self.timeout_factor + self.timeout_margin
+            return max(self.min_timeout, min(self.max_timeout, timeout))
+
+    def poll_succeeded(self, seconds, command, now=None):
+        """
+        Reports a poll that CloudShell answered
+
+        :param seconds: float : Round trip time of the poll
+        :param command: bool : Whether it returned a command, as opposed to being empty
+        """
+        now = now if now is not None else time.time()
+        with self._cond:
+            self.polls += 1
+            self._probing = False
+            self._failures = 0
+            self._open_for = None
+            self._latency = seconds if self._latency is None else 0.8 * self._latency + 0.2 * seconds
+            if self._state != CLOSED:
+                self._set_state(CLOSED)
+                self._resume_at = 0
+            if command:
+                self.commands += 1
+                self._fast_empty = 0
+            elif seconds < self.fast_empty_seconds:
+                self.empty += 1
+                self.fast_empty += 1
+                self._fast_empty += 1
+                interval = min(self.max_empty_interval, self.min_empty_interval * 2 ** (self._fast_empty - 1))
+                # Equal jitter: pollers that got an empty answer together don't come back together
+                delay = interval / 2 + self._random.uniform(0, interval / 2) - seconds
+                if delay > 0:
+                    self._pause(now + delay, 'Backing off %.2fs after %d empty polls that CloudShell answered immediately' % (delay, self._fast_empty))
+            else:
+                self.empty += 1
+                self._fast_empty = 0
+                self._hold_seconds = seconds if self._hold_seconds is None else 0.8 * self._hold_seconds + 0.2 * seconds
+            self._cond.notify_all()
+
+    def poll_failed(self, seconds, error, now=None):
+        """
+        Reports a poll that failed or timed out
+
+        :param seconds: float : Time until it failed
+        :param error: Exception
+        :return: float : Seconds until the next poll
+        """
+        now = now if now is not None else time.time()
+        with self._cond:
+            self.polls += 1
+            self.failed += 1
+            self._failures += 1
+            self._fast_empty = 0
+            self._last_error = str(error) or type(error).__name__
+            self._latency = seconds if self._latency is None else 0.8 * self._latency + 0.2 * seconds
+            probe, self._probing = self._probing, False
+            if probe or (self._state == CLOSED and self._failures >= self.failure_threshold):
+                self._open_for = min(self.max_open_seconds, self._open_for * 2) if self._open_for else self.open_seconds
+                self._resume_at = now + self._open_for
+                self._reason = 'Circuit breaker open for %.0fs after %d consecutive failed polls: %s' % (
+                    self._open_for, self._failures, self._last_error)
+                self.opened += 1
+                self._set_state(OPEN)
+            elif self._state == CLOSED:
+                backoff = self._random.uniform(0, min(self.max_backoff, self.initial_backoff * 2 ** (self._failures - 1)))
+                self._pause(now + backoff, 'Backing off %.2fs after %d consecutive failed polls: %s' % (
+                    backoff, self._failures, self._last_error))
+            self._cond.notify_all()
+            return max(0, self._resume_at - now)
+
+    def poll_cancelled(self):
+        """
+        Reports a poll that was interrupted without an outcome, e.g. by stop()
+        """
+        with self._cond:
+            self._probing = False
+            self._cond.notify_all()
+
+    def add_state_listener(self, on_state_change):
+        """
+        :param on_state_change: function : on_state_change(state) : Called, in addition to the others, whenever the breaker changes state
+        """
+        with self._cond:
+            self._listeners.append(on_state_change)
+
+    def state(self):
+        """
+        :return: str : 'closed', 'open' or 'half-open'
+        """
+        with self._cond:
+            return self._state
+
+    def stats(self, now=None):
+        """
+        :return: dict : Breaker state, whether polling is paused and why until when, the last error, the observed poll latency and hold time, the request timeout, and poll counters
+        """
+        now = now if now is not None else time.time()
+        timeout = self.request_timeout()
+        with self._cond:
+            paused = self._state != CLOSED or now < self._resume_at
+            return {
+                'state': self._state,
+                'paused': paused,
+                'reason': (self._reason if self._state != HALF_OPEN else 'Waiting for a probe poll to CloudShell') if paused else None,
+                'resume_at': self._resume_at if paused and self._state != HALF_OPEN else None,
+                'consecutive_failures': self._failures,
+                'last_error': self._last_error,
+                'latency_seconds': self._latency,
+                'hold_seconds': self._hold_seconds,
+                'request_timeout': timeout,
+                'polls': self.polls,
+                'commands': self.commands,
+                'empty': self.empty,
+                'fast_empty': self.fast_empty,
+                'failed': self.failed,
+                'opened': self.opened,
+            }
+
+    def _pause(self, until, reason):
+        if until > self._resume_at:
+            self._resume_at = until
+            self._reason = reason
+
+    def _set_state(self, state):
+        if state == self._state:
+            return
+        self._state = state
+        for listener in self._listeners:
+            listener(state)
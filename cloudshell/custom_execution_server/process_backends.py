@@ -0,0 +1,847 @@
+import array
+import errno
+import json
+import os
+import platform
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+from cloudshell.custom_execution_server.launcher import rusage_dict
+
+
+class PopenBackend:
+    """
+    Starts processes with subprocess.Popen
+
+    On Python 3 the new session is created with start_new_session rather than preexec_fn=os.setsid, so no Python
+    code runs in the forked child, which is what makes Popen unsafe and slow in a multi-threaded process. Resource
+    limits are likewise applied with prlimit() right after the child starts where it is available (Linux).
+    """
+    def __init__(self, logger=None):
+        """
+        :param logger: logging.Logger
+        """
+        self._running_on_windows = platform.system() == 'Windows'
+        self._logger = logger
+        self._warned_preexec = False
+
+    def spawn(self, command_list, env, directory, rlimits=None):
+        """
+        Starts a command in a new session with stdout and stderr going to one pipe
+
+        :param rlimits: dict : Resource limit name, e.g. 'RLIMIT_CPU', -> value applied to the child as soft and hard limit
+        :return: Process handle with pid, stdout (binary file), returncode, wait() and kill(), like subprocess.Popen
+        """
+        if self._running_on_windows:
+            if rlimits:
+                raise Exception('Resource limits are not supported on Windows')
+            return subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False, env=env, cwd=directory)
+        if rlimits and not (sys.version_info.major > 2 and hasattr(resource, 'prlimit')):
+            # Limits need code in the child, which rules out the faster vfork path
+            if not self._warned_preexec:
+                self._warned_preexec = True
+                if self._logger:
+                    self._logger.warning('Setting resource limits with preexec_fn, which can deadlock a multi-threaded server; '
+                                      'use Linux with Python 3, or the launcher backend')
+
+            def preexec():
+                os.setsid()
+                set_rlimits(rlimits)
+            return subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False, preexec_fn=preexec, env=env, cwd=directory)
+        if sys.version_info.major == 2:
+            return subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False, preexec_fn=os.setsid, env=env, cwd=directory)
+        process = subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False, start_new_session=True, env=env, cwd=directory)
+        if rlimits:
+            try:
+                for name, value in rlimits.items():
+                    resource.prlimit(process.pid, getattr(resource, name), (value, value))
+            except:
+                process.kill()
+                process.wait()
+                process.stdout.close()
+                raise
+        return process
+
+    def close(self):
+        pass
+
+
+def set_rlimits(rlimits):
+    for name, value in rlimits.items():
+        resource.setrlimit(getattr(resource, name), (value, value))
+
+
+def wait_with_rusage(process):
+    """
+    Waits for a process from any backend
+
+    :return: (int, dict) : Returncode and resource usage as returned by launcher.rusage_dict(), None where unavailable
+    """
+    if isinstance(process, subprocess.Popen):
+        if hasattr(os, 'wait4') and process.returncode is None:
+            while True:
+                try:
+                    _, status, rusage = os.wait4(process.pid, 0)
+                    break
+                except OSError as e:
+                    if e.errno != errno.EINTR:
+                        raise
+            process.returncode = _returncode(status)
+            return process.returncode, rusage_dict(rusage)
+        return process.wait(), None
+    returncode = process.wait()
+    return returncode, process.rusage
+
+
+def _returncode(status):
+    """
+    Converts a wait status to a returncode the way subprocess does: negative signal number if killed by a signal
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _find_executable(name, env):
+    if os.path.dirname(name):
+        return name
+    for directory in os.get_exec_path(env):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    raise OSError(errno.ENOENT, 'No such file or directory: %s' % name)
+
+
+class SpawnedProcess:
+    """
+    Handle of a process started by PosixSpawnBackend or LauncherBackend, with the parts of the Popen interface
+    ProcessRunner uses
+    """
+    def __init__(self, pid, stdout_fd, waiter):
+        """
+        :param pid: int
+        :param stdout_fd: int : Read end of the output pipe, owned by the handle
+        :param waiter: function : waiter(handle) : Blocks until the process has exited and sets returncode
+        """
+        self.pid = pid
+        self.stdout = os.fdopen(stdout_fd, 'rb')
+        self.returncode = None
+        self.rusage = None
+        self._waiter = waiter
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            if self.returncode is None:
+                self._waiter(self)
+        return self.returncode
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+class _LauncherProcess(SpawnedProcess):
+    def __init__(self, pid, stdout_fd):
+        SpawnedProcess.__init__(self, pid, stdout_fd, self._wait_exit)
+        self._exited = threading.Event()
+        self._exit_status = None
+
+    def set_exit(self, returncode, rusage):
+        self._exit_status = returncode
+        self.rusage = rusage
+        self._exited.set()
+
+    @staticmethod
+    def _wait_exit(handle):
+        handle._exited.wait()
+        handle.returncode = handle._exit_status
+
+
+class PosixSpawnBackend:
+    """
+    Starts processes with os.posix_spawn (Python 3.8+), which creates the child with vfork/clone semantics and
+    never runs Python code in it, so it is cheap regardless of the server's memory size and safe with threads
+    """
+    def __init__(self, logger=None):
+        """
+        :param logger: logging.Logger
+        """
+        if not hasattr(os, 'posix_spawn'):
+            raise Exception('os.posix_spawn is not available, it needs Python 3.8 or later on a POSIX system')
+        self._logger = logger
+
+    def spawn(self, command_list, env, directory, rlimits=None):
+        """
+        Resource limits are applied with prlimit() right after the child starts, which needs Linux and Python 3.4+
+        """
+        if rlimits and not hasattr(resource, 'prlimit'):
+            raise Exception('Resource limits with posix_spawn need resource.prlimit (Linux)')
+        if directory:
+            # posix_spawn can't change directory, so a shell does it and replaces itself with the command
+            command_list = ['/bin/sh', '-c', 'cd "$0" && exec "$@"', directory] + list(command_list)
+        path = _find_executable(command_list[0], env)
+        r, w = os.pipe()
+        try:
+            pid = os.posix_spawn(path, command_list, env,
+                                 file_actions=[(os.POSIX_SPAWN_DUP2, w, 1),
+                                               (os.POSIX_SPAWN_DUP2, w, 2)],
+                                 setsid=True)
+        except:
+            os.close(r)
+            raise
+        finally:
+            os.close(w)
+        if rlimits:
+            try:
+                for name, value in rlimits.items():
+                    resource.prlimit(pid, getattr(resource, name), (value, value))
+            except:
+                if self._logger:
+                    self._logger.warning('Failed to apply resource limits to pid %d, killing it' % pid)
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                os.close(r)
+                raise
+        return SpawnedProcess(pid, r, self._wait)
+
+    @staticmethod
+    def _wait(handle):
+        _, status, rusage = os.wait4(handle.pid, 0)
+        handle.returncode = _returncode(status)
+        handle.rusage = rusage_dict(rusage)
+
+    def close(self):
+        pass
+
+
+class LauncherBackend:
+    """
+    Starts processes from a small pre-forked helper process (launcher.py)
+
+    The helper is single-threaded and small, so its fork is cheap and safe. Spawn requests go to it over a Unix
+    socket, and it replies with the pid and passes back the read end of the output pipe. It reaps the children and
+    reports their exit status. The helper is started on first use and restarted if it dies.
+    """
+    def __init__(self, logger=None, reply_timeout=30):
+        """
+        :param logger: logging.Logger
+        :param reply_timeout: float : Seconds to wait for the launcher to reply to a spawn request
+        """
+        if not hasattr(socket, 'AF_UNIX') or sys.version_info < (3, 3):
+            raise Exception('The launcher backend needs Python 3.3 or later on a POSIX system')
+        self._logger = logger
+        self._reply_timeout = reply_timeout
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._sock = None
+        self._helper = None
+        self._reader = None
+        self._next_id = 0
+        self._pending = {}
+        self._children = {}
+
+    def spawn(self, command_list, env, directory, rlimits=None):
+        with self._lock:
+            self._ensure_started()
+            self._next_id += 1
+            request_id = self._next_id
+            reply = {'event': threading.Event()}
+            self._pending[request_id] = reply
+            sock = self._sock
+        data = (json.dumps({'id': request_id, 'argv': list(command_list), 'env': dict(env or {}), 'cwd': directory, 'rlimits': rlimits}) + '\n').encode('utf-8')
+        try:
+            with self._send_lock:
+                sock.sendall(data)
+        except (OSError, socket.error):
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise Exception('Process launcher is not running')
+        if not reply['event'].wait(self._reply_timeout):
+            with self._lock:
+                timed_out = self._pending.pop(request_id, None) is not None
+            if timed_out:
+                raise Exception('Process launcher did not reply within %g seconds' % self._reply_timeout)
+        if 'handle' in reply:
+            return reply['handle']
+        if reply.get('errno'):
+            raise OSError(reply['errno'], reply['error'])
+        raise Exception(reply.get('error') or 'Process launcher failed')
+
+    def close(self):
+        with self._lock:
+            sock, helper, reader = self._sock, self._helper, self._reader
+            self._sock = None
+        if sock is not None:
+            # The reader thread sees EOF and closes the socket
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+            helper.wait()
+            reader.join()
+
+    def _ensure_started(self):
+        if self._sock is not None and self._helper.poll() is None:
+            return
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            script = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'launcher.py')
+            self._helper = subprocess.Popen([sys.executable, script, str(child.fileno())], pass_fds=(child.fileno(),), close_fds=True)
+        finally:
+            child.close()
+        self._sock = parent
+        self._reader = threading.Thread(target=self._reader_thread, args=(parent,), name='process-launcher-reader')
+        self._reader.daemon = True
+        self._reader.start()
+        if self._logger:
+            self._logger.info('Started process launcher, pid %d' % self._helper.pid)
+
+    def _reader_thread(self, sock):
+        buf = b''
+        fds = []
+        fd_size = array.array('i').itemsize
+        try:
+            while True:
+                data, ancdata, _, _ = sock.recvmsg(65536, socket.CMSG_SPACE(64 * fd_size))
+                for level, kind, cdata in ancdata:
+                    if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                        a = array.array('i')
+                        a.frombytes(cdata[:len(cdata) - len(cdata) % fd_size])
+                        fds.extend(a)
+                if not data:
+                    break
+                buf += data
+                while b'\n' in buf:
+                    line, buf = buf.split(b'\n', 1)
+                    self._handle_message(json.loads(line.decode('utf-8')), fds)
+        except Exception as e:
+            if self._logger:
+                self._logger.warning('Process launcher connection failed: %s' % str(e))
+        finally:
+            self._launcher_gone(sock)
+
+    def _handle_message(self, message, fds):
+        # The launcher always replies to a spawn before reporting that child's exit
+        if 'exit' in message:
+            with self._lock:
+                handle = self._children.pop(message['exit'], None)
+            if handle is not None:
+                handle.set_exit(_returncode(message['status']), message.get('rusage'))
+            return
+        with self._lock:
+            reply = self._pending.pop(message['id'], None)
+            if reply is None:
+                # The spawn timed out, so nobody waits for this child
+                if 'pid' in message:
+                    os.close(fds.pop(0))
+                    try:
+                        os.kill(message['pid'], signal.SIGKILL)
+                    except OSError:
+                        pass
+                    if self._logger:
+                        self._logger.warning('Killed pid %d, started by the process launcher after its spawn timed out' % message['pid'])
+                return
+            if 'pid' in message:
+                # Every successful reply carries exactly one descriptor, in order
+                reply['handle'] = _LauncherProcess(message['pid'], fds.pop(0))
+                self._children[message['pid']] = reply['handle']
+            else:
+                reply.update(message)
+        reply['event'].set()
+
+    def _launcher_gone(self, sock):
+        with self._lock:
+            if self._sock is sock:
+                self._sock = None
+            pending, self._pending = self._pending, {}
+            children, self._children = self._children, {}
+        sock.close()
+        for reply in pending.values():
+            reply['error'] = 'Process launcher exited'
+            reply['event'].set()
+        if children and self._logger:
+            self._logger.warning('Process launcher exited with %d children running, their exit codes are lost' % len(children))
+        for handle in children.values():
+            th = threading.Thread(target=self._watch_orphan, args=(handle,), name='process-launcher-orphan')
+            th.daemon = True
+            th.start()
+
+    @staticmethod
+    def _watch_orphan(handle):
+        # Not our child, so it can only be polled
+        while True:
+            try:
+                os.kill(handle.pid, 0)
+            except OSError:
+                break
+            threading.Event().wait(0.5)
+        handle.set_exit(-signal.SIGKILL, None)
+
+
+_PYTHON_EXECUTABLE = re.compile(r'^python[0-9.]*$')
+
+
+class WarmRuntime:
+    """
+    A kind of test the warm pool keeps interpreters for, and how to tell its commands
+    """
+    def __init__(self, name, preload=(), interpreter=None, commands=None, scripts=False):
+        """
+        :param name: str : e.g. 'python' or 'robot'
+        :param preload: list : Modules the workers import before their first test, e.g. ['robot']
+        :param interpreter: str : Python interpreter of the workers, by default the server's
+        :param commands: dict : Command name -> module it runs, e.g. {'robot': 'robot'} to run 'robot suite.robot' as 'python -m robot suite.robot'
+        :param scripts: bool : Also run '*.py' commands, 'python script.py' and 'python -m module' in this runtime
+        """
+        self.name = name
+        self.preload = list(preload)
+        self.interpreter = interpreter or sys.executable
+        self.commands = dict(commands or {})
+        self.scripts = scripts
+
+    def resolve(self, command_list, env):
+        """
+        :param env: dict : Environment of the command, whose PATH finds a script given by name
+        :return: dict : Run request for warm_worker.py with 'module' or 'path' and 'argv', None if the command doesn't run in this runtime
+        """
+        executable = os.path.basename(command_list[0])
+        args = list(command_list[1:])
+        if executable in self.commands:
+            return {'module': self.commands[executable], 'argv': [command_list[0]] + args}
+        if not self.scripts:
+            return None
+        if _PYTHON_EXECUTABLE.match(executable):
+            if len(args) >= 2 and args[0] == '-m':
+                return {'module': args[1], 'argv': args[1:]}
+            if args and not args[0].startswith('-'):
+                return {'path': args[0], 'argv': args}
+            # Interpreter options would need a fresh interpreter
+            return None
+        if executable.endswith('.py'):
+            try:
+                path = _find_executable(command_list[0], env)
+            except OSError:
+                # The cold start reports it
+                return None
+            return {'path': path, 'argv': [path] + args}
+        return None
+
+
+class _WarmWorker:
+    """
+    One warm_worker.py process and the parent's end of its socket
+    """
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.runs = 0
+        self.baseline_rss = None
+        self._buf = b''
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            script = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'warm_worker.py')
+            # In a session of its own, so ProcessRunner stops a test by killing the worker's process group
+            self.process = subprocess.Popen([runtime.interpreter, script, str(child.fileno())] + runtime.preload,
+                                            pass_fds=(child.fileno(),), close_fds=True, start_new_session=True,
+                                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except:
+            parent.close()
+            raise
+        finally:
+            child.close()
+        self.pid = self.process.pid
+        self._sock = parent
+
+    def wait_ready(self, timeout):
+        """
+        Waits until the worker has imported its modules
+
+        :raises Exception: If it failed to, or didn't within timeout seconds
+        """
+        self._sock.settimeout(timeout)
+        try:
+            message = self.receive()
+        except socket.timeout:
+            raise Exception('Warm %s worker did not start within %ds' % (self.runtime.name, timeout))
+        finally:
+            self._sock.settimeout(None)
+        if message is None:
+            raise Exception('Warm %s worker exited with %s while starting' % (self.runtime.name, self.process.wait()))
+        if 'error' in message:
+            raise Exception(message['error'])
+        self.baseline_rss = message.get('rss')
+
+    def run(self, job, env, directory, rlimits):
+        """
+        Hands a test to the worker
+
+        :return: int : Read end of the test's output pipe
+        """
+        r, w = os.pipe()
+        request = dict(job, env=dict(env or {}), cwd=directory, rlimits=rlimits)
+        try:
+            self._sock.sendmsg([(json.dumps(request) + '\n').encode('utf-8')],
+                               [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [w]))])
+        except:
+            os.close(r)
+            raise
+        finally:
+            os.close(w)
+        self.runs += 1
+        return r
+
+    def receive(self):
+        """
+        :return: dict : Next message from the worker, None once it has exited
+        """
+        while b'\n' not in self._buf:
+            try:
+                data = self._sock.recv(65536)
+            except socket.timeout:
+                raise
+            except (OSError, socket.error):
+                # Reset by a worker that was killed
+                data = b''
+            if not data:
+                return None
+            self._buf += data
+        line, self._buf = self._buf.split(b'\n', 1)
+        return json.loads(line.decode('utf-8'))
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def close(self, timeout=5):
+        """
+        Ends the worker: it exits when its socket is closed, and is killed if it doesn't in time
+        """
+        self._sock.close()
+        deadline = time.time() + timeout
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if self.process.poll() is None:
+            try:
+                os.killpg(self.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self.process.wait()
+
+
+class _WarmProcess(SpawnedProcess):
+    """
+    Handle of a test running in a warm worker. Its pid is the worker's, so stopping the test kills the worker.
+    """
+    def __init__(self, backend, worker, stdout_fd):
+        SpawnedProcess.__init__(self, worker.pid, stdout_fd, self._wait_exit)
+        self._backend = backend
+        self._worker = worker
+        self._exit = None
+
+    def _wait_exit(self, handle):
+        message = self._worker.receive()
+        if message is None:
+            # Killed, e.g. by ProcessRunner.stop() or a resource limit
+            self.returncode = self._worker.process.wait()
+        else:
+            self.returncode = message['exit']
+            self.rusage = message.get('rusage')
+        self._exit = message
+
+    def release(self):
+        """
+        Returns the worker to the pool once the test can no longer be stopped, called by ProcessRunner after wait()
+        """
+        worker, self._worker = self._worker, None
+        if worker is not None:
+            self._backend._checkin(worker, self._exit)
+
+
+class WarmPoolBackend:
+    """
+    Runs Python based tests in interpreters started ahead of time, which have already imported the modules the tests
+    need, instead of paying for the interpreter startup and imports in every execution
+
+    A test command is matched against the runtimes in order, see WarmRuntime.resolve(), and handed to an idle worker of
+    the first runtime that runs it, with the environment, working directory and resource limits of the execution.
+    Commands no runtime runs, and tests arriving while no worker of their runtime is idle, are started cold by the
+    fallback backend.
+
+    A background thread keeps size idle workers per runtime. A worker is replaced after max_runs tests, once its memory
+    has grown by more than max_rss_growth_bytes since it started, or if a test left threads running. Stopping a test
+    kills its worker's process group, as for a cold process.
+
+    Tests share the worker with the tests before them: modules a test imports are unloaded after it, but changes it made
+    to preloaded modules stay, so only preload modules that tests don't modify.
+    """
+    def __init__(self, runtimes, size=2, max_runs=50, max_rss_growth_bytes=268435456, fallback=None, logger=None,
+                 start_timeout=60):
+        """
+        :param runtimes: list : WarmRuntime objects, matched in order
+        :param size: int : Idle workers kept per runtime
+        :param max_runs: int : Tests a worker runs before it is replaced
+        :param max_rss_growth_bytes: int : Growth of a worker's resident memory since it started after which it is replaced, None for no limit
+        :param fallback: Backend starting the tests that don't run warm, by default a PopenBackend
+        :param logger: logging.Logger
+        :param start_timeout: float : Seconds a worker may take to import its modules
+        """
+        if not hasattr(socket, 'AF_UNIX') or sys.version_info < (3, 3):
+            raise Exception('The warm backend needs Python 3.3 or later on a POSIX system')
+        self._runtimes = list(runtimes)
+        self._size = max(0, int(size))
+        self._max_runs = max(1, int(max_runs))
+        self._max_rss_growth_bytes = max_rss_growth_bytes
+        self._fallback = fallback or PopenBackend()
+        self._logger = logger
+        self._start_timeout = start_timeout
+        self._cond = threading.Condition()
+        self._closed = False
+        self._idle = dict((runtime.name, []) for runtime in self._runtimes)
+        self._busy = dict((runtime.name, 0) for runtime in self._runtimes)
+        self._retiring = []
+        self._retry_at = dict((runtime.name, 0) for runtime in self._runtimes)
+        self._start_failures = dict((runtime.name, 0) for runtime in self._runtimes)
+        self._runs_counter = None
+        self._recycled_counter = None
+        self._metric_labels = ()
+
+        self.warm_runs = 0
+        self.cold_runs = 0
+        self.started = 0
+        self.recycled = {}
+
+        self._thread = threading.Thread(target=self._maintain, name='warm-pool')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def spawn(self, command_list, env, directory, rlimits=None):
+        for runtime in self._runtimes:
+            job = runtime.resolve(command_list, env)
+            if job is None:
+                continue
+            while True:
+                worker = self._checkout(runtime)
+                if worker is None:
+                    break
+                try:
+                    return _WarmProcess(self, worker, worker.run(job, env, directory, rlimits))
+                except (OSError, socket.error) as e:
+                    # Died while idle, e.g. killed from outside
+                    self._retire(worker, 'died', busy=True)
+                    if self._logger:
+                        self._logger.warning('Warm %s worker %d is gone, trying another: %s' % (runtime.name, worker.pid, str(e)))
+            break
+        with self._cond:
+            self.cold_runs += 1
+        if self._runs_counter is not None:
+            self._runs_counter.inc(self._metric_labels + ('cold',))
+        return self._fallback.spawn(command_list, env, directory, rlimits=rlimits)
+
+    def register_metrics(self, registry, name='default'):
+        """
+        Called by ProcessRunner.register_metrics
+
+        :param name: str : Value of the 'runner' label
+        """
+        self._metric_labels = (name,)
+        gauge = registry.gauge('cloudshell_execution_server_warm_workers', 'Warm interpreter workers', ('runner', 'runtime', 'state'))
+        for runtime in self._runtimes:
+            gauge.set_function(lambda r=runtime.name: len(self._idle[r]), (name, runtime.name, 'idle'))
+            gauge.set_function(lambda r=runtime.name: self._busy[r], (name, runtime.name, 'busy'))
+        self._runs_counter = registry.counter('cloudshell_execution_server_warm_runs_total', 'Tests run by the warm backend, in a warm worker or started cold', ('runner', 'start'))
+        self._recycled_counter = registry.counter('cloudshell_execution_server_warm_workers_recycled_total', 'Warm workers replaced', ('runner', 'reason'))
+
+    def unregister_metrics(self, registry):
+        """
+        Called by ProcessRunner.close, removes the gauges added by register_metrics
+        """
+        gauge = registry.gauge('cloudshell_execution_server_warm_workers', 'Warm interpreter workers', ('runner', 'runtime', 'state'))
+        for runtime in self._runtimes:
+            for state in ('idle', 'busy'):
+                gauge.remove(self._metric_labels + (runtime.name, state))
+
+    def stats(self):
+        """
+        :return: dict : Idle and busy workers and start failures per runtime, workers started, tests run warm and cold, and workers recycled by reason
+        """
+        with self._cond:
+            return {
+                'runtimes': dict((r.name, {'idle': len(self._idle[r.name]), 'busy': self._busy[r.name],
+                                           'start_failures': self._start_failures[r.name]}) for r in self._runtimes),
+                'started': self.started,
+                'warm_runs': self.warm_runs,
+                'cold_runs': self.cold_runs,
+                'recycled': dict(self.recycled),
+            }
+
+    def close(self):
+        """
+        Ends the idle workers; busy ones end as soon as their test has finished
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._fallback.close()
+
+    def _checkout(self, runtime):
+        with self._cond:
+            idle = self._idle[runtime.name]
+            if not idle:
+                return None
+            worker = idle.pop()
+            self._busy[runtime.name] += 1
+            self.warm_runs += 1
+            # Refill behind it
+            self._cond.notify_all()
+        if self._runs_counter is not None:
+            self._runs_counter.inc(self._metric_labels + ('warm',))
+        return worker
+
+    def _checkin(self, worker, message):
+        """
+        :param message: dict : Exit message of the test the worker ran, None if the worker died
+        """
+        reason = None
+        if message is None or not worker.alive():
+            reason = 'died'
+        elif message.get('threads'):
+            reason = 'threads'
+        elif worker.runs >= self._max_runs:
+            reason = 'runs'
+        elif (self._max_rss_growth_bytes is not None and worker.baseline_rss is not None and message.get('rss') is not None
+              and message['rss'] - worker.baseline_rss > self._max_rss_growth_bytes):
+            reason = 'memory'
+        if reason is not None:
+            self._retire(worker, reason, busy=True)
+            return
+        with self._cond:
+            self._busy[worker.runtime.name] -= 1
+            closed = self._closed
+            if not closed:
+                self._idle[worker.runtime.name].append(worker)
+                self._cond.notify_all()
+        if closed:
+            worker.close()
+
+    def _retire(self, worker, reason, busy=False):
+        with self._cond:
+            if busy:
+                self._busy[worker.runtime.name] -= 1
+            self.recycled[reason] = self.recycled.get(reason, 0) + 1
+            closed = self._closed
+            if not closed:
+                self._retiring.append(worker)
+                self._cond.notify_all()
+        if closed:
+            worker.close()
+        if self._recycled_counter is not None:
+            self._recycled_counter.inc(self._metric_labels + (reason,))
+        if self._logger and reason != 'runs':
+            self._logger.info('Replacing warm %s worker %d after %d runs: %s' % (worker.runtime.name, worker.pid, worker.runs, reason))
+
+    def _needed(self, now):
+        # Called holding _cond
+        return [runtime for runtime in self._runtimes
+                if len(self._idle[runtime.name]) < self._size and now >= self._retry_at[runtime.name]]
+
+    def _maintain(self):
+        """
+        Starts workers up to size idle ones per runtime and ends retired ones, in the background
+        """
+        while True:
+            with self._cond:
+                while not self._closed and not self._retiring and not self._needed(time.time()):
+                    retry = [t for t in self._retry_at.values() if t > time.time()]
+                    self._cond.wait(min(retry) - time.time() if retry else None)
+                closed = self._closed
+                retiring, self._retiring = self._retiring, []
+                if closed:
+                    for idle in self._idle.values():
+                        retiring.extend(idle)
+                        del idle[:]
+                    needed = []
+                else:
+                    needed = self._needed(time.time())
+            for worker in retiring:
+                worker.close()
+            if closed:
+                return
+            self._start_workers(needed)
+
+    def _start_workers(self, runtimes):
+        started = []
+        for runtime in runtimes:
+            try:
+                started.append(_WarmWorker(runtime))
+            except Exception as e:
+                self._start_failed(runtime, e)
+        for worker in started:
+            try:
+                worker.wait_ready(self._start_timeout)
+            except Exception as e:
+                worker.close(timeout=0)
+                self._start_failed(worker.runtime, e)
+                continue
+            with self._cond:
+                self.started += 1
+                self._start_failures[worker.runtime.name] = 0
+                closed = self._closed
+                if not closed:
+                    self._idle[worker.runtime.name].append(worker)
+            if closed:
+                worker.close()
+
+    def _start_failed(self, runtime, e):
+        with self._cond:
+            self._start_failures[runtime.name] += 1
+            # Tests start cold meanwhile
+            delay = min(60, 2 ** self._start_failures[runtime.name])
+            self._retry_at[runtime.name] = time.time() + delay
+        if self._logger:
+            self._logger.warning('Failed to start a warm %s worker, retrying in %ds: %s' % (runtime.name, delay, str(e)))
+
+
+BACKENDS = {
+    'popen': PopenBackend,
+    'posix_spawn': PosixSpawnBackend,
+    'launcher': LauncherBackend,
+    'warm': WarmPoolBackend,
+}
+
+
+def make_backend(name, logger=None, warm_runtimes=None, warm_pool_size=2, warm_max_runs=50,
+                 warm_max_rss_growth_bytes=268435456, warm_fallback='popen'):
+    """
+    :param name: str : 'popen', 'posix_spawn', 'launcher' or 'warm'
+    :param warm_runtimes: dict : For 'warm': runtime name -> dict with the other WarmRuntime arguments, e.g. {"robot": {"preload": ["robot"], "commands": {"robot": "robot"}}}, matched in name order
+    :param warm_pool_size: int : For 'warm': idle workers kept per runtime
+    :param warm_max_runs: int : For 'warm': tests a worker runs before it is replaced
+    :param warm_max_rss_growth_bytes: int : For 'warm': memory growth after which a worker is replaced
+    :param warm_fallback: str : For 'warm': backend starting the tests that don't run warm
+    :return: Process backend for ProcessRunner(backend=...)
+    """
+    if name not in BACKENDS:
+        raise Exception('Unknown process backend %s, use one of %s' % (name, ', '.join(sorted(BACKENDS))))
+    if name == 'warm':
+        if warm_fallback == 'warm':
+            raise Exception('The warm backend can not fall back to itself')
+        runtimes = [WarmRuntime(runtime_name, **options) for runtime_name, options in sorted((warm_runtimes or {}).items())]
+        if not runtimes:
+            raise Exception('The warm backend needs at least one runtime in warm_runtimes')
+        return WarmPoolBackend(runtimes, size=warm_pool_size, max_runs=warm_max_runs,
+                               max_rss_growth_bytes=warm_max_rss_growth_bytes,
+                               fallback=make_backend(warm_fallback, logger), logger=logger)
+    return BACKENDS[name](logger)
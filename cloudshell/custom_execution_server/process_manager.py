@@ -1,29 +1,287 @@
+import logging
 import os
 import platform
 
-import re
 import signal
-import subprocess
+import tempfile
+import threading
+import time
 
 import sys
 
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
 
-def string23(b):
-    if sys.version_info.major == 3:
-        if isinstance(b, bytes):
-            return b.decode('utf-8', 'replace')
-    return b or ''
+from cloudshell.custom_execution_server.compat import string23
+from cloudshell.custom_execution_server.process_backends import PopenBackend, wait_with_rusage
+from cloudshell.custom_execution_server.report_data import ReportFile
+from cloudshell.custom_execution_server.request_log import LazyCall, redact_command, redact_env
+
+
+class OutputCapture:
+    """
+    Spools raw process output to temporary files, keeping only a bounded head and tail in memory
+
+    With segment_size and max_segments set, output is written to a series of segment files and the oldest segments
+    beyond max_segments are deleted, so disk use is bounded too; the head is always kept.
+    """
+    def __init__(self, directory=None, head_size=65536, tail_size=65536, segment_size=None, max_segments=None):
+        """
+        :param directory: str : Where to create the spool files, by default the system temp directory
+        :param head_size: int : Bytes from the start of the output kept in memory
+        :param tail_size: int : Bytes from the end of the output kept in memory
+        :param segment_size: int : Bytes per spool file, None for a single file
+        :param max_segments: int : Number of most recent spool files to keep, None to keep all
+        """
+        self._directory = directory
+        self._head_size = head_size
+        self._tail_size = tail_size
+        self._segment_size = max(segment_size, head_size) if segment_size else None
+        self._max_segments = max_segments
+        self._segments = []
+        self._file = None
+        self._segment_bytes = 0
+        self.head = b''
+        self.tail = b''
+        self.bytes_captured = 0
+        self.bytes_dropped = 0
+        self.start_time = time.time()
+        self.end_time = None
+
+    def feed(self, data):
+        """
+        :param data: bytes
+        """
+        if not data:
+            return
+        self.bytes_captured += len(data)
+        if len(self.head) < self._head_size:
+            self.head += data[:self._head_size - len(self.head)]
+        if len(data) >= self._tail_size:
+            self.tail = data[-self._tail_size:]
+        else:
+            self.tail = (self.tail + data)[-self._tail_size:]
+        while data:
+            if self._file is None or (self._segment_size and self._segment_bytes >= self._segment_size):
+                self._next_segment()
+            n = len(data) if not self._segment_size else min(len(data), self._segment_size - self._segment_bytes)
+            self._file.write(data[:n])
+            self._segment_bytes += n
+            data = data[n:]
+
+    def close(self):
+        """
+        Finishes writing. The spool files stay on disk until the report is uploaded or discard() is called.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.end_time is None:
+            self.end_time = time.time()
+
+    def discard(self):
+        self.close()
+        for path, _ in self._segments:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._segments = []
+
+    def bytes_per_second(self):
+        elapsed = (self.end_time or time.time()) - self.start_time
+        return self.bytes_captured / elapsed if elapsed > 0 else 0.0
+
+    def preview(self):
+        """
+        :return: str : The head and tail of the output, with a marker for the omitted middle
+        """
+        if self.bytes_captured <= len(self.head) + len(self.tail):
+            data = self.head + self.tail[len(self.tail) - (self.bytes_captured - len(self.head)):]
+            return string23(data, 'replace')
+        return '%s\n... (%d bytes omitted) ...\n%s' % (string23(self.head, 'replace'),
+                                                     self.bytes_captured - len(self.head) - len(self.tail),
+                                                     string23(self.tail, 'replace'))
+
+    def report_data(self):
+        """
+        Report data for a CommandResult that streams the spooled output and deletes the spool files after upload
+
+        :return: ReportFile or iterator of bytes
+        """
+        self.close()
+        if not self._segments:
+            return iter([])
+        if len(self._segments) == 1 and not self.bytes_dropped:
+            path, _ = self._segments[0]
+            self._segments = []
+            return ReportFile(path, delete=True)
+        return _SpoolReader(self)
+
+    def _next_segment(self):
+        if self._file is not None:
+            self._file.close()
+        fd, path = tempfile.mkstemp(prefix='ces-output-', suffix='.log', dir=self._directory)
+        self._file = os.fdopen(fd, 'wb')
+        self._segment_bytes = 0
+        self._segments.append((path, self.bytes_captured))
+        if self._max_segments and len(self._segments) > self._max_segments:
+            old, _ = self._segments.pop(0)
+            self.bytes_dropped += os.path.getsize(old)
+            os.remove(old)
+
+
+class _SpoolReader:
+    """
+    Iterates over the head and remaining segments of a rotated OutputCapture, deleting them when closed
+    """
+    def __init__(self, capture):
+        self._capture = capture
+
+    def __iter__(self):
+        if self._capture.bytes_dropped:
+            yield self._capture.head
+            yield ('\n... (%d bytes omitted) ...\n' % (self._capture.bytes_dropped - len(self._capture.head))).encode('utf-8')
+        for path, _ in list(self._capture._segments):
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(65536)
+                    if not chunk:
+                        break
+                    yield chunk
+
+    def close(self):
+        self._capture.discard()
+
+
+STOPPED_EXIT_CODE = -6000
+TIMEOUT_EXIT_CODE = -6001
+
+
+class ResourceLimits:
+    """
+    Limits for each process started by ProcessRunner. None means no limit.
+    """
+    def __init__(self, cpu_seconds=None, address_space_bytes=None, open_files=None, timeout=None, kill_grace=10):
+        """
+        :param cpu_seconds: int : CPU time (RLIMIT_CPU), after which the process gets SIGXCPU and then SIGKILL
+        :param address_space_bytes: int : Virtual memory (RLIMIT_AS), beyond which allocations fail
+        :param open_files: int : File descriptors (RLIMIT_NOFILE)
+        :param timeout: float : Wall-clock seconds before the process group is terminated like by stop()
+        :param kill_grace: float : Seconds after a timeout's SIGTERM before the process group gets SIGKILL
+        """
+        self.cpu_seconds = cpu_seconds
+        self.address_space_bytes = address_space_bytes
+        self.open_files = open_files
+        self.timeout = timeout
+        self.kill_grace = kill_grace
+
+    def rlimits(self):
+        """
+        :return: dict : RLIMIT_* name -> value, capped to this process's hard limits so they can be set
+        """
+        limits = {}
+        for name, value in (('RLIMIT_CPU', self.cpu_seconds),
+                            ('RLIMIT_AS', self.address_space_bytes),
+                            ('RLIMIT_NOFILE', self.open_files)):
+            if value is None:
+                continue
+            if resource is not None:
+                _, hard = resource.getrlimit(getattr(resource, name))
+                if hard != resource.RLIM_INFINITY:
+                    value = min(value, hard)
+            limits[name] = int(value)
+        return limits
+
+    def __repr__(self):
+        return 'ResourceLimits cpu_seconds=%s address_space_bytes=%s open_files=%s timeout=%s' % (
+            self.cpu_seconds, self.address_space_bytes, self.open_files, self.timeout)
+
+
+class ResourceUsage:
+    """
+    What a process cost, from wait4() where the platform has it
+    """
+    def __init__(self, wall_seconds, rusage=None):
+        """
+        :param wall_seconds: float
+        :param rusage: dict : As returned by launcher.rusage_dict(), None if unavailable
+        """
+        rusage = rusage or {}
+        self.wall_seconds = wall_seconds
+        self.user_seconds = rusage.get('utime')
+        self.system_seconds = rusage.get('stime')
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        maxrss = rusage.get('maxrss')
+        self.max_rss_bytes = maxrss * (1 if sys.platform == 'darwin' else 1024) if maxrss is not None else None
+        self.in_blocks = rusage.get('inblock')
+        self.out_blocks = rusage.get('oublock')
+
+    def as_dict(self):
+        return {
+            'wall_seconds': self.wall_seconds,
+            'user_seconds': self.user_seconds,
+            'system_seconds': self.system_seconds,
+            'max_rss_bytes': self.max_rss_bytes,
+            'in_blocks': self.in_blocks,
+            'out_blocks': self.out_blocks,
+        }
+
+    def __repr__(self):
+        return 'ResourceUsage %s' % ' '.join('%s=%s' % (k, v) for k, v in sorted(self.as_dict().items()))
 
 
 class ProcessRunner:
-    def __init__(self, logger):
+    def __init__(self, logger, on_process_started=None, backend=None, limits=None):
+        """
+        :param logger: logging.Logger
+        :param on_process_started: function : on_process_started(identifier, pid) : Called after each process starts, e.g. CustomExecutionServer.record_process to journal it
+        :param backend: How processes are started: PopenBackend (default), PosixSpawnBackend, LauncherBackend or WarmPoolBackend from process_backends, see make_backend()
+        :param limits: ResourceLimits : Default limits for every process, None for no limits
+        """
         self._logger = logger
+        self.on_process_started = on_process_started
+        self._backend = backend or PopenBackend(logger)
+        self.limits = limits
         self._current_processes = {}
         self._stopping_processes = []
+        self._timed_out = set()
         self._running_on_windows = platform.system() == 'Windows'
+        self._local = threading.local()
+        self._started_counter = None
+        self._timeout_counter = None
+        self._metric_labels = ()
+        self._metrics_registry = None
+
+    def register_metrics(self, registry, name='default'):
+        """
+        Reports running and started child processes in a MetricsRegistry, e.g. CustomExecutionServer.metrics
 
-    def execute_throwing(self, command_list, identifier, env=None, directory=None):
-        o, c = self.execute(command_list, identifier, env=env, directory=directory)
+        :param registry: MetricsRegistry
+        :param name: str : Value of the 'runner' label, to tell several runners apart. A runner replacing one that is
+                           still draining, e.g. after a config reload, needs a name of its own, or its gauges replace
+                           those of the old runner.
+        """
+        self._metric_labels = (name,)
+        self._metrics_registry = registry
+        registry.gauge('cloudshell_execution_server_child_processes', 'Child processes currently running', ('runner',)).set_function(
+            lambda: len(self._current_processes), self._metric_labels)
+        self._started_counter = registry.counter('cloudshell_execution_server_child_processes_started_total', 'Child processes started', ('runner',))
+        self._timeout_counter = registry.counter('cloudshell_execution_server_child_process_timeouts_total', 'Child processes terminated for exceeding their timeout', ('runner',))
+        if hasattr(self._backend, 'register_metrics'):
+            self._backend.register_metrics(registry, name)
+
+    def last_usage(self):
+        """
+        :return: ResourceUsage : Usage of the last process run by the calling thread, e.g. to set CommandResult.resource_usage
+        """
+        return getattr(self._local, 'usage', None)
+
+    def execute_throwing(self, command_list, identifier, env=None, directory=None, limits=None):
+        o, c = self.execute(command_list, identifier, env=env, directory=directory, limits=limits)
         if c:
             s = 'Error: %d: %s failed: %s' % (c, command_list, o)
             if self._logger:
@@ -31,38 +289,170 @@ class ProcessRunner:
             raise Exception(s)
         return o, c
 
-    def execute(self, command_list, identifier, env=None, directory=None):
-        env = env or {}
-        if True:
-            pcommands = []
-            for command in command_list:
-                pcommand = command
-                pcommand = re.sub(r':[^@:]*@', ':(password hidden)@', pcommand)
-                pcommand = re.sub(r"CLOUDSHELL_PASSWORD:[^']*", 'CLOUDSHELL_PASSWORD:(password hidden)', pcommand)
-                pcommands.append(pcommand)
-            penv = dict(env)
-            if 'CLOUDSHELL_PASSWORD' in penv:
-                penv['CLOUDSHELL_PASSWORD'] = '(hidden)'
+    def execute(self, command_list, identifier, env=None, directory=None, limits=None):
+        """
+        Runs a command and returns its whole output as a string. For commands with large output, see execute_spooled().
+
+        :param limits: ResourceLimits : Overrides the runner's default limits
+        :return: (str, int) : Output and exit code, (None, -6000) if stopped by stop(), or the output so far and -6001 if it timed out
+        """
+        process = self._start(command_list, identifier, env, directory, limits)
+        debug = self._logger is not None and self._logger.isEnabledFor(logging.DEBUG)
+        lines = []
+        try:
+            for line in iter(process.stdout.readline, b''):
+                line = string23(line, 'replace')
+                if debug:
+                    self._logger.debug('Output line: %s', line)
+                lines.append(line)
+        except:
+            self._abandon(process, identifier)
+            raise
+        output = ''.join(lines)
+        return self._finish(process, identifier, output)
 
+    def execute_spooled(self, command_list, identifier, env=None, directory=None, capture=None, block_size=65536, limits=None, parser=None):
+        """
+        Runs a command, spooling its output to disk with bounded memory use
+
+        Use capture.report_data() as CommandResult report data, capture.preview() for logging, and capture.discard()
+        if the output is not uploaded.
+
+        :param capture: OutputCapture : Capture settings, by default a single temp file with 64 KiB head and tail
+        :param block_size: int : Bytes per read from the output pipe
+        :param limits: ResourceLimits : Overrides the runner's default limits
+        :param parser: output_parsers.OutputParser : Also fed every block, e.g. make_parser('tap'), and closed at the end of the output
+        :return: (OutputCapture, int) : Captured output and exit code, (None, -6000) if stopped by stop(), or the output so far and -6001 if it timed out
+        """
+        capture = capture or OutputCapture()
+        process = None
+        try:
+            process = self._start(command_list, identifier, env, directory, limits)
+            fd = process.stdout.fileno()
+            while True:
+                data = os.read(fd, block_size)
+                if not data:
+                    break
+                capture.feed(data)
+                if parser is not None:
+                    parser.feed(data)
+            capture.close()
+            if parser is not None:
+                parser.close()
             if self._logger:
-                self._logger.debug('Execution %s: Running %s with env %s' % (identifier, pcommands, penv))
-        if self._running_on_windows:
-            process = subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False, env=env, cwd=directory)
-        else:
-            process = subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False, preexec_fn=os.setsid, env=env, cwd=directory)
+                self._logger.debug('Execution %s: captured %d bytes at %.0f bytes/s', identifier, capture.bytes_captured, capture.bytes_per_second())
+        except:
+            if process is not None:
+                self._abandon(process, identifier)
+            capture.discard()
+            raise
+        o, c = self._finish(process, identifier, capture)
+        if o is None:
+            capture.discard()
+        return o, c
+
+    def _start(self, command_list, identifier, env, directory, limits):
+        env = env or {}
+        limits = limits or self.limits
+        if self._logger:
+            self._logger.debug('Execution %s: Running %s with env %s and %s', identifier, LazyCall(redact_command, command_list), LazyCall(redact_env, env), limits)
+        self._local.usage = None
+        self._local.started = time.time()
+        process = self._backend.spawn(command_list, env, directory, rlimits=limits.rlimits() if limits else None)
         self._current_processes[identifier] = process
-        output = ''
-        for line in iter(process.stdout.readline, b''):
-            line = string23(line)
-            if self._logger:
-                self._logger.debug('Output line: %s' % line)
-            output += line
-        process.communicate()
+        self._local.timers = []
+        if limits and limits.timeout:
+            self._local.timers.append(self._start_timer(limits.timeout, self._timeout, identifier, process, limits.kill_grace))
+        if self._started_counter is not None:
+            self._started_counter.inc(self._metric_labels)
+        if self.on_process_started is not None:
+            try:
+                self.on_process_started(identifier, process.pid)
+            except:
+                self._abandon(process, identifier)
+                raise
+        return process
+
+    def _finish(self, process, identifier, output):
+        process.stdout.close()
+        returncode, rusage = wait_with_rusage(process)
+        for timer in self._local.timers:
+            timer.cancel()
+        self._local.usage = ResourceUsage(time.time() - self._local.started, rusage)
         self._current_processes.pop(identifier, None)
+        if hasattr(process, 'release'):
+            # No longer signalled for this execution, so the backend may reuse it
+            process.release()
+        if identifier in self._timed_out:
+            self._timed_out.discard(identifier)
+            if identifier in self._stopping_processes:
+                self._stopping_processes.remove(identifier)
+            return output, TIMEOUT_EXIT_CODE
         if identifier in self._stopping_processes:
             self._stopping_processes.remove(identifier)
-            return None, -6000
-        return output, process.returncode
+            return None, STOPPED_EXIT_CODE
+        return output, returncode
+
+    def _abandon(self, process, identifier):
+        """
+        Kills and reaps a started process whose output won't be read, e.g. because the parser fed with it raised,
+        so that it doesn't outlive its execution
+        """
+        try:
+            self._signal(process, getattr(signal, 'SIGKILL', signal.SIGTERM))
+            process.wait()
+        finally:
+            for timer in self._local.timers:
+                timer.cancel()
+            self._current_processes.pop(identifier, None)
+            self._timed_out.discard(identifier)
+            if identifier in self._stopping_processes:
+                self._stopping_processes.remove(identifier)
+            process.stdout.close()
+            if hasattr(process, 'release'):
+                process.release()
+
+    @staticmethod
+    def _start_timer(delay, fn, *args):
+        timer = threading.Timer(delay, fn, args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def _timeout(self, identifier, process, kill_grace):
+        if self._current_processes.get(identifier) is not process:
+            return
+        if self._logger:
+            self._logger.warning('Execution %s: process %d timed out, terminating it' % (identifier, process.pid))
+        if self._timeout_counter is not None:
+            self._timeout_counter.inc(self._metric_labels)
+        self._timed_out.add(identifier)
+        self._signal(process, signal.SIGTERM)
+        self._start_timer(kill_grace, self._kill_after_grace, identifier, process)
+
+    def _kill_after_grace(self, identifier, process):
+        if self._current_processes.get(identifier) is process:
+            self._signal(process, getattr(signal, 'SIGKILL', signal.SIGTERM))
+
+    def _signal(self, process, signum):
+        try:
+            if self._running_on_windows:
+                process.kill()
+            else:
+                os.killpg(process.pid, signum)
+        except OSError:
+            pass
+
+    def close(self):
+        """
+        Releases the backend, e.g. ends the launcher helper process, and removes the runner's gauges from the registry
+        """
+        self._backend.close()
+        registry, self._metrics_registry = self._metrics_registry, None
+        if registry is not None:
+            registry.gauge('cloudshell_execution_server_child_processes', 'Child processes currently running', ('runner',)).remove(self._metric_labels)
+            if hasattr(self._backend, 'unregister_metrics'):
+                self._backend.unregister_metrics(registry)
 
     def stop(self, identifier):
         if self._logger:
@@ -70,8 +460,5 @@ class ProcessRunner:
         process = self._current_processes.get(identifier)
         if process is not None:
             self._stopping_processes.append(identifier)
-            if self._running_on_windows:
-                process.kill()
-            else:
-                os.killpg(process.pid, signal.SIGTERM)
+            self._signal(process, signal.SIGTERM)
 
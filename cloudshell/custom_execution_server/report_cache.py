@@ -0,0 +1,223 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from cloudshell.custom_execution_server.journal import replace_file
+
+
+def content_digest(path=None, data=None, block_size=1048576):
+    """
+    :param path: str : File to hash
+    :param data: bytes : Data to hash if there is no file
+    :return: (str, int) : SHA-256 hex digest and size in bytes
+    """
+    h = hashlib.sha256()
+    if path is None:
+        h.update(data or b'')
+        return h.hexdigest(), len(data or b'')
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            h.update(block)
+            size += len(block)
+    return h.hexdigest(), size
+
+
+class ReportCache:
+    """
+    Content-addressed index of the reports already uploaded, so a report identical to an earlier one isn't uploaded
+    again
+
+    CloudShell has no way to point a report at content it already holds, so instead of the content a short note naming
+    the earlier execution and report is uploaded ('note'), or nothing at all ('skip'). Content uploaded longer ago than
+    max_age, which CloudShell may have purged since, or that verify() rejects, is uploaded in full and indexed again.
+
+    The index is an append-only file of JSON records {"h": sha256, "n": size, "id": execution_id, "f": report filename,
+    "t": upload time}, kept in least recently used order and compacted to the max_entries most recently used.
+    """
+    def __init__(self, path, logger, max_entries=10000, max_age=30 * 86400, min_bytes=4096, action='note', verify=None,
+                 compact_every=1000):
+        """
+        :param path: str : Index file, created if missing
+        :param logger: logging.Logger
+        :param max_entries: int : Reports indexed; the least recently uploaded or referenced are forgotten first
+        :param max_age: float : Seconds an upload can be referenced for, None for no limit
+        :param min_bytes: int : Smallest report worth looking up, since a note takes a few hundred bytes
+        :param action: str : 'note' to upload a note pointing at the earlier upload instead, 'skip' to upload nothing
+        :param verify: function : verify(entry) -> bool : Whether the earlier upload, a dict with execution_id, report_filename, size and time, can still be referenced. None to trust the index.
+        :param compact_every: int : Compact after this many records have been appended
+        """
+        if action not in ('note', 'skip'):
+            raise Exception('Report cache action must be note or skip, not %s' % action)
+        self._path = path
+        self._logger = logger
+        self._max_entries = max(1, int(max_entries))
+        self._max_age = max_age
+        self.min_bytes = min_bytes
+        self.action = action
+        self._verify = verify
+        self._compact_every = compact_every
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._file = None
+        self._appended = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.bytes_saved = 0
+
+    def open(self):
+        """
+        Loads the index and opens it for appending
+        """
+        directory = os.path.dirname(self._path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._lock:
+            if self._file is not None:
+                return
+            self._entries = self._load()
+            self._rewrite()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._rewrite()
+                self._file.close()
+                self._file = None
+
+    def lookup(self, digest, size, execution_id):
+        """
+        :param digest: str : SHA-256 hex digest of the report about to be uploaded
+        :param size: int
+        :param execution_id: str : Execution uploading it, which can't reference its own uploads
+        :return: dict : The earlier upload to reference instead, with execution_id, report_filename, size and time, or None to upload in full
+        """
+        if size < self.min_bytes:
+            return None
+        with self._lock:
+            record = self._entries.get(digest)
+            if record is None or record['n'] != size or record['id'] == execution_id:
+                self.misses += 1
+                return None
+            if self._max_age is not None and time.time() - record['t'] > self._max_age:
+                self.stale += 1
+                del self._entries[digest]
+                return None
+        entry = self._entry(record)
+        if self._verify is not None:
+            try:
+                usable = self._verify(entry)
+            except Exception as e:
+                self._logger.warning('Failed to verify earlier upload of %s by execution %s, uploading in full: %s' % (
+                    entry['report_filename'], entry['execution_id'], str(e)))
+                usable = False
+            if not usable:
+                with self._lock:
+                    self.stale += 1
+                    self._entries.pop(digest, None)
+                return None
+        with self._lock:
+            self.hits += 1
+            # Keep referenced content, so repeated reports stay deduplicated
+            self._append(record)
+        return entry
+
+    def record(self, digest, size, execution_id, report_filename):
+        """
+        Indexes content that has just been uploaded in full
+        """
+        if size < self.min_bytes:
+            return
+        with self._lock:
+            self._append({'h': digest, 'n': size, 'id': execution_id, 'f': report_filename, 't': time.time()})
+
+    def saved(self, n):
+        """
+        :param n: int : Bytes not uploaded thanks to a lookup() hit
+        """
+        with self._lock:
+            self.bytes_saved += n
+
+    def note(self, entry, digest):
+        """
+        :return: str : Report to upload instead of content identical to the earlier upload entry
+        """
+        return 'Identical to report %s of execution %s, uploaded %s\nsha256 %s, %d bytes\n' % (
+            entry['report_filename'], entry['execution_id'],
+            time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(entry['time'])), digest, entry['size'])
+
+    @staticmethod
+    def note_filename(report_filename):
+        return '%s.identical.txt' % report_filename
+
+    def stats(self):
+        """
+        :return: dict : Entries indexed and counters of hits, misses, stale entries and bytes saved
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'bytes_saved': self.bytes_saved,
+            }
+
+    @staticmethod
+    def _entry(record):
+        return {'execution_id': record['id'], 'report_filename': record['f'], 'size': record['n'], 'time': record['t']}
+
+    def _append(self, record):
+        self._entries.pop(record['h'], None)
+        self._entries[record['h']] = record
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        if self._file is None:
+            return
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        self._appended += 1
+        if self._appended >= self._compact_every:
+            self._rewrite()
+
+    def _load(self):
+        entries = OrderedDict()
+        if not os.path.exists(self._path):
+            return entries
+        with open(self._path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash mid-write
+                    self._logger.warning('Ignoring corrupt report cache line in %s' % self._path)
+                    continue
+                entries.pop(record['h'], None)
+                entries[record['h']] = record
+        while len(entries) > self._max_entries:
+            entries.popitem(last=False)
+        return entries
+
+    def _rewrite(self):
+        """
+        Atomically replaces the index file with one record per entry, least recently used first
+        """
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w') as f:
+            for record in self._entries.values():
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if self._file is not None:
+            self._file.close()
+        replace_file(tmp, self._path)
+        self._file = open(self._path, 'a')
+        self._appended = 0
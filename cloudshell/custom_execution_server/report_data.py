@@ -0,0 +1,239 @@
+import itertools
+import mimetypes
+import os
+import sys
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from cloudshell.custom_execution_server.compat import bytes23
+from cloudshell.custom_execution_server.connection_pool import iter_body_chunks
+
+
+class ReportFile:
+    """
+    Report data to stream from a file on disk instead of holding it in memory
+
+    Pass as report_data, e.g. PassedCommandResult('output.log', ReportFile('/tmp/1234.log', delete=True))
+    """
+    def __init__(self, path, delete=False):
+        """
+        :param path: str : File to upload
+        :param delete: bool : Delete the file after it has been uploaded
+        """
+        self.path = path
+        self.delete = delete
+
+    def __repr__(self):
+        return 'ReportFile(%s)' % self.path
+
+
+class Artifact:
+    """
+    Extra file of an execution, such as a screenshot, packet capture or XML result, uploaded as its own report next to
+    the main one
+
+    Add to CommandResult.artifacts, e.g. result.artifacts = artifacts_from_directory('/tmp/1234', delete=True)
+    """
+    def __init__(self, name, report_data, mime_type=None):
+        """
+        :param name: str : Report filename on CloudShell
+        :param report_data: Anything CommandResult.report_data can be, normally a ReportFile so it is streamed from disk
+        :param mime_type: str : By default guessed from the name
+        """
+        self.name = name
+        self.report_data = report_data
+        self.mime_type = mime_type or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        # Directory to remove once the artifact has been uploaded or dropped, see artifacts_from_directory()
+        self.cleanup_directory = None
+
+    def __repr__(self):
+        return 'Artifact(%s, %s, %s)' % (self.name, self.report_data if isinstance(self.report_data, ReportFile) else type(self.report_data).__name__, self.mime_type)
+
+
+def artifacts_from_files(paths, delete=False):
+    """
+    :param paths: list : Files to upload, each named after its basename
+    :param delete: bool : Delete each file after it has been uploaded
+    :return: list : Artifacts
+    """
+    return [Artifact(os.path.basename(path), ReportFile(path, delete=delete)) for path in paths]
+
+
+def artifacts_from_directory(directory, recursive=True, delete=False):
+    """
+    Makes an artifact of every file in a directory. Files in subdirectories are named after their relative path with
+    the separators replaced by '_', e.g. screenshots/login.png becomes screenshots_login.png.
+
+    :param directory: str
+    :param recursive: bool : Include subdirectories
+    :param delete: bool : Delete the whole directory once every artifact has been uploaded
+    :return: list : Artifacts, sorted by name
+    """
+    artifacts = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            if not os.path.isfile(path):
+                continue
+            name = os.path.relpath(path, directory).replace(os.sep, '_')
+            artifacts.append(Artifact(name, ReportFile(path)))
+        if not recursive:
+            break
+    # os.walk lists a directory's files before its subdirectories'
+    artifacts.sort(key=lambda a: a.name)
+    if delete:
+        for artifact in artifacts:
+            artifact.cleanup_directory = directory
+    return artifacts
+
+
+def is_streamed_report_data(report_data):
+    return not (report_data is None or isinstance(report_data, (bytes, str)) or
+                (sys.version_info.major == 2 and isinstance(report_data, unicode)))
+
+
+def open_report_body(report_data):
+    """
+    Turns CommandResult.report_data into a request body without reading streamed data into memory
+
+    :param report_data: str, bytes, ReportFile, file-like object or iterator of str/bytes chunks
+    :return: (body, int, function) : Request body, its length or None if unknown (to be sent chunked), and a function that releases the data after upload
+    """
+    if isinstance(report_data, ReportFile):
+        f = open(report_data.path, 'rb')
+
+        def close():
+            f.close()
+            if report_data.delete:
+                os.remove(report_data.path)
+        return f, os.fstat(f.fileno()).st_size, close
+    if not is_streamed_report_data(report_data):
+        data = bytes23(report_data)
+        return data, len(data), lambda: None
+    if hasattr(report_data, 'read'):
+        length = None
+        try:
+            length = os.fstat(report_data.fileno()).st_size - report_data.tell()
+        except:
+            pass
+        return report_data, length, getattr(report_data, 'close', lambda: None)
+    return report_data, None, getattr(report_data, 'close', lambda: None)
+
+
+# Formats that are already compressed, so compressing them again only costs CPU
+INCOMPRESSIBLE_EXTENSIONS = ('.gz', '.tgz', '.zst', '.zip', '.bz2', '.xz', '.7z', '.jar', '.png', '.jpg', '.jpeg', '.gif', '.mp4', '.pdf')
+INCOMPRESSIBLE_MIME_TYPES = ('application/gzip', 'application/x-gzip', 'application/zstd', 'application/zip', 'application/x-bzip2',
+                             'application/x-xz', 'application/x-7z-compressed', 'application/pdf')
+
+
+class ReportCompression:
+    """
+    Compresses reports as they are uploaded, without reading them into memory
+
+    In 'attachment' mode output.log is uploaded as output.log.gz (or .zst) with an application/gzip mime type, which
+    any CloudShell version stores as is. In 'content-encoding' mode the name and mime type are kept and the body is
+    sent with a Content-Encoding header, for servers or proxies that decode it. Reports smaller than the threshold,
+    and ones that are already compressed such as images and archives, are uploaded unchanged.
+    """
+    METHODS = {
+        # method: (default level, extension, mime type)
+        'gzip': (1, '.gz', 'application/gzip'),
+        'zstd': (3, '.zst', 'application/zstd'),
+    }
+
+    def __init__(self, method='gzip', level=None, threshold=65536, mode='attachment'):
+        """
+        :param method: str : 'gzip', or 'zstd' if the zstandard package is installed
+        :param level: int : Compression level, by default 1 for gzip (1-9) and 3 for zstd (1-22), the fastest levels that get most of the saving on text logs
+        :param threshold: int : Smallest report in bytes worth compressing
+        :param mode: str : 'attachment' or 'content-encoding'
+        """
+        if method not in self.METHODS:
+            raise Exception('Unknown report compression %s, use one of %s' % (method, ', '.join(sorted(self.METHODS))))
+        if method == 'zstd' and zstandard is None:
+            raise Exception('zstd report compression needs the zstandard package')
+        if mode not in ('attachment', 'content-encoding'):
+            raise Exception('Report compression mode must be attachment or content-encoding, not %s' % mode)
+        self.method = method
+        self.level = int(level) if level is not None else self.METHODS[method][0]
+        self.threshold = int(threshold or 0)
+        self.mode = mode
+
+    def __repr__(self):
+        return 'ReportCompression(%s level %d, threshold %d, %s)' % (self.method, self.level, self.threshold, self.mode)
+
+    def compress_body(self, report_filename, report_mime_type, body, length, on_done=None):
+        """
+        Compresses a report body from open_report_body()
+
+        :param body: bytes, file-like object or iterable of chunks
+        :param length: int : Length of body, None if unknown
+        :param on_done: function : on_done(uncompressed_bytes, compressed_bytes) : Called once the body has been compressed
+        :return: (str, str, object, int, dict) : Filename, mime type, body, its length (None if unknown) and extra headers to upload
+        """
+        if not self._compressible(report_filename, report_mime_type):
+            return report_filename, report_mime_type, body, length, {}
+        if isinstance(body, bytes):
+            if len(body) < self.threshold:
+                return report_filename, report_mime_type, body, length, {}
+            compressor = self._compressor()
+            data = compressor.compress(body) + compressor.flush()
+            if on_done is not None:
+                on_done(len(body), len(data))
+            return self._renamed(report_filename, report_mime_type, data, len(data))
+        if length is not None and length < self.threshold:
+            return report_filename, report_mime_type, body, length, {}
+        chunks = iter_body_chunks(body)
+        if length is None:
+            # Read ahead until the size is known to reach the threshold
+            head = []
+            n = 0
+            for chunk in chunks:
+                head.append(chunk)
+                n += len(chunk)
+                if n >= self.threshold:
+                    break
+            if n < self.threshold:
+                data = b''.join(head)
+                return report_filename, report_mime_type, data, len(data), {}
+            chunks = itertools.chain(head, chunks)
+        return self._renamed(report_filename, report_mime_type, self._compressed_chunks(chunks, on_done), None)
+
+    def _compressible(self, report_filename, report_mime_type):
+        if os.path.splitext(report_filename or '')[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+            return False
+        mime_type = (report_mime_type or '').split(';')[0].strip().lower()
+        return mime_type not in INCOMPRESSIBLE_MIME_TYPES and mime_type.split('/')[0] not in ('image', 'audio', 'video')
+
+    def _compressor(self):
+        if self.method == 'zstd':
+            return zstandard.ZstdCompressor(level=self.level).compressobj()
+        # wbits 16 + 15 writes a gzip header and trailer around the deflate stream
+        return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def _compressed_chunks(self, chunks, on_done):
+        compressor = self._compressor()
+        n_in = 0
+        n_out = 0
+        for chunk in chunks:
+            n_in += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                n_out += len(data)
+                yield data
+        data = compressor.flush()
+        n_out += len(data)
+        yield data
+        if on_done is not None:
+            on_done(n_in, n_out)
+
+    def _renamed(self, report_filename, report_mime_type, body, length):
+        if self.mode == 'content-encoding':
+            return report_filename, report_mime_type, body, length, {'Content-Encoding': self.method}
+        _, extension, mime_type = self.METHODS[self.method]
+        return report_filename + extension, mime_type, body, length, {}
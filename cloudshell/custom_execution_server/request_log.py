@@ -0,0 +1,137 @@
+import logging
+import re
+
+from cloudshell.custom_execution_server.report_data import is_streamed_report_data
+
+
+_URL_PASSWORD = re.compile(r':[^@]*@')
+_JSON_PASSWORD = re.compile(r'"Password":\s*"[^"]*"')
+_COMMAND_URL_PASSWORD = re.compile(r':[^@:]*@')
+_COMMAND_ENV_PASSWORD = re.compile(r"CLOUDSHELL_PASSWORD:[^']*")
+
+# Redaction looks this far past the preview so a password cut off by truncation is still hidden
+_REDACTION_MARGIN = 256
+
+
+def redact(text):
+    """
+    Hides passwords in URLs and JSON login payloads
+    """
+    if ':' not in text:
+        return text
+    text = _URL_PASSWORD.sub(':(password hidden)@', text)
+    return _JSON_PASSWORD.sub('"Password": "(password hidden)"', text)
+
+
+def redact_command(command_list):
+    """
+    Hides passwords in URLs and CLOUDSHELL_PASSWORD arguments of a command line
+    """
+    pcommands = []
+    for command in command_list:
+        if ':' in command:
+            command = _COMMAND_URL_PASSWORD.sub(':(password hidden)@', command)
+            command = _COMMAND_ENV_PASSWORD.sub('CLOUDSHELL_PASSWORD:(password hidden)', command)
+        pcommands.append(command)
+    return pcommands
+
+
+def redact_env(env):
+    env = dict(env or {})
+    if 'CLOUDSHELL_PASSWORD' in env:
+        env['CLOUDSHELL_PASSWORD'] = '(hidden)'
+    return env
+
+
+class LazyCall:
+    """
+    Log argument that calls fn(*args) only if the record is emitted:
+
+        logger.debug('Running %s', LazyCall(redact_command, command_list))
+    """
+    __slots__ = ('_fn', '_args')
+
+    def __init__(self, fn, *args):
+        self._fn = fn
+        self._args = args
+
+    def __str__(self):
+        return str(self._fn(*self._args))
+
+
+class PayloadPreview:
+    """
+    Log argument for a request or response body, decoded, redacted and truncated only if the record is emitted
+    """
+    __slots__ = ('_data', '_limit', '_length')
+
+    def __init__(self, data, limit, length=None):
+        """
+        :param data: str, bytes, None or streamed report data
+        :param limit: int : Characters to show, the rest is summarized
+        :param length: int : Length of streamed data, if known
+        """
+        self._data = data
+        self._limit = limit
+        self._length = length
+
+    def __str__(self):
+        data = self._data
+        if data is None:
+            return ''
+        if is_streamed_report_data(data):
+            return '(streamed data, %s bytes)' % (self._length if self._length is not None else 'unknown')
+        size = len(data)
+        window = data[:self._limit + _REDACTION_MARGIN]
+        if not isinstance(window, type(u'')):
+            try:
+                window = window.decode('utf-8')
+            except UnicodeDecodeError as e:
+                if len(window) < size and e.start >= len(window) - 3:
+                    # A multi-byte character cut off at the end of the window
+                    window = window[:e.start].decode('utf-8')
+                else:
+                    return '(%d bytes binary data)' % size
+        text = redact(window)
+        if size > self._limit:
+            return '%s... (%d bytes in total)' % (text[:self._limit], size)
+        return text
+
+
+class RequestLogger:
+    """
+    DEBUG logging of CloudShell API requests and responses that costs nothing unless DEBUG records are emitted
+
+    Bodies are only decoded, redacted and truncated to preview_size characters when a record is formatted.
+    """
+    def __init__(self, logger, preview_size=4096):
+        """
+        :param logger: logging.Logger
+        :param preview_size: int : Characters of each request and response body to log
+        """
+        self._logger = logger
+        self.preview_size = preview_size
+
+    def request(self, counter, method, url, headers, data, content_length=None):
+        if not self._logger.isEnabledFor(logging.DEBUG):
+            return
+        self._logger.debug('Request %d: %s %s headers=%s data=<<<%s>>>',
+                           counter, method, url, LazyCall(self._redact_headers, headers),
+                           PayloadPreview(data, self.preview_size, content_length))
+
+    def response(self, counter, code, body, hidden=False):
+        if not self._logger.isEnabledFor(logging.DEBUG):
+            return
+        if hidden:
+            self._logger.debug('Result %d: %d: (hidden)', counter, code)
+        else:
+            self._logger.debug('Result %d: %d: %s', counter, code, PayloadPreview(body, self.preview_size))
+
+    @staticmethod
+    def _redact_headers(headers):
+        if not headers:
+            return headers
+        pheaders = dict(headers)
+        if 'Authorization' in pheaders:
+            pheaders['Authorization'] = '(token hidden)'
+        return pheaders
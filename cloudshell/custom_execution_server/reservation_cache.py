@@ -0,0 +1,124 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.fetched = False
+        self.value = None
+        self.error = None
+
+
+def _copy_error(error):
+    """
+    :param error: Exception
+    :return: Exception : A copy of error without its traceback, so that each waiting caller raises its own exception
+    """
+    try:
+        return copy.copy(error)
+    except Exception:
+        return Exception(str(error))
+
+
+class ReservationCache:
+    """
+    LRU cache of reservation details JSON with expiry, where concurrent lookups of the same reservation share one fetch
+    """
+    def __init__(self, fetch, max_size=100, ttl=30):
+        """
+        :param fetch: function : fetch(reservation_id) -> str : Fetches the reservation JSON from CloudShell, raising on failure
+        :param max_size: int : Maximum number of reservations kept
+        :param ttl: float : Seconds a cached reservation stays valid. 0 disables caching but still coalesces concurrent lookups.
+        """
+        self._fetch = fetch
+        self._max_size = max(1, int(max_size))
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._flights = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.evictions = 0
+
+    def get(self, reservation_id):
+        """
+        :param reservation_id: str
+        :return: str : Reservation JSON
+        :raises: Exception : The fetch error, a copy of it in every caller waiting on the same fetch
+        """
+        with self._lock:
+            entry = self._entries.pop(reservation_id, None)
+            if entry is not None:
+                value, expires = entry
+                if time.time() < expires:
+                    self._entries[reservation_id] = entry
+                    self.hits += 1
+                    return value
+            flight = self._flights.get(reservation_id)
+            if flight is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                self.misses += 1
+                flight = _Flight()
+                self._flights[reservation_id] = flight
+                leader = True
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise _copy_error(flight.error)
+            return flight.value
+
+        try:
+            flight.value = self._fetch(reservation_id)
+            flight.fetched = True
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            # Whatever the fetch raised, the waiters must not block forever nor find the flight again
+            try:
+                with self._lock:
+                    del self._flights[reservation_id]
+                    if not flight.fetched:
+                        self.errors += 1
+                        self._entries.pop(reservation_id, None)
+                        if flight.error is None:
+                            flight.error = Exception('Fetching reservation %s was interrupted' % reservation_id)
+                    elif self._ttl > 0:
+                        self._entries[reservation_id] = (flight.value, time.time() + self._ttl)
+                        while len(self._entries) > self._max_size:
+                            self._entries.popitem(last=False)
+                            self.evictions += 1
+            finally:
+                flight.done.set()
+        return flight.value
+
+    def invalidate(self, reservation_id):
+        with self._lock:
+            self._entries.pop(reservation_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        :return: dict : Hit, miss, coalesced, error and eviction counters and current size. Every hit and coalesced lookup is one CloudShell API call saved.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'errors': self.errors,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+            }
@@ -0,0 +1,547 @@
+import heapq
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+
+from cloudshell.custom_execution_server.compat import bytes23
+from cloudshell.custom_execution_server.connection_pool import CloudShellApiError, iter_body_chunks
+from cloudshell.custom_execution_server.journal import replace_file
+from cloudshell.custom_execution_server.report_cache import content_digest
+from cloudshell.custom_execution_server.report_data import ReportFile, is_streamed_report_data
+from cloudshell.custom_execution_server.worker_pool import WorkerPool
+
+
+class TokenBucket:
+    """
+    Limits the average rate of an operation while allowing short bursts
+    """
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: float : Operations per second, None or 0 for no limit
+        :param burst: int : Operations allowed back to back after an idle period, by default one second's worth
+        """
+        self._rate = rate
+        self._burst = float(burst or max(1, rate or 1))
+        self._tokens = self._burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, cancel_event=None, tokens=1):
+        """
+        Waits for tokens
+
+        :param cancel_event: threading.Event : Stop waiting early when set
+        :param tokens: float : Tokens to take, e.g. the size of a chunk when limiting bytes per second. More than the
+                               burst are taken one burst at a time, so the bucket never goes into debt.
+        :return: bool : False if cancelled
+        """
+        if not self._rate:
+            return True
+        remaining = tokens
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+                self._last = now
+                need = min(remaining, self._burst)
+                if self._tokens >= need:
+                    self._tokens -= need
+                    remaining -= need
+                    if remaining <= 0:
+                        return True
+                    continue
+                wait = (need - self._tokens) / self._rate
+            if cancel_event is not None:
+                if cancel_event.wait(wait):
+                    return False
+            else:
+                time.sleep(wait)
+
+
+class ResultReporter:
+    """
+    Queue that sends FinishedExecution results and their reports to CloudShell in the background
+
+    A new result for an execution whose previous result is still waiting replaces it. Failed sends are retried
+    with exponential backoff and jitter, and all sends share a requests-per-second limit. With a spool directory,
+    every queued result is written to disk until it has been sent, and results left over from a previous run are
+    queued again by start().
+
+    A result with a summary, the dict parsed from its output by output_parsers, gets a second small JSON report
+    named after the main one, so a verdict and the failing tests can be read without downloading the whole log.
+
+    A result's artifacts are uploaded after its main report, several at a time on a pool shared by all results.
+    Artifacts larger than the size limit are dropped with a warning, and a retry only resends the artifacts that
+    failed.
+
+    With a ReportCache, reports and artifacts identical to ones uploaded before are replaced by a short note naming
+    the earlier upload, or skipped.
+    """
+    def __init__(self, send_finished, send_report, logger,
+                 spool_directory=None,
+                 requests_per_second=None,
+                 max_retries=None,
+                 initial_backoff=1.0,
+                 max_backoff=60.0,
+                 sender_count=2,
+                 on_done=None,
+                 name='reporter',
+                 artifact_workers=4,
+                 artifact_max_bytes=None,
+                 on_artifact=None,
+                 report_cache=None,
+                 on_dedup=None):
+        """
+        :param send_finished: function : send_finished(execution_id, payload_dict) : Sends FinishedExecution, raising on failure
+        :param send_report: function : send_report(execution_id, report_filename, report_mime_type, report_data) : Uploads the ExecutionReport, raising on failure
+        :param logger: logging.Logger
+        :param spool_directory: str : Directory for persisting unsent results, None to keep them in memory only
+        :param requests_per_second: float : Limit on CloudShell requests made by the reporter, None for no limit
+        :param max_retries: int : Retries before a result is dropped, None to retry until sent
+        :param initial_backoff: float : Seconds before the first retry
+        :param max_backoff: float : Upper bound for the retry delay
+        :param sender_count: int : Number of threads sending results
+        :param on_done: function : on_done(execution_id, sent) : Called once a result has been sent or dropped
+        :param name: str : Prefix for sender thread names
+        :param artifact_workers: int : Artifacts uploaded at once across all results
+        :param artifact_max_bytes: int : Largest artifact uploaded, None for no limit
+        :param on_artifact: function : on_artifact(execution_id, name, size, outcome) : Called with outcome 'sent' or 'too_large' for each artifact
+        :param report_cache: ReportCache : Index of uploaded content for not uploading it again, None to always upload in full
+        :param on_dedup: function : on_dedup(execution_id, name, hit, bytes_saved) : Called for each report looked up in report_cache
+        """
+        self._send_finished = send_finished
+        self._send_report = send_report
+        self._logger = logger
+        self._spool_directory = spool_directory
+        self._max_retries = max_retries
+        self._initial_backoff = initial_backoff
+        self._max_backoff = max_backoff
+        self._sender_count = max(1, int(sender_count))
+        self._on_done = on_done
+        self._name = name
+        self.rate_limiter = TokenBucket(requests_per_second)
+        self._artifact_max_bytes = artifact_max_bytes
+        self._on_artifact = on_artifact
+        self._report_cache = report_cache
+        self._on_dedup = on_dedup
+        self._artifact_pool = WorkerPool(artifact_workers, artifact_workers, logger, name='%s-artifact' % name)
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._stopping = threading.Event()
+        self._pending = {}
+        self._in_flight = set()
+        self._heap = []
+        self._seq = itertools.count()
+        self._threads = []
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.retries = 0
+        self.dropped = 0
+        self.artifacts_sent = 0
+        self.artifacts_too_large = 0
+
+        if spool_directory and not os.path.isdir(spool_directory):
+            os.makedirs(spool_directory)
+
+    def start(self):
+        """
+        Starts the sender threads, first queueing any results persisted by a previous run
+        """
+        self._stopping.clear()
+        if self._spool_directory:
+            self._load_spool()
+        self._artifact_pool.start()
+        for i in range(self._sender_count):
+            th = threading.Thread(target=self._sender_thread, name='%s-%d' % (self._name, i))
+            th.daemon = True
+            th.start()
+            self._threads.append(th)
+
+    def stop(self, timeout=10):
+        """
+        Waits up to timeout seconds for queued results to be sent, then stops the sender threads.
+        Unsent results stay in the spool directory for the next start().
+        """
+        deadline = time.time() + timeout
+        with self._lock:
+            while (self._pending or self._in_flight) and time.time() < deadline:
+                self._changed.wait(max(0, min(0.5, deadline - time.time())))
+        self._stopping.set()
+        with self._lock:
+            self._changed.notify_all()
+        for th in self._threads:
+            th.join(max(0, deadline - time.time()) + 1)
+        self._threads = []
+        self._artifact_pool.stop()
+
+    def submit(self, execution_id, result):
+        """
+        Queues the result of an execution, and its report if it has one
+
+        :param execution_id: str
+        :param result: CommandResult
+        """
+        entry = {
+            'execution_id': execution_id,
+            'seq': next(self._seq),
+            'finished': {
+                'ExecutionId': execution_id,
+                'Result': result.result,
+                'ErrorDescription': result.error_description,
+                'ErrorName': result.error_name,
+            },
+            'finished_sent': False,
+            'report_filename': result.report_filename,
+            'report_mime_type': result.report_mime_type,
+            'report_path': None,
+            'report_delete': False,
+            'report_sent': False,
+            'summary': None,
+            'artifacts': [],
+            'attempts': 0,
+        }
+        if getattr(result, 'summary', None) is not None:
+            entry['summary'] = json.dumps(result.summary, separators=(',', ':'), sort_keys=True)
+        report_data = None
+        if result.report_filename:
+            entry['report_path'], entry['report_delete'], report_data = self._prepare_report(result.report_data)
+        artifact_data = {}
+        for artifact in getattr(result, 'artifacts', None) or []:
+            self._add_artifact(entry, artifact, artifact_data)
+        self._persist(entry)
+
+        with self._lock:
+            old = self._pending.get(execution_id)
+            if old is not None:
+                self.coalesced += 1
+                self._release(old)
+            entry['_report_data'] = report_data
+            entry['_artifact_data'] = artifact_data
+            self._pending[execution_id] = entry
+            heapq.heappush(self._heap, (time.time(), entry['seq'], execution_id))
+            self.submitted += 1
+            self._changed.notify()
+
+    def throttle(self):
+        """
+        Waits for the shared rate limit, for other reporting requests such as the status heartbeat
+
+        :return: bool : False if the reporter is stopping
+        """
+        return self.rate_limiter.acquire(self._stopping)
+
+    def stats(self):
+        """
+        :return: dict : Queue depth, results in flight and counters of results submitted, coalesced, sent, retried and dropped
+        """
+        with self._lock:
+            return {
+                'queue_depth': len(self._pending),
+                'in_flight': len(self._in_flight),
+                'submitted': self.submitted,
+                'coalesced': self.coalesced,
+                'sent': self.sent,
+                'retries': self.retries,
+                'dropped': self.dropped,
+                'artifacts_sent': self.artifacts_sent,
+                'artifacts_too_large': self.artifacts_too_large,
+            }
+
+    def _prepare_report(self, report_data):
+        """
+        Makes report data resendable: ReportFiles are referenced by path, streams are copied to disk,
+        and in-memory data is kept in memory or spooled if there is a spool directory
+
+        :return: (str, bool, bytes) : Path of the data on disk and whether it is ours to delete, or the data in memory
+        """
+        if isinstance(report_data, ReportFile):
+            return report_data.path, report_data.delete, None
+        if not is_streamed_report_data(report_data) and not self._spool_directory:
+            return None, False, bytes23(report_data)
+        fd, path = tempfile.mkstemp(prefix='report-', suffix='.dat', dir=self._spool_directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if is_streamed_report_data(report_data):
+                    for chunk in iter_body_chunks(report_data):
+                        f.write(chunk)
+                else:
+                    f.write(bytes23(report_data))
+        finally:
+            close = getattr(report_data, 'close', None)
+            if close is not None:
+                close()
+        return path, True, None
+
+    def _add_artifact(self, entry, artifact, artifact_data):
+        path, delete, data = self._prepare_report(artifact.report_data)
+        size = os.path.getsize(path) if path and os.path.exists(path) else len(data or b'')
+        a = {
+            'name': artifact.name,
+            'mime_type': artifact.mime_type,
+            'path': path,
+            'delete': delete,
+            'cleanup_directory': getattr(artifact, 'cleanup_directory', None),
+            'size': size,
+            'sent': False,
+            'dropped': False,
+        }
+        if self._artifact_max_bytes is not None and size > self._artifact_max_bytes:
+            self._logger.warning('Not uploading artifact %s of execution %s: %d bytes is over the limit of %d' % (
+                artifact.name, entry['execution_id'], size, self._artifact_max_bytes))
+            a['dropped'] = True
+            with self._lock:
+                self.artifacts_too_large += 1
+            if self._on_artifact is not None:
+                self._on_artifact(entry['execution_id'], artifact.name, size, 'too_large')
+        elif data is not None:
+            artifact_data[len(entry['artifacts'])] = data
+        entry['artifacts'].append(a)
+
+    def _spool_path(self, entry):
+        return os.path.join(self._spool_directory, '%s-%d.json' % (re.sub(r'[^-\w.]', '_', entry['execution_id']), entry['seq']))
+
+    def _persist(self, entry):
+        if not self._spool_directory:
+            return
+        path = self._spool_path(entry)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(dict((k, v) for k, v in entry.items() if not k.startswith('_')), f)
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(path + '.tmp', path)
+
+    def _release(self, entry):
+        """
+        Deletes the spool file and any report file owned by an entry that was sent, dropped or replaced
+        """
+        if self._spool_directory:
+            try:
+                os.remove(self._spool_path(entry))
+            except OSError:
+                pass
+        if entry.get('report_delete') and entry.get('report_path'):
+            try:
+                os.remove(entry['report_path'])
+            except OSError:
+                pass
+        cleanup_directories = set()
+        for a in entry.get('artifacts') or []:
+            if a['delete'] and a['path']:
+                try:
+                    os.remove(a['path'])
+                except OSError:
+                    pass
+            if a.get('cleanup_directory'):
+                cleanup_directories.add(a['cleanup_directory'])
+        for directory in cleanup_directories:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _load_spool(self):
+        n = 0
+        for filename in sorted(os.listdir(self._spool_directory)):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self._spool_directory, filename)) as f:
+                    entry = json.load(f)
+            except Exception as e:
+                self._logger.warning('Ignoring unreadable spooled result %s: %s' % (filename, str(e)))
+                continue
+            os.remove(os.path.join(self._spool_directory, filename))
+            entry['seq'] = next(self._seq)
+            entry['_report_data'] = None
+            entry['_artifact_data'] = {}
+            if entry.get('report_path') and not os.path.exists(entry['report_path']):
+                entry['report_filename'] = ''
+            for a in entry.get('artifacts') or []:
+                if not a['path'] or not os.path.exists(a['path']):
+                    # Kept in memory by the previous run, or deleted since
+                    a['dropped'] = True
+            self._persist(entry)
+            with self._lock:
+                self._pending[entry['execution_id']] = entry
+                heapq.heappush(self._heap, (time.time(), entry['seq'], entry['execution_id']))
+                self.submitted += 1
+            n += 1
+        if n:
+            self._logger.info('Queued %d unsent results from %s' % (n, self._spool_directory))
+
+    def _next_entry(self):
+        with self._lock:
+            while not self._stopping.is_set():
+                now = time.time()
+                if self._heap:
+                    due, seq, execution_id = self._heap[0]
+                    entry = self._pending.get(execution_id)
+                    if entry is None or entry['seq'] != seq:
+                        heapq.heappop(self._heap)
+                        continue
+                    if due > now:
+                        self._changed.wait(due - now)
+                        continue
+                    if execution_id in self._in_flight:
+                        # Retried once the older result of the execution is sent
+                        heapq.heapreplace(self._heap, (now + 0.1, seq, execution_id))
+                        continue
+                    heapq.heappop(self._heap)
+                    del self._pending[execution_id]
+                    self._in_flight.add(execution_id)
+                    return entry
+                else:
+                    self._changed.wait(1)
+            return None
+
+    def _sender_thread(self):
+        while True:
+            entry = self._next_entry()
+            if entry is None:
+                return
+            execution_id = entry['execution_id']
+            try:
+                self._send(entry)
+            except Exception as e:
+                retry = not (isinstance(e, CloudShellApiError) and e.is_permanent())
+                entry['attempts'] += 1
+                if retry and (self._max_retries is None or entry['attempts'] <= self._max_retries):
+                    delay = random.uniform(0, min(self._max_backoff, self._initial_backoff * 2 ** (entry['attempts'] - 1)))
+                    self._logger.warning('Failed to report execution %s (attempt %d), retrying in %.1fs: %s' % (execution_id, entry['attempts'], delay, str(e)))
+                    self._persist(entry)
+                    with self._lock:
+                        self.retries += 1
+                        self._in_flight.discard(execution_id)
+                        if execution_id in self._pending:
+                            # A newer result arrived while this one was being sent
+                            self.coalesced += 1
+                            self._release(entry)
+                        else:
+                            self._pending[execution_id] = entry
+                            heapq.heappush(self._heap, (time.time() + delay, entry['seq'], execution_id))
+                        self._changed.notify_all()
+                    continue
+                self._logger.error('Dropping result of execution %s after %d attempts: %s: %s' % (execution_id, entry['attempts'], str(e), traceback.format_exc()))
+                sent = False
+            else:
+                sent = True
+            self._release(entry)
+            with self._lock:
+                self._in_flight.discard(execution_id)
+                if sent:
+                    self.sent += 1
+                else:
+                    self.dropped += 1
+                self._changed.notify_all()
+            if self._on_done is not None:
+                self._on_done(execution_id, sent)
+
+    def _send(self, entry):
+        execution_id = entry['execution_id']
+        if not entry['finished_sent']:
+            if not self.rate_limiter.acquire(self._stopping):
+                raise Exception('Reporter stopping')
+            self._send_finished(execution_id, entry['finished'])
+            entry['finished_sent'] = True
+            self._persist(entry)
+        if entry['report_filename'] and not entry.get('report_sent'):
+            if not self.rate_limiter.acquire(self._stopping):
+                raise Exception('Reporter stopping')
+            self._upload(execution_id, entry['report_filename'], entry['report_mime_type'], entry['report_path'], entry['_report_data'])
+            entry['report_sent'] = True
+            self._persist(entry)
+        if entry.get('summary'):
+            if not self.rate_limiter.acquire(self._stopping):
+                raise Exception('Reporter stopping')
+            self._send_report(execution_id, summary_filename(entry['report_filename']), 'application/json', entry['summary'])
+            entry['summary'] = None
+            self._persist(entry)
+        artifacts = [(i, a) for i, a in enumerate(entry.get('artifacts') or []) if not a['sent'] and not a['dropped']]
+        if artifacts:
+            self._send_artifacts(entry, artifacts)
+
+    def _send_artifacts(self, entry, artifacts):
+        """
+        Uploads artifacts on the artifact pool and waits for all of them, raising the first error once they are done
+        """
+        done = threading.Condition(threading.Lock())
+        remaining = [len(artifacts)]
+        errors = []
+
+        def upload(i, a):
+            try:
+                self._send_artifact(entry, i, a)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                with done:
+                    remaining[0] -= 1
+                    done.notify_all()
+
+        for i, a in artifacts:
+            if not self._artifact_pool.submit(upload, (i, a), block=True, stop_event=self._stopping):
+                with done:
+                    remaining[0] -= 1
+                errors.append(Exception('Reporter stopping'))
+        with done:
+            while remaining[0]:
+                done.wait(1)
+        self._persist(entry)
+        if errors:
+            raise errors[0]
+
+    def _send_artifact(self, entry, i, a):
+        execution_id = entry['execution_id']
+        if not self.rate_limiter.acquire(self._stopping):
+            raise Exception('Reporter stopping')
+        self._upload(execution_id, a['name'], a['mime_type'], a['path'], None if a['path'] else entry['_artifact_data'][i])
+        a['sent'] = True
+        with self._lock:
+            self.artifacts_sent += 1
+        if self._on_artifact is not None:
+            self._on_artifact(execution_id, a['name'], a['size'], 'sent')
+
+    def _upload(self, execution_id, report_filename, report_mime_type, path, data):
+        """
+        Uploads a report from a file or memory, or a note instead if the report cache has seen the same content
+        """
+        cache = self._report_cache
+        size = os.path.getsize(path) if path else len(data)
+        if cache is None or size < cache.min_bytes:
+            self._send_report(execution_id, report_filename, report_mime_type, ReportFile(path) if path else data)
+            return
+        digest, size = content_digest(path, data)
+        earlier = cache.lookup(digest, size, execution_id)
+        if earlier is None:
+            self._send_report(execution_id, report_filename, report_mime_type, ReportFile(path) if path else data)
+            cache.record(digest, size, execution_id, report_filename)
+            saved = 0
+        elif cache.action == 'note':
+            note = bytes23(cache.note(earlier, digest))
+            self._send_report(execution_id, cache.note_filename(report_filename), 'text/plain', note)
+            saved = max(0, size - len(note))
+        else:
+            saved = size
+        if earlier is not None:
+            cache.saved(saved)
+            self._logger.info('Report %s of execution %s is identical to %s of execution %s, saved %d bytes' % (
+                report_filename, execution_id, earlier['report_filename'], earlier['execution_id'], saved))
+        if self._on_dedup is not None:
+            self._on_dedup(execution_id, report_filename, earlier is not None, saved)
+
+
+def summary_filename(report_filename):
+    """
+    :param report_filename: str : Name of the main report, e.g. output.log
+    :return: str : Name of its summary report, e.g. output.summary.json
+    """
+    if not report_filename:
+        return 'summary.json'
+    return '%s.summary.json' % os.path.splitext(report_filename)[0]
@@ -0,0 +1,92 @@
+import threading
+import time
+import traceback
+
+
+class PeriodicTask:
+    """
+    Runs a function in its own thread on an interval, early when triggered, and stops as soon as the stop event is set
+
+    Triggers are debounced: a burst of trigger() calls within the debounce period leads to one run. If the function
+    returns False, meaning there was nothing to do, the interval doubles up to idle_interval; a trigger or a run
+    returning True resets it.
+    """
+    def __init__(self, fn, interval, stop_event, logger, debounce=0.0, idle_interval=None, name='periodic'):
+        """
+        :param fn: function : fn() -> bool or None : Return False when idle to back off
+        :param interval: float : Seconds between runs
+        :param stop_event: threading.Event : Shared by every task of the server; setting it wakes all of them
+        :param logger: logging.Logger
+        :param debounce: float : Seconds to wait after a trigger for more triggers before running
+        :param idle_interval: float : Upper bound for the backed off interval, by default no backoff
+        :param name: str : Thread name
+        """
+        self._fn = fn
+        self._interval = interval
+        self._idle_interval = max(interval, idle_interval or interval)
+        self._debounce = debounce
+        self._stop_event = stop_event
+        self._logger = logger
+        self._name = name
+        self._wake = threading.Condition(threading.Lock())
+        self._triggered_at = None
+        self._thread = None
+
+        self.runs = 0
+        self.triggered_runs = 0
+
+    def start(self):
+        """
+        :return: threading.Thread
+        """
+        self._thread = threading.Thread(target=self._run, name=self._name)
+        self._thread.start()
+        return self._thread
+
+    def trigger(self):
+        """
+        Requests a run after the debounce period
+        """
+        with self._wake:
+            if self._triggered_at is None:
+                self._triggered_at = time.time()
+            self._wake.notify()
+
+    def wake(self):
+        """
+        Wakes the thread so it notices that the stop event was set
+        """
+        with self._wake:
+            self._wake.notify()
+
+    def _run(self):
+        interval = self._interval
+        next_run = time.time()
+        while not self._stop_event.is_set():
+            with self._wake:
+                while not self._stop_event.is_set():
+                    now = time.time()
+                    if self._triggered_at is not None:
+                        due = min(next_run, self._triggered_at + self._debounce)
+                    else:
+                        due = next_run
+                    if now >= due:
+                        break
+                    self._wake.wait(due - now)
+                if self._stop_event.is_set():
+                    return
+                triggered = self._triggered_at is not None
+                self._triggered_at = None
+            try:
+                busy = self._fn()
+            except Exception as e:
+                self._logger.warning('%s failed: %s: %s' % (self._name, str(e), traceback.format_exc()))
+                busy = True
+            self.runs += 1
+            if triggered:
+                self.triggered_runs += 1
+            if busy is False and not triggered:
+                interval = min(self._idle_interval, interval * 2)
+            else:
+                interval = self._interval
+            next_run = time.time() + interval
@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: processes sharing a token file may then log in at the same time
+    fcntl = None
+
+from cloudshell.custom_execution_server.journal import replace_file
+
+
+class CloudShellSession:
+    """
+    CloudShell API auth token, shared by every server that logs in as the same user so they log in only once
+
+    With a token_file, the token is also shared with the other processes on the host logging in as the same user: a
+    process starting up takes the token from the file instead of logging in, and a process that has to log in holds a
+    lock on the file meanwhile, so the others wait and take its token.
+
+    With max_age, a token is renewed once it is older than max_age - refresh_margin: the first request to notice logs in
+    again while the other requests carry on with the current token. A token CloudShell rejects is renewed with
+    relogin(); callers that were rejected with the same token share one login.
+    """
+    def __init__(self, token_file=None, max_age=None, refresh_margin=60, logger=None):
+        """
+        :param token_file: str : File to share the token through, one per CloudShell host and user. It is created readable by its owner only. None to keep the token in this process.
+        :param max_age: float : Seconds a token is valid for after logging in, None if tokens don't expire
+        :param refresh_margin: float : Seconds before max_age the token is renewed
+        :param logger: logging.Logger : For failures to write the token file
+        """
+        self._token_file = token_file
+        self._max_age = max_age
+        self._refresh_margin = refresh_margin
+        self._logger = logger
+        self._lock = threading.Lock()
+        self.token = None
+        self.issued = None
+
+        self.logins = 0
+        self.refreshes = 0
+        self.rejected = 0
+        self.shared = 0
+
+    def ensure_login(self, login):
+        """
+        Logs in unless already logged in with a token that isn't due for renewal. Concurrent callers wait for the one
+        login in progress, unless their token is still valid.
+
+        :param login: function : login() -> str : Logs in and returns the token
+        :return: str : Token
+        """
+        token, issued = self.token, self.issued
+        if token is not None and not self._due(issued, self._refresh_margin):
+            return token
+        if token is not None and not self._due(issued, 0):
+            if not self._lock.acquire(False):
+                # Another thread is renewing it
+                return token
+            try:
+                return self._renew(login, token, False)
+            finally:
+                self._lock.release()
+        with self._lock:
+            return self._renew(login, token, False)
+
+    def relogin(self, login, rejected_token):
+        """
+        Replaces a token that CloudShell rejected, unless another caller already has
+
+        :param login: function : login() -> str
+        :param rejected_token: str : Token the request was rejected with
+        :return: str : New token
+        """
+        with self._lock:
+            return self._renew(login, rejected_token, True)
+
+    def stats(self):
+        """
+        :return: dict : Token age, and counters of logins, of which proactive refreshes and renewals of rejected tokens, and of tokens taken from the token file
+        """
+        return {
+            'token_age': time.time() - self.issued if self.issued is not None else None,
+            'logins': self.logins,
+            'refreshes': self.refreshes,
+            'rejected': self.rejected,
+            'shared': self.shared,
+        }
+
+    def _due(self, issued, margin):
+        return self._max_age is not None and time.time() - issued >= self._max_age - margin
+
+    def _renew(self, login, stale, rejected):
+        # Called holding _lock
+        if self.token is not None and self.token != stale and not self._due(self.issued, self._refresh_margin):
+            # Renewed by the thread this one waited for
+            return self.token
+        lock_file = self._lock_token_file()
+        try:
+            shared = self._read_token_file()
+            if shared is not None and shared['token'] != stale and not self._due(shared['time'], self._refresh_margin):
+                self.token, self.issued = shared['token'], shared['time']
+                self.shared += 1
+                return self.token
+            token = login()
+            self.token, self.issued = token, time.time()
+            self.logins += 1
+            if rejected:
+                self.rejected += 1
+            elif stale is not None:
+                self.refreshes += 1
+            self._write_token_file()
+            return token
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+
+    def _lock_token_file(self):
+        """
+        :return: file : Open lock file holding an exclusive lock, released by closing it. None without a token file or fcntl.
+        """
+        if not self._token_file or fcntl is None:
+            return None
+        directory = os.path.dirname(self._token_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        f = open(self._token_file + '.lock', 'a')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        except Exception:
+            f.close()
+            raise
+        return f
+
+    def _read_token_file(self):
+        if not self._token_file:
+            return None
+        try:
+            with open(self._token_file) as f:
+                o = json.load(f)
+            return o if o.get('token') and isinstance(o.get('time'), (int, float)) else None
+        except (IOError, OSError, ValueError, AttributeError):
+            return None
+
+    def _write_token_file(self):
+        if not self._token_file:
+            return
+        tmp = '%s.%d.tmp' % (self._token_file, os.getpid())
+        try:
+            with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump({'token': self.token, 'time': self.issued}, f)
+            replace_file(tmp, self._token_file)
+        except (IOError, OSError) as e:
+            # This process has the token anyway, the others will log in themselves
+            if self._logger:
+                self._logger.warning('Failed to write token file %s: %s' % (self._token_file, str(e)))
@@ -0,0 +1,178 @@
+import os
+import re
+import threading
+
+from cloudshell.custom_execution_server.connection_pool import HttpConnectionPool
+from cloudshell.custom_execution_server.custom_execution_server import CustomExecutionServer
+from cloudshell.custom_execution_server.metrics import MetricsRegistry, MetricsServer
+from cloudshell.custom_execution_server.session import CloudShellSession
+from cloudshell.custom_execution_server.worker_pool import FairWorkerPool
+
+
+class ServerSupervisor:
+    """
+    Hosts several CustomExecutionServers in one process
+
+    The servers share one keep-alive connection pool, one login per CloudShell user, one metrics registry and
+    endpoint, and one pool of worker threads that FairWorkerPool divides between them by weight. Each server still
+    long-polls for its own commands and can be started, stopped, added and removed without affecting the others.
+    """
+    def __init__(self, logger, cloudshell_host, cloudshell_port, worker_count,
+                 connection_pool=None, metrics_port=None, metrics_host='127.0.0.1', token_directory=None, token_max_age=None):
+        """
+        :param logger: logging.Logger : Default logger for the servers and the shared pools
+        :param cloudshell_host: str
+        :param cloudshell_port: int
+        :param worker_count: int : Executions running at once across all servers. Each server is also held to its own capacity.
+        :param connection_pool: HttpConnectionPool : By default one is created with a connection per worker
+        :param metrics_port: int : Serve the metrics of all servers at http://metrics_host:metrics_port/metrics, None to not serve them
+        :param metrics_host: str
+        :param token_directory: str : Directory of token files, one per CloudShell user, so that other processes on the host logging in as the same user share their logins. None to not share them.
+        :param token_max_age: float : Seconds an auth token is valid for, see CloudShellSession
+        """
+        self._logger = logger
+        self._cloudshell_host = cloudshell_host
+        self._cloudshell_port = cloudshell_port
+        self._connection_pool = connection_pool or HttpConnectionPool(max_size=max(4, int(worker_count)))
+        self._worker_pool = FairWorkerPool(worker_count, logger)
+        self.metrics = MetricsRegistry()
+        self._metrics_server = MetricsServer(self.metrics, metrics_host, metrics_port, logger) if metrics_port is not None else None
+        self._metrics_started = False
+        self._token_directory = token_directory
+        self._token_max_age = token_max_age
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._servers = {}
+        self._running = set()
+
+    def add_server(self, server_name, server_description, server_type, server_capacity, command_handler,
+                   cloudshell_username, cloudshell_password, cloudshell_domain, weight=1, logger=None, **kwargs):
+        """
+        Registers a server on CloudShell and hosts it, stopped until start(server_name)
+
+        :param weight: float : Share of the shared workers when servers compete for them
+        :param logger: logging.Logger : By default the supervisor's logger
+        :param kwargs: Other CustomExecutionServer arguments, e.g. worker_queue_size or journal_path
+        :return: CustomExecutionServer
+        """
+        with self._lock:
+            if server_name in self._servers:
+                raise Exception('Execution server %s is already hosted' % server_name)
+            key = (cloudshell_username, cloudshell_domain)
+            session = self._sessions.get(key)
+            if session is None:
+                session = CloudShellSession(token_file=self._token_file(cloudshell_username, cloudshell_domain),
+                                            max_age=self._token_max_age,
+                                            logger=self._logger)
+                self._sessions[key] = session
+        server = CustomExecutionServer(server_name=server_name,
+                                       server_description=server_description,
+                                       server_type=server_type,
+                                       server_capacity=server_capacity,
+                                       command_handler=command_handler,
+                                       logger=logger or self._logger,
+                                       cloudshell_host=self._cloudshell_host,
+                                       cloudshell_port=self._cloudshell_port,
+                                       cloudshell_username=cloudshell_username,
+                                       cloudshell_password=cloudshell_password,
+                                       cloudshell_domain=cloudshell_domain,
+                                       auto_register=True,
+                                       auto_start=False,
+                                       connection_pool=self._connection_pool,
+                                       metrics=self.metrics,
+                                       session=session,
+                                       worker_pool=self._worker_pool,
+                                       worker_weight=weight,
+                                       **kwargs)
+        with self._lock:
+            self._servers[server_name] = server
+        return server
+
+    def remove_server(self, server_name):
+        """
+        Stops a server and stops hosting it. Its running executions still finish and report their results.
+        """
+        self.stop(server_name)
+        with self._lock:
+            self._servers.pop(server_name)
+        self._worker_pool.remove_tenant(server_name)
+
+    def server(self, server_name):
+        """
+        :return: CustomExecutionServer
+        """
+        return self._servers[server_name]
+
+    def server_names(self):
+        with self._lock:
+            return sorted(self._servers)
+
+    def start(self, server_name=None):
+        """
+        :param server_name: str : Server to start, None for all stopped servers
+        """
+        if self._metrics_server and not self._metrics_started:
+            self._metrics_server.start()
+            self._metrics_started = True
+        for name in self._select(server_name):
+            with self._lock:
+                if name in self._running:
+                    continue
+                self._running.add(name)
+            self._logger.info('Starting execution server %s' % name)
+            self._servers[name].start()
+
+    def stop(self, server_name=None):
+        """
+        :param server_name: str : Server to stop, None for all running servers. The others keep running.
+        """
+        for name in self._select(server_name):
+            with self._lock:
+                if name not in self._running:
+                    continue
+                self._running.discard(name)
+            self._logger.info('Stopping execution server %s' % name)
+            self._servers[name].stop()
+
+    def close(self):
+        """
+        Stops every server, the shared workers once their queued executions have run, and the metrics endpoint
+        """
+        self.stop()
+        self._worker_pool.stop()
+        if self._metrics_started:
+            self._metrics_server.stop()
+            self._metrics_started = False
+
+    def stats(self):
+        """
+        :return: dict : Per server running flag and worker stats, the shared worker pool, the number of logins and of tokens taken from token files
+        """
+        with self._lock:
+            running = set(self._running)
+            sessions = list(self._sessions.values())
+        pool = self._worker_pool.stats()
+        return {
+            'servers': dict((name, {
+                'running': name in running,
+                'workers': pool['tenants'].get(name),
+            }) for name in self.server_names()),
+            'workers': pool['workers'],
+            'busy': pool['busy'],
+            'queue_depth': pool['queue_depth'],
+            'logins': sum(s.logins for s in sessions),
+            'shared_logins': sum(s.shared for s in sessions),
+        }
+
+    def _token_file(self, username, domain):
+        if not self._token_directory:
+            return None
+        name = '%s_%s_%s.token' % (self._cloudshell_host, domain, username)
+        return os.path.join(self._token_directory, re.sub(r'[^-@.a-zA-Z0-9_]', '_', name))
+
+    def _select(self, server_name):
+        if server_name is None:
+            return self.server_names()
+        if server_name not in self._servers:
+            raise Exception('Execution server %s is not hosted' % server_name)
+        return [server_name]
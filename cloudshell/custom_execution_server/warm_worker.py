@@ -0,0 +1,221 @@
+"""
+Warm Python interpreter started by WarmPoolBackend, which imports the runtime's modules once and then runs one test
+at a time in this process, saving the interpreter startup and imports of every test
+
+The protocol runs over a Unix socket, one JSON object per line:
+
+    ready    {"ready": true, "rss": <bytes>} once the modules are imported, or {"error": "..."} if one failed
+    run      {"path": "test.py"} or {"module": "robot"}, with "argv": [...], "env": {...}, "cwd": "/dir" or null and
+             "rlimits": {"RLIMIT_CPU": 60} or null, and the write end of the test's output pipe attached as SCM_RIGHTS
+    exit     {"exit": <exit code>, "rusage": {...}, "rss": <bytes>, "threads": <threads left running>}, once per run
+
+Between runs the environment, working directory, sys.argv, sys.path and resource limits are restored and the modules
+the test imported are unloaded, so the next test imports its own code afresh. The worker exits when the socket is
+closed, and is killed with its process group to stop a test.
+
+Only uses the standard library, so it can run on another interpreter than the server's:
+
+    python warm_worker.py <socket fd> [module ...]
+"""
+import array
+import importlib
+import json
+import os
+import runpy
+import signal
+import socket
+import sys
+import threading
+import traceback
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _send(sock, message):
+    sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+
+def _rss():
+    """
+    :return: int : Resident memory of this process in bytes, None if unavailable
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    if resource is not None:
+        # Peak rather than current, in kilobytes on Linux and bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return None
+
+
+def _exit_code(code):
+    # As the interpreter exits with sys.exit(code)
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code % 256
+    sys.stderr.write('%s\n' % code)
+    return 1
+
+
+class _Worker:
+    def __init__(self, sock):
+        self._sock = sock
+        self._buf = b''
+        self._fds = []
+        self._modules = set(sys.modules)
+        self._env = dict(os.environ)
+        self._cwd = os.getcwd()
+        self._path = list(sys.path)
+        self._argv = list(sys.argv)
+        self._threads = threading.active_count()
+
+    def receive(self):
+        """
+        :return: (dict, int) : Next request and the descriptor attached to it, (None, None) once the socket is closed
+        """
+        fd_size = array.array('i').itemsize
+        while b'\n' not in self._buf:
+            data, ancdata, _, _ = self._sock.recvmsg(65536, socket.CMSG_SPACE(4 * fd_size))
+            for level, kind, cdata in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    a = array.array('i')
+                    a.frombytes(cdata[:len(cdata) - len(cdata) % fd_size])
+                    self._fds.extend(a)
+            if not data:
+                return None, None
+            self._buf += data
+        line, self._buf = self._buf.split(b'\n', 1)
+        return json.loads(line.decode('utf-8')), self._fds.pop(0)
+
+    def run(self, job, output_fd):
+        """
+        Runs one test with its output going to output_fd, which is closed afterwards
+
+        :return: dict : Exit message
+        """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved = os.dup(1), os.dup(2)
+        os.dup2(output_fd, 1)
+        os.dup2(output_fd, 2)
+        os.close(output_fd)
+        os.environ.clear()
+        os.environ.update(job.get('env') or {})
+        limits = {}
+        before = resource.getrusage(resource.RUSAGE_SELF) if resource is not None else None
+        try:
+            if job.get('cwd'):
+                os.chdir(job['cwd'])
+            limits = self._set_rlimits(job.get('rlimits'), before)
+            sys.argv = list(job['argv'])
+            if 'module' in job:
+                runpy.run_module(job['module'], run_name='__main__', alter_sys=True)
+            elif not os.path.exists(job['path']):
+                # As the interpreter reports it
+                sys.stderr.write("%s: can't open file '%s': [Errno 2] No such file or directory\n" % (sys.executable, job['path']))
+                raise SystemExit(2)
+            else:
+                # As the interpreter does for a script
+                sys.path.insert(0, os.path.dirname(os.path.abspath(job['path'])))
+                runpy.run_path(job['path'], run_name='__main__')
+            code = 0
+        except SystemExit as e:
+            code = _exit_code(e.code)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            except Exception:
+                pass
+            for name, previous in limits.items():
+                resource.setrlimit(getattr(resource, name), previous)
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+            self._reset()
+        message = {'exit': code, 'rss': _rss(), 'threads': threading.active_count() - self._threads}
+        if before is not None:
+            after = resource.getrusage(resource.RUSAGE_SELF)
+            message['rusage'] = {
+                'utime': after.ru_utime - before.ru_utime,
+                'stime': after.ru_stime - before.ru_stime,
+                # This interpreter's peak, including the runs before
+                'maxrss': after.ru_maxrss,
+                'inblock': after.ru_inblock - before.ru_inblock,
+                'oublock': after.ru_oublock - before.ru_oublock,
+            }
+        return message
+
+    @staticmethod
+    def _set_rlimits(rlimits, usage):
+        """
+        Lowers the soft limits for one run, leaving the hard limits so they can be raised again
+
+        :return: dict : Limit name -> previous (soft, hard) to restore
+        """
+        previous = {}
+        for name, value in (rlimits or {}).items():
+            kind = getattr(resource, name)
+            soft, hard = resource.getrlimit(kind)
+            if name == 'RLIMIT_CPU':
+                # CPU time counts from the start of the process, not of the run
+                value += int(usage.ru_utime + usage.ru_stime) + 1
+            if hard != resource.RLIM_INFINITY:
+                value = min(value, hard)
+            resource.setrlimit(kind, (value, hard))
+            previous[name] = (soft, hard)
+        return previous
+
+    def _reset(self):
+        os.environ.clear()
+        os.environ.update(self._env)
+        os.chdir(self._cwd)
+        sys.argv = list(self._argv)
+        sys.path[:] = self._path
+        for name in list(sys.modules):
+            if name not in self._modules:
+                del sys.modules[name]
+
+
+def main(fd, modules):
+    # Tests shouldn't import the server's modules by accident
+    if sys.path and os.path.realpath(sys.path[0]) == os.path.dirname(os.path.realpath(__file__)):
+        del sys.path[0]
+    sock = socket.socket(fileno=fd)
+    # The server may ignore these, and ignored signals stay ignored in its children
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_DFL)
+    try:
+        for name in modules:
+            importlib.import_module(name)
+    except BaseException as e:
+        _send(sock, {'error': 'Failed to import %s: %s: %s' % (name, type(e).__name__, str(e))})
+        os._exit(1)
+    worker = _Worker(sock)
+    try:
+        _send(sock, {'ready': True, 'rss': _rss()})
+        while True:
+            job, output_fd = worker.receive()
+            if job is None:
+                break
+            _send(sock, worker.run(job, output_fd))
+    except Exception:
+        # The server went away
+        pass
+    # Without waiting for threads a test left running
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]), sys.argv[2:])
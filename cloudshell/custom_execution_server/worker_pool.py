@@ -0,0 +1,473 @@
+import threading
+import time
+import traceback
+from collections import deque
+
+
+class WorkerPool:
+    """
+    Fixed set of reusable worker threads fed from a bounded queue
+    """
+    def __init__(self, size, queue_size, logger, name='worker'):
+        """
+        :param size: int : Number of worker threads
+        :param queue_size: int : Maximum number of tasks waiting for a free worker
+        :param logger: logging.Logger
+        :param name: str : Prefix for worker thread names
+        """
+        self._size = max(1, int(size))
+        self._queue_size = max(1, int(queue_size))
+        self._logger = logger
+        self._name = name
+        self._queue = deque()
+        self._lock = threading.Lock()
+        # Workers wait on _work, submitters and pollers on _capacity_changed
+        self._work = threading.Condition(self._lock)
+        self._capacity_changed = threading.Condition(self._lock)
+        # Live worker threads, of which _retiring are to exit before taking another task
+        self._threads = []
+        self._busy = 0
+        self._retiring = 0
+        self._running = False
+        self._started_time = None
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_queue_depth = 0
+        self.busy_seconds = 0.0
+
+    def start(self):
+        """
+        Starts the workers, also after stop(): workers that haven't exited yet carry on
+        """
+        with self._lock:
+            self._running = True
+            self._started_time = time.time()
+            while len(self._threads) - self._retiring < self._size:
+                self._spawn_locked()
+
+    def stop(self, wait=False):
+        """
+        Tells all workers to exit once the tasks already queued have run
+
+        :param wait: bool : Join the worker threads before returning
+        """
+        with self._lock:
+            self._running = False
+            threads = list(self._threads)
+            self._work.notify_all()
+            self._capacity_changed.notify_all()
+        if wait:
+            for th in threads:
+                th.join()
+
+    def resize(self, size):
+        """
+        Changes the number of workers. Extra workers exit after finishing their current task, ahead of queued tasks.
+
+        :param size: int
+        """
+        size = max(1, int(size))
+        with self._lock:
+            self._size = size
+            running = len(self._threads) - self._retiring
+            if self._running:
+                while running < size:
+                    self._spawn_locked()
+                    running += 1
+            self._retiring += max(0, running - size)
+            self._work.notify_all()
+            self._capacity_changed.notify_all()
+
+    def has_capacity(self):
+        """
+        :return: bool : True if a task submitted now would not have to be rejected
+        """
+        with self._lock:
+            return self._has_capacity_locked()
+
+    def wait_for_capacity(self, timeout):
+        """
+        Blocks until a worker or a queue slot is free
+
+        :param timeout: float : Seconds
+        :return: bool : True if there is capacity
+        """
+        deadline = time.time() + timeout
+        with self._lock:
+            while not self._has_capacity_locked():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._capacity_changed.wait(remaining)
+            return True
+
+    def wake(self):
+        """
+        Wakes threads blocked in wait_for_capacity() early, e.g. so they notice the server stopping
+        """
+        with self._lock:
+            self._capacity_changed.notify_all()
+
+    def submit(self, fn, args=(), block=False, stop_event=None):
+        """
+        Queues fn(*args) to run on a worker
+
+        :param fn: function
+        :param args: tuple
+        :param block: bool : Wait for a queue slot instead of rejecting the task when the queue is full
+        :param stop_event: threading.Event : Stops waiting for a queue slot once set, e.g. when the server stops
+        :return: bool : False if the task was rejected because the queue was full
+        """
+        with self._lock:
+            while len(self._queue) >= self._queue_size:
+                if not block or (stop_event is not None and stop_event.is_set()):
+                    self.rejected += 1
+                    return False
+                self._capacity_changed.wait(0.5)
+            self._queue.append((fn, args))
+            self.submitted += 1
+            self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+            self._work.notify()
+        return True
+
+    def stats(self):
+        """
+        :return: dict : Queue depth, busy workers, utilization (fraction of worker time spent running tasks) and task counters
+        """
+        with self._lock:
+            busy_seconds = self.busy_seconds
+            elapsed = time.time() - self._started_time if self._started_time else 0
+            return {
+                'workers': self._size,
+                'busy': self._busy,
+                'queue_depth': len(self._queue),
+                'queue_size': self._queue_size,
+                'max_queue_depth': self.max_queue_depth,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'utilization': busy_seconds / (elapsed * self._size) if elapsed > 0 else 0.0,
+            }
+
+    def _has_capacity_locked(self):
+        return self._busy + len(self._queue) < self._size + self._queue_size
+
+    def _spawn_locked(self):
+        th = threading.Thread(target=self._worker_thread, name='%s-%d' % (self._name, len(self._threads)))
+        th.daemon = True
+        self._threads.append(th)
+        th.start()
+
+    def _worker_thread(self):
+        current = threading.current_thread()
+        try:
+            while True:
+                with self._lock:
+                    while True:
+                        # Still holding the lock when leaving _threads, so that start() never counts an exiting worker as live
+                        if self._retiring > 0:
+                            self._retiring -= 1
+                            self._threads.remove(current)
+                            return
+                        if self._queue:
+                            fn, args = self._queue.popleft()
+                            break
+                        if not self._running:
+                            # Stopped, and the tasks queued before have run
+                            self._threads.remove(current)
+                            return
+                        self._work.wait()
+                    self._busy += 1
+                    # A queue slot was freed
+                    self._capacity_changed.notify_all()
+                t0 = time.time()
+                try:
+                    fn(*args)
+                    failed = False
+                except Exception as e:
+                    failed = True
+                    self._logger.error('Unhandled exception in %s: %s: %s' % (self._name, str(e), traceback.format_exc()))
+                with self._lock:
+                    self._busy -= 1
+                    self.busy_seconds += time.time() - t0
+                    if failed:
+                        self.failed += 1
+                    else:
+                        self.completed += 1
+                    self._capacity_changed.notify_all()
+        finally:
+            with self._lock:
+                if current in self._threads:
+                    self._threads.remove(current)
+
+
+class FairWorkerPool:
+    """
+    Worker threads shared by several servers, each submitting through its own tenant()
+
+    A free worker takes the next task from the tenant with the fewest busy workers relative to its weight, the one
+    served longest ago on a tie. So a server with a deep queue can't starve the others, and every tenant is also held
+    to its own capacity.
+    """
+    def __init__(self, size, logger, name='shared-worker'):
+        """
+        :param size: int : Number of worker threads shared by all tenants
+        :param logger: logging.Logger
+        :param name: str : Prefix for worker thread names
+        """
+        self._size = max(1, int(size))
+        self._logger = logger
+        self._name = name
+        self._lock = threading.Lock()
+        # Workers wait on _work, pollers and submitters on _capacity_changed
+        self._work = threading.Condition(self._lock)
+        self._capacity_changed = threading.Condition(self._lock)
+        self._tenants = {}
+        self._threads = []
+        self._retiring = 0
+        self._stopping = False
+        self._serial = 0
+
+    def tenant(self, name, capacity, queue_size, weight=1):
+        """
+        :param name: str : Unique among the tenants, e.g. the server name
+        :param capacity: int : Most tasks of this tenant running at once
+        :param queue_size: int : Maximum number of tasks of this tenant waiting for a worker
+        :param weight: float : Relative share of the workers when tenants compete for them
+        :return: Pool for one server with the interface of WorkerPool
+        """
+        with self._lock:
+            if name in self._tenants:
+                raise Exception('Worker pool %s already has a tenant %s' % (self._name, name))
+            tenant = _Tenant(self, name, capacity, queue_size, weight)
+            self._tenants[name] = tenant
+            return tenant
+
+    def remove_tenant(self, name):
+        """
+        Forgets a tenant once its queued and running tasks have finished, after which the name can be reused
+        """
+        with self._lock:
+            tenant = self._tenants.get(name)
+            if tenant is not None:
+                tenant._removed = True
+                self._forget_if_idle_locked(tenant)
+
+    def _forget_if_idle_locked(self, tenant):
+        if tenant._removed and not tenant._queue and not tenant._busy and self._tenants.get(tenant.name) is tenant:
+            del self._tenants[tenant.name]
+
+    def start(self):
+        with self._lock:
+            self._stopping = False
+            while len(self._threads) - self._retiring < self._size:
+                self._spawn_locked()
+
+    def stop(self, wait=False):
+        """
+        Tells all workers to exit once every tenant's queued tasks have run
+
+        :param wait: bool : Join the worker threads before returning
+        """
+        with self._lock:
+            self._stopping = True
+            threads = list(self._threads)
+            self._work.notify_all()
+        if wait:
+            for th in threads:
+                th.join()
+
+    def resize(self, size):
+        """
+        Changes the number of shared workers. Extra workers exit after finishing their current task.
+        """
+        with self._lock:
+            self._size = max(1, int(size))
+            running = len(self._threads) - self._retiring
+            if self._threads:
+                while running < self._size:
+                    self._spawn_locked()
+                    running += 1
+            self._retiring += max(0, running - self._size)
+            self._work.notify_all()
+
+    def stats(self):
+        """
+        :return: dict : Shared workers, busy workers, queued tasks and per tenant stats
+        """
+        with self._lock:
+            tenants = list(self._tenants.values())
+            workers, busy = self._size, sum(t._busy for t in tenants)
+            queued = sum(len(t._queue) for t in tenants)
+        return {
+            'workers': workers,
+            'busy': busy,
+            'queue_depth': queued,
+            'tenants': dict((t.name, t.stats()) for t in tenants),
+        }
+
+    def _spawn_locked(self):
+        th = threading.Thread(target=self._worker_thread, name='%s-%d' % (self._name, len(self._threads)))
+        th.daemon = True
+        self._threads.append(th)
+        th.start()
+
+    def _next_task_locked(self):
+        best = None
+        best_key = None
+        for tenant in self._tenants.values():
+            if tenant._queue and tenant._busy < tenant._capacity:
+                key = (tenant._busy / float(tenant._weight), tenant._last_served)
+                if best is None or key < best_key:
+                    best, best_key = tenant, key
+        if best is None:
+            return None
+        self._serial += 1
+        best._last_served = self._serial
+        best._busy += 1
+        return best, best._queue.popleft()
+
+    def _worker_thread(self):
+        current = threading.current_thread()
+        try:
+            while True:
+                with self._lock:
+                    while True:
+                        if self._retiring > 0:
+                            self._retiring -= 1
+                            self._threads.remove(current)
+                            return
+                        picked = self._next_task_locked()
+                        if picked is not None:
+                            break
+                        if self._stopping and not any(t._queue for t in self._tenants.values()):
+                            # Still holding the lock, so that start() never counts an exiting worker as live
+                            self._threads.remove(current)
+                            return
+                        self._work.wait()
+                    # A slot in the tenant's queue was freed
+                    self._capacity_changed.notify_all()
+                tenant, (fn, args) = picked
+                t0 = time.time()
+                try:
+                    fn(*args)
+                    failed = False
+                except Exception as e:
+                    failed = True
+                    self._logger.error('Unhandled exception in %s: %s: %s' % (tenant._name, str(e), traceback.format_exc()))
+                with self._lock:
+                    tenant._busy -= 1
+                    tenant.busy_seconds += time.time() - t0
+                    if failed:
+                        tenant.failed += 1
+                    else:
+                        tenant.completed += 1
+                    self._forget_if_idle_locked(tenant)
+                    # The tenant may have queued tasks that its capacity held back
+                    self._work.notify()
+                    self._capacity_changed.notify_all()
+        finally:
+            with self._lock:
+                if current in self._threads:
+                    self._threads.remove(current)
+
+
+class _Tenant:
+    """
+    One server's share of a FairWorkerPool
+    """
+    def __init__(self, pool, name, capacity, queue_size, weight):
+        self._pool = pool
+        self.name = name
+        self._name = '%s-%s' % (pool._name, name)
+        self._capacity = max(1, int(capacity))
+        self._queue_size = max(1, int(queue_size))
+        self._weight = max(0.001, float(weight))
+        self._queue = deque()
+        self._busy = 0
+        self._last_served = 0
+        self._started_time = None
+        self._removed = False
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_queue_depth = 0
+        self.busy_seconds = 0.0
+
+    def start(self):
+        self._started_time = time.time()
+        self._pool.start()
+
+    def stop(self, wait=False):
+        """
+        The shared workers keep running for the other tenants. Tasks already queued still run.
+
+        :param wait: bool : Wait until this tenant's queued and running tasks have finished
+        """
+        if wait:
+            with self._pool._lock:
+                while self._queue or self._busy:
+                    self._pool._capacity_changed.wait()
+
+    def resize(self, size):
+        with self._pool._lock:
+            self._capacity = max(1, int(size))
+            self._pool._work.notify_all()
+            self._pool._capacity_changed.notify_all()
+
+    def has_capacity(self):
+        with self._pool._lock:
+            return self._has_capacity_locked()
+
+    def wait_for_capacity(self, timeout):
+        deadline = time.time() + timeout
+        with self._pool._lock:
+            while not self._has_capacity_locked():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._pool._capacity_changed.wait(remaining)
+            return True
+
+    def wake(self):
+        with self._pool._lock:
+            self._pool._capacity_changed.notify_all()
+
+    def submit(self, fn, args=(), block=False, stop_event=None):
+        with self._pool._lock:
+            while not self._has_capacity_locked():
+                if not block or (stop_event is not None and stop_event.is_set()):
+                    self.rejected += 1
+                    return False
+                self._pool._capacity_changed.wait(0.5)
+            self._queue.append((fn, args))
+            self.submitted += 1
+            self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+            self._pool._work.notify()
+        return True
+
+    def stats(self):
+        with self._pool._lock:
+            elapsed = time.time() - self._started_time if self._started_time else 0
+            return {
+                'workers': self._capacity,
+                'busy': self._busy,
+                'queue_depth': len(self._queue),
+                'queue_size': self._queue_size,
+                'max_queue_depth': self.max_queue_depth,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'weight': self._weight,
+                'utilization': self.busy_seconds / (elapsed * self._capacity) if elapsed > 0 else 0.0,
+            }
+
+    def _has_capacity_locked(self):
+        return self._busy + len(self._queue) < self._capacity + self._queue_size
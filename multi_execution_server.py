@@ -0,0 +1,275 @@
+import getpass
+import json
+import subprocess
+import sys
+import os
+import logging
+import re
+import traceback
+import platform
+from logging.handlers import RotatingFileHandler
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+
+from cloudshell.custom_execution_server.custom_execution_server import CustomExecutionServerCommandHandler, PassedCommandResult, \
+    FailedCommandResult, StoppedCommandResult
+
+from cloudshell.custom_execution_server.daemon import become_daemon_and_wait
+from cloudshell.custom_execution_server.process_backends import make_backend
+from cloudshell.custom_execution_server.process_manager import ProcessRunner, STOPPED_EXIT_CODE
+from cloudshell.custom_execution_server.supervisor import ServerSupervisor
+
+if platform.system() == 'Windows':
+    default_log_dir = '.'
+else:
+    default_log_dir = '/var/log'
+
+
+def input23(msg):
+    if sys.version_info.major == 3:
+        return input(msg)
+    else:
+        return raw_input(msg)
+
+jsonexample = '''Example multi_config.json:
+{
+  "cloudshell_server_address" : "192.168.2.108",
+  "cloudshell_port": 8029,
+  "cloudshell_snq_port": 9000,
+
+  "cloudshell_username" : "admin",
+  // or
+  "cloudshell_username" : "<PROMPT>",
+
+  "cloudshell_password" : "myadminpassword",
+  // or
+  "cloudshell_password" : "<PROMPT>",
+
+  "cloudshell_domain" : "Global",
+
+  "worker_count": 16,
+  // executions running at once across all servers
+
+  "servers": [
+    {
+      "cloudshell_execution_server_name" : "PythonSample1",
+      "cloudshell_execution_server_description" : "CES in Python",
+      "cloudshell_execution_server_type" : "Python",
+      "cloudshell_execution_server_capacity" : 8,
+      "weight": 2
+      // share of the workers when servers compete for them, default 1
+    },
+    {
+      "cloudshell_execution_server_name" : "RobotSample1",
+      "cloudshell_execution_server_type" : "Robot",
+      "cloudshell_execution_server_capacity" : 4,
+      // optional, by default the top level login is used:
+      "cloudshell_username" : "robot",
+      "cloudshell_password" : "robotpassword",
+      "cloudshell_domain" : "Global"
+    }
+  ],
+
+  "log_directory": "/var/log",
+  "log_level": "INFO",
+  // CRITICAL | ERROR | WARNING | INFO | DEBUG
+  "log_filename": "multi_execution_server.log",
+
+  // optional:
+  "metrics_port": 9464,
+  // serves Prometheus metrics of all servers at http://127.0.0.1:<metrics_port>/metrics
+  "process_backend": "launcher",
+  // popen | posix_spawn | launcher | warm: Python based tests run in interpreters started ahead of time
+  "warm_runtimes": {"python": {"preload": ["unittest"], "scripts": true}},
+  // runtime -> modules its workers import up front, commands they run as modules, and whether they run *.py scripts
+  "warm_pool_size": 4,
+  // idle workers kept per runtime for all servers together
+  "token_directory": "/var/spool/cloudshell-tokens",
+  // processes on this host share auth tokens through files here, one per CloudShell user, instead of each logging in
+  "token_max_age": 86400
+  // seconds an auth token is valid for; it is renewed a minute before. Tokens CloudShell rejects are renewed anyway.
+}
+
+Note: Remove all // comments before using
+'''
+configfile = os.path.join(os.path.dirname(__file__), 'multi_config.json')
+
+if len(sys.argv) > 1:
+    usage = '''CloudShell custom execution servers hosted in one process
+Usage:
+    python %s                                      # run with %s
+    python %s --config <path to JSON config file>  # run with JSON config file from custom location
+    python %s -c <path to JSON config file>        # run with JSON config file from custom location
+
+%s
+The servers will run in the background. Send SIGTERM to shut them down.
+''' % (sys.argv[0], configfile, sys.argv[0], sys.argv[0], jsonexample)
+    for i in range(1, len(sys.argv)):
+        if sys.argv[i] in ['--help', '-h', '-help', '/?', '/help', '-?']:
+            print(usage)
+            sys.exit(1)
+        if sys.argv[i] in ['--config', '-c']:
+            if i+1 < len(sys.argv):
+                configfile = sys.argv[i+1]
+            else:
+                print(usage)
+                sys.exit(1)
+
+try:
+    with open(configfile) as f:
+        o = json.load(f)
+except:
+    print('''%s
+
+Failed to load JSON config file "%s".
+
+%s
+
+    ''' % (traceback.format_exc(), configfile, jsonexample))
+    sys.exit(1)
+
+cloudshell_server_address = o.get('cloudshell_server_address')
+definitions = o.get('servers') or []
+
+errors = []
+if not cloudshell_server_address:
+    errors.append('cloudshell_server_address must be specified')
+if not definitions:
+    errors.append('servers must list at least one execution server')
+for d in definitions:
+    if not d.get('cloudshell_execution_server_name'):
+        errors.append('cloudshell_execution_server_name must be specified for every server')
+    if not d.get('cloudshell_execution_server_type'):
+        errors.append('cloudshell_execution_server_type must be specified for server %s. The type must be registered in CloudShell portal under JOB SCHEDULING>Execution Server Types.' % d.get('cloudshell_execution_server_name'))
+if errors:
+    raise Exception('Fix the following in %s:\n' % configfile + '\n'.join(errors))
+
+cloudshell_username = o.get('cloudshell_username', '<PROMPT>')
+cloudshell_password = o.get('cloudshell_password', '<PROMPT>')
+
+if '<PROMPT>' in cloudshell_username:
+    cloudshell_username = cloudshell_username.replace('<PROMPT>', input23('CloudShell username: '))
+if '<PROMPT>' in cloudshell_password:
+    cloudshell_password = cloudshell_password.replace('<PROMPT>', getpass.getpass('CloudShell password: '))
+
+cloudshell_snq_port = int(o.get('cloudshell_snq_port', 9000))
+cloudshell_port = int(o.get('cloudshell_port', 8029))
+cloudshell_domain = o.get('cloudshell_domain', 'Global')
+worker_count = int(o.get('worker_count', sum(int(d.get('cloudshell_execution_server_capacity', 5)) for d in definitions)))
+log_directory = o.get('log_directory', default_log_dir)
+log_level = o.get('log_level', 'INFO')
+log_filename = o.get('log_filename', 'multi_execution_server.log')
+metrics_port = o.get('metrics_port')
+token_directory = o.get('token_directory')
+token_max_age = o.get('token_max_age')
+process_backend = o.get('process_backend', 'popen')
+warm_runtimes = o.get('warm_runtimes')
+warm_pool_size = int(o.get('warm_pool_size', 2))
+
+
+class MyCustomExecutionServerCommandHandler(CustomExecutionServerCommandHandler):
+    """
+    Runs the test path as a command, like the handler in sample_execution_server.py, through a ProcessRunner shared by
+    all servers
+    """
+    def __init__(self, process_runner, username, password, domain):
+        CustomExecutionServerCommandHandler.__init__(self)
+        self._process_runner = process_runner
+        self._username = username
+        self._password = password
+        self._domain = domain
+
+    def execute_command(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger):
+        BADCHAR = r'[^-@%.,_a-zA-Z0-9 ]'
+        test_path = re.sub(BADCHAR, '_', test_path)
+
+        logger.info('execute %s %s %s %s %s %s\n' % (test_path, test_arguments, execution_id, username, reservation_id, reservation_json))
+        tt = [test_path]
+        if test_arguments and test_arguments != 'None':
+            tt += test_arguments.split(' ')
+
+        try:
+            capture, mainretcode = self._process_runner.execute_spooled(tt, execution_id, env={
+                'CLOUDSHELL_RESERVATION_ID': reservation_id or 'None',
+                'CLOUDSHELL_SERVER_ADDRESS': cloudshell_server_address or 'None',
+                'CLOUDSHELL_SERVER_PORT': str(cloudshell_port) or 'None',
+                'CLOUDSHELL_USERNAME': self._username or 'None',
+                'CLOUDSHELL_PASSWORD': self._password or 'None',
+                'CLOUDSHELL_DOMAIN': self._domain or 'None',
+                'CLOUDSHELL_RESERVATION_INFO': reservation_json or 'None',
+            })
+        except Exception as uue:
+            return FailedCommandResult('output.log', 'External process crashed: %s: %s' % (str(uue), traceback.format_exc()), 'text/plain')
+
+        if mainretcode == STOPPED_EXIT_CODE:
+            return StoppedCommandResult()
+        if mainretcode == 0:
+            result = PassedCommandResult('output.log', capture.report_data(), 'text/plain')
+        else:
+            result = FailedCommandResult('output.log', capture.report_data(), 'text/plain')
+        result.resource_usage = self._process_runner.last_usage()
+        return result
+
+    def stop_command(self, execution_id, logger):
+        logger.info('stop %s\n' % execution_id)
+        self._process_runner.stop(execution_id)
+
+log_pathname = '%s/%s' % (log_directory, log_filename)
+logger = logging.getLogger('multi_execution_server')
+handler = RotatingFileHandler(log_pathname, maxBytes=100000, backupCount=100)
+handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+logger.addHandler(handler)
+if log_level:
+    logger.setLevel(logging.getLevelName(log_level.upper()))
+
+print('\nLogging to %s\n' % log_pathname)
+
+# Execution ids are unique across servers, so one runner can serve all of them
+process_runner = ProcessRunner(logger, backend=make_backend(process_backend, logger, warm_runtimes=warm_runtimes,
+                                                             warm_pool_size=warm_pool_size))
+
+supervisor = ServerSupervisor(logger, cloudshell_server_address, cloudshell_snq_port, worker_count,
+                              metrics_port=int(metrics_port) if metrics_port is not None else None,
+                              token_directory=token_directory,
+                              token_max_age=float(token_max_age) if token_max_age else None)
+process_runner.register_metrics(supervisor.metrics, 'shared')
+
+for d in definitions:
+    username = d.get('cloudshell_username', cloudshell_username)
+    password = d.get('cloudshell_password', cloudshell_password)
+    domain = d.get('cloudshell_domain', cloudshell_domain)
+    supervisor.add_server(d['cloudshell_execution_server_name'],
+                          d.get('cloudshell_execution_server_description', ''),
+                          d['cloudshell_execution_server_type'],
+                          int(d.get('cloudshell_execution_server_capacity', 5)),
+                          MyCustomExecutionServerCommandHandler(process_runner, username, password, domain),
+                          username, password, domain,
+                          weight=float(d.get('weight', 1)))
+
+
+def daemon_start():
+    supervisor.start()
+    s = '\n\nExecution servers %s started\nTo stop them:\nkill %d\n\nIt is safe to close this terminal.\n' % (', '.join(supervisor.server_names()), os.getpid())
+    logger.info(s)
+    print (s)
+
+
+def daemon_stop():
+    msgstopping = "Stopping execution servers %s, please wait up to 2 minutes..." % ', '.join(supervisor.server_names())
+    msgstopped = "Execution servers finished shutting down"
+    logger.info(msgstopping)
+    print (msgstopping)
+    try:
+        subprocess.call(['wall', msgstopping])
+    except:
+        pass
+    supervisor.close()
+    process_runner.close()
+    logger.info(msgstopped)
+    print (msgstopped)
+    try:
+        subprocess.call(['wall', msgstopped])
+    except:
+        pass
+
+become_daemon_and_wait(daemon_start, daemon_stop)
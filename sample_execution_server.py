@@ -6,6 +6,8 @@ import time
 import os
 import logging
 import re
+import shutil
+import tempfile
 import traceback
 import platform
 from logging.handlers import RotatingFileHandler
@@ -15,8 +17,16 @@ sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 from cloudshell.custom_execution_server.custom_execution_server import CustomExecutionServer, CustomExecutionServerCommandHandler, PassedCommandResult, \
     FailedCommandResult, ErrorCommandResult, StoppedCommandResult
 
-from cloudshell.custom_execution_server.daemon import become_daemon_and_wait
-from cloudshell.custom_execution_server.process_manager import ProcessRunner
+from cloudshell.custom_execution_server.capacity_tuner import CapacityPolicy
+from cloudshell.custom_execution_server.connection_pool import HttpConnectionPool
+from cloudshell.custom_execution_server.daemon import become_daemon_and_wait, reopen_log_files
+from cloudshell.custom_execution_server.output_parsers import make_parser
+from cloudshell.custom_execution_server.process_backends import make_backend
+from cloudshell.custom_execution_server.poll_controller import PollController
+from cloudshell.custom_execution_server.report_cache import ReportCache
+from cloudshell.custom_execution_server.session import CloudShellSession
+from cloudshell.custom_execution_server.process_manager import ProcessRunner, ResourceLimits, STOPPED_EXIT_CODE, TIMEOUT_EXIT_CODE
+from cloudshell.custom_execution_server.report_data import ReportCompression, artifacts_from_directory
 
 if platform.system() == 'Windows':
     default_log_dir = '.'
@@ -60,8 +70,80 @@ jsonexample = '''Example config.json:
   "log_directory": "/var/log",
   "log_level": "INFO",
   // CRITICAL | ERROR | WARNING | INFO | DEBUG
-  "log_filename": "<EXECUTION_SERVER_NAME>.log"
-
+  "log_filename": "<EXECUTION_SERVER_NAME>.log",
+
+  // optional:
+  "connection_pool_size": 4,
+  "connection_idle_timeout": 30,
+  "worker_queue_size": 5,
+  "queue_full_policy": "block",
+  // block: stop polling while all workers are busy | reject: report new executions as errors
+  "poller_count": 1,
+  "reservation_cache_size": 100,
+  "reservation_cache_ttl": 30,
+  "result_spool_directory": "/var/spool/<EXECUTION_SERVER_NAME>",
+  "report_requests_per_second": 20,
+  "journal_path": "/var/spool/<EXECUTION_SERVER_NAME>/journal.log",
+  "journal_fsync": "interval",
+  // always | interval | never
+  "status_interval": 60,
+  "status_idle_interval": 300,
+  "metrics_port": 9464,
+  // serves Prometheus metrics at http://127.0.0.1:<metrics_port>/metrics
+  "process_backend": "popen",
+  // popen | posix_spawn | launcher | warm: Python based tests run in interpreters started ahead of time
+  "warm_runtimes": {"python": {"preload": ["unittest"], "scripts": true}, "robot": {"preload": ["robot"], "commands": {"robot": "robot"}}},
+  // runtime -> modules its workers import up front, commands they run as modules, and whether they run *.py scripts
+  "warm_pool_size": 2,
+  // idle workers kept per runtime; tests arriving while none is idle start cold with warm_fallback_backend
+  "warm_max_runs": 50,
+  "warm_max_rss_growth_bytes": 268435456,
+  // workers are replaced after warm_max_runs tests or once their memory has grown by this much
+  "warm_fallback_backend": "popen",
+  "execution_timeout": 7200,
+  // seconds of wall-clock time before a test process is terminated
+  "execution_cpu_seconds": 3600,
+  "execution_memory_bytes": 4294967296,
+  "execution_open_files": 4096,
+  "capacity_max": 16,
+  // adjusts the capacity between capacity_min and capacity_max to the load average and available memory
+  "capacity_min": 1,
+  "capacity_max_load_per_cpu": 1.0,
+  "capacity_memory_per_execution_bytes": 1073741824,
+  "capacity_trace_path": "/var/log/<EXECUTION_SERVER_NAME>-capacity.jsonl",
+  "output_format": "tap",
+  // tap | junit | robot: the verdict comes from the test results in the output instead of the exit code,
+  // and output.summary.json with the counts and failed tests is uploaded next to output.log
+  "report_compression": "gzip",
+  // gzip | zstd (needs the zstandard package): reports of at least report_compression_threshold bytes are uploaded compressed
+  "report_compression_level": 1,
+  "report_compression_threshold": 65536,
+  "report_compression_mode": "attachment",
+  // attachment: output.log is uploaded as output.log.gz | content-encoding: output.log is sent with Content-Encoding: gzip
+  "artifact_directory": "/var/tmp",
+  // each test gets an empty directory in CLOUDSHELL_ARTIFACT_DIR under here; files it leaves there are uploaded next to output.log
+  "artifact_workers": 4,
+  "artifact_max_bytes": 104857600,
+  "report_bytes_per_second": 10485760,
+  // upload bandwidth limit for all reports and artifacts together
+  "report_cache_path": "/var/spool/<EXECUTION_SERVER_NAME>/report-cache.jsonl",
+  // reports and artifacts identical to ones uploaded before are replaced by a note naming the earlier execution
+  "report_cache_max_entries": 10000,
+  "report_cache_max_age": 2592000,
+  // seconds; older uploads may have been purged from CloudShell, so they are uploaded in full again
+  "report_cache_action": "note",
+  // note | skip: upload nothing for identical reports
+  "poll_failure_threshold": 3,
+  // consecutive failed polls before polling pauses for poll_open_seconds and then resumes with a single probe poll
+  "poll_open_seconds": 30,
+  "poll_max_backoff": 30,
+  "poll_max_timeout": 300,
+  // longest PendingCommand request timeout; it adapts to how long CloudShell holds polls open
+  "session_token_file": "/var/spool/cloudshell-admin.token",
+  // servers on this host logging in as the same user share the auth token through this file instead of each logging in;
+  // use a different file for each user
+  "session_max_age": 86400
+  // seconds an auth token is valid for; it is renewed a minute before. Tokens CloudShell rejects are renewed anyway.
 }
 
 Note: Remove all // comments before using
@@ -76,7 +158,7 @@ Usage:
     python %s -c <path to JSON config file>        # run with JSON config file from custom location
 
 %s
-The server will run in the background. Send SIGTERM to shut it down.
+The server will run in the background. Send SIGTERM to shut it down, or SIGHUP to reload the config file.
 ''' % (sys.argv[0], configfile, sys.argv[0], sys.argv[0], jsonexample)
     for i in range(1, len(sys.argv)):
         if sys.argv[i] in ['--help', '-h', '-help', '/?', '/help', '-?']:
@@ -89,9 +171,18 @@ The server will run in the background. Send SIGTERM to shut it down.
                 print(usage)
                 sys.exit(1)
 
-try:
-    with open(configfile) as f:
+
+def read_config(path):
+    with open(path) as f:
         o = json.load(f)
+    for k in list(o.keys()):
+        v = str(o[k])
+        if '<EXECUTION_SERVER_NAME>' in v:
+            o[k] = o[k].replace('<EXECUTION_SERVER_NAME>', o.get('cloudshell_execution_server_name') or '')
+    return o
+
+try:
+    o = read_config(configfile)
 except:
     print('''%s
 
@@ -124,12 +215,6 @@ if '<PROMPT>' in cloudshell_username:
 if '<PROMPT>' in cloudshell_password:
     cloudshell_password = cloudshell_password.replace('<PROMPT>', getpass.getpass('CloudShell password: '))
 
-for k in list(o.keys()):
-    v = str(o[k])
-    if '<EXECUTION_SERVER_NAME>' in v:
-        o[k] = o[k].replace('<EXECUTION_SERVER_NAME>', server_name)
-
-
 server_description = o.get('cloudshell_execution_server_description', '')
 server_capacity = int(o.get('cloudshell_execution_server_capacity', 5))
 cloudshell_snq_port = int(o.get('cloudshell_snq_port', 9000))
@@ -138,14 +223,75 @@ cloudshell_domain = o.get('cloudshell_domain', 'Global')
 log_directory = o.get('log_directory', default_log_dir)
 log_level = o.get('log_level', 'INFO')
 log_filename = o.get('log_filename', server_name + '.log')
+connection_pool_size = int(o.get('connection_pool_size', 4))
+connection_idle_timeout = float(o.get('connection_idle_timeout', 30))
+worker_queue_size = int(o.get('worker_queue_size', server_capacity))
+queue_full_policy = o.get('queue_full_policy', 'block')
+poller_count = int(o.get('poller_count', 1))
+reservation_cache_size = int(o.get('reservation_cache_size', 100))
+reservation_cache_ttl = float(o.get('reservation_cache_ttl', 30))
+result_spool_directory = o.get('result_spool_directory')
+report_requests_per_second = o.get('report_requests_per_second')
+journal_path = o.get('journal_path')
+journal_fsync = o.get('journal_fsync', 'interval')
+status_interval = float(o.get('status_interval', 60))
+status_idle_interval = o.get('status_idle_interval')
+metrics_port = o.get('metrics_port')
+capacity_max = o.get('capacity_max')
+capacity_min = int(o.get('capacity_min', 1))
+capacity_max_load_per_cpu = float(o.get('capacity_max_load_per_cpu', 1.0))
+capacity_memory_per_execution_bytes = o.get('capacity_memory_per_execution_bytes')
+capacity_trace_path = o.get('capacity_trace_path')
+report_compression = o.get('report_compression')
+report_compression_level = o.get('report_compression_level')
+report_compression_threshold = o.get('report_compression_threshold', 65536)
+report_compression_mode = o.get('report_compression_mode', 'attachment')
+artifact_workers = int(o.get('artifact_workers', 4))
+artifact_max_bytes = o.get('artifact_max_bytes')
+report_bytes_per_second = o.get('report_bytes_per_second')
+report_cache_path = o.get('report_cache_path')
+report_cache_max_entries = int(o.get('report_cache_max_entries', 10000))
+report_cache_max_age = o.get('report_cache_max_age', 30 * 86400)
+report_cache_action = o.get('report_cache_action', 'note')
+poll_failure_threshold = int(o.get('poll_failure_threshold', 3))
+poll_open_seconds = float(o.get('poll_open_seconds', 30))
+poll_max_backoff = float(o.get('poll_max_backoff', 30))
+poll_max_timeout = float(o.get('poll_max_timeout', 300))
+session_token_file = o.get('session_token_file')
+session_max_age = o.get('session_max_age')
 
 
 class MyCustomExecutionServerCommandHandler(CustomExecutionServerCommandHandler):
 
-    def __init__(self, logger):
+    def __init__(self, logger, o):
+        """
+        :param o: dict : Config, from which process_backend, the warm_* settings, output_format, artifact_directory and the execution_* limits are used
+        """
         CustomExecutionServerCommandHandler.__init__(self)
         self._logger = logger
-        self._process_runner = ProcessRunner(self._logger)
+        self._output_format = o.get('output_format')
+        self._artifact_directory = o.get('artifact_directory') or tempfile.gettempdir()
+        if self._output_format:
+            # Fail on a typo at startup rather than on every execution
+            make_parser(self._output_format)
+        process_backend = o.get('process_backend', 'popen')
+        execution_timeout = o.get('execution_timeout')
+        execution_cpu_seconds = o.get('execution_cpu_seconds')
+        execution_memory_bytes = o.get('execution_memory_bytes')
+        execution_open_files = o.get('execution_open_files')
+        limits = None
+        if execution_timeout or execution_cpu_seconds or execution_memory_bytes or execution_open_files:
+            limits = ResourceLimits(cpu_seconds=int(execution_cpu_seconds) if execution_cpu_seconds else None,
+                                    address_space_bytes=int(execution_memory_bytes) if execution_memory_bytes else None,
+                                    open_files=int(execution_open_files) if execution_open_files else None,
+                                    timeout=float(execution_timeout) if execution_timeout else None)
+        backend = make_backend(process_backend, self._logger,
+                               warm_runtimes=o.get('warm_runtimes'),
+                               warm_pool_size=int(o.get('warm_pool_size', 2)),
+                               warm_max_runs=int(o.get('warm_max_runs', 50)),
+                               warm_max_rss_growth_bytes=o.get('warm_max_rss_growth_bytes', 268435456),
+                               warm_fallback=o.get('warm_fallback_backend', 'popen'))
+        self.process_runner = ProcessRunner(self._logger, backend=backend, limits=limits)
 
     def execute_command(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger):
         BADCHAR = r'[^-@%.,_a-zA-Z0-9 ]'
@@ -160,8 +306,11 @@ class MyCustomExecutionServerCommandHandler(CustomExecutionServerCommandHandler)
             if test_arguments and test_arguments != 'None':
                 tt += test_arguments.split(' ')
 
+            parser = make_parser(self._output_format) if self._output_format else None
+            artifact_dir = tempfile.mkdtemp(prefix='ces-artifacts-', dir=self._artifact_directory)
             try:
-                output, mainretcode = self._process_runner.execute(tt, execution_id, env={
+                capture, mainretcode = self.process_runner.execute_spooled(tt, execution_id, parser=parser, env={
+                    'CLOUDSHELL_ARTIFACT_DIR': artifact_dir,
                     'CLOUDSHELL_RESERVATION_ID': reservation_id or 'None',
                     'CLOUDSHELL_SERVER_ADDRESS': cloudshell_server_address or 'None',
                     'CLOUDSHELL_SERVER_PORT': str(cloudshell_port) or 'None',
@@ -171,27 +320,42 @@ class MyCustomExecutionServerCommandHandler(CustomExecutionServerCommandHandler)
                     'CLOUDSHELL_RESERVATION_INFO': reservation_json or 'None',
                 })
             except Exception as uue:
-                mainretcode = -5000
-                output = 'External process crashed: %s: %s' % (str(uue), traceback.format_exc())
+                shutil.rmtree(artifact_dir, ignore_errors=True)
+                return FailedCommandResult('output.log', 'External process crashed: %s: %s' % (str(uue), traceback.format_exc()), 'text/plain')
 
-            if mainretcode == -6000:
+            if mainretcode == STOPPED_EXIT_CODE:
+                shutil.rmtree(artifact_dir, ignore_errors=True)
                 return StoppedCommandResult()
 
-            self._logger.debug('Result of %s: %d: %s' % (tt, mainretcode, string23(output)))
+            self._logger.debug('Result of %s: %d: %s' % (tt, mainretcode, capture.preview()))
             logname = 'output.log'
-            logdata = output
-
-            if mainretcode == 0:
-                return PassedCommandResult(logname, logdata, 'text/plain')
+            logdata = capture.report_data()
+
+            passed = mainretcode == 0
+            if parser is not None and parser.passed + parser.failed + parser.skipped > 0:
+                # A test runner may exit 0 with failed tests or non-zero for reasons other than failures
+                passed = parser.verdict() == 'Passed' and mainretcode != TIMEOUT_EXIT_CODE
+            if passed:
+                result = PassedCommandResult(logname, logdata, 'text/plain')
             else:
-                return FailedCommandResult(logname, logdata, 'text/plain')
+                # Including TIMEOUT_EXIT_CODE, with the output up to the timeout
+                result = FailedCommandResult(logname, logdata, 'text/plain')
+            if parser is not None:
+                result.summary = parser.summary()
+                result.summary['exit_code'] = mainretcode
+            result.resource_usage = self.process_runner.last_usage()
+            # The directory is removed once the artifacts have been uploaded
+            result.artifacts = artifacts_from_directory(artifact_dir, delete=True)
+            if not result.artifacts:
+                shutil.rmtree(artifact_dir, ignore_errors=True)
+            return result
         except Exception as ue:
             self._logger.error(str(ue) + ': ' + traceback.format_exc())
             raise ue
 
     def stop_command(self, execution_id, logger):
         logger.info('stop %s\n' % execution_id)
-        self._process_runner.stop(execution_id)
+        self.process_runner.stop(execution_id)
 
 log_pathname = '%s/%s' % (log_directory, log_filename)
 logger = logging.getLogger(server_name)
@@ -203,12 +367,14 @@ if log_level:
 
 print('\nLogging to %s\n' % log_pathname)
 
+command_handler = MyCustomExecutionServerCommandHandler(logger, o)
+
 server = CustomExecutionServer(server_name=server_name,
                                server_description=server_description,
                                server_type=server_type,
                                server_capacity=server_capacity,
 
-                               command_handler=MyCustomExecutionServerCommandHandler(logger),
+                               command_handler=command_handler,
 
                                logger=logger,
 
@@ -219,12 +385,53 @@ server = CustomExecutionServer(server_name=server_name,
                                cloudshell_domain=cloudshell_domain,
 
                                auto_register=True,
-                               auto_start=False)
+                               auto_start=False,
+
+                               connection_pool=HttpConnectionPool(max_size=connection_pool_size,
+                                                                  idle_timeout=connection_idle_timeout),
+                               session=CloudShellSession(token_file=session_token_file,
+                                                         max_age=float(session_max_age) if session_max_age else None,
+                                                         logger=logger),
+                               worker_queue_size=worker_queue_size,
+                               queue_full_policy=queue_full_policy,
+                               poller_count=poller_count,
+                               reservation_cache_size=reservation_cache_size,
+                               reservation_cache_ttl=reservation_cache_ttl,
+                               result_spool_directory=result_spool_directory,
+                               report_requests_per_second=float(report_requests_per_second) if report_requests_per_second else None,
+                               journal_path=journal_path,
+                               journal_fsync=journal_fsync,
+                               status_interval=status_interval,
+                               status_idle_interval=float(status_idle_interval) if status_idle_interval else None,
+                               metrics_port=int(metrics_port) if metrics_port is not None else None,
+                               capacity_policy=CapacityPolicy(capacity_min, int(capacity_max),
+                                                              max_load_per_cpu=capacity_max_load_per_cpu,
+                                                              memory_per_execution_bytes=int(capacity_memory_per_execution_bytes) if capacity_memory_per_execution_bytes else None) if capacity_max else None,
+                               capacity_trace_path=capacity_trace_path,
+                               report_compression=ReportCompression(report_compression,
+                                                                    level=report_compression_level,
+                                                                    threshold=int(report_compression_threshold),
+                                                                    mode=report_compression_mode) if report_compression else None,
+                               artifact_workers=artifact_workers,
+                               artifact_max_bytes=int(artifact_max_bytes) if artifact_max_bytes else None,
+                               report_bytes_per_second=float(report_bytes_per_second) if report_bytes_per_second else None,
+                               report_cache=ReportCache(report_cache_path, logger,
+                                                        max_entries=report_cache_max_entries,
+                                                        max_age=float(report_cache_max_age) if report_cache_max_age else None,
+                                                        action=report_cache_action) if report_cache_path else None,
+                               poll_controller=PollController(failure_threshold=poll_failure_threshold,
+                                                              open_seconds=poll_open_seconds,
+                                                              max_backoff=poll_max_backoff,
+                                                              max_timeout=poll_max_timeout))
+
+# Journal each test process so it can be reattached if the server restarts while it runs
+command_handler.process_runner.on_process_started = server.record_process
+command_handler.process_runner.register_metrics(server.metrics, server_name)
 
 
 def daemon_start():
     server.start()
-    s = '\n\n%s execution server %s started\nTo stop %s:\nkill %d\n\nIt is safe to close this terminal.\n' % (server_type, server_name, server_name, os.getpid())
+    s = '\n\n%s execution server %s started\nTo stop %s:\nkill %d\nTo reload %s:\nkill -HUP %d\n\nIt is safe to close this terminal.\n' % (server_type, server_name, server_name, os.getpid(), configfile, os.getpid())
     logger.info(s)
     print (s)
 
@@ -239,6 +446,7 @@ def daemon_stop():
     except:
         pass
     server.stop()
+    command_handler.process_runner.close()
     logger.info(msgstopped)
     print (msgstopped)
     try:
@@ -246,4 +454,90 @@ def daemon_stop():
     except:
         pass
 
-become_daemon_and_wait(daemon_start, daemon_stop)
+# Number of config reloads, which tells the process runner of each reload apart in the metrics
+reloads = 0
+
+# Settings that daemon_reload() applies; changes to the others need a restart
+RELOADABLE_SETTINGS = [
+    'cloudshell_execution_server_description',
+    'cloudshell_execution_server_capacity',
+    'log_directory',
+    'log_level',
+    'log_filename',
+    'process_backend',
+    'warm_runtimes',
+    'warm_pool_size',
+    'warm_max_runs',
+    'warm_max_rss_growth_bytes',
+    'warm_fallback_backend',
+    'execution_timeout',
+    'execution_cpu_seconds',
+    'execution_memory_bytes',
+    'execution_open_files',
+    'output_format',
+    'artifact_directory',
+]
+
+
+def daemon_reload():
+    """
+    On SIGHUP: re-reads the config, updates description and capacity on CloudShell, reopens the log file, and runs
+    new executions on a new command handler while running ones finish on the old one. Polling goes on throughout.
+    The new log file and command handler are built first, so an invalid config changes nothing.
+    """
+    global o, command_handler, handler, log_pathname, reloads
+    logger.info('Reloading %s' % configfile)
+    try:
+        n = read_config(configfile)
+    except Exception as e:
+        logger.error('Failed to reload %s, keeping the current configuration: %s' % (configfile, str(e)))
+        return
+    for k in sorted(set(o.keys()) | set(n.keys())):
+        if k not in RELOADABLE_SETTINGS and o.get(k) != n.get(k):
+            logger.warning('%s changed in %s, restart the server to apply it' % (k, configfile))
+
+    new_log_pathname = '%s/%s' % (n.get('log_directory', default_log_dir), n.get('log_filename', server_name + '.log'))
+    new_handler = None
+    try:
+        server_capacity = int(n.get('cloudshell_execution_server_capacity', 5))
+        log_level = logging.getLevelName(n['log_level'].upper()) if n.get('log_level') else None
+        if log_level is not None and not isinstance(log_level, int):
+            raise Exception('Unknown log_level %s' % n['log_level'])
+        if new_log_pathname != log_pathname:
+            new_handler = RotatingFileHandler(new_log_pathname, maxBytes=100000, backupCount=100)
+        new_command_handler = MyCustomExecutionServerCommandHandler(logger, n)
+    except Exception as e:
+        if new_handler is not None:
+            new_handler.close()
+        logger.error('Failed to reload %s, keeping the current configuration: %s' % (configfile, str(e)))
+        return
+
+    if new_handler is not None:
+        new_handler.setFormatter(handler.formatter)
+        logger.addHandler(new_handler)
+        logger.removeHandler(handler)
+        handler.close()
+        handler = new_handler
+        log_pathname = new_log_pathname
+    else:
+        reopen_log_files(logger)
+    if log_level is not None:
+        logger.setLevel(log_level)
+
+    try:
+        server.reconfigure(server_description=n.get('cloudshell_execution_server_description', ''),
+                           server_capacity=server_capacity)
+    except Exception as e:
+        logger.error('Failed to update execution server %s: %s' % (server_name, str(e)))
+
+    reloads += 1
+    old_handler = command_handler
+    command_handler = new_command_handler
+    command_handler.process_runner.on_process_started = server.record_process
+    # The old runner keeps reporting under its own label until its executions have finished and close() removes it
+    command_handler.process_runner.register_metrics(server.metrics, '%s-reload-%d' % (server_name, reloads))
+    server.set_command_handler(command_handler, on_drained=old_handler.process_runner.close)
+    o = n
+    logger.info('Reloaded %s' % configfile)
+
+become_daemon_and_wait(daemon_start, daemon_stop, on_reload=daemon_reload, logger=logger)
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'benchmarks'))
+
+from cloudshell.custom_execution_server.async_execution_server import AsyncCustomExecutionServer, AsyncHttpConnectionPool
+from cloudshell.custom_execution_server.custom_execution_server import CustomExecutionServerCommandHandler, PassedCommandResult, StoppedCommandResult
+
+from mock_cloudshell import MockCloudShell
+
+logger = logging.getLogger('test')
+
+
+class BlockingHandler(CustomExecutionServerCommandHandler):
+    """
+    Synchronous handler running each test for float(test_path) seconds, or until it is stopped
+    """
+    def __init__(self):
+        CustomExecutionServerCommandHandler.__init__(self)
+        self.stopped = []
+        self.stop_times = {}
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def _event(self, execution_id):
+        with self._lock:
+            return self._events.setdefault(execution_id, threading.Event())
+
+    def execute_command(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger):
+        if self._event(execution_id).wait(float(test_path or 0)):
+            return StoppedCommandResult()
+        return PassedCommandResult('result.log', 'ok', 'text/plain')
+
+    def stop_command(self, execution_id, logger):
+        self.stopped.append(execution_id)
+        self.stop_times[execution_id] = time.time()
+        self._event(execution_id).set()
+
+
+class AsyncServerTest(unittest.TestCase):
+    def setUp(self):
+        self.mock = MockCloudShell(poll_timeout=0.3)
+        self.mock.start()
+        self.addCleanup(self.mock.stop)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def run_server(self, handler, capacity, scenario, **kwargs):
+        async def main():
+            server = AsyncCustomExecutionServer('async', 'test', 'Python', capacity, handler, logger,
+                                                '127.0.0.1', self.mock.port, 'admin', 'admin', 'Global', **kwargs)
+            await server.start()
+            try:
+                await scenario(server)
+            finally:
+                await server.stop()
+        self.loop.run_until_complete(main())
+
+    async def wait_finished(self, count, timeout=10):
+        deadline = time.time() + timeout
+        while len(self.mock.finished) < count and time.time() < deadline:
+            await asyncio.sleep(0.02)
+
+    def test_stop_arrives_while_every_slot_is_busy(self):
+        handler = BlockingHandler()
+
+        async def scenario(server):
+            self.mock.add_commands([{'Type': 'startExecution', 'ExecutionId': '1', 'TestPath': '5'}])
+            await asyncio.sleep(0.5)
+            t0 = time.time()
+            self.mock.add_commands([{'Type': 'stopExecution', 'ExecutionId': '1'}])
+            await self.wait_finished(1)
+            self.assertLess(handler.stop_times['1'] - t0, 2)
+            # A late duplicate report would arrive by now
+            await asyncio.sleep(0.5)
+        self.run_server(handler, 1, scenario)
+        self.assertEqual([(f['ExecutionId'], f['Result']) for f in self.mock.finished], [('1', 'Stopped')])
+
+    def test_stop_after_finish_is_not_reported(self):
+        handler = BlockingHandler()
+
+        async def scenario(server):
+            self.mock.add_commands([{'Type': 'startExecution', 'ExecutionId': '1', 'TestPath': '0'}])
+            await self.wait_finished(1)
+            self.mock.add_commands([{'Type': 'stopExecution', 'ExecutionId': '1'}])
+            await asyncio.sleep(1)
+        self.run_server(handler, 1, scenario)
+        self.assertEqual([(f['ExecutionId'], f['Result']) for f in self.mock.finished], [('1', 'Passed')])
+        self.assertEqual(handler.stopped, [])
+
+    def test_executions_beyond_capacity_wait_for_a_slot(self):
+        handler = BlockingHandler()
+        running = []
+
+        async def scenario(server):
+            self.mock.add_commands([{'Type': 'startExecution', 'ExecutionId': str(i), 'TestPath': '0.3'} for i in range(4)])
+            await asyncio.sleep(0.2)
+            running.append(len(server._execution_ids))
+            await self.wait_finished(4)
+        self.run_server(handler, 2, scenario)
+        self.assertEqual(sorted(f['ExecutionId'] for f in self.mock.finished), ['0', '1', '2', '3'])
+        self.assertEqual(set(f['Result'] for f in self.mock.finished), set(['Passed']))
+
+    def test_stop_waits_for_replies(self):
+        handler = BlockingHandler()
+
+        async def scenario(server):
+            request = server._request
+
+            async def slow_request(method, path, *args, **kwargs):
+                if path == '/API/Execution/UpdateFilesEnded':
+                    await asyncio.sleep(0.3)
+                return await request(method, path, *args, **kwargs)
+            server._request = slow_request
+            self.mock.add_commands([{'Type': 'updateFiles', 'ExecutionId': ''}])
+            deadline = time.time() + 5
+            while not server._background_tasks and time.time() < deadline:
+                await asyncio.sleep(0.01)
+            self.assertEqual(self.mock.update_files_ended, 0)
+        self.run_server(handler, 1, scenario)
+        self.assertEqual(self.mock.update_files_ended, 1)
+
+    def test_failed_reply_is_logged(self):
+        async def fail():
+            raise ValueError('Connection refused')
+
+        async def scenario(server):
+            with self.assertLogs(logger, 'ERROR') as logs:
+                await asyncio.gather(server._start_background_task(fail(), 'UpdateFilesEnded'), return_exceptions=True)
+                await asyncio.sleep(0)
+            self.assertEqual(logs.output, ['ERROR:test:UpdateFilesEnded failed: Connection refused'])
+            self.assertEqual(server._background_tasks, set())
+        self.run_server(BlockingHandler(), 1, scenario)
+
+    def test_status_heartbeat_follows_the_schedule(self):
+        async def scenario(server):
+            await asyncio.sleep(0.5)
+            idle = len(self.mock.status_updates)
+            self.mock.add_commands([{'Type': 'startExecution', 'ExecutionId': '1', 'TestPath': '0.6'}])
+            await self.wait_finished(1)
+            await asyncio.sleep(0.3)
+            updates.extend(u for _, u in self.mock.status_updates[idle:])
+            updates.insert(0, idle)
+        updates = []
+        self.run_server(BlockingHandler(), 1, scenario, status_interval=0.1, status_idle_interval=10, status_debounce=0.05)
+        # Backs off while idle: the first heartbeat, then 0.2s later, then 0.4s later
+        self.assertLessEqual(updates[0], 3)
+        ids = [u['ExecutionIds'] for u in updates[1:]]
+        self.assertGreaterEqual(ids.count(['1']), 3)
+        self.assertEqual(ids[-1], [])
+
+
+class AsyncHttpConnectionPoolTest(unittest.TestCase):
+    def test_reuses_connection(self):
+        mock = MockCloudShell()
+        mock.start()
+        self.addCleanup(mock.stop)
+        pool = AsyncHttpConnectionPool()
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        async def main():
+            for _ in range(3):
+                code, _ = await pool.request('127.0.0.1', mock.port, 'put', '/API/Auth/login', body=b'{}')
+                self.assertEqual(code, 200)
+            pool.close()
+        loop.run_until_complete(main())
+        self.assertEqual(pool.stats()['opened'], 1)
+        self.assertEqual(pool.stats()['reused'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
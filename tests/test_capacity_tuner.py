@@ -0,0 +1,113 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from cloudshell.custom_execution_server.capacity_tuner import CapacityPolicy, CapacityTuner, HostSampler, read_trace, simulate
+
+from tests.test_custom_execution_server import Handler, ServerTestCase
+
+
+def sample(t, load=0.0, executions=0, memory=None, cpus=4):
+    return {'time': t, 'load': load, 'cpus': cpus, 'available_memory_bytes': memory, 'executions': executions}
+
+
+class FixedSampler:
+    def __init__(self, samples):
+        self.samples = list(samples)
+
+    def sample(self):
+        return self.samples.pop(0)
+
+
+class CapacityPolicyTest(unittest.TestCase):
+    def test_target_from_load(self):
+        policy = CapacityPolicy(1, 10)
+        self.assertEqual(policy.target(sample(0, load=1.0, executions=2)), 5)
+        self.assertEqual(policy.target(sample(0, load=0.0)), 4)
+        self.assertEqual(policy.target(sample(0, load=20.0, executions=3)), 1)
+        self.assertEqual(policy.target(sample(0, load=None)), 10)
+
+    def test_target_from_memory(self):
+        policy = CapacityPolicy(1, 10, memory_per_execution_bytes=1000, reserve_memory_bytes=500)
+        self.assertEqual(policy.target(sample(0, load=None, executions=1, memory=3600)), 4)
+
+    def test_bounds(self):
+        self.assertRaises(Exception, CapacityPolicy, 0, 5)
+        self.assertRaises(Exception, CapacityPolicy, 5, 4)
+
+
+class CapacityTunerTest(unittest.TestCase):
+    def test_change_needs_stable_samples(self):
+        tuner = CapacityTuner(CapacityPolicy(1, 10, stable_samples=3, min_update_interval=0), 2)
+        self.assertIsNone(tuner.step(sample(0, load=0.0)))
+        self.assertIsNone(tuner.step(sample(1, load=1.0)))
+        # Grows to the smallest target the samples agreed on
+        self.assertEqual(tuner.step(sample(2, load=0.0)), 3)
+
+    def test_direction_change_restarts_the_count(self):
+        tuner = CapacityTuner(CapacityPolicy(1, 10, stable_samples=2, min_update_interval=0), 4)
+        self.assertIsNone(tuner.step(sample(0, load=0.0, executions=4)))
+        self.assertIsNone(tuner.step(sample(1, load=8.0, executions=4)))
+        self.assertEqual(tuner.step(sample(2, load=6.0, executions=4)), 2)
+
+    def test_hysteresis_and_update_interval(self):
+        tuner = CapacityTuner(CapacityPolicy(1, 10, hysteresis=2, stable_samples=1, min_update_interval=100), 4)
+        self.assertIsNone(tuner.step(sample(0, load=0.0, executions=1)))
+        self.assertEqual(tuner.step(sample(1, load=0.0, executions=3)), 7)
+        tuner.applied(7, 1)
+        self.assertIsNone(tuner.step(sample(50, load=12.0, executions=3)))
+        self.assertEqual(tuner.step(sample(101, load=12.0, executions=3)), 1)
+
+    def test_run_once_applies_and_retries_failures(self):
+        applied = []
+
+        def apply(capacity):
+            if not applied:
+                applied.append(None)
+                raise Exception('CloudShell unavailable')
+            applied.append(capacity)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        trace = os.path.join(directory, 'trace.jsonl')
+        tuner = CapacityTuner(CapacityPolicy(1, 10, stable_samples=1, min_update_interval=0), 2,
+                              sampler=FixedSampler([sample(0), sample(1)]), apply=apply, trace_path=trace)
+        tuner.run_once()
+        self.assertEqual((tuner.capacity, tuner.failed_updates), (2, 1))
+        tuner.run_once()
+        self.assertEqual((tuner.capacity, tuner.updates, applied), (4, 1, [None, 4]))
+        self.assertEqual(read_trace(trace), [sample(0), sample(1)])
+
+    def test_simulate(self):
+        policy = CapacityPolicy(1, 8, stable_samples=2, min_update_interval=0)
+        timeline = simulate(policy, [sample(t, load=0.0) for t in range(3)], 2)
+        self.assertEqual([(p['capacity'], p['changed']) for p in timeline], [(2, False), (4, True), (4, False)])
+
+
+class HostSamplerTest(unittest.TestCase):
+    def test_sample(self):
+        s = HostSampler(lambda: 3).sample()
+        self.assertEqual(s['executions'], 3)
+        self.assertGreaterEqual(s['cpus'], 1)
+        json.dumps(s)
+
+
+class SetCapacityTest(ServerTestCase):
+    def test_set_capacity_updates_cloudshell_and_workers(self):
+        server = self.make_server(Handler(), capacity=2)
+        server.set_capacity(5)
+        self.assertEqual(self.mock.servers['test']['Capacity'], 5)
+        self.assertEqual(server.worker_stats()['workers'], 5)
+
+    def test_failed_update_keeps_the_capacity(self):
+        server = self.make_server(Handler(), capacity=2)
+        self.mock.error_status = 503
+        self.assertRaises(Exception, server.set_capacity, 5)
+        self.mock.error_status = None
+        self.assertEqual(self.mock.servers['test']['Capacity'], 2)
+        self.assertEqual(server.worker_stats()['workers'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
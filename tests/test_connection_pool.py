@@ -0,0 +1,169 @@
+import os
+import socket
+import threading
+import time
+import unittest
+
+from cloudshell.custom_execution_server.connection_pool import HttpConnectionPool, RequestInterrupted
+
+
+class ScriptedServer:
+    """
+    HTTP server on one accepted connection at a time, answering each request as the next action says:
+    'ok' responds, 'close' closes the connection without responding, a number sleeps that long and then responds
+    """
+    def __init__(self, actions):
+        self.actions = list(actions)
+        self.requests = []
+        self.connections = 0
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(8)
+        self.port = self._sock.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except (OSError, socket.error):
+                return
+            self.connections += 1
+            t = threading.Thread(target=self._connection, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _connection(self, conn):
+        buf = b''
+        try:
+            while True:
+                while b'\r\n\r\n' not in buf:
+                    data = conn.recv(65536)
+                    if not data:
+                        return
+                    buf += data
+                head, buf = buf.split(b'\r\n\r\n', 1)
+                request_line = head.split(b'\r\n')[0].decode('latin-1')
+                self.requests.append(request_line)
+                action = self.actions.pop(0) if self.actions else 'ok'
+                if action == 'close':
+                    return
+                if action != 'ok':
+                    time.sleep(action)
+                conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+        except (OSError, socket.error):
+            pass
+        finally:
+            conn.close()
+
+    def close(self):
+        self._sock.close()
+
+
+class HttpConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = HttpConnectionPool(max_size=2, idle_timeout=30)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_reuses_connection(self):
+        server = ScriptedServer([])
+        self.addCleanup(server.close)
+        self.assertEqual(self.pool.request('127.0.0.1', server.port, 'get', '/a'), (200, b'ok'))
+        self.assertEqual(self.pool.request('127.0.0.1', server.port, 'put', '/b', body=b'x'), (200, b'ok'))
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(self.pool.stats()['reused'], 1)
+
+    def test_timeout_on_reused_connection_is_not_retried(self):
+        server = ScriptedServer(['ok', 2])
+        self.addCleanup(server.close)
+        self.pool.request('127.0.0.1', server.port, 'get', '/a')
+        t0 = time.time()
+        self.assertRaises(socket.timeout, self.pool.request, '127.0.0.1', server.port, 'get', '/b', timeout=0.5)
+        self.assertLess(time.time() - t0, 1.5)
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(self.pool.stats()['stale_reconnects'], 0)
+
+    def test_idempotent_request_closed_without_response_is_retried(self):
+        server = ScriptedServer(['ok', 'close'])
+        self.addCleanup(server.close)
+        self.pool.request('127.0.0.1', server.port, 'get', '/a')
+        self.assertEqual(self.pool.request('127.0.0.1', server.port, 'get', '/b'), (200, b'ok'))
+        self.assertEqual(server.requests, ['GET /a HTTP/1.1', 'GET /b HTTP/1.1', 'GET /b HTTP/1.1'])
+        self.assertEqual(self.pool.stats()['stale_reconnects'], 1)
+
+    def test_non_idempotent_request_closed_without_response_is_not_retried(self):
+        server = ScriptedServer(['ok', 'close'])
+        self.addCleanup(server.close)
+        self.pool.request('127.0.0.1', server.port, 'get', '/a')
+        self.assertRaises(Exception, self.pool.request, '127.0.0.1', server.port, 'delete', '/API/Execution/PendingCommand')
+        self.assertEqual(server.requests, ['GET /a HTTP/1.1', 'DELETE /API/Execution/PendingCommand HTTP/1.1'])
+
+    def test_retry_policy(self):
+        self.assertTrue(HttpConnectionPool._retryable(BrokenPipeError(), 'delete', 0))
+        self.assertFalse(HttpConnectionPool._retryable(BrokenPipeError(), 'delete', 10))
+        self.assertFalse(HttpConnectionPool._retryable(socket.timeout(), 'get', 0))
+
+    def test_interrupt(self):
+        server = ScriptedServer([5])
+        self.addCleanup(server.close)
+        errors = []
+
+        def poll():
+            try:
+                self.pool.request('127.0.0.1', server.port, 'delete', '/poll', tag='poll')
+            except Exception as e:
+                errors.append(e)
+        t = threading.Thread(target=poll)
+        t.start()
+        time.sleep(0.3)
+        self.pool.interrupt('poll')
+        t.join(2)
+        self.assertFalse(t.is_alive())
+        self.assertIsInstance(errors[0], RequestInterrupted)
+        self.assertRaises(RequestInterrupted, self.pool.request, '127.0.0.1', server.port, 'get', '/a', tag='poll')
+        self.pool.clear_interrupt('poll')
+
+
+class FakeConnection:
+    def __init__(self, sock):
+        self.sock = sock
+
+
+class FakePooledConnection:
+    def __init__(self, sock):
+        self.connection = FakeConnection(sock)
+
+
+class IsDroppedTest(unittest.TestCase):
+    def check(self, ours, theirs):
+        pc = FakePooledConnection(ours)
+        self.assertFalse(HttpConnectionPool._is_dropped(pc))
+        theirs.close()
+        self.assertTrue(HttpConnectionPool._is_dropped(pc))
+
+    def test_socketpair(self):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.check(ours, theirs)
+
+    @unittest.skipUnless(hasattr(os, 'dup2'), 'needs dup2')
+    def test_descriptor_above_select_limit(self):
+        ours, theirs = socket.socketpair()
+        try:
+            fd = os.dup2(ours.fileno(), 1500) or 1500
+        except OSError:
+            ours.close()
+            theirs.close()
+            self.skipTest('Descriptor limit below 1500')
+        ours.close()
+        high = socket.socket(fileno=fd)
+        self.addCleanup(high.close)
+        self.check(high, theirs)
+
+
+if __name__ == '__main__':
+    unittest.main()
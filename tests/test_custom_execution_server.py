@@ -0,0 +1,189 @@
+import logging
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'benchmarks'))
+
+from cloudshell.custom_execution_server.custom_execution_server import CustomExecutionServer, CustomExecutionServerCommandHandler, PassedCommandResult, StoppedCommandResult
+
+from mock_cloudshell import MockCloudShell
+
+logger = logging.getLogger('test')
+
+
+class Handler(CustomExecutionServerCommandHandler):
+    """
+    Runs each test for float(test_path) seconds, or until it is stopped
+    """
+    def __init__(self, name='handler'):
+        CustomExecutionServerCommandHandler.__init__(self)
+        self.name = name
+        self.executed = []
+        self.stopped = []
+        self._stop_events = {}
+        self._lock = threading.Lock()
+
+    def execute_command(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger):
+        with self._lock:
+            self.executed.append(execution_id)
+            event = self._stop_events.setdefault(execution_id, threading.Event())
+        if event.wait(float(test_path or 0)):
+            return StoppedCommandResult()
+        return PassedCommandResult('result.log', self.name, 'text/plain')
+
+    def stop_command(self, execution_id, logger):
+        with self._lock:
+            self.stopped.append(execution_id)
+            self._stop_events.setdefault(execution_id, threading.Event()).set()
+
+
+def start_execution(execution_id, seconds=0, **fields):
+    command = {'Type': 'startExecution', 'ExecutionId': execution_id, 'TestPath': str(seconds)}
+    command.update(fields)
+    return command
+
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mock = MockCloudShell(poll_timeout=0.3)
+        self.mock.start()
+        self.addCleanup(self.mock.stop)
+
+    def make_server(self, handler, capacity=2, **kwargs):
+        server = CustomExecutionServer('test', 'test server', 'Python', capacity, handler, logger,
+                                       '127.0.0.1', self.mock.port, 'admin', 'admin', 'Global',
+                                       auto_register=True, auto_start=False, **kwargs)
+        return server
+
+    def results(self):
+        return dict((f['ExecutionId'], f['Result']) for f in self.mock.finished)
+
+
+class PollingTest(ServerTestCase):
+    def test_several_pollers_dispatch_every_command(self):
+        handler = Handler()
+        server = self.make_server(handler, capacity=4, poller_count=3)
+        self.mock.add_commands([start_execution(str(i)) for i in range(12)])
+        server.start()
+        self.addCleanup(server.stop)
+        self.assertTrue(self.mock.wait_finished(12, 10))
+        self.assertEqual(sorted(handler.executed, key=int), [str(i) for i in range(12)])
+        self.assertEqual(set(self.results().values()), set(['Passed']))
+        self.assertEqual(server.dispatch_stats()['pollers'], 3)
+
+    def test_stop_reaches_a_running_execution(self):
+        handler = Handler()
+        server = self.make_server(handler, capacity=1)
+        self.mock.add_commands([start_execution('1', 10)])
+        server.start()
+        self.addCleanup(server.stop)
+        deadline = time.time() + 5
+        while not handler.executed and time.time() < deadline:
+            time.sleep(0.01)
+        self.mock.add_commands([{'Type': 'stopExecution', 'ExecutionId': '1'}])
+        self.assertTrue(self.mock.wait_finished(1, 5))
+        self.assertEqual(handler.stopped, ['1'])
+        self.assertEqual(self.results(), {'1': 'Stopped'})
+
+
+class IgnoringHandler(Handler):
+    """
+    Passes each test even when it is stopped
+    """
+    def execute_command(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger):
+        Handler.execute_command(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger)
+        return PassedCommandResult('result.log', self.name, 'text/plain')
+
+
+class StopTest(ServerTestCase):
+    def wait_executed(self, handler, count):
+        deadline = time.time() + 5
+        while len(handler.executed) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_stopped_execution_is_reported_once(self):
+        handler = IgnoringHandler()
+        server = self.make_server(handler, capacity=1)
+        self.mock.add_commands([start_execution('1', 10)])
+        server.start()
+        self.addCleanup(server.stop)
+        self.wait_executed(handler, 1)
+        self.mock.add_commands([{'Type': 'stopExecution', 'ExecutionId': '1'}])
+        self.assertTrue(self.mock.wait_finished(1, 5))
+        time.sleep(0.5)
+        self.assertEqual(len(self.mock.finished), 1)
+        self.assertEqual(self.results(), {'1': 'Stopped'})
+        self.assertEqual(server._stopped_ids, set())
+
+    def test_stop_of_an_execution_that_is_not_running_is_ignored(self):
+        handler = Handler()
+        server = self.make_server(handler, capacity=1)
+        self.mock.add_commands([start_execution('1'), {'Type': 'stopExecution', 'ExecutionId': 'unknown'}])
+        server.start()
+        self.addCleanup(server.stop)
+        self.assertTrue(self.mock.wait_finished(1, 5))
+        self.mock.add_commands([{'Type': 'stopExecution', 'ExecutionId': '1'}, start_execution('2')])
+        self.assertTrue(self.mock.wait_finished(2, 5))
+        time.sleep(0.5)
+        self.assertEqual(handler.stopped, [])
+        self.assertEqual(self.results(), {'1': 'Passed', '2': 'Passed'})
+        self.assertEqual(len(self.mock.finished), 2)
+        self.assertEqual(server._stopped_ids, set())
+
+    def test_queued_execution_is_stopped_before_it_runs(self):
+        handler = Handler()
+        server = self.make_server(handler, capacity=1, worker_queue_size=2)
+        self.mock.add_commands([start_execution('1', 1), start_execution('2')])
+        server.start()
+        self.addCleanup(server.stop)
+        self.wait_executed(handler, 1)
+        self.mock.add_commands([{'Type': 'stopExecution', 'ExecutionId': '2'}])
+        self.assertTrue(self.mock.wait_finished(2, 5))
+        time.sleep(0.3)
+        self.assertEqual(handler.executed, ['1'])
+        self.assertEqual(self.results(), {'1': 'Passed', '2': 'Stopped'})
+        self.assertEqual(len(self.mock.finished), 2)
+
+
+class ReloadTest(ServerTestCase):
+    def test_running_executions_finish_on_the_old_handler(self):
+        old, new = Handler('old'), Handler('new')
+        server = self.make_server(old, capacity=2)
+        self.mock.add_commands([start_execution('1', 10)])
+        server.start()
+        self.addCleanup(server.stop)
+        deadline = time.time() + 5
+        while not old.executed and time.time() < deadline:
+            time.sleep(0.01)
+        drained = []
+        server.set_command_handler(new, on_drained=lambda: drained.append(time.time()))
+        self.mock.add_commands([start_execution('2')])
+        self.assertTrue(self.mock.wait_finished(1, 5))
+        self.assertEqual((old.executed, new.executed, drained), (['1'], ['2'], []))
+        self.mock.add_commands([{'Type': 'stopExecution', 'ExecutionId': '1'}])
+        self.assertTrue(self.mock.wait_finished(2, 5))
+        self.assertEqual((old.stopped, new.stopped), (['1'], []))
+        self.assertEqual(len(drained), 1)
+
+    def test_idle_handler_is_drained_at_once(self):
+        server = self.make_server(Handler(), capacity=2)
+        drained = []
+        server.set_command_handler(Handler(), on_drained=lambda: drained.append(True))
+        self.assertEqual(drained, [True])
+
+    def test_reconfigure(self):
+        server = self.make_server(Handler(), capacity=2)
+        server.reconfigure(server_description='new description', server_capacity=3)
+        self.assertEqual((self.mock.servers['test']['Description'], self.mock.servers['test']['Capacity']), ('new description', 3))
+        self.mock.error_status = 503
+        self.assertRaises(Exception, server.reconfigure, server_description='other')
+        self.mock.error_status = None
+        server.reconfigure(server_capacity=3)
+        self.assertEqual(self.mock.servers['test']['Description'], 'new description')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from cloudshell.custom_execution_server.journal import ExecutionJournal, ACCEPTED, RUNNING, PROCESS, FINISHED, REPORTED, process_start_time
+
+from tests.test_custom_execution_server import Handler, ServerTestCase
+
+logger = logging.getLogger('test')
+
+
+class JournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.path = os.path.join(self.directory, 'journal', 'executions.log')
+
+    def open_journal(self, **kwargs):
+        journal = ExecutionJournal(self.path, logger, **kwargs)
+        live = journal.open()
+        self.addCleanup(journal.close)
+        return journal, live
+
+    def lines(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+
+class ExecutionJournalTest(JournalTestCase):
+    def test_replay_returns_live_executions(self):
+        journal, live = self.open_journal()
+        self.assertEqual(live, {})
+        journal.record(ACCEPTED, '1')
+        journal.record(ACCEPTED, '2')
+        journal.record(RUNNING, '2')
+        journal.record(PROCESS, '2', pid=1234, start_time=5678)
+        journal.record(ACCEPTED, '3')
+        journal.record(RUNNING, '3')
+        journal.record(FINISHED, '3', result={'Result': 'Passed'})
+        journal.record(ACCEPTED, '4')
+        journal.record(REPORTED, '4')
+        journal.close()
+        _, live = self.open_journal()
+        self.assertEqual(live, {
+            '1': {'state': ACCEPTED},
+            '2': {'state': RUNNING, 'pid': 1234, 'start_time': 5678},
+            '3': {'state': FINISHED, 'result': {'Result': 'Passed'}},
+        })
+
+    def test_torn_last_line_is_ignored(self):
+        journal, _ = self.open_journal(fsync='always')
+        journal.record(ACCEPTED, '1')
+        journal._file.write('{"t": 1, "e": "acc')
+        journal._file.flush()
+        reopened = ExecutionJournal(self.path, logger)
+        self.assertEqual(reopened.open(), {'1': {'state': ACCEPTED}})
+        reopened.close()
+
+    def test_compaction_keeps_only_live_executions(self):
+        journal, _ = self.open_journal(compact_every=10)
+        for i in range(4):
+            journal.record(ACCEPTED, str(i))
+            journal.record(RUNNING, str(i))
+            journal.record(REPORTED, str(i))
+        journal.record(ACCEPTED, 'live')
+        journal.record(PROCESS, 'live', pid=1234, start_time=5678)
+        # Compacted to execution 3's accepted record after the 10th record, then 4 appended
+        self.assertEqual(len(self.lines()), 5)
+        journal.compact()
+        self.assertEqual([(r['e'], r['id']) for r in self.lines()], [(ACCEPTED, 'live'), (PROCESS, 'live')])
+        self.assertEqual(self.lines()[1]['start_time'], 5678)
+        self.assertEqual(journal.live_count(), 1)
+
+    def test_bad_fsync_mode(self):
+        self.assertRaises(Exception, ExecutionJournal, self.path, logger, fsync='sometimes')
+
+
+@unittest.skipUnless(os.path.exists('/proc/self/stat'), 'needs /proc')
+class ProcessStartTimeTest(unittest.TestCase):
+    def test_start_time(self):
+        self.assertIsInstance(process_start_time(os.getpid()), int)
+        self.assertEqual(process_start_time(os.getpid()), process_start_time(os.getpid()))
+        process = subprocess.Popen(['sleep', '10'])
+        self.assertGreaterEqual(process_start_time(process.pid), process_start_time(os.getpid()))
+        process.kill()
+        process.wait()
+        self.assertIsNone(process_start_time(process.pid))
+
+
+@unittest.skipUnless(os.path.exists('/proc/self/stat') and hasattr(os, 'killpg'), 'needs /proc and process groups')
+class RecoveryTest(ServerTestCase):
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.path = os.path.join(self.directory, 'executions.log')
+
+    def spawn(self):
+        process = subprocess.Popen(['sleep', '30'], start_new_session=True)
+        self.addCleanup(process.wait)
+        self.addCleanup(process.kill)
+        return process
+
+    def journal_running(self, execution_id, pid, start_time):
+        journal = ExecutionJournal(self.path, logger)
+        journal.open()
+        journal.record(ACCEPTED, execution_id)
+        journal.record(RUNNING, execution_id)
+        journal.record(PROCESS, execution_id, pid=pid, start_time=start_time)
+        journal.close()
+
+    def start_server(self):
+        server = self.make_server(Handler(), capacity=1, journal_path=self.path)
+        server.start()
+        self.addCleanup(server.stop)
+        return server
+
+    def finished(self):
+        return dict((f['ExecutionId'], (f['Result'], f['ErrorName'])) for f in self.mock.finished)
+
+    def test_reattached_execution_is_reported_with_unknown_outcome(self):
+        process = self.spawn()
+        self.journal_running('1', process.pid, process_start_time(process.pid))
+        self.start_server()
+        time.sleep(0.5)
+        self.assertEqual(self.mock.finished, [])
+        process.kill()
+        process.wait()
+        self.assertTrue(self.mock.wait_finished(1, 5))
+        self.assertEqual(self.finished(), {'1': ('Error', 'Reattached, outcome unknown')})
+
+    def test_reattached_execution_can_be_stopped(self):
+        process = self.spawn()
+        self.journal_running('1', process.pid, process_start_time(process.pid))
+        self.start_server()
+        self.mock.add_commands([{'Type': 'stopExecution', 'ExecutionId': '1'}])
+        self.assertTrue(self.mock.wait_finished(1, 5))
+        self.assertEqual(process.wait(5), -15)
+        self.assertEqual(self.finished(), {'1': ('Stopped', '')})
+
+    def test_reused_pid_is_not_reattached_or_stopped(self):
+        process = self.spawn()
+        self.journal_running('1', process.pid, process_start_time(process.pid) - 1)
+        self.start_server()
+        self.mock.add_commands([{'Type': 'stopExecution', 'ExecutionId': '1'}])
+        self.assertTrue(self.mock.wait_finished(1, 5))
+        self.assertEqual(self.finished(), {'1': ('Error', 'Execution interrupted')})
+        time.sleep(0.5)
+        self.assertIsNone(process.poll())
+
+
+if __name__ == '__main__':
+    unittest.main()
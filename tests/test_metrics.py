@@ -0,0 +1,107 @@
+import sys
+import threading
+import unittest
+
+if sys.version_info.major == 2:
+    from httplib import HTTPConnection
+else:
+    from http.client import HTTPConnection
+
+from cloudshell.custom_execution_server.metrics import MetricsRegistry, MetricsServer
+
+from tests.test_custom_execution_server import Handler, ServerTestCase, start_execution
+
+
+def scrape(port, path='/metrics'):
+    connection = HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return response.status, response.read().decode('utf-8')
+    finally:
+        connection.close()
+
+
+class MetricsTest(unittest.TestCase):
+    def test_counter_adds_up_threads_including_exited_ones(self):
+        counter = MetricsRegistry().counter('requests_total', 'Requests', ('endpoint',))
+
+        def work():
+            for _ in range(1000):
+                counter.inc(('poll',))
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        counter.inc(('poll',), 5)
+        self.assertEqual(counter.value(('poll',)), 4005)
+        self.assertEqual(counter.value(('poll',)), 4005)
+        self.assertEqual(counter.value(('status',)), 0)
+
+    def test_histogram_rendering(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram('latency_seconds', 'Latency', ('server',), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, ('a',))
+        self.assertEqual(histogram.count(('a',)), 4)
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{server="a",le="0.1"} 2',
+            'latency_seconds_bucket{server="a",le="1"} 3',
+            'latency_seconds_bucket{server="a",le="+Inf"} 4',
+            'latency_seconds_sum{server="a"} 3.65',
+            'latency_seconds_count{server="a"} 4',
+        ]) + '\n')
+
+    def test_gauge(self):
+        registry = MetricsRegistry()
+        gauge = registry.gauge('queue_depth', 'Queue depth', ('server',))
+        depth = [3]
+        gauge.set_function(lambda: depth[0], ('a',))
+        gauge.set(7, ('b',))
+        gauge.set_function(lambda: 1 / 0, ('c',))
+        depth[0] = 4
+        self.assertIn('queue_depth{server="a"} 4\nqueue_depth{server="b"} 7\n', registry.render())
+        gauge.remove(('a',))
+        self.assertNotIn('server="a"', registry.render())
+
+    def test_labels_are_escaped(self):
+        registry = MetricsRegistry()
+        registry.counter('x_total', 'X', ('name',)).inc(('a"b\\c\nd',))
+        self.assertIn('x_total{name="a\\"b\\\\c\\nd"} 1', registry.render())
+
+    def test_registry_returns_existing_metrics(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('x_total', 'X', ('server',))
+        self.assertIs(registry.counter('x_total', 'X', ('server',)), counter)
+        self.assertRaises(Exception, registry.gauge, 'x_total', 'X', ('server',))
+        self.assertRaises(Exception, registry.counter, 'x_total', 'X', ('other',))
+        self.assertRaises(Exception, counter.inc, ('a', 'b'))
+
+    def test_server(self):
+        registry = MetricsRegistry()
+        registry.counter('x_total', 'X').inc()
+        server = MetricsServer(registry, port=0)
+        server.start()
+        self.addCleanup(server.stop)
+        self.assertEqual(scrape(server.port), (200, registry.render()))
+        self.assertEqual(scrape(server.port, '/other')[0], 404)
+
+
+class ServerMetricsTest(ServerTestCase):
+    def test_executions_are_counted(self):
+        server = self.make_server(Handler(), capacity=2, metrics_port=0)
+        self.mock.add_commands([start_execution(str(i)) for i in range(3)])
+        server.start()
+        self.addCleanup(server.stop)
+        self.assertTrue(self.mock.wait_finished(3, 10))
+        _, text = scrape(server._metrics_server.port)
+        self.assertIn('cloudshell_execution_server_commands_total{server="test",type="startExecution"} 3', text)
+        self.assertIn('cloudshell_execution_server_execution_seconds_count{server="test",result="Passed"} 3', text)
+        self.assertIn('cloudshell_execution_server_capacity{server="test"} 2', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
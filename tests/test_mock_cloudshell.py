@@ -0,0 +1,82 @@
+import json
+import os
+import sys
+import time
+import unittest
+
+if sys.version_info.major == 2:
+    from httplib import HTTPConnection
+else:
+    from http.client import HTTPConnection
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'benchmarks'))
+
+from mock_cloudshell import MockCloudShell
+
+
+class MockCloudShellTest(unittest.TestCase):
+    def make_mock(self, **kwargs):
+        mock = MockCloudShell(**kwargs)
+        mock.start()
+        self.addCleanup(mock.stop)
+        return mock
+
+    def request(self, mock, method, path, body=None):
+        connection = HTTPConnection('127.0.0.1', mock.port, timeout=10)
+        try:
+            connection.request(method, path, json.dumps(body) if body is not None else None, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def finish(self, mock, execution_id):
+        return self.request(mock, 'PUT', '/API/Execution/FinishedExecution', {'ExecutionId': execution_id, 'Result': 'Passed'})[0]
+
+    def test_errors_are_injected_only_on_chosen_endpoints(self):
+        mock = self.make_mock(error_rate=1.0, error_endpoints=['FinishedExecution'], error_code=503)
+        self.assertEqual(self.request(mock, 'POST', '/API/Auth/login', {})[0], 200)
+        self.assertEqual(self.finish(mock, '1'), 503)
+        self.assertEqual(self.request(mock, 'POST', '/API/Execution/Status', {'Name': 'x', 'ExecutionIds': []})[0], 200)
+        self.assertEqual((mock.injected_errors, mock.finished), (1, []))
+
+    def test_error_rate_is_reproducible(self):
+        codes = []
+        for _ in range(2):
+            mock = self.make_mock(error_rate=0.5, seed=7)
+            codes.append([self.finish(mock, str(i)) for i in range(20)])
+        self.assertEqual(codes[0], codes[1])
+        self.assertTrue(0 < codes[0].count(500) < 20)
+
+    def test_outage(self):
+        mock = self.make_mock()
+        mock.error_status = 503
+        self.assertEqual(self.finish(mock, '1'), 503)
+        mock.error_status = None
+        self.assertEqual(self.finish(mock, '1'), 200)
+
+    def test_latency(self):
+        mock = self.make_mock(latency=0.2)
+        t0 = time.time()
+        self.finish(mock, '1')
+        self.assertGreaterEqual(time.time() - t0, 0.2)
+
+    def test_feed_commands_at_a_rate(self):
+        mock = self.make_mock()
+        t0 = time.time()
+        mock.feed_commands([{'Type': 'startExecution', 'ExecutionId': str(i)} for i in range(5)], 20, poisson=False).join(5)
+        self.assertGreaterEqual(time.time() - t0, 0.18)
+        times = [mock.command_arrival_times[str(i)] for i in range(5)]
+        self.assertEqual(times, sorted(times))
+
+    def test_stop_ends_feeding(self):
+        mock = MockCloudShell()
+        mock.start()
+        feeder = mock.feed_commands([{'Type': 'startExecution', 'ExecutionId': str(i)} for i in range(100)], 1)
+        mock.stop()
+        self.assertFalse(feeder.is_alive())
+        self.assertLess(len(mock.command_arrival_times), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from cloudshell.custom_execution_server.output_parsers import JUnitParser, RobotParser, TapParser, make_parser, parse_file
+from cloudshell.custom_execution_server.process_manager import ProcessRunner
+
+TAP = b'''TAP version 13
+1..5
+ok 1 - connects
+not ok 2 - logs in # expected 200, got 401
+ok 3 - uploads # SKIP no storage
+not ok 4 - flaky # TODO fix later
+    not ok 1 - indented subtest
+ok 5 - disconnects
+'''
+
+ROBOT = b'''==============================================================================
+Suite
+==============================================================================
+Open Session                                                          | PASS |
+------------------------------------------------------------------------------
+Send Command                                                          | FAIL |
+Expected 'OK' but got 'ERROR'
+------------------------------------------------------------------------------
+Optional Step                                                         | SKIP |
+------------------------------------------------------------------------------
+Suite                                                                 | FAIL |
+3 tests, 1 passed, 1 failed, 1 skipped
+==============================================================================
+'''
+
+JUNIT = b'''collecting tests...
+<?xml version="1.0" encoding="utf-8"?>
+<testsuites><testsuite name="suite" tests="4">
+<testcase classname="test_net" name="test_ping"/>
+<testcase classname="test_net" name="test_dns"><failure message="timed out">Traceback
+  line 1</failure></testcase>
+<testcase classname="test_net" name="test_http"><error message="refused"/></testcase>
+<testcase name="test_later"><skipped/></testcase>
+</testsuite></testsuites>
+finished
+'''
+
+
+def feed(parser, data, block_size):
+    for i in range(0, len(data), block_size):
+        parser.feed(data[i:i + block_size])
+    parser.close()
+    return parser
+
+
+class TapParserTest(unittest.TestCase):
+    def test_counts(self):
+        for block_size in (1, 7, len(TAP)):
+            parser = feed(TapParser(), TAP, block_size)
+            self.assertEqual((parser.passed, parser.failed, parser.skipped, parser.planned), (2, 1, 2, 5), block_size)
+            self.assertEqual(parser.failures, [{'name': 'logs in', 'message': 'expected 200, got 401'}])
+            self.assertTrue(parser.complete)
+            self.assertEqual(parser.verdict(), 'Failed')
+
+    def test_missing_plan_is_incomplete(self):
+        parser = feed(TapParser(), b'ok 1 - a\nok 2 - b', 4)
+        self.assertEqual(parser.passed, 2)
+        self.assertFalse(parser.complete)
+        self.assertEqual(parser.verdict(), 'Passed')
+
+    def test_bail_out(self):
+        parser = feed(TapParser(), b'1..3\nok 1\nBail out! database down\n', 100)
+        self.assertEqual(parser.failures, [{'name': 'Bail out!', 'message': 'database down'}])
+        self.assertFalse(parser.complete)
+
+    def test_failures_are_capped(self):
+        data = b''.join(b'not ok %d - test %d\n' % (i, i) for i in range(1, 11))
+        summary = feed(TapParser(max_failures=3, max_message_size=6), data, 64).summary()
+        self.assertEqual(summary['failed'], 10)
+        self.assertEqual([f['name'] for f in summary['failures']], ['test 1', 'test 2', 'test 3'])
+        self.assertEqual(summary['failures_omitted'], 7)
+
+    def test_long_lines_are_cut(self):
+        parser = feed(TapParser(max_line_size=100), b'x' * 100000 + b'\nok 1 - after\n', 1000)
+        self.assertEqual(parser.passed, 1)
+        self.assertEqual(parser.bytes_parsed, 100000 + 14)
+
+
+class RobotParserTest(unittest.TestCase):
+    def test_counts_tests_but_not_suites(self):
+        for block_size in (1, 13, len(ROBOT)):
+            parser = feed(RobotParser(), ROBOT, block_size)
+            self.assertEqual((parser.passed, parser.failed, parser.skipped), (1, 1, 1), block_size)
+            self.assertEqual(parser.failures, [{'name': 'Send Command', 'message': "Expected 'OK' but got 'ERROR'"}])
+            self.assertTrue(parser.complete)
+
+    def test_result_on_the_last_line(self):
+        parser = feed(RobotParser(), b'Only Test    | PASS |\n', 5)
+        self.assertEqual(parser.passed, 1)
+        self.assertFalse(parser.complete)
+
+
+class JUnitParserTest(unittest.TestCase):
+    def test_counts(self):
+        for block_size in (1, 17, len(JUNIT)):
+            parser = feed(JUnitParser(), JUNIT, block_size)
+            self.assertEqual((parser.passed, parser.failed, parser.skipped), (1, 2, 1), block_size)
+            self.assertEqual(parser.failures, [{'name': 'test_net.test_dns', 'message': 'timed out\nTraceback\n  line 1'},
+                                               {'name': 'test_net.test_http', 'message': 'refused'}])
+            self.assertTrue(parser.complete)
+            self.assertIsNone(parser.parse_error)
+
+    def test_truncated_document(self):
+        parser = feed(JUnitParser(), JUNIT[:JUNIT.index(b'<testcase name')], 50)
+        self.assertEqual((parser.passed, parser.failed), (1, 2))
+        self.assertFalse(parser.complete)
+        self.assertTrue(parser.parse_error)
+
+    def test_no_xml(self):
+        parser = feed(JUnitParser(), b'no tests here\n', 4)
+        self.assertEqual(parser.summary()['total'], 0)
+        self.assertEqual(parser.verdict(), 'Failed')
+
+
+class MakeParserTest(unittest.TestCase):
+    def test_unknown_format(self):
+        self.assertRaises(Exception, make_parser, 'nunit')
+
+    def test_summary_json(self):
+        summary = json.loads(feed(make_parser('tap'), TAP, 1024).summary_json())
+        self.assertEqual((summary['format'], summary['verdict'], summary['total'], summary['planned']), ('tap', 'Failed', 5, 5))
+
+    def test_parse_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        path = os.path.join(directory, 'results.xml')
+        with open(path, 'wb') as f:
+            f.write(JUNIT)
+        parser = parse_file(make_parser('junit'), path, block_size=10)
+        self.assertEqual(parser.summary()['total'], 4)
+
+    def test_parses_output_as_it_is_captured(self):
+        runner = ProcessRunner(None)
+        self.addCleanup(runner.close)
+        parser = make_parser('tap')
+        script = 'import sys\nfor i in range(1, 1001):\n    sys.stdout.write("ok %d - test %d\\n" % (i, i))\nsys.stdout.write("1..1000\\n")\n'
+        capture, code = runner.execute_spooled([sys.executable, '-c', script], '1', parser=parser, block_size=100)
+        capture.discard()
+        self.assertEqual(code, 0)
+        self.assertEqual((parser.passed, parser.complete), (1000, True))
@@ -0,0 +1,115 @@
+import threading
+import time
+import unittest
+
+from cloudshell.custom_execution_server.poll_controller import CLOSED, HALF_OPEN, OPEN, PollController
+
+from tests.test_custom_execution_server import Handler, ServerTestCase, start_execution
+
+
+class PollControllerTest(unittest.TestCase):
+    def make_controller(self, **kwargs):
+        states = []
+        controller = PollController(on_state_change=states.append, **kwargs)
+        controller._random.seed(1)
+        return controller, states
+
+    def test_backoff_grows_with_failures(self):
+        controller, states = self.make_controller(failure_threshold=10, initial_backoff=1, max_backoff=4)
+        delays = [controller.poll_failed(0.1, Exception('Connection refused'), now=100) for _ in range(6)]
+        self.assertTrue(all(0 <= d <= 4 for d in delays), delays)
+        self.assertLessEqual(delays[0], 1)
+        self.assertEqual(controller.next_delay(now=100 + max(delays))[0], 0)
+        stats = controller.stats(now=100)
+        self.assertEqual((stats['consecutive_failures'], stats['last_error'], stats['state']), (6, 'Connection refused', CLOSED))
+        self.assertIn('consecutive failed polls: Connection refused', stats['reason'])
+        self.assertEqual(states, [])
+
+    def test_breaker_opens_probes_and_closes(self):
+        controller, states = self.make_controller(failure_threshold=3, open_seconds=10, max_open_seconds=25)
+        for _ in range(3):
+            controller.poll_failed(0.1, Exception('Connection refused'), now=100)
+        self.assertEqual(controller.state(), OPEN)
+        delay, reason = controller.next_delay(now=105)
+        self.assertEqual(delay, 5)
+        self.assertIn('Circuit breaker open for 10s', reason)
+        # One probe at a time once the breaker is half-open
+        self.assertEqual(controller.next_delay(now=110), (0, None))
+        self.assertEqual(controller.state(), HALF_OPEN)
+        self.assertGreater(controller.next_delay(now=110)[0], 0)
+        # A failed probe opens it for twice as long, up to max_open_seconds
+        self.assertEqual(controller.poll_failed(0.1, Exception('Timed out'), now=110), 20)
+        controller.next_delay(now=130)
+        self.assertEqual(controller.poll_failed(0.1, Exception('Timed out'), now=130), 25)
+        controller.next_delay(now=155)
+        controller.poll_succeeded(1, True, now=155)
+        self.assertEqual(controller.state(), CLOSED)
+        self.assertEqual(controller.next_delay(now=155), (0, None))
+        self.assertEqual(states, [OPEN, HALF_OPEN, OPEN, HALF_OPEN, OPEN, HALF_OPEN, CLOSED])
+        self.assertEqual((controller.stats()['opened'], controller.stats()['failed']), (3, 5))
+
+    def test_cancelled_probe_lets_another_poll_probe(self):
+        controller, states = self.make_controller(failure_threshold=1, open_seconds=10)
+        controller.poll_failed(0.1, Exception('Connection refused'), now=100)
+        self.assertEqual(controller.next_delay(now=110), (0, None))
+        controller.poll_cancelled()
+        self.assertEqual(controller.next_delay(now=110), (0, None))
+
+    def test_fast_empty_polls_back_off(self):
+        controller, states = self.make_controller(min_empty_interval=1, max_empty_interval=4, fast_empty_seconds=0.25)
+        delays = []
+        for _ in range(5):
+            controller.poll_succeeded(0, False, now=100)
+            delays.append(controller.next_delay(now=100)[0])
+            controller._resume_at = 0
+        for delay, interval in zip(delays, (1, 2, 4, 4, 4)):
+            self.assertTrue(interval / 2.0 <= delay <= interval, delays)
+        # A command, or an empty poll that CloudShell held open, resets it
+        controller.poll_succeeded(0, True, now=100)
+        controller.poll_succeeded(0, False, now=100)
+        self.assertLessEqual(controller.next_delay(now=100)[0], 1)
+        self.assertEqual(controller.stats()['fast_empty'], 6)
+
+    def test_request_timeout_follows_hold_time(self):
+        controller, states = self.make_controller(initial_timeout=120, min_timeout=30, max_timeout=300, timeout_factor=2, timeout_margin=10)
+        self.assertEqual(controller.request_timeout(), 120)
+        controller.poll_succeeded(20, False)
+        self.assertEqual(controller.request_timeout(), 50)
+        controller.poll_succeeded(5, False)
+        self.assertEqual(controller.request_timeout(), 2 * (0.8 * 20 + 0.2 * 5) + 10)
+        for _ in range(50):
+            controller.poll_succeeded(1, False)
+        self.assertEqual(controller.request_timeout(), 30)
+        # Polls that returned a command don't say how long CloudShell holds empty ones
+        controller.poll_succeeded(1000, True)
+        self.assertEqual(controller.request_timeout(), 30)
+
+    def test_wait_returns_when_stopped(self):
+        controller, states = self.make_controller(failure_threshold=1, open_seconds=60)
+        controller.poll_failed(0.1, Exception('Connection refused'))
+        stop = threading.Event()
+        result = []
+        th = threading.Thread(target=lambda: result.append(controller.wait(stop)))
+        th.start()
+        time.sleep(0.1)
+        stop.set()
+        controller.wake()
+        th.join(5)
+        self.assertEqual(result, [False])
+
+
+class ServerBreakerTest(ServerTestCase):
+    def test_polling_resumes_after_an_outage(self):
+        controller = PollController(failure_threshold=2, initial_backoff=0.01, open_seconds=0.3, max_open_seconds=0.5)
+        server = self.make_server(Handler(), capacity=1, poll_controller=controller)
+        server.start()
+        self.addCleanup(server.stop)
+        self.mock.error_status = 503
+        deadline = time.time() + 10
+        while controller.stats()['opened'] < 1 and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertTrue(server.poll_stats()['paused'])
+        self.mock.error_status = None
+        self.mock.add_commands([start_execution('1')])
+        self.assertTrue(self.mock.wait_finished(1, 10))
+        self.assertEqual(controller.state(), CLOSED)
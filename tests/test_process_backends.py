@@ -0,0 +1,358 @@
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    mock = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from cloudshell.custom_execution_server.metrics import MetricsRegistry
+from cloudshell.custom_execution_server.process_backends import LauncherBackend, PopenBackend, PosixSpawnBackend, WarmPoolBackend, WarmRuntime, make_backend, wait_with_rusage
+from cloudshell.custom_execution_server.process_manager import ProcessRunner, ResourceLimits, STOPPED_EXIT_CODE
+
+logger = logging.getLogger('test')
+
+PRINT_NOFILE = 'import resource; print(resource.getrlimit(resource.RLIMIT_NOFILE))'
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+@unittest.skipIf(os.name != 'posix', 'needs POSIX')
+class BackendTests:
+    """
+    Tests every backend has to pass, mixed into a TestCase per backend
+    """
+    def make_backend(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.backend = self.make_backend()
+        self.addCleanup(self.backend.close)
+
+    def run_python(self, code, directory=None, env=None, rlimits=None):
+        process = self.backend.spawn([sys.executable, '-c', code], dict(os.environ, **(env or {})), directory, rlimits)
+        output = process.stdout.read()
+        process.stdout.close()
+        returncode, rusage = wait_with_rusage(process)
+        return output.decode('utf-8'), returncode, rusage
+
+    def test_output_and_exit_code(self):
+        output, returncode, _ = self.run_python('import sys; print("out"); sys.stderr.write("err\\n"); sys.exit(4)')
+        self.assertEqual(sorted(output.split()), ['err', 'out'])
+        self.assertEqual(returncode, 4)
+
+    def test_environment_and_directory(self):
+        directory = os.path.realpath(tempfile.gettempdir())
+        output, _, _ = self.run_python('import os; print(os.getcwd()); print(os.environ["X_TEST"])', directory, {'X_TEST': 'value'})
+        self.assertEqual(output.split(), [directory, 'value'])
+
+    def test_new_session(self):
+        output, _, _ = self.run_python('import os; print(os.getsid(0) == os.getpid())')
+        self.assertEqual(output.strip(), 'True')
+
+    def test_rlimits(self):
+        output, returncode, _ = self.run_python(PRINT_NOFILE, rlimits={'RLIMIT_NOFILE': 64})
+        self.assertEqual((output.strip(), returncode), ('(64, 64)', 0))
+
+    def test_killed(self):
+        process = self.backend.spawn([sys.executable, '-c', 'import time; time.sleep(30)'], dict(os.environ), None)
+        process.kill()
+        returncode, rusage = wait_with_rusage(process)
+        process.stdout.close()
+        self.assertEqual(returncode, -9)
+        self.assertIn('maxrss', rusage)
+
+    def test_missing_executable(self):
+        self.assertRaises(OSError, self.backend.spawn, ['/nonexistent/command'], dict(os.environ), None)
+
+    def test_concurrent_spawns(self):
+        results = []
+
+        def run(i):
+            results.append(self.run_python('print(%d)' % i)[0].strip())
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        self.assertEqual(sorted(results, key=int), [str(i) for i in range(8)])
+
+
+class PopenBackendTest(BackendTests, unittest.TestCase):
+    def make_backend(self):
+        self.log = RecordingHandler()
+        logger.addHandler(self.log)
+        self.addCleanup(logger.removeHandler, self.log)
+        return PopenBackend(logger)
+
+    @unittest.skipUnless(hasattr(resource, 'prlimit') and mock is not None, 'needs prlimit and unittest.mock')
+    def test_rlimits_without_preexec_fn(self):
+        with mock.patch('subprocess.Popen', wraps=subprocess.Popen) as popen:
+            process = self.backend.spawn([sys.executable, '-c', PRINT_NOFILE], dict(os.environ), None, {'RLIMIT_NOFILE': 64})
+        self.assertNotIn('preexec_fn', popen.call_args[1])
+        self.assertEqual(process.stdout.read().strip(), b'(64, 64)')
+        process.stdout.close()
+        process.wait()
+        self.assertEqual(self.log.messages, [])
+
+    def test_preexec_fn_fallback_warns(self):
+        class NoPrlimit:
+            RLIMIT_NOFILE = resource.RLIMIT_NOFILE
+            setrlimit = staticmethod(resource.setrlimit)
+        with mock.patch('cloudshell.custom_execution_server.process_backends.resource', NoPrlimit):
+            output, _, _ = self.run_python(PRINT_NOFILE, rlimits={'RLIMIT_NOFILE': 64})
+            self.run_python(PRINT_NOFILE, rlimits={'RLIMIT_NOFILE': 64})
+        self.assertEqual(output.strip(), '(64, 64)')
+        self.assertEqual(len(self.log.messages), 1)
+
+
+@unittest.skipUnless(hasattr(os, 'posix_spawn') and hasattr(resource, 'prlimit'), 'needs posix_spawn and prlimit')
+class PosixSpawnBackendTest(BackendTests, unittest.TestCase):
+    def make_backend(self):
+        return PosixSpawnBackend(logger)
+
+
+@unittest.skipUnless(os.name == 'posix' and sys.version_info >= (3, 3), 'needs Python 3.3 on POSIX')
+class LauncherBackendTest(BackendTests, unittest.TestCase):
+    def make_backend(self):
+        return LauncherBackend(logger)
+
+    def test_restarts_after_the_launcher_dies(self):
+        self.run_python('pass')
+        helper = self.backend._helper
+        helper.kill()
+        helper.wait()
+        self.backend._reader.join(5)
+        output, returncode, _ = self.run_python('print("again")')
+        self.assertEqual((output.strip(), returncode), ('again', 0))
+        self.assertNotEqual(self.backend._helper.pid, helper.pid)
+
+    def test_spawn_times_out_when_the_launcher_hangs(self):
+        self.run_python('pass')
+        self.backend._reply_timeout = 0.5
+        helper = self.backend._helper
+        os.kill(helper.pid, signal.SIGSTOP)
+        try:
+            t0 = time.time()
+            self.assertRaises(Exception, self.backend.spawn, [sys.executable, '-c', 'import time; time.sleep(30)'], dict(os.environ), None)
+            self.assertLess(time.time() - t0, 5)
+        finally:
+            os.kill(helper.pid, signal.SIGCONT)
+        # The late reply's child is killed, and the launcher carries on
+        output, returncode, _ = self.run_python('print("again")')
+        self.assertEqual((output.strip(), returncode), ('again', 0))
+        self.assertEqual(self.backend._helper.pid, helper.pid)
+        self.assertEqual(self.backend._pending, {})
+
+    def test_orphans_are_watched_by_daemon_threads(self):
+        process = self.backend.spawn([sys.executable, '-c', 'import time; time.sleep(30)'], dict(os.environ), None)
+        self.addCleanup(process.stdout.close)
+        helper = self.backend._helper
+        helper.kill()
+        helper.wait()
+        self.backend._reader.join(5)
+        watchers = [th for th in threading.enumerate() if th.name == 'process-launcher-orphan']
+        self.assertEqual([th.daemon for th in watchers], [True])
+        process.kill()
+        self.assertEqual(process.wait(), -signal.SIGKILL)
+
+
+class WarmRuntimeTest(unittest.TestCase):
+    def test_resolve(self):
+        robot = WarmRuntime('robot', commands={'robot': 'robot'})
+        self.assertEqual(robot.resolve(['/usr/bin/robot', 'suite.robot'], {}), {'module': 'robot', 'argv': ['/usr/bin/robot', 'suite.robot']})
+        self.assertIsNone(robot.resolve(['python3', 'test.py'], {}))
+        python = WarmRuntime('python', scripts=True)
+        self.assertEqual(python.resolve(['/usr/bin/python3.11', 'test.py', 'x'], {}), {'path': 'test.py', 'argv': ['test.py', 'x']})
+        self.assertEqual(python.resolve(['python', '-m', 'pytest', '-x'], {}), {'module': 'pytest', 'argv': ['pytest', '-x']})
+        # Interpreter options need a fresh interpreter
+        self.assertIsNone(python.resolve(['python', '-c', 'pass'], {}))
+        self.assertIsNone(python.resolve(['bash', 'test.sh'], {}))
+
+    def test_script_on_path(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        path = os.path.join(directory, 'run_tests.py')
+        with open(path, 'w') as f:
+            f.write('#!/usr/bin/env python\n')
+        os.chmod(path, 0o755)
+        python = WarmRuntime('python', scripts=True)
+        self.assertEqual(python.resolve(['run_tests.py', '-v'], {'PATH': directory}), {'path': path, 'argv': [path, '-v']})
+        self.assertIsNone(python.resolve(['missing.py'], {'PATH': directory}))
+
+
+TEST_SCRIPT = '''import os
+import sys
+import threading
+import time
+print('pid %d' % os.getpid())
+print('preloaded %s' % ('xml.dom.minidom' in sys.modules))
+print('helper %s' % ('warm_test_helper' in sys.modules))
+print('env %s' % os.environ.get('X_TEST'))
+print('cwd %s' % os.getcwd())
+print('argv %s' % ' '.join(sys.argv[1:]))
+import resource
+print('nofile %d' % resource.getrlimit(resource.RLIMIT_NOFILE)[0])
+import warm_test_helper
+action = sys.argv[1] if len(sys.argv) > 1 else ''
+if action == 'exit':
+    sys.exit(3)
+if action == 'message':
+    sys.exit('failed')
+if action == 'raise':
+    raise ValueError('boom')
+if action == 'thread':
+    th = threading.Thread(target=time.sleep, args=(30,))
+    th.daemon = True
+    th.start()
+if action == 'sleep':
+    time.sleep(30)
+'''
+
+
+@unittest.skipUnless(os.name == 'posix' and sys.version_info >= (3, 3), 'needs Python 3.3 on POSIX')
+class WarmPoolBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.script = os.path.join(self.directory, 'test_warm.py')
+        with open(self.script, 'w') as f:
+            f.write(TEST_SCRIPT)
+        open(os.path.join(self.directory, 'warm_test_helper.py'), 'w').close()
+
+    def make_runner(self, size=1, preload=('xml.dom.minidom',), **kwargs):
+        backend = WarmPoolBackend([WarmRuntime('python', preload=preload, scripts=True)], size=size, logger=logger, **kwargs)
+        runner = ProcessRunner(logger, backend=backend)
+        self.addCleanup(runner.close)
+        return runner, backend
+
+    def wait_idle(self, backend, n=1):
+        deadline = time.time() + 30
+        while backend.stats()['runtimes']['python']['idle'] < n and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(backend.stats()['runtimes']['python']['idle'], n)
+
+    def run_test(self, runner, *args, **kwargs):
+        output, code = runner.execute([sys.executable, self.script] + list(args), 'test', env=kwargs.pop('env', {}), **kwargs)
+        return dict(line.split(' ', 1) for line in output.splitlines() if ' ' in line), code, output
+
+    def test_runs_in_a_warm_worker(self):
+        runner, backend = self.make_runner()
+        self.wait_idle(backend)
+        directory = os.path.realpath(tempfile.gettempdir())
+        lines, code, _ = self.run_test(runner, 'a', 'b', env={'X_TEST': 'value'}, directory=directory)
+        self.assertEqual(code, 0)
+        self.assertEqual((lines['preloaded'], lines['helper'], lines['env'], lines['cwd'], lines['argv']), ('True', 'False', 'value', directory, 'a b'))
+        self.assertEqual((backend.stats()['warm_runs'], backend.stats()['cold_runs']), (1, 0))
+
+    def test_runs_are_isolated(self):
+        runner, backend = self.make_runner()
+        self.wait_idle(backend)
+        first, _, _ = self.run_test(runner, env={'X_TEST': 'first'}, limits=ResourceLimits(open_files=64))
+        self.assertEqual(first['nofile'], '64')
+        self.wait_idle(backend)
+        second, _, _ = self.run_test(runner)
+        # The same worker, without the module, environment and limits of the test before
+        self.assertEqual(second['pid'], first['pid'])
+        self.assertEqual((second['helper'], second['env']), ('False', 'None'))
+        self.assertNotEqual(second['nofile'], '64')
+
+    def test_exit_codes(self):
+        runner, backend = self.make_runner()
+        for args, expected in ((['exit'], 3), (['message'], 1), (['raise'], 1)):
+            self.wait_idle(backend)
+            _, code, output = self.run_test(runner, *args)
+            self.assertEqual(code, expected, output)
+        self.assertIn('ValueError: boom', output)
+        self.assertEqual(backend.stats()['cold_runs'], 0)
+
+    def test_recycled_after_max_runs(self):
+        runner, backend = self.make_runner(max_runs=2)
+        pids = []
+        for _ in range(3):
+            self.wait_idle(backend)
+            pids.append(self.run_test(runner)[0]['pid'])
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+        self.assertEqual(backend.stats()['recycled'], {'runs': 1})
+
+    def test_recycled_when_a_test_leaves_threads(self):
+        runner, backend = self.make_runner()
+        self.wait_idle(backend)
+        first = self.run_test(runner, 'thread')[0]['pid']
+        self.wait_idle(backend)
+        self.assertNotEqual(self.run_test(runner)[0]['pid'], first)
+        self.assertEqual(backend.stats()['recycled'], {'threads': 1})
+
+    def test_stop_kills_the_worker(self):
+        runner, backend = self.make_runner()
+        self.wait_idle(backend)
+        threading.Timer(0.5, runner.stop, ('test',)).start()
+        output, code = runner.execute([sys.executable, self.script, 'sleep'], 'test', env={})
+        self.assertEqual(code, STOPPED_EXIT_CODE)
+        self.assertEqual(backend.stats()['recycled'], {'died': 1})
+        self.wait_idle(backend)
+
+    def test_cold_fallback(self):
+        runner, backend = self.make_runner(size=0)
+        lines, code, _ = self.run_test(runner, env=dict(os.environ, X_TEST='cold'))
+        self.assertEqual((lines['preloaded'], lines['env'], code), ('False', 'cold', 0))
+        output, code = runner.execute([sys.executable, '-c', 'print("options")'], 'test', env=dict(os.environ))
+        self.assertEqual((output.strip(), code), ('options', 0))
+        self.assertEqual((backend.stats()['warm_runs'], backend.stats()['cold_runs']), (0, 2))
+
+    def test_failed_import_starts_tests_cold(self):
+        runner, backend = self.make_runner(preload=('no_such_module_here',))
+        deadline = time.time() + 30
+        while not backend.stats()['runtimes']['python']['start_failures'] and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(backend.stats()['runtimes']['python']['start_failures'], 1)
+        self.assertEqual(self.run_test(runner, env=dict(os.environ))[1], 0)
+        self.assertEqual(backend.stats()['cold_runs'], 1)
+
+    def test_metrics(self):
+        registry = MetricsRegistry()
+        runner, backend = self.make_runner()
+        runner.register_metrics(registry, 'warm-runner')
+        self.wait_idle(backend)
+        self.run_test(runner)
+        text = registry.render()
+        self.assertIn('cloudshell_execution_server_warm_workers{runner="warm-runner",runtime="python",state="busy"} 0', text)
+        self.assertIn('cloudshell_execution_server_warm_runs_total{runner="warm-runner",start="warm"} 1', text)
+        backend.unregister_metrics(registry)
+        self.assertNotIn('cloudshell_execution_server_warm_workers{', registry.render())
+
+
+class MakeBackendTest(unittest.TestCase):
+    def test_names(self):
+        backend = make_backend('popen', logger)
+        self.assertIsInstance(backend, PopenBackend)
+        if hasattr(os, 'posix_spawn'):
+            self.assertIs(make_backend('posix_spawn', logger)._logger, logger)
+        self.assertRaises(Exception, make_backend, 'fork')
+        self.assertRaises(Exception, make_backend, 'warm', warm_runtimes={})
+        self.assertRaises(Exception, make_backend, 'warm', warm_runtimes={'python': {}}, warm_fallback='warm')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from cloudshell.custom_execution_server.metrics import MetricsRegistry
+from cloudshell.custom_execution_server.process_manager import OutputCapture, ProcessRunner, ResourceLimits, ResourceUsage, STOPPED_EXIT_CODE, TIMEOUT_EXIT_CODE
+from cloudshell.custom_execution_server.report_data import ReportFile
+
+
+def read_report(report_data):
+    if isinstance(report_data, ReportFile):
+        with open(report_data.path, 'rb') as f:
+            data = f.read()
+        os.remove(report_data.path)
+        return data
+    try:
+        return b''.join(report_data)
+    finally:
+        report_data.close()
+
+
+class OutputCaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def spool_files(self):
+        return os.listdir(self.directory)
+
+    def test_short_output_is_previewed_whole(self):
+        capture = OutputCapture(self.directory, head_size=8, tail_size=8)
+        capture.feed(b'hello ')
+        capture.feed(b'world')
+        self.assertEqual(capture.preview(), 'hello world')
+        self.assertEqual(read_report(capture.report_data()), b'hello world')
+        self.assertEqual(self.spool_files(), [])
+
+    def test_long_output_keeps_head_and_tail_in_memory(self):
+        capture = OutputCapture(self.directory, head_size=4, tail_size=4)
+        for i in range(100):
+            capture.feed(b'%04d' % i)
+        self.assertEqual((capture.head, capture.tail), (b'0000', b'0099'))
+        self.assertEqual(capture.preview(), '0000\n... (392 bytes omitted) ...\n0099')
+        self.assertEqual(read_report(capture.report_data()), b''.join(b'%04d' % i for i in range(100)))
+
+    def test_rotation_bounds_disk_use(self):
+        capture = OutputCapture(self.directory, head_size=10, tail_size=10, segment_size=100, max_segments=2)
+        for i in range(100):
+            capture.feed(b'%09d\n' % i)
+        self.assertEqual(len(self.spool_files()), 2)
+        self.assertEqual(capture.bytes_captured, 1000)
+        self.assertEqual(capture.bytes_dropped, 800)
+        data = read_report(capture.report_data())
+        self.assertTrue(data.startswith(b'000000000\n\n... (790 bytes omitted) ...\n000000080\n'))
+        self.assertTrue(data.endswith(b'000000099\n'))
+        self.assertEqual(self.spool_files(), [])
+
+    def test_discard_removes_spool_files(self):
+        capture = OutputCapture(self.directory)
+        capture.feed(b'x')
+        capture.discard()
+        self.assertEqual(self.spool_files(), [])
+
+
+class ExecuteSpooledTest(unittest.TestCase):
+    def test_output_and_exit_code(self):
+        runner = ProcessRunner(None)
+        self.addCleanup(runner.close)
+        capture, code = runner.execute_spooled([sys.executable, '-c', 'import sys; sys.stdout.write("x" * 200000); sys.exit(3)'], '1',
+                                               capture=OutputCapture(head_size=10, tail_size=10))
+        self.assertEqual(code, 3)
+        self.assertEqual(capture.bytes_captured, 200000)
+        self.assertEqual(read_report(capture.report_data()), b'x' * 200000)
+
+    def test_execute_decodes_invalid_utf8(self):
+        runner = ProcessRunner(None)
+        self.addCleanup(runner.close)
+        output, code = runner.execute([sys.executable, '-c', 'import os; os.write(1, b"a\\xffb\\n")'], '1')
+        self.assertEqual((output, code), (u'a�b\n', 0))
+
+
+class FailingParser:
+    def __init__(self):
+        self.data = b''
+
+    def feed(self, data):
+        self.data += data
+        raise ValueError('Unparseable output')
+
+
+@unittest.skipIf(os.name != 'posix', 'needs POSIX')
+class FailureCleanupTest(unittest.TestCase):
+    SCRIPT = 'import os, sys, time; sys.stdout.write("%d\\n" % os.getpid()); sys.stdout.flush(); time.sleep(30)'
+
+    def assertGone(self, runner, pid):
+        self.assertEqual(runner._current_processes, {})
+        # Reaped, not only killed
+        self.assertRaises(OSError, os.kill, pid, 0)
+
+    def test_parser_error_kills_the_process(self):
+        runner = ProcessRunner(None, limits=ResourceLimits(timeout=30))
+        self.addCleanup(runner.close)
+        parser = FailingParser()
+        t0 = time.time()
+        self.assertRaises(ValueError, runner.execute_spooled, [sys.executable, '-c', self.SCRIPT], '1', parser=parser)
+        self.assertLess(time.time() - t0, 5)
+        self.assertGone(runner, int(parser.data))
+        self.assertTrue(all(timer.finished.is_set() for timer in runner._local.timers))
+
+    def test_on_process_started_error_kills_the_process(self):
+        pids = []
+
+        def on_process_started(identifier, pid):
+            pids.append(pid)
+            raise IOError('Journal not writable')
+        runner = ProcessRunner(None, on_process_started=on_process_started)
+        self.addCleanup(runner.close)
+        self.assertRaises(IOError, runner.execute, [sys.executable, '-c', self.SCRIPT], '1')
+        self.assertGone(runner, pids[0])
+
+
+@unittest.skipIf(os.name != 'posix', 'needs POSIX')
+class LimitsTest(unittest.TestCase):
+    def setUp(self):
+        self.runner = ProcessRunner(None)
+        self.addCleanup(self.runner.close)
+
+    def test_timeout_terminates_the_process_group(self):
+        registry = MetricsRegistry()
+        self.runner.register_metrics(registry)
+        t0 = time.time()
+        # The grandchild would keep the output pipe open if only the child were signalled
+        output, code = self.runner.execute(['/bin/sh', '-c', 'echo started; sleep 30 & sleep 30'], '1', limits=ResourceLimits(timeout=0.5))
+        self.assertLess(time.time() - t0, 5)
+        self.assertEqual((output, code), ('started\n', TIMEOUT_EXIT_CODE))
+        self.assertIn('cloudshell_execution_server_child_process_timeouts_total{runner="default"} 1', registry.render())
+
+    def test_timeout_kills_after_grace(self):
+        code = 'import signal, sys, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); print("x"); sys.stdout.flush(); time.sleep(30)'
+        t0 = time.time()
+        _, exit_code = self.runner.execute_spooled([sys.executable, '-c', code], '1', limits=ResourceLimits(timeout=0.3, kill_grace=0.3))
+        self.assertEqual(exit_code, TIMEOUT_EXIT_CODE)
+        self.assertLess(time.time() - t0, 5)
+
+    def test_default_and_per_execution_limits(self):
+        self.runner.limits = ResourceLimits(open_files=64)
+        script = 'import resource; print(resource.getrlimit(resource.RLIMIT_NOFILE)[0])'
+        self.assertEqual(self.runner.execute([sys.executable, '-c', script], '1')[0].strip(), '64')
+        self.assertEqual(self.runner.execute([sys.executable, '-c', script], '2', limits=ResourceLimits(open_files=32))[0].strip(), '32')
+
+    def test_cpu_limit(self):
+        _, code = self.runner.execute([sys.executable, '-c', 'while True: pass'], '1', limits=ResourceLimits(cpu_seconds=1, timeout=30))
+        self.assertIn(code, (-9, -24))
+
+    def test_usage(self):
+        self.runner.execute([sys.executable, '-c', 'x = bytearray(50 * 1024 * 1024); sum(range(3000000))'], '1')
+        usage = self.runner.last_usage()
+        self.assertGreater(usage.wall_seconds, 0)
+        self.assertGreater(usage.user_seconds, 0)
+        self.assertGreater(usage.max_rss_bytes, 50 * 1024 * 1024)
+        # Per thread, so concurrent executions each see their own
+        other = []
+        th = threading.Thread(target=lambda: other.append(self.runner.last_usage()))
+        th.start()
+        th.join()
+        self.assertEqual(other, [None])
+
+    def test_stop(self):
+        def stop():
+            while '1' not in self.runner._current_processes:
+                time.sleep(0.01)
+            self.runner.stop('1')
+        threading.Thread(target=stop).start()
+        self.assertEqual(self.runner.execute([sys.executable, '-c', 'import time; time.sleep(30)'], '1'), (None, STOPPED_EXIT_CODE))
+
+    def test_rlimits_are_capped_to_hard_limits(self):
+        import resource
+        _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        limits = ResourceLimits(open_files=hard + 1 if hard != resource.RLIM_INFINITY else 1000, cpu_seconds=5)
+        self.assertLessEqual(limits.rlimits()['RLIMIT_NOFILE'], hard if hard != resource.RLIM_INFINITY else 1000)
+        self.assertEqual(limits.rlimits()['RLIMIT_CPU'], 5)
+        self.assertEqual(ResourceLimits().rlimits(), {})
+
+
+class RunnerMetricsTest(unittest.TestCase):
+    def test_replaced_runner_keeps_its_gauge_until_closed(self):
+        registry = MetricsRegistry()
+        old = ProcessRunner(None)
+        old.register_metrics(registry, 'server')
+        old._current_processes['1'] = None
+        new = ProcessRunner(None)
+        new.register_metrics(registry, 'server-reload-1')
+        text = registry.render()
+        self.assertIn('cloudshell_execution_server_child_processes{runner="server"} 1', text)
+        self.assertIn('cloudshell_execution_server_child_processes{runner="server-reload-1"} 0', text)
+        old.close()
+        text = registry.render()
+        self.assertNotIn('runner="server"}', text)
+        self.assertIn('cloudshell_execution_server_child_processes{runner="server-reload-1"} 0', text)
+        new.close()
+
+
+class ResourceUsageTest(unittest.TestCase):
+    def test_without_rusage(self):
+        usage = ResourceUsage(1.5)
+        self.assertEqual(usage.as_dict()['wall_seconds'], 1.5)
+        self.assertIsNone(usage.max_rss_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from cloudshell.custom_execution_server.custom_execution_server import PassedCommandResult
+from cloudshell.custom_execution_server.report_cache import ReportCache, content_digest
+from cloudshell.custom_execution_server.result_reporter import ResultReporter
+
+from tests.test_result_reporter import FakeCloudShell
+
+logger = logging.getLogger('test')
+
+DIGEST = hashlib.sha256(b'x' * 5000).hexdigest()
+
+
+class ReportCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.path = os.path.join(self.directory, 'cache', 'index.jsonl')
+
+    def make_cache(self, **kwargs):
+        cache = ReportCache(self.path, logger, **kwargs)
+        cache.open()
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_content_digest(self):
+        path = os.path.join(self.directory, 'report.log')
+        with open(path, 'wb') as f:
+            f.write(b'x' * 5000)
+        self.assertEqual(content_digest(path, block_size=64), (DIGEST, 5000))
+        self.assertEqual(content_digest(data=b'x' * 5000), (DIGEST, 5000))
+
+    def test_lookup(self):
+        cache = self.make_cache()
+        self.assertIsNone(cache.lookup(DIGEST, 5000, '1'))
+        cache.record(DIGEST, 5000, '1', 'output.log')
+        # An execution can't reference its own upload, nor content of another size
+        self.assertIsNone(cache.lookup(DIGEST, 5000, '1'))
+        self.assertIsNone(cache.lookup(DIGEST, 5001, '2'))
+        entry = cache.lookup(DIGEST, 5000, '2')
+        self.assertEqual((entry['execution_id'], entry['report_filename'], entry['size']), ('1', 'output.log', 5000))
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 3))
+        self.assertIn('Identical to report output.log of execution 1', cache.note(entry, DIGEST))
+        self.assertEqual(cache.note_filename('output.log'), 'output.log.identical.txt')
+
+    def test_small_reports_are_not_indexed(self):
+        cache = self.make_cache(min_bytes=4096)
+        cache.record('small', 100, '1', 'output.log')
+        self.assertIsNone(cache.lookup('small', 100, '2'))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_old_uploads_are_stale(self):
+        cache = self.make_cache(max_age=60)
+        cache.record(DIGEST, 5000, '1', 'output.log')
+        cache._entries[DIGEST]['t'] -= 61
+        self.assertIsNone(cache.lookup(DIGEST, 5000, '2'))
+        self.assertEqual((cache.stats()['stale'], cache.stats()['entries']), (1, 0))
+
+    def test_verify(self):
+        checked = []
+
+        def verify(entry):
+            checked.append(entry['execution_id'])
+            if entry['execution_id'] == '2':
+                raise Exception('Connection refused')
+            return entry['execution_id'] != '1'
+
+        cache = self.make_cache(verify=verify)
+        cache.record(DIGEST, 5000, '1', 'output.log')
+        self.assertIsNone(cache.lookup(DIGEST, 5000, '3'))
+        cache.record(DIGEST, 5000, '2', 'output.log')
+        self.assertIsNone(cache.lookup(DIGEST, 5000, '3'))
+        cache.record(DIGEST, 5000, '4', 'output.log')
+        self.assertEqual(cache.lookup(DIGEST, 5000, '3')['execution_id'], '4')
+        self.assertEqual(checked, ['1', '2', '4'])
+        self.assertEqual(cache.stats()['stale'], 2)
+
+    def test_least_recently_used_are_forgotten(self):
+        cache = self.make_cache(max_entries=2)
+        cache.record('a', 5000, '1', 'a.log')
+        cache.record('b', 5000, '1', 'b.log')
+        cache.lookup('a', 5000, '2')
+        cache.record('c', 5000, '1', 'c.log')
+        self.assertIsNone(cache.lookup('b', 5000, '2'))
+        self.assertIsNotNone(cache.lookup('a', 5000, '2'))
+        self.assertIsNotNone(cache.lookup('c', 5000, '2'))
+
+    def test_index_survives_a_restart(self):
+        cache = self.make_cache(compact_every=2)
+        for name in 'abc':
+            cache.record(name, 5000, '1', '%s.log' % name)
+        cache.lookup('a', 5000, '2')
+        # Not closed, like a server that crashed mid-write
+        with open(self.path, 'a') as f:
+            f.write('{"h": "d", "n"')
+        cache = ReportCache(self.path, logger, max_entries=2)
+        cache.open()
+        self.addCleanup(cache.close)
+        self.assertEqual(list(cache._entries), ['c', 'a'])
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+    def test_action(self):
+        self.assertRaises(Exception, ReportCache, self.path, logger, action='link')
+
+
+class ReporterDedupTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.path = os.path.join(directory, 'index.jsonl')
+
+    def run_two(self, action):
+        cache = ReportCache(self.path, logger, action=action)
+        cache.open()
+        self.addCleanup(cache.close)
+        cloudshell = FakeCloudShell()
+        deduped = []
+        reporter = ResultReporter(cloudshell.send_finished, cloudshell.send_report, logger, sender_count=1, report_cache=cache,
+                                  on_dedup=lambda execution_id, name, hit, saved: deduped.append((execution_id, hit, saved)))
+        reporter.start()
+        self.addCleanup(reporter.stop, 1)
+        for execution_id in ('1', '2'):
+            reporter.submit(execution_id, PassedCommandResult('output.log', 'x' * 5000))
+            deadline = time.time() + 5
+            while len(deduped) < int(execution_id) and time.time() < deadline:
+                time.sleep(0.01)
+        reporter.stop()
+        return cloudshell, cache, deduped
+
+    def test_identical_report_is_replaced_by_a_note(self):
+        cloudshell, cache, deduped = self.run_two('note')
+        self.assertEqual([(execution_id, name) for execution_id, name, _ in cloudshell.reports],
+                         [('1', 'output.log'), ('2', 'output.log.identical.txt')])
+        self.assertIn(DIGEST.encode('ascii'), cloudshell.reports[1][2])
+        saved = 5000 - len(cloudshell.reports[1][2])
+        self.assertEqual(deduped, [('1', False, 0), ('2', True, saved)])
+        self.assertEqual(cache.stats()['bytes_saved'], saved)
+
+    def test_identical_report_is_skipped(self):
+        cloudshell, cache, deduped = self.run_two('skip')
+        self.assertEqual([execution_id for execution_id, _, _ in cloudshell.reports], ['1'])
+        self.assertEqual(len(cloudshell.finished), 2)
+        self.assertEqual(cache.stats()['bytes_saved'], 5000)
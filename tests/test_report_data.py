@@ -0,0 +1,204 @@
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zlib
+
+from cloudshell.custom_execution_server.compat import bytes23, string23, string23ppbinary
+from cloudshell.custom_execution_server.custom_execution_server import PassedCommandResult
+from cloudshell.custom_execution_server.report_data import Artifact, ReportCompression, ReportFile, artifacts_from_directory, artifacts_from_files, is_streamed_report_data, open_report_body, zstandard
+
+from tests.test_custom_execution_server import Handler, ServerTestCase, start_execution
+
+
+class CompatTest(unittest.TestCase):
+    def test_conversions(self):
+        self.assertEqual(bytes23(u'caf\xe9'), b'caf\xc3\xa9')
+        self.assertEqual(bytes23(None), b'')
+        self.assertEqual(string23(b'caf\xc3\xa9'), u'caf\xe9')
+        self.assertEqual(string23(b'\xff', 'replace'), u'�')
+        self.assertRaises(UnicodeDecodeError, string23, b'\xff')
+        self.assertEqual(string23ppbinary(b'\x00\x01'), '(2 bytes binary data)')
+        self.assertEqual(string23ppbinary(None), '')
+
+
+class OpenReportBodyTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def write(self, data):
+        path = os.path.join(self.directory, 'report.log')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_in_memory(self):
+        self.assertFalse(is_streamed_report_data('text'))
+        body, length, close = open_report_body(u'caf\xe9')
+        self.assertEqual((body, length), (b'caf\xc3\xa9', 5))
+        close()
+
+    def test_report_file(self):
+        path = self.write(b'x' * 1000)
+        body, length, close = open_report_body(ReportFile(path))
+        self.assertEqual(length, 1000)
+        self.assertEqual(body.read(), b'x' * 1000)
+        close()
+        self.assertTrue(os.path.exists(path))
+
+    def test_report_file_deleted_after_upload(self):
+        path = self.write(b'x')
+        _, _, close = open_report_body(ReportFile(path, delete=True))
+        close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_file_object_length_from_position(self):
+        f = open(self.write(b'0123456789'), 'rb')
+        f.read(4)
+        body, length, close = open_report_body(f)
+        self.assertEqual(length, 6)
+        close()
+        self.assertTrue(f.closed)
+
+    def test_iterator_has_unknown_length(self):
+        self.assertTrue(is_streamed_report_data(iter([b'a'])))
+        body, length, _ = open_report_body(iter([b'a', b'b']))
+        self.assertIsNone(length)
+        self.assertEqual(b''.join(body), b'ab')
+        body, length, _ = open_report_body(io.BytesIO(b'abc'))
+        self.assertEqual(length, None)
+
+
+class ArtifactsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        os.makedirs(os.path.join(self.directory, 'screenshots', 'failed'))
+        for name in ('results.xml', os.path.join('screenshots', 'login.png'), os.path.join('screenshots', 'failed', 'logout.png')):
+            open(os.path.join(self.directory, name), 'w').close()
+
+    def test_directory(self):
+        artifacts = artifacts_from_directory(self.directory)
+        self.assertEqual([(a.name, a.mime_type) for a in artifacts],
+                         [('results.xml', 'application/xml'), ('screenshots_failed_logout.png', 'image/png'), ('screenshots_login.png', 'image/png')])
+        self.assertTrue(all(isinstance(a.report_data, ReportFile) and not a.report_data.delete for a in artifacts))
+        self.assertEqual(set(a.cleanup_directory for a in artifacts), set([None]))
+
+    def test_directory_not_recursive_and_deleted(self):
+        artifacts = artifacts_from_directory(self.directory, recursive=False, delete=True)
+        self.assertEqual([(a.name, a.cleanup_directory) for a in artifacts], [('results.xml', self.directory)])
+
+    def test_files(self):
+        artifacts = artifacts_from_files([os.path.join(self.directory, 'results.xml')], delete=True)
+        self.assertEqual(artifacts[0].name, 'results.xml')
+        self.assertTrue(artifacts[0].report_data.delete)
+
+    def test_mime_type(self):
+        self.assertEqual(Artifact('dump', b'').mime_type, 'application/octet-stream')
+        self.assertEqual(Artifact('dump', b'', 'text/plain').mime_type, 'text/plain')
+
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class ReportCompressionTest(unittest.TestCase):
+    def test_small_reports_are_unchanged(self):
+        compression = ReportCompression(threshold=100)
+        self.assertEqual(compression.compress_body('output.log', 'text/plain', b'x' * 99, 99), ('output.log', 'text/plain', b'x' * 99, 99, {}))
+        name, mime_type, body, length, headers = compression.compress_body('output.log', 'text/plain', iter([b'x' * 50, b'y' * 49]), None)
+        self.assertEqual((name, body, length), ('output.log', b'x' * 50 + b'y' * 49, 99))
+
+    def test_attachment(self):
+        done = []
+        compression = ReportCompression(threshold=100)
+        name, mime_type, body, length, headers = compression.compress_body('output.log', 'text/plain', b'line\n' * 1000, 5000,
+                                                                           on_done=lambda *sizes: done.append(sizes))
+        self.assertEqual((name, mime_type, headers), ('output.log.gz', 'application/gzip', {}))
+        self.assertEqual(length, len(body))
+        self.assertEqual(gunzip(body), b'line\n' * 1000)
+        self.assertEqual(done, [(5000, length)])
+
+    def test_streamed_body_of_unknown_length(self):
+        done = []
+        compression = ReportCompression(threshold=100, mode='content-encoding')
+        chunks = iter([b'a' * 60, b'b' * 60, b'c' * 60])
+        name, mime_type, body, length, headers = compression.compress_body('output.log', 'text/plain', chunks, None,
+                                                                           on_done=lambda *sizes: done.append(sizes))
+        self.assertEqual((name, mime_type, length, headers), ('output.log', 'text/plain', None, {'Content-Encoding': 'gzip'}))
+        data = b''.join(body)
+        self.assertEqual(gunzip(data), b'a' * 60 + b'b' * 60 + b'c' * 60)
+        self.assertEqual(done, [(180, len(data))])
+
+    def test_file_body(self):
+        body = io.BytesIO(b'z' * 200000)
+        name, mime_type, body, length, headers = ReportCompression(level=9).compress_body('output.log', 'text/plain', body, 200000)
+        self.assertIsNone(length)
+        self.assertEqual(gunzip(b''.join(body)), b'z' * 200000)
+
+    def test_compressed_formats_are_unchanged(self):
+        compression = ReportCompression(threshold=0)
+        for name, mime_type in (('screen.png', 'image/png'), ('logs.zip', 'application/octet-stream'), ('capture', 'application/gzip; x=1')):
+            self.assertEqual(compression.compress_body(name, mime_type, b'data', 4)[:2], (name, mime_type))
+
+    def test_settings(self):
+        self.assertEqual(ReportCompression().level, 1)
+        self.assertRaises(Exception, ReportCompression, 'brotli')
+        self.assertRaises(Exception, ReportCompression, mode='inline')
+        if zstandard is None:
+            self.assertRaises(Exception, ReportCompression, 'zstd')
+
+    @unittest.skipIf(zstandard is None, 'needs the zstandard package')
+    def test_zstd(self):
+        name, mime_type, body, length, headers = ReportCompression('zstd', threshold=0).compress_body('output.log', 'text/plain', b'x' * 1000, 1000)
+        self.assertEqual((name, mime_type), ('output.log.zst', 'application/zstd'))
+        self.assertEqual(zstandard.ZstdDecompressor().decompress(body), b'x' * 1000)
+
+
+class FileHandler(Handler):
+    def __init__(self, report_data):
+        Handler.__init__(self)
+        self.report_data = report_data
+
+    def execute_command(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger):
+        return PassedCommandResult('result.log', self.report_data(), 'text/plain')
+
+
+class StreamedUploadTest(ServerTestCase):
+    def run_one(self, report_data, **kwargs):
+        server = self.make_server(FileHandler(report_data), capacity=1, **kwargs)
+        self.mock.add_commands([start_execution('1')])
+        server.start()
+        self.addCleanup(server.stop)
+        self.assertTrue(self.mock.wait_finished(1, 10))
+        # The report is uploaded after FinishedExecution
+        deadline = time.time() + 5
+        while not self.mock.reports and time.time() < deadline:
+            time.sleep(0.01)
+        return [length for _, length in self.mock.reports]
+
+    def test_compressed_upload(self):
+        lengths = self.run_one(lambda: b'same line\n' * 100000, report_compression=ReportCompression(threshold=1000))
+        self.assertEqual(len(lengths), 1)
+        self.assertLess(lengths[0], 100000)
+        self.assertTrue(self.mock.reports[0][0].endswith('.gz'), self.mock.reports[0][0])
+
+    def test_report_file_is_uploaded_and_deleted(self):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'y' * 300000)
+        self.assertEqual(self.run_one(lambda: ReportFile(path, delete=True)), [300000])
+        deadline = time.time() + 5
+        while os.path.exists(path) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(os.path.exists(path))
+
+    def test_iterator_is_uploaded_chunked(self):
+        self.assertEqual(self.run_one(lambda: iter([b'a' * 70000, b'b' * 70000])), [140000])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import threading
+import time
+import unittest
+
+from cloudshell.custom_execution_server.reservation_cache import ReservationCache
+
+
+class ReservationCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.fetched = []
+
+    def fetch(self, reservation_id):
+        self.fetched.append(reservation_id)
+        return '{"id": "%s", "n": %d}' % (reservation_id, len(self.fetched))
+
+    def test_hit_within_ttl(self):
+        cache = ReservationCache(self.fetch, ttl=30)
+        self.assertEqual(cache.get('r1'), cache.get('r1'))
+        self.assertEqual(self.fetched, ['r1'])
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_expiry(self):
+        cache = ReservationCache(self.fetch, ttl=0.05)
+        cache.get('r1')
+        time.sleep(0.1)
+        cache.get('r1')
+        self.assertEqual(self.fetched, ['r1', 'r1'])
+
+    def test_ttl_zero_does_not_cache(self):
+        cache = ReservationCache(self.fetch, ttl=0)
+        cache.get('r1')
+        cache.get('r1')
+        self.assertEqual(len(self.fetched), 2)
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ReservationCache(self.fetch, max_size=2)
+        cache.get('r1')
+        cache.get('r2')
+        cache.get('r1')
+        cache.get('r3')
+        cache.get('r1')
+        cache.get('r2')
+        self.assertEqual(self.fetched, ['r1', 'r2', 'r3', 'r2'])
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+    def test_concurrent_lookups_share_one_fetch(self):
+        release = threading.Event()
+
+        def slow_fetch(reservation_id):
+            release.wait(5)
+            return self.fetch(reservation_id)
+        cache = ReservationCache(slow_fetch)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('r1'))) for _ in range(5)]
+        for t in threads:
+            t.start()
+        time.sleep(0.1)
+        release.set()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(self.fetched, ['r1'])
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(cache.stats()['coalesced'], 4)
+
+    def test_fetch_error_is_shared_and_not_cached(self):
+        release = threading.Event()
+        calls = []
+
+        def failing_fetch(reservation_id):
+            calls.append(reservation_id)
+            release.wait(5)
+            raise ValueError('CloudShell down')
+        cache = ReservationCache(failing_fetch)
+        errors = []
+
+        def get():
+            try:
+                cache.get('r1')
+            except ValueError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=get) for _ in range(3)]
+        for t in threads:
+            t.start()
+        time.sleep(0.1)
+        release.set()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(len(set(map(id, errors))), 3)
+        self.assertEqual(set(str(e) for e in errors), set(['CloudShell down']))
+        self.assertEqual(len(calls), 1)
+        self.assertRaises(ValueError, cache.get, 'r1')
+        self.assertEqual(len(calls), 2)
+
+    def test_interrupted_fetch_releases_the_waiters(self):
+        release = threading.Event()
+
+        def interrupted_fetch(reservation_id):
+            release.wait(5)
+            raise KeyboardInterrupt()
+        cache = ReservationCache(interrupted_fetch)
+        errors = {}
+
+        def leader():
+            try:
+                cache.get('r1')
+            except KeyboardInterrupt as e:
+                errors['leader'] = e
+
+        def waiter():
+            try:
+                cache.get('r1')
+            except Exception as e:
+                errors['waiter'] = e
+        threads = [threading.Thread(target=leader)]
+        threads[0].start()
+        time.sleep(0.1)
+        threads.append(threading.Thread(target=waiter))
+        threads[1].start()
+        time.sleep(0.1)
+        release.set()
+        for t in threads:
+            t.join(5)
+        self.assertFalse(any(t.is_alive() for t in threads))
+        self.assertEqual(sorted(errors), ['leader', 'waiter'])
+        self.assertIn('interrupted', str(errors['waiter']))
+        self.assertEqual(cache.stats()['errors'], 1)
+        cache._fetch = self.fetch
+        self.assertIn('"r1"', cache.get('r1'))
+
+    def test_invalidate(self):
+        cache = ReservationCache(self.fetch)
+        cache.get('r1')
+        cache.invalidate('r1')
+        cache.get('r1')
+        self.assertEqual(len(self.fetched), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
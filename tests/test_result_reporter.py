@@ -0,0 +1,236 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from cloudshell.custom_execution_server.connection_pool import CloudShellApiError
+from cloudshell.custom_execution_server.custom_execution_server import ErrorCommandResult, PassedCommandResult
+from cloudshell.custom_execution_server.report_data import Artifact, ReportFile, artifacts_from_directory
+from cloudshell.custom_execution_server.result_reporter import ResultReporter, TokenBucket
+
+logger = logging.getLogger('test')
+
+
+class FakeCloudShell:
+    """
+    Records what a ResultReporter sends, failing the first sends of each execution as told
+    """
+    def __init__(self, failures=None, error=None, report_failures=None):
+        self.finished = []
+        self.reports = []
+        self.failures = dict(failures or {})
+        self.report_failures = dict(report_failures or {})
+        self.error = error or Exception('Connection refused')
+        self.release = threading.Event()
+        self.release.set()
+        self._lock = threading.Lock()
+
+    def send_finished(self, execution_id, payload):
+        self.release.wait(5)
+        with self._lock:
+            if self.failures.get(execution_id):
+                self.failures[execution_id] -= 1
+                raise self.error
+            self.finished.append(payload)
+
+    def send_report(self, execution_id, report_filename, report_mime_type, report_data):
+        if isinstance(report_data, ReportFile):
+            with open(report_data.path, 'rb') as f:
+                report_data = f.read()
+        with self._lock:
+            if self.report_failures.get(report_filename):
+                self.report_failures[report_filename] -= 1
+                raise self.error
+            self.reports.append((execution_id, report_filename, report_data))
+
+
+class ResultReporterTest(unittest.TestCase):
+    def make_reporter(self, cloudshell, **kwargs):
+        done = []
+        kwargs.setdefault('initial_backoff', 0.01)
+        reporter = ResultReporter(cloudshell.send_finished, cloudshell.send_report, logger,
+                                  on_done=lambda execution_id, sent: done.append((execution_id, sent)), **kwargs)
+        reporter.start()
+        self.addCleanup(reporter.stop, 1)
+        return reporter, done
+
+    def test_sends_result_and_report(self):
+        cloudshell = FakeCloudShell()
+        reporter, done = self.make_reporter(cloudshell)
+        reporter.submit('1', PassedCommandResult('result.log', 'all good'))
+        reporter.stop()
+        self.assertEqual([f['Result'] for f in cloudshell.finished], ['Passed'])
+        self.assertEqual(cloudshell.reports, [('1', 'result.log', b'all good')])
+        self.assertEqual(done, [('1', True)])
+
+    def test_retries_until_sent(self):
+        cloudshell = FakeCloudShell(failures={'1': 3})
+        reporter, done = self.make_reporter(cloudshell)
+        reporter.submit('1', PassedCommandResult('result.log', 'all good'))
+        reporter.stop()
+        self.assertEqual(len(cloudshell.finished), 1)
+        self.assertEqual(reporter.stats()['retries'], 3)
+        self.assertEqual(done, [('1', True)])
+
+    def test_drops_after_max_retries(self):
+        cloudshell = FakeCloudShell(failures={'1': 10})
+        reporter, done = self.make_reporter(cloudshell, max_retries=2)
+        reporter.submit('1', ErrorCommandResult('Error', 'boom'))
+        reporter.stop()
+        self.assertEqual(cloudshell.finished, [])
+        self.assertEqual(reporter.stats()['dropped'], 1)
+        self.assertEqual(done, [('1', False)])
+
+    def test_permanent_error_is_not_retried(self):
+        cloudshell = FakeCloudShell(failures={'1': 1}, error=CloudShellApiError(404, 'Unknown execution'))
+        reporter, done = self.make_reporter(cloudshell)
+        reporter.submit('1', ErrorCommandResult('Error', 'boom'))
+        reporter.stop()
+        self.assertEqual(reporter.stats()['retries'], 0)
+        self.assertEqual(done, [('1', False)])
+
+    def test_newer_result_replaces_a_queued_one(self):
+        cloudshell = FakeCloudShell()
+        cloudshell.release.clear()
+        reporter, done = self.make_reporter(cloudshell, sender_count=1)
+        reporter.submit('0', ErrorCommandResult('Error', 'busy'))
+        time.sleep(0.1)
+        reporter.submit('1', ErrorCommandResult('Error', 'first'))
+        reporter.submit('1', ErrorCommandResult('Error', 'second'))
+        cloudshell.release.set()
+        reporter.stop()
+        self.assertEqual([(f['ExecutionId'], f['ErrorDescription']) for f in cloudshell.finished], [('0', 'busy'), ('1', 'second')])
+        self.assertEqual(reporter.stats()['coalesced'], 1)
+
+    def test_newer_result_waits_for_the_one_in_flight(self):
+        cloudshell = FakeCloudShell()
+        cloudshell.release.clear()
+        reporter, done = self.make_reporter(cloudshell, sender_count=2)
+        reporter.submit('1', ErrorCommandResult('Error', 'first'))
+        time.sleep(0.1)
+        reporter.submit('1', ErrorCommandResult('Error', 'second'))
+        time.sleep(0.3)
+        cloudshell.release.set()
+        reporter.stop(5)
+        self.assertEqual([f['ErrorDescription'] for f in cloudshell.finished], ['first', 'second'])
+        self.assertEqual(done, [('1', True), ('1', True)])
+
+    def test_spooled_results_survive_a_restart(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        # Never started, like a server that exited before sending
+        ResultReporter(None, None, logger, spool_directory=directory).submit('1', PassedCommandResult('result.log', 'spooled report'))
+        cloudshell = FakeCloudShell()
+        reporter, done = self.make_reporter(cloudshell, spool_directory=directory)
+        reporter.stop()
+        self.assertEqual([f['ExecutionId'] for f in cloudshell.finished], ['1'])
+        self.assertEqual(cloudshell.reports, [('1', 'result.log', b'spooled report')])
+        self.assertEqual(done, [('1', True)])
+        self.assertEqual(os.listdir(directory), [])
+
+
+class ArtifactTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        os.makedirs(os.path.join(self.directory, 'screenshots'))
+        for name, size in (('results.xml', 100), ('capture.pcap', 5000), (os.path.join('screenshots', 'login.png'), 200)):
+            with open(os.path.join(self.directory, name), 'wb') as f:
+                f.write(b'a' * size)
+
+    def make_reporter(self, cloudshell, **kwargs):
+        outcomes = []
+        reporter = ResultReporter(cloudshell.send_finished, cloudshell.send_report, logger, initial_backoff=0.01,
+                                  on_artifact=lambda execution_id, name, size, outcome: outcomes.append((name, size, outcome)), **kwargs)
+        reporter.start()
+        self.addCleanup(reporter.stop, 1)
+        return reporter, outcomes
+
+    def result(self, delete=False):
+        result = PassedCommandResult('output.log', 'log')
+        result.artifacts = artifacts_from_directory(self.directory, delete=delete) + [Artifact('notes.txt', u'in memory')]
+        return result
+
+    def test_uploads_every_artifact_after_the_report(self):
+        cloudshell = FakeCloudShell()
+        reporter, outcomes = self.make_reporter(cloudshell, artifact_workers=2)
+        reporter.submit('1', self.result())
+        reporter.stop()
+        self.assertEqual(cloudshell.reports[0], ('1', 'output.log', b'log'))
+        self.assertEqual(sorted((name, len(data)) for _, name, data in cloudshell.reports[1:]),
+                         [('capture.pcap', 5000), ('notes.txt', 9), ('results.xml', 100), ('screenshots_login.png', 200)])
+        self.assertEqual(sorted(outcomes), [('capture.pcap', 5000, 'sent'), ('notes.txt', 9, 'sent'), ('results.xml', 100, 'sent'),
+                                            ('screenshots_login.png', 200, 'sent')])
+        self.assertTrue(os.path.exists(self.directory))
+
+    def test_too_large_artifacts_are_dropped(self):
+        cloudshell = FakeCloudShell()
+        reporter, outcomes = self.make_reporter(cloudshell, artifact_max_bytes=1000)
+        reporter.submit('1', self.result())
+        reporter.stop()
+        self.assertNotIn('capture.pcap', [name for _, name, _ in cloudshell.reports])
+        self.assertIn(('capture.pcap', 5000, 'too_large'), outcomes)
+        self.assertEqual((reporter.stats()['artifacts_sent'], reporter.stats()['artifacts_too_large']), (3, 1))
+
+    def test_retry_only_resends_failed_artifacts(self):
+        cloudshell = FakeCloudShell(report_failures={'capture.pcap': 2})
+        reporter, outcomes = self.make_reporter(cloudshell)
+        reporter.submit('1', self.result(delete=True))
+        reporter.stop()
+        self.assertEqual(len(cloudshell.finished), 1)
+        self.assertEqual(sorted(name for _, name, _ in cloudshell.reports),
+                         ['capture.pcap', 'notes.txt', 'output.log', 'results.xml', 'screenshots_login.png'])
+        self.assertEqual(reporter.stats()['retries'], 2)
+        # Removed once everything was uploaded
+        self.assertFalse(os.path.exists(self.directory))
+
+    def test_stopping_reporter_does_not_wait_for_the_artifact_pool(self):
+        reporter, outcomes = self.make_reporter(FakeCloudShell(), artifact_workers=1)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        # A busy worker and a full queue
+        reporter._artifact_pool.submit(release.wait, (5,))
+        reporter._artifact_pool.submit(release.wait, (5,))
+        reporter._stopping.set()
+        t0 = time.time()
+        entry = {'execution_id': '1', 'artifacts': [{'name': 'notes.txt', 'sent': False, 'dropped': False}]}
+        self.assertRaises(Exception, reporter._send_artifacts, entry, list(enumerate(entry['artifacts'])))
+        self.assertLess(time.time() - t0, 1)
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(50, burst=5)
+        t0 = time.time()
+        for _ in range(5):
+            bucket.acquire()
+        self.assertLess(time.time() - t0, 0.05)
+        for _ in range(10):
+            bucket.acquire()
+        self.assertGreater(time.time() - t0, 0.15)
+
+    def test_large_acquire_does_not_go_into_debt(self):
+        bucket = TokenBucket(100, burst=10)
+        t0 = time.time()
+        bucket.acquire(tokens=50)
+        self.assertGreater(time.time() - t0, 0.35)
+        self.assertGreaterEqual(bucket._tokens, 0)
+
+    def test_no_limit(self):
+        bucket = TokenBucket(None)
+        for _ in range(1000):
+            self.assertTrue(bucket.acquire())
+
+    def test_cancel(self):
+        bucket = TokenBucket(0.1, burst=1)
+        bucket.acquire()
+        cancel = threading.Event()
+        cancel.set()
+        self.assertFalse(bucket.acquire(cancel))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import logging
+import threading
+import time
+import unittest
+
+from cloudshell.custom_execution_server.scheduler import PeriodicTask
+
+from tests.test_custom_execution_server import Handler, ServerTestCase, start_execution
+
+logger = logging.getLogger('test')
+
+
+class PeriodicTaskTest(unittest.TestCase):
+    def make_task(self, fn, interval, **kwargs):
+        stop_event = threading.Event()
+        task = PeriodicTask(fn, interval, stop_event, logger, **kwargs)
+        thread = task.start()
+
+        def stop():
+            stop_event.set()
+            task.wake()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.addCleanup(stop)
+        return task, stop
+
+    def test_runs_on_interval(self):
+        task, _ = self.make_task(lambda: None, 0.05)
+        time.sleep(0.28)
+        self.assertTrue(4 <= task.runs <= 7, task.runs)
+
+    def test_burst_of_triggers_is_debounced(self):
+        task, _ = self.make_task(lambda: None, 60, debounce=0.1)
+        time.sleep(0.05)
+        self.assertEqual(task.runs, 1)
+        for _ in range(10):
+            task.trigger()
+            time.sleep(0.005)
+        time.sleep(0.3)
+        self.assertEqual((task.runs, task.triggered_runs), (2, 1))
+
+    def test_idle_backoff_and_reset(self):
+        runs = []
+
+        def idle():
+            runs.append(time.time())
+            return False
+        task, _ = self.make_task(idle, 0.05, idle_interval=0.4)
+        time.sleep(0.8)
+        gaps = [b - a for a, b in zip(runs, runs[1:])]
+        self.assertGreater(gaps[-1], 0.15)
+        n = task.runs
+        task.trigger()
+        time.sleep(0.05)
+        self.assertEqual(task.runs, n + 1)
+
+    def test_stop_wakes_a_long_wait(self):
+        task, stop = self.make_task(lambda: None, 60)
+        t0 = time.time()
+        stop()
+        self.assertLess(time.time() - t0, 1)
+
+    def test_failure_is_logged_and_retried(self):
+        task, _ = self.make_task(lambda: 1 / 0, 0.05)
+        time.sleep(0.2)
+        self.assertGreater(task.runs, 1)
+
+
+class HeartbeatTest(ServerTestCase):
+    def test_heartbeat_follows_execution_changes(self):
+        server = self.make_server(Handler(), capacity=1, status_interval=60, status_debounce=0.05)
+        server.start()
+        self.addCleanup(server.stop)
+        self.mock.add_commands([start_execution('1', 0.5)])
+        self.assertTrue(self.mock.wait_finished(1, 5))
+        time.sleep(0.3)
+        ids = [update['ExecutionIds'] for _, update in self.mock.status_updates]
+        self.assertIn(['1'], ids)
+        self.assertEqual(ids[-1], [])
+        self.assertLess(len(ids), 6)
+
+    def test_stop_does_not_wait_for_the_long_poll(self):
+        self.mock.poll_timeout = 30
+        server = self.make_server(Handler(), capacity=1)
+        server.start()
+        time.sleep(0.3)
+        t0 = time.time()
+        server.stop()
+        self.assertLess(time.time() - t0, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
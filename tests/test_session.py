@@ -0,0 +1,146 @@
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
+from cloudshell.custom_execution_server.session import CloudShellSession, fcntl
+
+from tests.test_custom_execution_server import Handler, ServerTestCase, start_execution
+
+
+class Login:
+    """
+    Hands out token-1, token-2, ... taking seconds each
+    """
+    def __init__(self, seconds=0):
+        self.seconds = seconds
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        time.sleep(self.seconds)
+        with self._lock:
+            self.calls += 1
+            return 'token-%d' % self.calls
+
+
+def run_threads(n, target):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(target())) for _ in range(n)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join(10)
+    return results
+
+
+class CloudShellSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.token_file = os.path.join(self.directory, 'tokens', 'admin@cloudshell.json')
+
+    def test_logs_in_once(self):
+        login = Login(0.1)
+        session = CloudShellSession()
+        self.assertEqual(run_threads(5, lambda: session.ensure_login(login)), ['token-1'] * 5)
+        self.assertEqual(login.calls, 1)
+        self.assertEqual(session.stats()['logins'], 1)
+
+    def test_refreshes_before_expiry(self):
+        login = Login()
+        session = CloudShellSession(max_age=100, refresh_margin=10)
+        session.ensure_login(login)
+        session.issued -= 85
+        self.assertEqual(session.ensure_login(login), 'token-1')
+        session.issued -= 10
+        self.assertEqual(session.ensure_login(login), 'token-2')
+        self.assertEqual((session.stats()['logins'], session.stats()['refreshes']), (2, 1))
+
+    def test_requests_carry_on_while_the_token_is_refreshed(self):
+        login = Login(0.3)
+        session = CloudShellSession(max_age=100, refresh_margin=10)
+        session.token, session.issued = 'token-0', time.time() - 95
+        t0 = time.time()
+        refresher = threading.Thread(target=session.ensure_login, args=(login,))
+        refresher.start()
+        time.sleep(0.05)
+        self.assertEqual(session.ensure_login(login), 'token-0')
+        self.assertLess(time.time() - t0, 0.2)
+        refresher.join(5)
+        self.assertEqual((session.token, login.calls), ('token-1', 1))
+
+    def test_rejected_token_is_renewed_once(self):
+        login = Login(0.1)
+        session = CloudShellSession()
+        token = session.ensure_login(login)
+        self.assertEqual(run_threads(5, lambda: session.relogin(login, token)), ['token-2'] * 5)
+        self.assertEqual((login.calls, session.stats()['rejected']), (2, 1))
+
+    def test_token_file_is_shared(self):
+        login = Login()
+        first = CloudShellSession(token_file=self.token_file)
+        self.assertEqual(first.ensure_login(login), 'token-1')
+        self.assertEqual(stat.S_IMODE(os.stat(self.token_file).st_mode), 0o600)
+        second = CloudShellSession(token_file=self.token_file)
+        self.assertEqual(second.ensure_login(login), 'token-1')
+        self.assertEqual((login.calls, second.stats()['shared']), (1, 1))
+        # A token rejected by CloudShell isn't taken from the file again
+        self.assertEqual(second.relogin(login, 'token-1'), 'token-2')
+        self.assertEqual(first.relogin(login, 'token-1'), 'token-2')
+        self.assertEqual(login.calls, 2)
+
+    def test_expired_token_in_file_is_not_shared(self):
+        with open(os.path.join(self.directory, 'token.json'), 'w') as f:
+            json.dump({'token': 'old', 'time': time.time() - 1000}, f)
+        session = CloudShellSession(token_file=os.path.join(self.directory, 'token.json'), max_age=100)
+        self.assertEqual(session.ensure_login(Login()), 'token-1')
+
+    def test_corrupt_token_file(self):
+        os.makedirs(os.path.dirname(self.token_file))
+        with open(self.token_file, 'w') as f:
+            f.write('{"token": ')
+        self.assertEqual(CloudShellSession(token_file=self.token_file).ensure_login(Login()), 'token-1')
+
+    @unittest.skipIf(fcntl is None, 'needs fcntl')
+    def test_waits_for_another_process_logging_in(self):
+        os.makedirs(os.path.dirname(self.token_file))
+        # Another process holding the lock while it logs in
+        lock = open(self.token_file + '.lock', 'a')
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        login = Login()
+        session = CloudShellSession(token_file=self.token_file)
+        results = []
+        th = threading.Thread(target=lambda: results.append(session.ensure_login(login)))
+        th.start()
+        time.sleep(0.2)
+        self.assertEqual(results, [])
+        with open(self.token_file, 'w') as f:
+            json.dump({'token': 'theirs', 'time': time.time()}, f)
+        lock.close()
+        th.join(5)
+        self.assertEqual((results, login.calls), (['theirs'], 0))
+
+
+class ServerSessionTest(ServerTestCase):
+    def test_logs_in_again_when_the_token_expires(self):
+        server = self.make_server(Handler(), capacity=1)
+        server.start()
+        self.addCleanup(server.stop)
+        self.mock.add_commands([start_execution('1')])
+        self.assertTrue(self.mock.wait_finished(1, 10))
+        self.mock.expire_token()
+        self.mock.add_commands([start_execution('2')])
+        self.assertTrue(self.mock.wait_finished(2, 10))
+        self.assertEqual(server.session_stats()['rejected'], 1)
+        self.assertEqual(self.mock.logins, 2)
+
+    def test_servers_share_a_session(self):
+        session = CloudShellSession()
+        self.make_server(Handler(), capacity=1, session=session)
+        self.make_server(Handler(), capacity=1, session=session)
+        self.assertEqual((session.stats()['logins'], self.mock.logins), (1, 1))
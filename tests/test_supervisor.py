@@ -0,0 +1,65 @@
+import logging
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'benchmarks'))
+
+from cloudshell.custom_execution_server.supervisor import ServerSupervisor
+
+from mock_cloudshell import MockCloudShell
+from tests.test_custom_execution_server import Handler, start_execution
+
+logger = logging.getLogger('test')
+
+
+class ServerSupervisorTest(unittest.TestCase):
+    def setUp(self):
+        self.mock = MockCloudShell(poll_timeout=0.3)
+        self.mock.start()
+        self.addCleanup(self.mock.stop)
+        self.supervisor = ServerSupervisor(logger, '127.0.0.1', self.mock.port, 4, metrics_port=0)
+        self.addCleanup(self.supervisor.close)
+        self.handlers = {}
+        for name in ('a', 'b'):
+            self.handlers[name] = Handler(name)
+            self.supervisor.add_server(name, 'test server', 'Python', 2, self.handlers[name], 'admin', 'admin', 'Global')
+
+    def test_servers_share_one_login_and_get_their_own_commands(self):
+        self.mock.add_commands([start_execution('a%d' % i, ServerName='a') for i in range(3)] +
+                               [start_execution('b%d' % i, ServerName='b') for i in range(3)])
+        self.supervisor.start()
+        self.assertTrue(self.mock.wait_finished(6, 10))
+        self.assertEqual(sorted(self.handlers['a'].executed), ['a0', 'a1', 'a2'])
+        self.assertEqual(sorted(self.handlers['b'].executed), ['b0', 'b1', 'b2'])
+        self.assertEqual(self.mock.logins, 1)
+        self.assertEqual(sorted(self.mock.servers), ['a', 'b'])
+        stats = self.supervisor.stats()
+        self.assertEqual((stats['workers'], stats['logins']), (4, 1))
+        self.assertTrue(stats['servers']['a']['running'])
+
+    def test_stopping_one_server_leaves_the_other_running(self):
+        self.supervisor.start()
+        self.supervisor.stop('a')
+        self.mock.add_commands([start_execution('b1', ServerName='b')])
+        self.assertTrue(self.mock.wait_finished(1, 10))
+        self.assertEqual(self.handlers['b'].executed, ['b1'])
+        stats = self.supervisor.stats()['servers']
+        self.assertEqual((stats['a']['running'], stats['b']['running']), (False, True))
+
+    def test_add_and_remove(self):
+        self.assertRaises(Exception, self.supervisor.add_server, 'a', 'test server', 'Python', 2, Handler(), 'admin', 'admin', 'Global')
+        self.supervisor.start()
+        self.supervisor.remove_server('a')
+        self.assertEqual(self.supervisor.server_names(), ['b'])
+        self.assertRaises(Exception, self.supervisor.start, 'a')
+
+    def test_shared_metrics(self):
+        self.supervisor.start()
+        text = self.supervisor.metrics.render()
+        self.assertIn('cloudshell_execution_server_capacity{server="a"} 2', text)
+        self.assertIn('cloudshell_execution_server_capacity{server="b"} 2', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+import logging
+import threading
+import time
+import unittest
+
+from cloudshell.custom_execution_server.worker_pool import FairWorkerPool, WorkerPool
+
+logger = logging.getLogger('test')
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def live_workers(name):
+    return [t for t in threading.enumerate() if t.name.startswith(name + '-')]
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def test_runs_tasks(self):
+        pool = WorkerPool(2, 10, logger, name='runs')
+        pool.start()
+        done = []
+        for i in range(5):
+            self.assertTrue(pool.submit(done.append, (i,)))
+        pool.stop(wait=True)
+        self.assertEqual(sorted(done), [0, 1, 2, 3, 4])
+        self.assertEqual(pool.stats()['completed'], 5)
+
+    def test_restart_after_stop(self):
+        pool = WorkerPool(2, 10, logger, name='restart')
+        pool.start()
+        pool.stop()
+        pool.start()
+        ran = threading.Event()
+        pool.submit(ran.set)
+        self.assertTrue(ran.wait(2))
+        self.assertTrue(wait_until(lambda: len(live_workers('restart')) == 2))
+        pool.stop(wait=True)
+
+    def test_busy_worker_during_stop_does_not_shrink_the_pool(self):
+        pool = WorkerPool(2, 10, logger, name='busy')
+        pool.start()
+        release = threading.Event()
+        pool.submit(release.wait)
+        self.assertTrue(wait_until(lambda: pool.stats()['busy'] == 1))
+        pool.stop()
+        pool.start()
+        release.set()
+        self.assertTrue(wait_until(lambda: len(live_workers('busy')) == 2))
+        time.sleep(0.1)
+        self.assertEqual(len(live_workers('busy')), 2)
+        events = [threading.Event() for _ in range(2)]
+        barrier = threading.Semaphore(0)
+
+        def both(e):
+            barrier.release()
+            e.wait(2)
+        for e in events:
+            pool.submit(both, (e,))
+        # Both run at once, so there are two workers
+        self.assertTrue(barrier.acquire(timeout=2) and barrier.acquire(timeout=2))
+        for e in events:
+            e.set()
+        pool.stop(wait=True)
+
+    def test_rejects_when_full(self):
+        pool = WorkerPool(1, 1, logger, name='full')
+        release = threading.Event()
+        # Not started, so tasks only queue
+        self.assertTrue(pool.submit(release.wait))
+        self.assertFalse(pool.submit(release.wait))
+        self.assertEqual(pool.stats()['rejected'], 1)
+
+    def test_blocking_submit_returns_once_stopped(self):
+        pool = WorkerPool(1, 1, logger, name='blocked')
+        pool.submit(time.sleep, (0,))
+        stop = threading.Event()
+        result = []
+        t = threading.Thread(target=lambda: result.append(pool.submit(time.sleep, (0,), block=True, stop_event=stop)))
+        t.start()
+        time.sleep(0.2)
+        self.assertTrue(t.is_alive())
+        stop.set()
+        t.join(2)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(result, [False])
+
+    def test_resize(self):
+        pool = WorkerPool(1, 10, logger, name='resize')
+        pool.start()
+        pool.resize(3)
+        self.assertTrue(wait_until(lambda: len(live_workers('resize')) == 3))
+        pool.resize(1)
+        self.assertTrue(wait_until(lambda: len(live_workers('resize')) == 1))
+        pool.stop(wait=True)
+        self.assertEqual(live_workers('resize'), [])
+
+    def test_shrink_and_stop_with_a_full_queue(self):
+        pool = WorkerPool(2, 2, logger, name='shrink')
+        pool.start()
+        release = threading.Event()
+        for _ in range(2):
+            self.assertTrue(pool.submit(release.wait, (5,)))
+        self.assertTrue(wait_until(lambda: pool.stats()['busy'] == 2))
+        for _ in range(2):
+            self.assertTrue(pool.submit(release.wait, (5,)))
+        self.assertFalse(pool.has_capacity())
+        # Neither waits for a queue slot
+        t0 = time.time()
+        pool.resize(1)
+        pool.stop()
+        self.assertLess(time.time() - t0, 0.5)
+        pool.start()
+        self.assertEqual(pool.stats()['queue_depth'], 2)
+        release.set()
+        # The retired worker exits ahead of the queued tasks, which still run
+        self.assertTrue(wait_until(lambda: pool.stats()['completed'] == 4))
+        self.assertEqual(len(live_workers('shrink')), 1)
+        self.assertTrue(pool.has_capacity())
+        pool.stop(wait=True)
+
+
+class FairWorkerPoolTest(unittest.TestCase):
+    def test_tenant_capacity_and_fairness(self):
+        pool = FairWorkerPool(2, logger, name='fair')
+        a = pool.tenant('a', 2, 10)
+        b = pool.tenant('b', 2, 10)
+        release = threading.Event()
+        order = []
+        lock = threading.Lock()
+
+        def task(name):
+            with lock:
+                order.append(name)
+            release.wait(2)
+        # a queues first, but b still gets a worker
+        for _ in range(4):
+            a.submit(task, ('a',))
+        b.submit(task, ('b',))
+        a.start()
+        self.assertTrue(wait_until(lambda: len(order) == 2))
+        self.assertEqual(sorted(order), ['a', 'b'])
+        release.set()
+        a.stop(wait=True)
+        b.stop(wait=True)
+        self.assertEqual(a.stats()['completed'], 4)
+        self.assertEqual(b.stats()['completed'], 1)
+        pool.stop(wait=True)
+
+    def test_restart_after_stop(self):
+        pool = FairWorkerPool(2, logger, name='fair-restart')
+        t = pool.tenant('a', 2, 10)
+        pool.start()
+        pool.stop()
+        pool.start()
+        ran = threading.Event()
+        t.submit(ran.set)
+        self.assertTrue(ran.wait(2))
+        pool.stop(wait=True)
+
+    def test_removed_tenant_name_can_be_reused(self):
+        pool = FairWorkerPool(1, logger, name='fair-remove')
+        pool.tenant('a', 1, 1)
+        self.assertRaises(Exception, pool.tenant, 'a', 1, 1)
+        pool.remove_tenant('a')
+        pool.tenant('a', 1, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()